@@ -4,9 +4,12 @@ from jose import JWTError, jwt
 from passlib.context import CryptContext
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
-from sqlalchemy.orm import Session
+from sqlalchemy import event, inspect, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, make_transient_to_detached
+from app.cache import TTLCache
 from app.database import get_db
-from app.models import User, APIKey
+from app.models import User, APIKey, Role, UserRole
 import os
 
 SECRET_KEY = os.getenv("SECRET_KEY", "your-secret-key-change-in-production")
@@ -16,6 +19,32 @@ ACCESS_TOKEN_EXPIRE_MINUTES = 60 * 24 * 7
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/auth/login")
 
+# 已认证用户缓存：user_id -> 游离状态的 User 快照。
+# JWT 每次仍完整校验，只是省掉按 ID 查询用户；用户行被 ORM 更新或删除时自动失效，
+# 其他 worker 上的旧数据最多保留 USER_CACHE_TTL 秒
+user_cache = TTLCache(
+    maxsize=int(os.getenv("USER_CACHE_SIZE", "10000")),
+    ttl=float(os.getenv("USER_CACHE_TTL", "60")),
+)
+
+
+def _user_snapshot(user: User) -> User:
+    """复制已加载的列属性，生成不属于任何会话的 User，供各请求 merge"""
+    snapshot = User(**{attr.key: getattr(user, attr.key) for attr in inspect(User).column_attrs})
+    make_transient_to_detached(snapshot)
+    return snapshot
+
+
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def _invalidate_cached_user(mapper, connection, target):
+    user_cache.pop(target.id)
+
+
+def invalidate_user(user_id: int):
+    """批量 UPDATE / 原生 SQL 修改用户资料后需手动调用"""
+    user_cache.pop(user_id)
+
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     return pwd_context.verify(plain_password, hashed_password)
@@ -51,9 +80,15 @@ def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(
     except (JWTError, ValueError):
         raise credentials_exception
     
+    # 命中缓存时 merge(load=False) 得到挂在本请求会话上的副本，不访问数据库
+    snapshot = user_cache.get(user_id)
+    if snapshot is not None:
+        return db.merge(snapshot, load=False)
+    
     user = db.query(User).filter(User.id == user_id).first()
     if user is None:
         raise credentials_exception
+    user_cache.set(user_id, _user_snapshot(user))
     return user
 
 
@@ -61,7 +96,27 @@ async def get_current_active_user(current_user: User = Depends(get_current_user)
     return current_user
 
 
-async def get_current_user_ws(token: str, db: Session) -> User:
+def get_current_admin_user(
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+) -> User:
+    """要求当前用户拥有 admin 角色"""
+    admin_role = db.query(UserRole).join(
+        Role, UserRole.role_id == Role.id
+    ).filter(
+        UserRole.user_id == current_user.id,
+        Role.name == "admin"
+    ).first()
+    
+    if not admin_role:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="需要管理员权限",
+        )
+    return current_user
+
+
+async def get_current_user_ws(token: str, db: AsyncSession) -> User:
     """WebSocket 用的用户认证"""
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
@@ -76,9 +131,15 @@ async def get_current_user_ws(token: str, db: Session) -> User:
     except (JWTError, ValueError):
         raise credentials_exception
     
-    user = db.query(User).filter(User.id == user_id).first()
+    snapshot = user_cache.get(user_id)
+    if snapshot is not None:
+        return await db.merge(snapshot, load=False)
+    
+    result = await db.execute(select(User).filter(User.id == user_id))
+    user = result.scalars().first()
     if user is None:
         raise credentials_exception
+    user_cache.set(user_id, _user_snapshot(user))
     return user
 
 
@@ -0,0 +1,110 @@
+"""
+进程内 LRU + TTL 缓存
+
+条目超过 ttl 秒视为过期，容量达到 maxsize 时淘汰最久未使用的条目。
+传入 weigher 和 maxweight 时，还按条目大小之和（如字节数）淘汰，适合大小差别很大的值。
+带命中/未命中计数，供管理员接口查看命中率。加锁后可同时用于事件循环和线程池中的同步接口。
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+_MISSING = object()
+
+
+class TTLCache:
+    def __init__(self, maxsize: int = 1024, ttl: float = 60.0, timer: Callable[[], float] = time.monotonic,
+                 weigher: Optional[Callable[[Any], int]] = None, maxweight: int = 0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timer = timer
+        self.weigher = weigher
+        self.maxweight = maxweight
+        self.weight = 0
+        # 值为 (过期时间, 值, 大小)
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.maxsize > 0 and self.ttl > 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is not _MISSING:
+                expires_at, value, _ = entry
+                if expires_at > self.timer():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                self._remove(key)
+            self.misses += 1
+            return default
+
+    def set(self, key: Hashable, value: Any):
+        if not self.enabled:
+            return
+        weight = self.weigher(value) if self.weigher else 0
+        if self.maxweight and weight > self.maxweight:
+            return
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (self.timer() + self.ttl, value, weight)
+            self.weight += weight
+            while len(self._data) > self.maxsize or (self.maxweight and self.weight > self.maxweight):
+                _, (_, _, evicted) = self._data.popitem(last=False)
+                self.weight -= evicted
+                self.evictions += 1
+
+    def _remove(self, key: Hashable) -> tuple:
+        entry = self._data.pop(key)
+        self.weight -= entry[2]
+        return entry
+
+    def pop(self, key: Hashable) -> Optional[Any]:
+        """删除一个条目（主动失效）"""
+        with self._lock:
+            if key not in self._data:
+                return None
+            self.invalidations += 1
+            return self._remove(key)[1]
+
+    def pop_where(self, predicate: Callable[[Hashable], bool]) -> int:
+        """删除键满足条件的全部条目，返回删除数量"""
+        with self._lock:
+            keys = [key for key in self._data if predicate(key)]
+            for key in keys:
+                self._remove(key)
+            self.invalidations += len(keys)
+            return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.weight = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get_stats(self) -> dict:
+        lookups = self.hits + self.misses
+        stats = {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "ttl_seconds": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+        if self.weigher:
+            stats.update(weight=self.weight, maxweight=self.maxweight)
+        return stats
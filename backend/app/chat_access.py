@@ -0,0 +1,92 @@
+"""
+群聊访问权限缓存
+
+几乎每个群聊接口都要先确认群聊存在且活跃、再查当前用户的成员记录。
+这里把两者合并为一次查询，结果按 (群聊ID, 用户ID) 缓存在进程内（LRU + TTL），
+缓存内容只有群聊是否活跃、成员角色和禁言状态。
+
+成员加入/退出/被踢出、角色变更、禁言、群聊关闭等写操作之后必须调用
+ConnectionManager.invalidate_room_access：本进程立即失效，并通过广播代理通知其他 worker。
+TTL 是兜底，保证代理消息丢失时旧权限最多保留 CHAT_ACCESS_CACHE_TTL 秒。
+"""
+import os
+from dataclasses import dataclass
+from typing import Optional
+
+from sqlalchemy import and_, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.cache import TTLCache
+from app.chat_models import ChatRoom, ChatRoomMember, ChatRoomStatus
+
+
+@dataclass(frozen=True)
+class RoomAccess:
+    """用户在某个群聊中的权限"""
+    room_active: bool
+    role: Optional[str] = None
+    is_muted: bool = False
+
+    @property
+    def is_member(self) -> bool:
+        return self.role is not None
+
+    @property
+    def is_manager(self) -> bool:
+        return self.role in ("owner", "admin")
+
+
+class RoomAccessCache:
+    def __init__(self, maxsize: Optional[int] = None, ttl: Optional[float] = None):
+        self.cache = TTLCache(
+            maxsize=maxsize if maxsize is not None else int(os.getenv("CHAT_ACCESS_CACHE_SIZE", "10000")),
+            ttl=ttl if ttl is not None else float(os.getenv("CHAT_ACCESS_CACHE_TTL", "30")),
+        )
+        # 每次失效加一；查询期间发生过失效则不写入缓存，避免把失效前读到的旧数据放回去
+        self._generation = 0
+
+    async def get(self, db: AsyncSession, chat_room_id: int, user_id: int) -> RoomAccess:
+        key = (chat_room_id, user_id)
+        access = self.cache.get(key)
+        if access is not None:
+            return access
+
+        generation = self._generation
+        row = (await db.execute(
+            select(ChatRoom.id, ChatRoomMember.role, ChatRoomMember.is_muted).outerjoin(
+                ChatRoomMember, and_(
+                    ChatRoomMember.chat_room_id == ChatRoom.id,
+                    ChatRoomMember.user_id == user_id
+                )
+            ).filter(
+                ChatRoom.id == chat_room_id,
+                ChatRoom.status == ChatRoomStatus.ACTIVE
+            )
+        )).first()
+
+        if row is None:
+            access = RoomAccess(room_active=False)
+        else:
+            access = RoomAccess(room_active=True, role=row.role, is_muted=bool(row.is_muted))
+        if generation == self._generation:
+            self.cache.set(key, access)
+        return access
+
+    def invalidate(self, chat_room_id: int, user_id: Optional[int] = None):
+        """失效某个成员的缓存；不指定 user_id 时失效整个群聊"""
+        self._generation += 1
+        if user_id is None:
+            self.cache.pop_where(lambda key: key[0] == chat_room_id)
+        else:
+            self.cache.pop((chat_room_id, user_id))
+
+    def clear(self):
+        self._generation += 1
+        self.cache.clear()
+
+    def get_stats(self) -> dict:
+        return self.cache.get_stats()
+
+
+# 全局权限缓存
+room_access = RoomAccessCache()
@@ -0,0 +1,122 @@
+"""
+群聊消息发布/订阅代理
+
+多个 uvicorn worker（或多台机器）各自只持有本进程的 WebSocket 连接。
+ConnectionManager 把广播消息发布到代理，每个 worker 订阅同一个频道，
+收到后只投递给本地连接，这样一条消息只需发布一次即可到达所有在线用户。
+
+- InProcessBroker：单进程部署（默认），直接回调本地投递
+- RedisBroker：兼容 Redis PUBLISH/SUBSCRIBE 协议，用于多 worker / 多节点部署
+
+消息信封格式：
+    {"kind": "room", "chat_room_id": 1, "message": {...}, "exclude_user_id": 2}
+    {"kind": "user", "user_id": 2, "message": {...}}
+    {"kind": "access", "chat_room_id": 1, "user_id": 2}
+    {"kind": "unread", "chat_room_id": 1, "last_message_id": 9, "counts": [[user_id, unread_count, delta], ...]}
+"""
+import asyncio
+import json
+import os
+from typing import Awaitable, Callable, Optional
+
+Handler = Callable[[dict], Awaitable[None]]
+
+DEFAULT_CHANNEL = "studysync:chat"
+
+
+class Broker:
+    """代理基类"""
+
+    def __init__(self):
+        self._handler: Optional[Handler] = None
+
+    async def start(self, handler: Handler):
+        """开始订阅，收到的信封交给 handler 处理"""
+        self._handler = handler
+
+    async def stop(self):
+        self._handler = None
+
+    async def publish(self, envelope: dict):
+        raise NotImplementedError
+
+
+class InProcessBroker(Broker):
+    """进程内代理：发布即投递，只适用于单 worker"""
+
+    async def publish(self, envelope: dict):
+        if self._handler is not None:
+            await self._handler(envelope)
+
+
+class RedisBroker(Broker):
+    """
+    基于 Redis PUBLISH/SUBSCRIBE 的代理
+
+    client 需提供 redis.asyncio.Redis 的 publish() 和 pubsub() 接口，
+    测试中可以注入本地替身；未传入时按 url 创建 redis 客户端。
+    """
+
+    def __init__(self, url: Optional[str] = None, channel: str = DEFAULT_CHANNEL, client=None):
+        super().__init__()
+        self.url = url
+        self.channel = channel
+        self._client = client
+        self._pubsub = None
+        self._reader: Optional[asyncio.Task] = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            import redis.asyncio as redis
+            self._client = redis.from_url(self.url)
+        return self._client
+
+    async def start(self, handler: Handler):
+        await super().start(handler)
+        self._pubsub = self.client.pubsub()
+        await self._pubsub.subscribe(self.channel)
+        self._reader = asyncio.create_task(self._read_loop())
+
+    async def stop(self):
+        if self._reader is not None:
+            self._reader.cancel()
+            try:
+                await self._reader
+            except asyncio.CancelledError:
+                pass
+            self._reader = None
+        if self._pubsub is not None:
+            await self._pubsub.unsubscribe(self.channel)
+            await self._pubsub.aclose()
+            self._pubsub = None
+        await super().stop()
+
+    async def publish(self, envelope: dict):
+        payload = json.dumps(envelope, ensure_ascii=False, default=str)
+        await self.client.publish(self.channel, payload)
+
+    async def _read_loop(self):
+        async for item in self._pubsub.listen():
+            if item.get("type") != "message":
+                continue
+            data = item["data"]
+            if isinstance(data, bytes):
+                data = data.decode("utf-8")
+            try:
+                envelope = json.loads(data)
+            except json.JSONDecodeError:
+                continue
+            try:
+                await self._handler(envelope)
+            except Exception as e:
+                # 单条消息投递失败不能中断订阅
+                print(f"投递广播消息失败: {e}")
+
+
+def create_broker_from_env() -> Broker:
+    """CHAT_BROKER_URL 为 redis:// 或 rediss:// 时使用 Redis，否则使用进程内代理"""
+    url = os.getenv("CHAT_BROKER_URL", "").strip()
+    if url.startswith(("redis://", "rediss://")):
+        return RedisBroker(url, channel=os.getenv("CHAT_BROKER_CHANNEL", DEFAULT_CHANNEL))
+    return InProcessBroker()
@@ -1,13 +1,28 @@
 """
 群聊ID生成器
 
-提供唯一、安全、易记的群聊ID生成算法
+提供唯一、安全、易记的群聊ID生成算法，以及聊天消息使用的递增消息ID生成器
 """
+import asyncio
+import logging
+import os
 import secrets
+import socket
 import string
+import threading
+import time
+from datetime import datetime, timedelta, timezone
 from typing import Optional
+from sqlalchemy import delete, insert, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 
+from app.chat_models import ChatWorkerLease
+from app.database import AsyncSessionLocal
+
+logger = logging.getLogger(__name__)
+
 
 class ChatIdGenerator:
     """群聊ID生成器"""
@@ -66,6 +81,31 @@ class ChatIdGenerator:
             
         return None
     
+    @classmethod
+    async def generate_unique_async(cls, db: AsyncSession, length: int = 6, max_attempts: int = 10) -> Optional[str]:
+        """
+        生成唯一的群聊ID（异步会话版本）
+        
+        Args:
+            db: 异步数据库会话
+            length: ID长度
+            max_attempts: 最大尝试次数
+            
+        Returns:
+            str: 唯一的群聊ID，失败返回None
+        """
+        from app.chat_models import ChatRoom
+        for attempt in range(max_attempts):
+            chat_id = cls.generate(length)
+            existing = await db.scalar(select(ChatRoom.id).filter(ChatRoom.chat_id == chat_id))
+            if existing is None:
+                return chat_id
+        
+        if length < cls.MAX_LENGTH:
+            return await cls.generate_unique_async(db, length + 1, max_attempts)
+        
+        return None
+    
     @classmethod
     def is_valid(cls, chat_id: str) -> bool:
         """
@@ -112,4 +152,175 @@ class ChatIdGenerator:
                 formatted += "-"
             formatted += char
             
-        return formatted
\ No newline at end of file
+        return formatted
+
+
+class MessageIdGenerator:
+    """
+    聊天消息ID生成器（snowflake 风格）
+
+    消息ID在写库之前就在应用内分配，WebSocket 可以立即广播，再由后台批量写入。
+    ID 由 41 位毫秒时间戳 + 5 位 worker 编号 + 7 位序号组成，共 53 位，
+    在 JavaScript 中也能精确表示；同一 worker 内严格递增，不同 worker 之间按时间大致有序。
+
+    worker 编号由 WorkerLease 在应用启动时从 chat_worker_leases 表领取，保证同时运行的进程编号不同；
+    脚本和测试等未启动应用的场景使用 CHAT_WORKER_ID 或进程号取模的临时编号。
+    """
+    
+    # 2024-01-01 00:00:00 UTC
+    EPOCH_MS = 1704067200000
+    WORKER_BITS = 5
+    SEQUENCE_BITS = 7
+    MAX_WORKER_ID = (1 << WORKER_BITS) - 1
+    MAX_SEQUENCE = (1 << SEQUENCE_BITS) - 1
+    # 时钟回拨超过该毫秒数时直接报错，不在锁内等待时钟追上
+    MAX_BACKWARD_MS = 10
+    
+    def __init__(self, worker_id: Optional[int] = None):
+        if worker_id is None:
+            worker_id = int(os.getenv("CHAT_WORKER_ID", os.getpid() % (self.MAX_WORKER_ID + 1)))
+        self.worker_id = self._checked(worker_id)
+        self._last_ms = -1
+        self._sequence = 0
+        self._lock = threading.Lock()
+    
+    @classmethod
+    def _checked(cls, worker_id: int) -> int:
+        if not 0 <= worker_id <= cls.MAX_WORKER_ID:
+            raise ValueError(f"worker 编号必须在 0-{cls.MAX_WORKER_ID} 之间")
+        return worker_id
+
+    def set_worker_id(self, worker_id: int):
+        """切换 worker 编号（领取到租约后调用）"""
+        with self._lock:
+            self.worker_id = self._checked(worker_id)
+    
+    @staticmethod
+    def _now_ms() -> int:
+        return int(time.time() * 1000)
+    
+    def next_id(self) -> int:
+        """生成下一个消息ID"""
+        with self._lock:
+            now = max(self._now_ms(), self._last_ms)  # 时钟回拨时沿用上一次的时间戳
+            if now == self._last_ms:
+                self._sequence = (self._sequence + 1) & self.MAX_SEQUENCE
+                if self._sequence == 0:
+                    # 当前毫秒序号用尽，等到下一毫秒；时钟回拨较多时报错而不是长时间等待
+                    behind = self._last_ms - self._now_ms()
+                    if behind > self.MAX_BACKWARD_MS:
+                        raise RuntimeError(f"系统时钟回拨 {behind} 毫秒，暂时无法生成消息ID")
+                    while now <= self._last_ms:
+                        time.sleep((self._last_ms - now + 1) / 1000)
+                        now = self._now_ms()
+            else:
+                self._sequence = 0
+            self._last_ms = now
+            return (
+                ((now - self.EPOCH_MS) << (self.WORKER_BITS + self.SEQUENCE_BITS))
+                | (self.worker_id << self.SEQUENCE_BITS)
+                | self._sequence
+            )
+    
+    @classmethod
+    def timestamp_ms(cls, message_id: int) -> int:
+        """从消息ID还原生成时间（毫秒时间戳）"""
+        return (message_id >> (cls.WORKER_BITS + cls.SEQUENCE_BITS)) + cls.EPOCH_MS
+
+
+
+class WorkerLease:
+    """
+    worker 编号租约
+
+    启动时在 chat_worker_leases 中领取一个空闲或已过期的编号（INSERT 或按过期条件 UPDATE，
+    以影响行数判断是否抢到），之后每 ttl/3 秒续期一次；续期发现租约已被别的进程取得时重新领取。
+    配置了 CHAT_WORKER_ID 时使用固定编号，不领取租约。
+    """
+
+    def __init__(self, generator: MessageIdGenerator, session_factory=None, ttl: Optional[float] = None):
+        self.generator = generator
+        self.session_factory = session_factory or AsyncSessionLocal
+        self.ttl = ttl if ttl is not None else float(os.getenv("CHAT_WORKER_LEASE_TTL", "60"))
+        self.owner = f"{socket.gethostname()[:60]}:{os.getpid()}:{secrets.token_hex(4)}"
+        self.worker_id: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def acquire(self) -> int:
+        """领取一个 worker 编号并设置到生成器上，全部被占用时报错"""
+        now = datetime.now(timezone.utc)
+        values = {"owner": self.owner, "expires_at": now + timedelta(seconds=self.ttl)}
+        table = ChatWorkerLease.__table__
+        async with self.session_factory() as db:
+            taken = set((await db.execute(select(table.c.worker_id))).scalars())
+            for worker_id in range(MessageIdGenerator.MAX_WORKER_ID + 1):
+                if worker_id in taken:
+                    result = await db.execute(
+                        update(table).where(table.c.worker_id == worker_id, table.c.expires_at < now).values(**values)
+                    )
+                    claimed = result.rowcount == 1
+                else:
+                    try:
+                        await db.execute(insert(table).values(worker_id=worker_id, **values))
+                        claimed = True
+                    except IntegrityError:
+                        # 其他进程同时领取了这个编号
+                        await db.rollback()
+                        claimed = False
+                if claimed:
+                    await db.commit()
+                    self.worker_id = worker_id
+                    self.generator.set_worker_id(worker_id)
+                    logger.info("领取消息ID worker 编号 %d", worker_id)
+                    return worker_id
+        raise RuntimeError(f"没有空闲的消息ID worker 编号（最多 {MessageIdGenerator.MAX_WORKER_ID + 1} 个进程）")
+
+    async def renew(self):
+        """续期；租约已被其他进程取得时重新领取编号"""
+        table = ChatWorkerLease.__table__
+        expires_at = datetime.now(timezone.utc) + timedelta(seconds=self.ttl)
+        async with self.session_factory() as db:
+            result = await db.execute(
+                update(table).where(table.c.worker_id == self.worker_id, table.c.owner == self.owner)
+                .values(expires_at=expires_at)
+            )
+            await db.commit()
+        if result.rowcount != 1:
+            logger.error("消息ID worker 编号 %s 的租约已失效，重新领取", self.worker_id)
+            await self.acquire()
+
+    async def start(self):
+        if os.getenv("CHAT_WORKER_ID"):
+            return
+        await self.acquire()
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.ttl / 3)
+            try:
+                await self.renew()
+            except Exception as e:
+                logger.warning("续期消息ID worker 编号失败: %s", e)
+
+    async def stop(self):
+        """停止续期并释放租约（应用关闭时调用）"""
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        table = ChatWorkerLease.__table__
+        try:
+            async with self.session_factory() as db:
+                await db.execute(delete(table).where(table.c.worker_id == self.worker_id, table.c.owner == self.owner))
+                await db.commit()
+        except Exception as e:
+            logger.warning("释放消息ID worker 编号失败: %s", e)
+
+
+message_ids = MessageIdGenerator()
+worker_lease = WorkerLease(message_ids)
@@ -0,0 +1,343 @@
+"""
+聊天消息批量写入（write-behind）
+
+WebSocket 收到消息后：
+1. 在应用内分配消息ID和时间戳（不需要等数据库返回）
+2. 立即广播
+3. 消息进入内存缓冲区，由后台任务每隔几毫秒用一条多行 INSERT 批量写入 chat_messages
+
+成员的 last_active_at 同样先在内存中合并，同一成员在一个刷新周期内只更新一次。
+其他成员的未读数在写入消息的同一事务中增加（见 app.chat_unread），提交后交给 unread_listener 推送。
+
+持久化模式（CHAT_MESSAGE_DURABILITY）：
+- write_behind：先广播后落库，进程崩溃时最多丢失一个刷新周期内的消息
+- durable：发送方等待所在批次提交成功后再广播（组提交，仍然是批量写入）
+
+消息ID按进程分配、按 ID 分页（after_id、last_read_message_id），因此 ID 小的消息必须在客户端读到更大的 ID 之前落库：
+- 同一进程内缓冲区按 ID 顺序写入，按 ID 读取某个群聊之前先写入缓冲区（flush_room）
+- 多个进程各自缓冲时无法保证这一点，write_behind 可能让 ID 较小的消息晚于客户端的游标落库而被跳过，
+  所以配置了 CHAT_BROKER_URL（多 worker 部署）时默认使用 durable；
+  durable 下先落库再广播，仍然存在的只是各进程时钟之间毫秒级的交错
+
+写入失败时：
+- 连接类错误（数据库不可用）：整批放回缓冲区头部，下个周期重试，不计入重试次数上限
+- 其他错误（外键、主键冲突、非法字符等）：重试 CHAT_WRITE_MAX_RETRIES 次后改为逐条写入，
+  仍然失败的消息写入 chat_message_dead_letters 并记录日志，其余消息照常落库，缓冲区不会被一条坏数据卡住
+"""
+import asyncio
+import json
+import logging
+import os
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import and_, bindparam, insert, update
+from sqlalchemy.exc import DBAPIError, InterfaceError, OperationalError
+
+from app.chat_id_generator import message_ids
+from app.chat_models import ChatMessage, ChatMessageDeadLetter, ChatRoomMember
+from app.chat_unread import UnreadUpdate, add_new_messages
+from app.database import AsyncSessionLocal
+from app.services.message_search import search_text
+
+WRITE_BEHIND = "write_behind"
+DURABLE = "durable"
+
+# 单条 INSERT 最多包含的行数，避免超出数据库参数个数限制
+INSERT_CHUNK_ROWS = 1000
+
+logger = logging.getLogger(__name__)
+
+
+def is_transient(error: Exception) -> bool:
+    """是否为连接类错误（数据库暂时不可用），这类错误与具体的消息无关"""
+    if isinstance(error, DBAPIError) and error.connection_invalidated:
+        return True
+    return isinstance(error, (OperationalError, InterfaceError, ConnectionError, TimeoutError))
+
+
+@dataclass
+class WriterSettings:
+    """批量写入配置，来自环境变量"""
+    durability: str = WRITE_BEHIND
+    flush_interval_ms: int = 20
+    batch_size: int = 500
+    active_interval_ms: int = 5000
+    max_retries: int = 3
+
+    @classmethod
+    def from_env(cls) -> "WriterSettings":
+        # 多 worker 部署（配置了跨进程广播）默认 durable，见模块说明中的 ID 顺序问题
+        multi_worker = os.getenv("CHAT_BROKER_URL", "").strip().startswith(("redis://", "rediss://"))
+        default = DURABLE if multi_worker else WRITE_BEHIND
+        durability = (os.getenv("CHAT_MESSAGE_DURABILITY", "").strip().lower() or default)
+        if durability not in (WRITE_BEHIND, DURABLE):
+            raise ValueError(f"不支持的消息持久化模式: {durability}")
+        return cls(
+            durability=durability,
+            flush_interval_ms=int(os.getenv("CHAT_WRITE_FLUSH_MS", "20")),
+            batch_size=int(os.getenv("CHAT_WRITE_BATCH_SIZE", "500")),
+            active_interval_ms=int(os.getenv("CHAT_ACTIVE_FLUSH_MS", "5000")),
+            max_retries=int(os.getenv("CHAT_WRITE_MAX_RETRIES", "3")),
+        )
+
+
+class MessageWriter:
+    """聊天消息后台批量写入器"""
+
+    def __init__(self, settings: Optional[WriterSettings] = None, session_factory=None):
+        self.settings = settings or WriterSettings.from_env()
+        self.session_factory = session_factory or AsyncSessionLocal
+        # 待写入的消息行，以及 durable 模式下等待该行落库的 future
+        self._pending: List[Tuple[dict, Optional[asyncio.Future]]] = []
+        self._pending_ids = set()
+        # 消息ID -> 已失败的写入次数（不含连接类错误）
+        self._attempts: Dict[int, int] = {}
+        # 合并后的成员活跃时间: {(chat_room_id, user_id): datetime}
+        self._active: Dict[Tuple[int, int], datetime] = {}
+        self._active_flushed_at = 0.0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._flush_lock: Optional[asyncio.Lock] = None
+        # 每个批次提交后以未读数变化调用，由 WebSocket 管理器注册
+        self.unread_listener: Optional[Callable[[List[UnreadUpdate]], Awaitable[None]]] = None
+        self.messages_written = 0
+        self.batches_written = 0
+        self.last_batch_size = 0
+        self.failed_batches = 0
+        self.isolated_batches = 0
+        self.dead_letters = 0
+        self.active_updates = 0
+
+    def _ensure_started(self):
+        # 测试等场景下事件循环可能被替换，后台任务需要跟随当前循环重新创建
+        if (self._task is None or self._task.done()
+                or self._task.get_loop() is not asyncio.get_running_loop()):
+            self._wakeup = asyncio.Event()
+            self._flush_lock = asyncio.Lock()
+            self._task = asyncio.create_task(self._run())
+
+    def new_message(self, chat_room_id: int, user_id: int, content: str, message_type: str = "text") -> dict:
+        """分配消息ID和时间戳，返回待写入的消息行"""
+        return {
+            "id": message_ids.next_id(),
+            "chat_room_id": chat_room_id,
+            "user_id": user_id,
+            "content": content,
+            "message_type": message_type,
+            "is_deleted": False,
+            "created_at": datetime.now(timezone.utc),
+            "search_tokens": search_text(content),
+        }
+
+    async def submit(self, row: dict, durable: Optional[bool] = None):
+        """
+        提交一条消息
+
+        durable 为 True（或配置为 durable 模式）时等待所在批次提交后才返回，
+        否则只放入缓冲区立即返回。
+        """
+        self._ensure_started()
+        if durable is None:
+            durable = self.settings.durability == DURABLE
+        future = asyncio.get_running_loop().create_future() if durable else None
+        self._pending.append((row, future))
+        self._pending_ids.add(row["id"])
+        if len(self._pending) >= self.settings.batch_size:
+            self._wakeup.set()
+        if future is not None:
+            await future
+
+    def touch_member(self, chat_room_id: int, user_id: int, at: Optional[datetime] = None):
+        """记录成员活跃时间，按刷新周期合并写入"""
+        self._ensure_started()
+        self._active[(chat_room_id, user_id)] = at or datetime.now(timezone.utc)
+
+    def is_pending(self, message_id: int) -> bool:
+        """消息是否还在缓冲区中未写入"""
+        return message_id in self._pending_ids
+
+    async def flush_room(self, chat_room_id: int):
+        """
+        缓冲区中有该群聊的消息时先全部写入
+
+        按 ID 分页读取前调用：缓冲区按 ID 顺序写入，读到的最大 ID 之前的本进程消息都已落库。
+        """
+        if any(row["chat_room_id"] == chat_room_id for row, _ in self._pending):
+            await self.flush(include_active=False)
+
+    async def _run(self):
+        interval = self.settings.flush_interval_ms / 1000
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush(include_active=False)
+                loop_time = asyncio.get_running_loop().time()
+                if loop_time - self._active_flushed_at >= self.settings.active_interval_ms / 1000:
+                    await self._flush_active()
+                    self._active_flushed_at = loop_time
+            except Exception as e:
+                # 写入失败的消息已放回缓冲区，下个周期重试
+                logger.warning("批量写入聊天消息失败: %s", e)
+
+    async def flush(self, include_active: bool = True):
+        """立即写入缓冲区中的全部消息"""
+        if self._flush_lock is None:
+            return
+        async with self._flush_lock:
+            while self._pending:
+                batch = self._pending[:self.settings.batch_size]
+                del self._pending[:len(batch)]
+                await self._write_batch(batch)
+            if include_active:
+                await self._flush_active()
+
+    async def _insert(self, rows: List[dict]) -> List[UnreadUpdate]:
+        async with self.session_factory() as db:
+            for start in range(0, len(rows), INSERT_CHUNK_ROWS):
+                await db.execute(insert(ChatMessage).values(rows[start:start + INSERT_CHUNK_ROWS]))
+            unread_updates = await add_new_messages(db, rows)
+            await db.commit()
+        return unread_updates
+
+    async def _write_batch(self, batch: List[Tuple[dict, Optional[asyncio.Future]]]):
+        try:
+            unread_updates = await self._insert([row for row, _ in batch])
+        except Exception as e:
+            self.failed_batches += 1
+            retry = []
+            for row, future in batch:
+                if future is None:
+                    retry.append((row, future))
+                else:
+                    # durable 模式直接把错误交给发送方，不再重试
+                    self._pending_ids.discard(row["id"])
+                    if not future.done():
+                        future.set_exception(e)
+            if not retry:
+                raise
+            if not is_transient(e):
+                attempts = 0
+                for row, _ in retry:
+                    attempts = max(attempts, self._attempts.get(row["id"], 0) + 1)
+                    self._attempts[row["id"]] = attempts
+                if attempts >= self.settings.max_retries:
+                    await self._write_one_by_one(retry, e)
+                    return
+            self._pending[:0] = retry
+            raise
+        await self._written(batch, unread_updates)
+
+    async def _write_one_by_one(self, batch: List[Tuple[dict, Optional[asyncio.Future]]], batch_error: Exception):
+        """整批多次失败后逐条写入，找出并隔离失败的消息"""
+        self.isolated_batches += 1
+        logger.warning("聊天消息批次重试 %d 次仍失败，改为逐条写入（%d 条）: %s",
+                       self.settings.max_retries, len(batch), batch_error)
+        for index, item in enumerate(batch):
+            try:
+                unread_updates = await self._insert([item[0]])
+            except Exception as e:
+                if is_transient(e):
+                    self._pending[:0] = batch[index:]
+                    raise
+                await self._dead_letter(item[0], e)
+                continue
+            await self._written([item], unread_updates)
+
+    async def _dead_letter(self, row: dict, error: Exception):
+        """把无法写入的消息移出缓冲区，保存到死信表"""
+        self._pending_ids.discard(row["id"])
+        attempts = self._attempts.pop(row["id"], 0) + 1
+        self.dead_letters += 1
+        payload = json.dumps(row, ensure_ascii=False, default=str)
+        logger.error("聊天消息 %s（群聊 %s）写入失败 %d 次，转入死信: %s",
+                     row["id"], row["chat_room_id"], attempts, error)
+        try:
+            async with self.session_factory() as db:
+                await db.execute(insert(ChatMessageDeadLetter).values(
+                    message_id=row["id"], chat_room_id=row["chat_room_id"], user_id=row["user_id"],
+                    payload=payload, error=str(error)[:2000], attempts=attempts,
+                ))
+                await db.commit()
+        except Exception as e:
+            # 死信表也写不进去时日志是最后的记录
+            logger.error("保存死信失败: %s，消息内容: %s", e, payload)
+
+    async def _written(self, batch: List[Tuple[dict, Optional[asyncio.Future]]], unread_updates: List[UnreadUpdate]):
+        for row, future in batch:
+            self._pending_ids.discard(row["id"])
+            self._attempts.pop(row["id"], None)
+            if future is not None and not future.done():
+                future.set_result(row["id"])
+        self.messages_written += len(batch)
+        self.batches_written += 1
+        self.last_batch_size = len(batch)
+        if unread_updates and self.unread_listener is not None:
+            try:
+                await self.unread_listener(unread_updates)
+            except Exception as e:
+                # 推送失败不影响已提交的消息，客户端下次拉取群聊列表时会拿到正确的未读数
+                logger.warning("推送未读数失败: %s", e)
+
+    async def _flush_active(self):
+        if not self._active:
+            return
+        active, self._active = self._active, {}
+        params = [
+            {"room_id": room_id, "member_user_id": user_id, "active_at": at}
+            for (room_id, user_id), at in active.items()
+        ]
+        try:
+            async with self.session_factory() as db:
+                await db.execute(
+                    update(ChatRoomMember.__table__)
+                    .where(and_(
+                        ChatRoomMember.__table__.c.chat_room_id == bindparam("room_id"),
+                        ChatRoomMember.__table__.c.user_id == bindparam("member_user_id"),
+                    ))
+                    .values(last_active_at=bindparam("active_at")),
+                    params,
+                )
+                await db.commit()
+        except Exception:
+            # 放回去与之后的活跃时间合并，保留较新的值
+            for key, at in active.items():
+                if key not in self._active or self._active[key] < at:
+                    self._active[key] = at
+            raise
+        self.active_updates += len(params)
+
+    async def close(self):
+        """停止后台任务并写入剩余数据（应用关闭时调用）"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.flush()
+
+    def get_stats(self) -> dict:
+        return {
+            "durability": self.settings.durability,
+            "flush_interval_ms": self.settings.flush_interval_ms,
+            "batch_size": self.settings.batch_size,
+            "pending_messages": len(self._pending),
+            "pending_member_activity": len(self._active),
+            "messages_written": self.messages_written,
+            "batches_written": self.batches_written,
+            "last_batch_size": self.last_batch_size,
+            "failed_batches": self.failed_batches,
+            "isolated_batches": self.isolated_batches,
+            "dead_letters": self.dead_letters,
+            "member_activity_updates": self.active_updates,
+        }
+
+
+message_writer = MessageWriter()
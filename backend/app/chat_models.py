@@ -1,4 +1,4 @@
-from sqlalchemy import Column, BigInteger, Integer, String, Text, Boolean, DateTime, ForeignKey, Enum, Index
+from sqlalchemy import Column, BigInteger, Integer, String, Text, Boolean, DateTime, ForeignKey, Enum, Index, DDL, event
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
 from app.database import Base
@@ -32,6 +32,7 @@ class ChatRoom(Base):
     group_id = Column(BigInteger, ForeignKey("groups.id", ondelete="CASCADE"), nullable=True)  # 关联的学习群组
     created_by = Column(BigInteger, ForeignKey("users.id"), nullable=False)
     max_members = Column(Integer, default=500, nullable=False)  # 最大成员数
+    member_count = Column(Integer, default=0, server_default="0", nullable=False)  # 当前成员数，见 app.member_counts
     is_public = Column(Boolean, default=True, nullable=False)  # 是否公开可搜索
     status = Column(Enum(ChatRoomStatus), default=ChatRoomStatus.ACTIVE, nullable=False)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
@@ -55,6 +56,8 @@ class ChatRoomMember(Base):
     joined_at = Column(DateTime(timezone=True), server_default=func.now())
     last_active_at = Column(DateTime(timezone=True), nullable=True)
     is_muted = Column(Boolean, default=False, nullable=False)  # 是否禁言
+    last_read_message_id = Column(BigInteger, nullable=True)  # 已读到的消息ID
+    unread_count = Column(Integer, default=0, server_default="0", nullable=False)  # 未读消息数，见 app.chat_unread
     
     # 联合唯一索引
     __table_args__ = (
@@ -103,7 +106,52 @@ class ChatMessage(Base):
     message_type = Column(String(20), default="text", nullable=False)  # text, image, file
     is_deleted = Column(Boolean, default=False, nullable=False)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
+    # 全文搜索分词结果（空格分隔），由 app.services.message_search.search_text 生成
+    search_tokens = Column(Text, nullable=True)
+    
+    # 聊天记录按 (群聊, 消息ID) 游标分页，只索引未删除的消息
+    __table_args__ = (
+        Index(
+            'idx_chat_message_room_id_desc', chat_room_id, id.desc(),
+            postgresql_where=(is_deleted == False),
+            sqlite_where=(is_deleted == False)
+        ),
+    )
     
     # 关联
     chat_room = relationship("ChatRoom")
-    user = relationship("User")
\ No newline at end of file
+    user = relationship("User")
+
+# PostgreSQL 下由 search_tokens 生成 tsvector 存储列并建立 GIN 索引，
+# 搜索和排序直接读取已存储的 tsvector，不必逐行重新计算 to_tsvector。
+# 该列不映射到模型，只在 app.services.message_search 中引用
+event.listen(ChatMessage.__table__, "after_create", DDL(
+    "ALTER TABLE chat_messages ADD COLUMN search_vector tsvector GENERATED ALWAYS AS "
+    "(to_tsvector('simple'::regconfig, coalesce(search_tokens, ''))) STORED"
+).execute_if(dialect="postgresql"))
+event.listen(ChatMessage.__table__, "after_create", DDL(
+    "CREATE INDEX idx_chat_message_search ON chat_messages USING gin (search_vector)"
+).execute_if(dialect="postgresql"))
+
+
+class ChatMessageDeadLetter(Base):
+    """写入失败的聊天消息（死信），见 app.chat_message_writer"""
+    __tablename__ = "chat_message_dead_letters"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    message_id = Column(BigInteger, nullable=False, index=True)  # 原消息ID（可能与已有消息重复，因此不作主键）
+    chat_room_id = Column(BigInteger, nullable=False)
+    user_id = Column(BigInteger, nullable=False)
+    payload = Column(Text, nullable=False)  # 原消息行的 JSON
+    error = Column(Text, nullable=False)
+    attempts = Column(Integer, nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+
+class ChatWorkerLease(Base):
+    """消息ID生成器的 worker 编号租约，每个进程启动时领取一个，见 app.chat_id_generator"""
+    __tablename__ = "chat_worker_leases"
+
+    worker_id = Column(Integer, primary_key=True, autoincrement=False)
+    owner = Column(String(100), nullable=False)  # 主机名:进程号:随机后缀
+    expires_at = Column(DateTime(timezone=True), nullable=False)
@@ -144,4 +144,14 @@ class ChatRoomBriefResponse(BaseModel):
     is_public: bool
     
     class Config:
-        from_attributes = True
\ No newline at end of file
+        from_attributes = True
+
+class ChatReadPosition(BaseModel):
+    """某个群聊的已读位置"""
+    chat_room_id: int
+    message_id: int = Field(..., ge=1, description="已读到的消息ID")
+
+
+class ChatReadRequest(BaseModel):
+    """批量上报已读位置"""
+    positions: List[ChatReadPosition] = Field(..., min_length=1, max_length=200, description="各群聊的已读位置")
@@ -0,0 +1,176 @@
+"""
+群聊已读游标与未读数
+
+每个成员记录 last_read_message_id（已读到的消息ID）和 unread_count（未读数）。
+未读数是增量维护的计数，读取时不做 COUNT：
+- 消息批量写入时，在同一事务里给群聊中除发送者以外、已读游标落后的成员加上本批条数
+- 成员上报已读位置时，只统计游标之后剩余的消息重新得出未读数（读到最新时为 0 行）
+- 删除消息时，给尚未读到该消息的成员减一
+
+跨 worker 的极端并发下计数可能有偏差，可用 python -m app.maintenance recount-unread 按游标重新统计。
+"""
+from collections import defaultdict
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import and_, bindparam, func, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.chat_models import ChatMessage, ChatRoomMember
+
+members = ChatRoomMember.__table__
+messages = ChatMessage.__table__
+
+
+@dataclass
+class UnreadUpdate:
+    """一个群聊中因新消息而变化的未读数，推送给在线成员"""
+    chat_room_id: int
+    last_message_id: int
+    # [(user_id, unread_count, delta)]
+    counts: List[Tuple[int, int, int]] = field(default_factory=list)
+
+    def to_envelope(self) -> dict:
+        return {
+            "kind": "unread",
+            "chat_room_id": self.chat_room_id,
+            "last_message_id": self.last_message_id,
+            "counts": [list(item) for item in self.counts],
+        }
+
+
+def unread_after(chat_room_id, cursor, user_id):
+    """群聊中 cursor 之后他人发送的未删除消息数（子查询）"""
+    return select(func.count(messages.c.id)).where(
+        messages.c.chat_room_id == chat_room_id,
+        messages.c.id > cursor,
+        messages.c.is_deleted == False,
+        messages.c.user_id != user_id
+    ).scalar_subquery()
+
+
+async def add_new_messages(db: AsyncSession, rows: Iterable[dict]) -> List[UnreadUpdate]:
+    """
+    新消息写入后增加成员未读数，需与 INSERT 在同一事务中执行
+
+    按 (群聊, 发送者) 分组，每组一条 UPDATE ... RETURNING。
+    """
+    groups: Dict[Tuple[int, int], List[int]] = defaultdict(list)
+    for row in rows:
+        if not row.get("is_deleted"):
+            groups[(row["chat_room_id"], row["user_id"])].append(row["id"])
+
+    rooms: Dict[int, dict] = {}
+    for (chat_room_id, sender_id), ids in groups.items():
+        result = await db.execute(
+            update(members).where(
+                members.c.chat_room_id == chat_room_id,
+                members.c.user_id != sender_id,
+                func.coalesce(members.c.last_read_message_id, 0) < max(ids)
+            ).values(
+                unread_count=members.c.unread_count + len(ids)
+            ).returning(members.c.user_id, members.c.unread_count)
+        )
+        room = rooms.setdefault(chat_room_id, {"last_message_id": 0, "counts": {}, "deltas": defaultdict(int)})
+        room["last_message_id"] = max(room["last_message_id"], max(ids))
+        for user_id, unread_count in result.all():
+            room["counts"][user_id] = unread_count
+            room["deltas"][user_id] += len(ids)
+
+    return [
+        UnreadUpdate(
+            chat_room_id=chat_room_id,
+            last_message_id=room["last_message_id"],
+            counts=[(user_id, count, room["deltas"][user_id]) for user_id, count in room["counts"].items()]
+        )
+        for chat_room_id, room in rooms.items()
+        if room["counts"]
+    ]
+
+
+async def mark_read(db: AsyncSession, user_id: int, positions: Dict[int, int]) -> List[dict]:
+    """
+    批量推进已读游标，positions 为 {群聊ID: 已读到的消息ID}
+
+    游标只前进不后退，且不超过群聊中最新的消息；不是成员的群聊忽略。
+    固定三条 SQL：读取当前状态、批量 UPDATE、读取新状态。返回每个群聊的新状态和未读变化量。
+    """
+    if not positions:
+        return []
+
+    latest = select(func.max(messages.c.id)).where(
+        messages.c.chat_room_id == members.c.chat_room_id
+    ).scalar_subquery()
+    before = {
+        row.chat_room_id: row
+        for row in (await db.execute(
+            select(
+                members.c.chat_room_id, members.c.last_read_message_id,
+                members.c.unread_count, latest.label("latest_id")
+            ).where(
+                members.c.user_id == user_id,
+                members.c.chat_room_id.in_(list(positions))
+            )
+        )).all()
+    }
+
+    params = []
+    for chat_room_id, row in before.items():
+        cursor = min(positions[chat_room_id], row.latest_id or 0)
+        if cursor > (row.last_read_message_id or 0):
+            params.append({"room_id": chat_room_id, "cursor": cursor})
+
+    if params:
+        await db.execute(
+            update(members).where(and_(
+                members.c.chat_room_id == bindparam("room_id"),
+                members.c.user_id == user_id,
+                func.coalesce(members.c.last_read_message_id, 0) < bindparam("cursor")
+            )).values(
+                last_read_message_id=bindparam("cursor"),
+                unread_count=unread_after(members.c.chat_room_id, bindparam("cursor"), user_id)
+            ),
+            params
+        )
+        await db.commit()
+
+    after = (await db.execute(
+        select(members.c.chat_room_id, members.c.last_read_message_id, members.c.unread_count).where(
+            members.c.user_id == user_id,
+            members.c.chat_room_id.in_(list(before))
+        )
+    )).all() if before else []
+
+    return [
+        {
+            "chat_room_id": row.chat_room_id,
+            "last_read_message_id": row.last_read_message_id,
+            "unread_count": row.unread_count,
+            "delta": row.unread_count - before[row.chat_room_id].unread_count
+        }
+        for row in after
+    ]
+
+
+async def remove_message(db: AsyncSession, chat_room_id: int, message_id: int, sender_id: int):
+    """消息被删除后，尚未读到它的成员未读数减一（调用方负责提交）"""
+    await db.execute(
+        update(members).where(
+            members.c.chat_room_id == chat_room_id,
+            members.c.user_id != sender_id,
+            func.coalesce(members.c.last_read_message_id, 0) < message_id,
+            members.c.unread_count > 0
+        ).values(unread_count=members.c.unread_count - 1)
+    )
+
+
+def recount_statement(chat_room_id: Optional[int] = None):
+    """按已读游标重新统计未读数的 UPDATE 语句（运维命令使用）"""
+    statement = update(members).values(
+        unread_count=unread_after(
+            members.c.chat_room_id, func.coalesce(members.c.last_read_message_id, 0), members.c.user_id
+        )
+    )
+    if chat_room_id is not None:
+        statement = statement.where(members.c.chat_room_id == chat_room_id)
+    return statement
@@ -1,245 +1,671 @@
 import json
-from typing import Dict, Set
-from fastapi import WebSocket, WebSocketDisconnect, Depends, HTTPException, status
-from sqlalchemy.orm import Session
-from sqlalchemy import desc
-from app.database import get_db
+import os
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional, Set, Tuple
+from fastapi import WebSocket, WebSocketDisconnect, HTTPException, status
+from sqlalchemy.ext.asyncio import AsyncSession
 from app.auth import get_current_user_ws
-from app.chat_models import ChatRoom, ChatRoomMember, ChatMessage, ChatRoomStatus
+from app.chat_access import RoomAccess, room_access
+from app.chat_broker import Broker, InProcessBroker, create_broker_from_env
+from app.chat_message_writer import message_writer
+from app.chat_unread import UnreadUpdate
 from app.models import User
 import asyncio
 from datetime import datetime
 
 
+# 每次使用时创建新的异步会话，如 app.database.AsyncSessionLocal
+SessionFactory = Callable[[], AsyncSession]
+
+# 慢消费者处理策略
+DROP_OLDEST = "drop_oldest"
+DISCONNECT = "disconnect"
+
+
+@dataclass
+class ConnectionSettings:
+    """每个连接的发送队列配置，来自环境变量"""
+    queue_size: int = 256
+    slow_consumer_policy: str = DROP_OLDEST
+    slow_consumer_timeout_ms: int = 5000
+    max_subscriptions: int = 50
+
+    @classmethod
+    def from_env(cls) -> "ConnectionSettings":
+        policy = os.getenv("CHAT_SLOW_CONSUMER_POLICY", DROP_OLDEST).strip().lower()
+        if policy not in (DROP_OLDEST, DISCONNECT):
+            raise ValueError(f"不支持的慢消费者策略: {policy}")
+        return cls(
+            queue_size=int(os.getenv("CHAT_SEND_QUEUE_SIZE", "256")),
+            slow_consumer_policy=policy,
+            slow_consumer_timeout_ms=int(os.getenv("CHAT_SLOW_CONSUMER_TIMEOUT_MS", "5000")),
+            max_subscriptions=int(os.getenv("CHAT_MAX_SUBSCRIPTIONS", "50")),
+        )
+
+
+class ClientConnection:
+    """
+    单个 WebSocket 连接及其发送队列
+
+    广播只把消息放进有界队列，由独立的写协程负责真正发送，
+    一个慢客户端不会拖慢同一群聊里的其他人。
+    - 队列满时：drop_oldest 丢弃最旧的消息；disconnect 直接断开
+    - 单次发送超过 slow_consumer_timeout_ms：视为慢消费者并断开
+    - 发送异常：断开并从管理器中移除
+    """
+
+    def __init__(self, websocket: WebSocket, user_id: int, settings: ConnectionSettings,
+                 on_close: Callable[["ClientConnection", str], None]):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.settings = settings
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=settings.queue_size)
+        # 该连接订阅的群聊
+        self.rooms: Set[int] = set()
+        self.dropped = 0
+        self.closed = False
+        self._on_close = on_close
+        self._writer: Optional[asyncio.Task] = None
+        self._closer: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._writer = asyncio.create_task(self._write_loop())
+
+    def send(self, message: dict) -> bool:
+        """把单条消息放入该连接的发送队列"""
+        return self.enqueue(json.dumps(message, ensure_ascii=False, default=str))
+
+    def enqueue(self, text: str) -> bool:
+        if self.closed:
+            return False
+        try:
+            self.queue.put_nowait(text)
+            return True
+        except asyncio.QueueFull:
+            pass
+        if self.settings.slow_consumer_policy == DROP_OLDEST:
+            self.queue.get_nowait()
+            self.queue.put_nowait(text)
+            self.dropped += 1
+            return True
+        self.fail("queue_full")
+        return False
+
+    async def _write_loop(self):
+        timeout = self.settings.slow_consumer_timeout_ms / 1000
+        try:
+            while True:
+                text = await self.queue.get()
+                await asyncio.wait_for(self.websocket.send_text(text), timeout)
+        except asyncio.CancelledError:
+            raise
+        except asyncio.TimeoutError:
+            self.fail("send_timeout")
+        except Exception:
+            self.fail("send_error")
+
+    def fail(self, reason: str):
+        """发送失败或消费过慢：移除连接并关闭 socket"""
+        if self.closed:
+            return
+        self._on_close(self, reason)
+        self.close(status.WS_1008_POLICY_VIOLATION)
+
+    def close(self, code: int):
+        """停止写协程并由服务端关闭 socket"""
+        self.stop()
+        self._closer = asyncio.create_task(self._close_socket(code))
+
+    async def _close_socket(self, code: int):
+        try:
+            await asyncio.wait_for(
+                self.websocket.close(code=code),
+                self.settings.slow_consumer_timeout_ms / 1000
+            )
+        except Exception:
+            pass
+
+    def stop(self):
+        """停止写协程（客户端已断开时直接调用）"""
+        self.closed = True
+        if self._writer is not None and self._writer is not asyncio.current_task():
+            self._writer.cancel()
+
+
 class ConnectionManager:
-    """WebSocket 连接管理器"""
+    """
+    WebSocket 连接管理器
+    
+    每个用户在一个 worker 上只保留一条连接，一条连接可以同时订阅多个群聊。
+    """
+    
+    def __init__(self, broker: Optional[Broker] = None, settings: Optional[ConnectionSettings] = None):
+        # 存储每个群聊的连接: {chat_room_id: {user_id: ClientConnection}}
+        self.active_connections: Dict[int, Dict[int, ClientConnection]] = {}
+        # 存储每个用户的连接: {user_id: ClientConnection}
+        self.user_connections: Dict[int, ClientConnection] = {}
+        # 反向索引，用户订阅的群聊: {user_id: {chat_room_id}}
+        self.user_rooms: Dict[int, Set[int]] = {}
+        # 广播经由代理发布，各 worker 订阅后投递给本地连接
+        self.broker = broker or InProcessBroker()
+        self.settings = settings or ConnectionSettings.from_env()
+        self.slow_consumer_disconnects = 0
+        self.send_failures = 0
+        self._started = False
     
-    def __init__(self):
-        # 存储每个群聊的连接: {chat_room_id: {user_id: WebSocket}}
-        self.active_connections: Dict[int, Dict[int, WebSocket]] = {}
-        # 存储用户当前所在的群聊: {user_id: chat_room_id}
-        self.user_rooms: Dict[int, int] = {}
+    async def start(self):
+        """订阅广播频道（应用启动时调用）"""
+        if not self._started:
+            self._started = True
+            await self.broker.start(self.deliver)
     
-    async def connect(self, websocket: WebSocket, chat_room_id: int, user_id: int):
-        """建立 WebSocket 连接"""
+    async def stop(self):
+        if self._started:
+            await self.broker.stop()
+            self._started = False
+    
+    async def connect(self, websocket: WebSocket, user_id: int) -> ClientConnection:
+        """建立 WebSocket 连接，同一用户的旧连接会被关闭"""
         await websocket.accept()
         
-        if chat_room_id not in self.active_connections:
-            self.active_connections[chat_room_id] = {}
+        old_connection = self.user_connections.get(user_id)
+        if old_connection is not None:
+            self.disconnect(user_id, old_connection)
+            old_connection.close(status.WS_1000_NORMAL_CLOSURE)
         
-        # 如果用户已在其他群聊，先断开
-        if user_id in self.user_rooms:
-            old_room = self.user_rooms[user_id]
-            if old_room in self.active_connections and user_id in self.active_connections[old_room]:
-                del self.active_connections[old_room][user_id]
-        
-        self.active_connections[chat_room_id][user_id] = websocket
-        self.user_rooms[user_id] = chat_room_id
-    
-    def disconnect(self, chat_room_id: int, user_id: int):
-        """断开 WebSocket 连接"""
-        if chat_room_id in self.active_connections:
-            if user_id in self.active_connections[chat_room_id]:
-                del self.active_connections[chat_room_id][user_id]
-            
+        connection = ClientConnection(websocket, user_id, self.settings, self._on_connection_failed)
+        connection.start()
+        self.user_connections[user_id] = connection
+        self.user_rooms[user_id] = connection.rooms
+        return connection
+    
+    def subscribe(self, connection: ClientConnection, chat_room_id: int) -> bool:
+        """连接订阅群聊；连接已失效或超过订阅上限时返回 False"""
+        if self.user_connections.get(connection.user_id) is not connection:
+            return False
+        if chat_room_id in connection.rooms:
+            return True
+        if len(connection.rooms) >= self.settings.max_subscriptions:
+            return False
+        self.active_connections.setdefault(chat_room_id, {})[connection.user_id] = connection
+        connection.rooms.add(chat_room_id)
+        return True
+    
+    def unsubscribe(self, connection: ClientConnection, chat_room_id: int) -> bool:
+        """取消订阅群聊"""
+        if chat_room_id not in connection.rooms:
+            return False
+        connection.rooms.discard(chat_room_id)
+        room = self.active_connections.get(chat_room_id)
+        if room is not None and room.get(connection.user_id) is connection:
+            del room[connection.user_id]
             # 如果群聊没有连接了，清理
-            if not self.active_connections[chat_room_id]:
+            if not room:
                 del self.active_connections[chat_room_id]
+        return True
+    
+    def disconnect(self, user_id: int, connection: Optional[ClientConnection] = None) -> Set[int]:
+        """
+        断开 WebSocket 连接，返回该连接订阅过的群聊
         
-        if user_id in self.user_rooms:
-            del self.user_rooms[user_id]
+        传入 connection 时只在它仍是当前连接时才移除，避免误删用户重连后的新连接。
+        """
+        current = self.user_connections.get(user_id)
+        if current is None or (connection is not None and current is not connection):
+            if connection is not None:
+                connection.stop()
+            return set()
+        
+        rooms = set(current.rooms)
+        for chat_room_id in rooms:
+            self.unsubscribe(current, chat_room_id)
+        del self.user_connections[user_id]
+        del self.user_rooms[user_id]
+        current.stop()
+        return rooms
+    
+    def _on_connection_failed(self, connection: ClientConnection, reason: str):
+        if reason == "send_error":
+            self.send_failures += 1
+        else:
+            self.slow_consumer_disconnects += 1
+        self.disconnect(connection.user_id, connection)
     
     async def broadcast_to_room(self, chat_room_id: int, message: dict, exclude_user_id: int = None):
-        """向群聊广播消息"""
+        """向群聊广播消息（发布到代理，由每个 worker 投递给本地连接）"""
+        await self.start()
+        await self.broker.publish({
+            "kind": "room",
+            "chat_room_id": chat_room_id,
+            "message": message,
+            "exclude_user_id": exclude_user_id,
+        })
+    
+    async def send_to_user(self, user_id: int, message: dict):
+        """向指定用户发送消息（用户可能连接在其他 worker 上）"""
+        await self.start()
+        await self.broker.publish({"kind": "user", "user_id": user_id, "message": message})
+    
+    async def invalidate_room_access(self, chat_room_id: int, user_id: Optional[int] = None,
+                                     revoke: Optional[str] = None):
+        """
+        成员或群聊状态变更后失效权限缓存：本进程立即生效，其他 worker 通过代理通知
+
+        revoke 为原因说明时表示失去了访问权限（退出、被踢出、群聊删除），
+        各 worker 上该成员（不指定 user_id 时为全部成员）的连接同时退订该群聊。
+        """
+        room_access.invalidate(chat_room_id, user_id)
+        await self.start()
+        await self.broker.publish({
+            "kind": "access", "chat_room_id": chat_room_id, "user_id": user_id, "revoke": revoke
+        })
+    
+    async def publish_unread(self, updates: List[UnreadUpdate]):
+        """推送新消息带来的未读数变化，每个群聊一个信封，由各 worker 发给本地在线的成员"""
+        await self.start()
+        for update in updates:
+            await self.broker.publish(update.to_envelope())
+    
+    async def deliver(self, envelope: dict):
+        """处理代理推送的信封，只投递给本进程持有的连接"""
+        kind = envelope.get("kind")
+        if kind == "room":
+            self._deliver_to_room(
+                envelope["chat_room_id"], envelope["message"], envelope.get("exclude_user_id")
+            )
+        elif kind == "user":
+            self._deliver_to_user(envelope["user_id"], envelope["message"])
+        elif kind == "access":
+            room_access.invalidate(envelope["chat_room_id"], envelope.get("user_id"))
+            if envelope.get("revoke"):
+                self._revoke(envelope["chat_room_id"], envelope.get("user_id"), envelope["revoke"])
+        elif kind == "unread":
+            self._deliver_unread(envelope)
+    
+    def _deliver_to_room(self, chat_room_id: int, message: dict, exclude_user_id: int = None):
         if chat_room_id not in self.active_connections:
             return
         
+        # 只序列化一次；入队不会阻塞，真正的发送由各连接的写协程并发完成
         message_json = json.dumps(message, ensure_ascii=False, default=str)
         
-        for user_id, connection in self.active_connections[chat_room_id].items():
+        for user_id, connection in list(self.active_connections[chat_room_id].items()):
             if exclude_user_id and user_id == exclude_user_id:
                 continue
-            try:
-                await connection.send_text(message_json)
-            except Exception:
-                # 发送失败，标记为断开
-                pass
+            connection.enqueue(message_json)
     
-    async def send_to_user(self, user_id: int, message: dict):
-        """向指定用户发送消息"""
-        if user_id not in self.user_rooms:
-            return
-        
-        chat_room_id = self.user_rooms[user_id]
-        if chat_room_id not in self.active_connections:
-            return
-        
-        if user_id not in self.active_connections[chat_room_id]:
-            return
-        
-        try:
-            message_json = json.dumps(message, ensure_ascii=False, default=str)
-            await self.active_connections[chat_room_id][user_id].send_text(message_json)
-        except Exception:
-            pass
+    def _revoke(self, chat_room_id: int, user_id: Optional[int], reason: str):
+        """失去权限的成员不再收到该群聊的广播"""
+        room = self.active_connections.get(chat_room_id, {})
+        connections = list(room.values()) if user_id is None else [room[user_id]] if user_id in room else []
+        for connection in connections:
+            self.unsubscribe(connection, chat_room_id)
+            connection.send({"type": "unsubscribed", "chat_room_id": chat_room_id, "reason": reason})
+    
+    def _deliver_to_user(self, user_id: int, message: dict):
+        connection = self.user_connections.get(user_id)
+        if connection is not None:
+            connection.send(message)
+    
+    def _deliver_unread(self, envelope: dict):
+        for user_id, unread_count, delta in envelope["counts"]:
+            connection = self.user_connections.get(user_id)
+            if connection is not None:
+                connection.send({
+                    "type": "unread",
+                    "chat_room_id": envelope["chat_room_id"],
+                    "unread_count": unread_count,
+                    "delta": delta,
+                    "last_message_id": envelope["last_message_id"]
+                })
     
     def get_online_users(self, chat_room_id: int) -> Set[int]:
-        """获取群聊在线用户列表"""
+        """获取群聊在线用户列表（仅本 worker 上的连接）"""
         if chat_room_id not in self.active_connections:
             return set()
         return set(self.active_connections[chat_room_id].keys())
+    
+    def is_online(self, user_id: int) -> bool:
+        return user_id in self.user_connections
+    
+    def get_user_rooms(self, user_id: int) -> Set[int]:
+        """用户当前订阅的群聊（仅本 worker）"""
+        return set(self.user_rooms.get(user_id, ()))
+    
+    def get_stats(self) -> dict:
+        """本 worker 的连接与发送队列统计"""
+        connections = list(self.user_connections.values())
+        return {
+            "rooms": len(self.active_connections),
+            "connections": len(connections),
+            "subscriptions": sum(len(c.rooms) for c in connections),
+            "queued_messages": sum(c.queue.qsize() for c in connections),
+            "max_queue_depth": max((c.queue.qsize() for c in connections), default=0),
+            "dropped_messages": sum(c.dropped for c in connections),
+            "slow_consumer_disconnects": self.slow_consumer_disconnects,
+            "send_failures": self.send_failures,
+            "queue_size": self.settings.queue_size,
+            "slow_consumer_policy": self.settings.slow_consumer_policy,
+            "slow_consumer_timeout_ms": self.settings.slow_consumer_timeout_ms,
+        }
 
 
 # 全局连接管理器
-manager = ConnectionManager()
+manager = ConnectionManager(create_broker_from_env())
+message_writer.unread_listener = manager.publish_unread
+
+
+async def _authorize_room(session_factory: SessionFactory, chat_room_id: int,
+                          user_id: int) -> Tuple[Optional[RoomAccess], Optional[str]]:
+    """
+    校验群聊存在且活跃、用户是群聊成员（走权限缓存），返回 (权限, 错误原因)
+
+    每次校验使用单独的短会话：命中缓存时不会取连接，未命中时查询后立即归还，
+    空闲的 WebSocket 不会占着连接池里的连接（也不会停在未结束的事务中）。
+    """
+    async with session_factory() as db:
+        access = await room_access.get(db, chat_room_id, user_id)
+    if not access.room_active:
+        return None, "群聊不存在"
+    if not access.is_member:
+        return None, "不是群聊成员"
+    return access, None
+
+
+async def _check_can_send(session_factory: SessionFactory, chat_room_id: int, user_id: int) -> Optional[str]:
+    """每条消息发送前重新确认权限（通常命中缓存），被踢出或禁言后立即生效"""
+    access, error = await _authorize_room(session_factory, chat_room_id, user_id)
+    if error:
+        return error
+    if access.is_muted:
+        return "您已被禁言"
+    return None
+
+
+async def _authenticate(websocket: WebSocket, token: str, session_factory: SessionFactory) -> Optional[User]:
+    """验证 token，失败时关闭连接并返回 None；查询用户的会话用完即关闭"""
+    async with session_factory() as db:
+        try:
+            return await get_current_user_ws(token, db)
+        except HTTPException:
+            pass
+    await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+    return None
+
+
+async def _join_room(connection: ClientConnection, user: User, chat_room_id: int) -> bool:
+    """订阅群聊并通知群内成员；连接已失效或超过订阅上限时返回 False"""
+    if not manager.subscribe(connection, chat_room_id):
+        return False
+    
+    # 更新最后活跃时间（合并后批量写入）
+    message_writer.touch_member(chat_room_id, user.id)
+    
+    # 发送欢迎消息
+    welcome_msg = {
+        "type": "system",
+        "chat_room_id": chat_room_id,
+        "content": f"欢迎 {user.username} 加入群聊",
+        "timestamp": datetime.utcnow().isoformat()
+    }
+    await manager.broadcast_to_room(chat_room_id, welcome_msg)
+    
+    # 发送在线用户列表
+    online_users = manager.get_online_users(chat_room_id)
+    connection.send({
+        "type": "online_users",
+        "chat_room_id": chat_room_id,
+        "users": list(online_users),
+        "count": len(online_users)
+    })
+    
+    # 广播用户加入通知
+    join_notification = {
+        "type": "user_joined",
+        "chat_room_id": chat_room_id,
+        "user_id": user.id,
+        "username": user.username,
+        "timestamp": datetime.utcnow().isoformat()
+    }
+    await manager.broadcast_to_room(chat_room_id, join_notification, exclude_user_id=user.id)
+    return True
+
+
+async def _leave_rooms(user: User, chat_room_ids: Set[int]):
+    """广播用户离开通知（用户已通过新连接重新订阅的群聊除外）"""
+    for chat_room_id in chat_room_ids:
+        if user.id in manager.get_online_users(chat_room_id):
+            continue
+        leave_notification = {
+            "type": "user_left",
+            "chat_room_id": chat_room_id,
+            "user_id": user.id,
+            "username": user.username,
+            "timestamp": datetime.utcnow().isoformat()
+        }
+        await manager.broadcast_to_room(chat_room_id, leave_notification)
+
+
+async def _handle_chat_message(connection: ClientConnection, user: User, chat_room_id: int, message_data: dict):
+    """
+    处理一条聊天消息
+    
+    消息ID和时间戳在应用内分配，写库由 message_writer 批量完成；
+    write_behind 模式下先广播后落库，durable 模式下等所在批次提交后再广播。
+    """
+    msg_type = message_data.get("type", "text")
+    content = message_data.get("content", "").strip()
+    
+    if not content and msg_type == "text":
+        connection.send({
+            "type": "error",
+            "chat_room_id": chat_room_id,
+            "message": "消息内容不能为空"
+        })
+        return
+    
+    row = message_writer.new_message(chat_room_id, user.id, content, msg_type)
+    await message_writer.submit(row)
+    
+    # 构建消息响应
+    message_response = {
+        "type": "message",
+        "chat_room_id": chat_room_id,
+        "message_id": row["id"],
+        "user_id": user.id,
+        "username": user.username,
+        "avatar_url": user.avatar_url,
+        "content": content,
+        "message_type": msg_type,
+        "timestamp": row["created_at"].isoformat(),
+        "is_own": False
+    }
+    
+    # 广播给所有群聊成员
+    await manager.broadcast_to_room(chat_room_id, message_response)
+    
+    # 更新最后活跃时间（合并后批量写入）
+    message_writer.touch_member(chat_room_id, user.id)
 
 
 async def chat_websocket_endpoint(
     websocket: WebSocket,
     chat_room_id: int,
     token: str,
-    db: Session = Depends(get_db)
+    session_factory: SessionFactory
 ):
-    """WebSocket 聊天端点"""
+    """WebSocket 聊天端点（单群聊连接，兼容旧客户端）"""
     
     # 验证用户身份
-    try:
-        user = await get_current_user_ws(token, db)
-    except HTTPException:
-        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+    user = await _authenticate(websocket, token, session_factory)
+    if user is None:
         return
     
-    # 验证群聊存在且活跃
-    chat_room = db.query(ChatRoom).filter(
-        ChatRoom.id == chat_room_id,
-        ChatRoom.status == ChatRoomStatus.ACTIVE
-    ).first()
-    
-    if not chat_room:
-        await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason="群聊不存在")
+    # 验证群聊存在、用户是群聊成员且未被禁言
+    error = await _check_can_send(session_factory, chat_room_id, user.id)
+    if error:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason=error)
         return
     
-    # 验证用户是群聊成员
-    member = db.query(ChatRoomMember).filter(
-        ChatRoomMember.chat_room_id == chat_room_id,
-        ChatRoomMember.user_id == user.id
-    ).first()
+    # 建立连接
+    connection = await manager.connect(websocket, user.id)
     
-    if not member:
-        await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason="不是群聊成员")
-        return
+    try:
+        if not await _join_room(connection, user, chat_room_id):
+            # 订阅前连接已被同一用户的新连接取代
+            raise WebSocketDisconnect(status.WS_1000_NORMAL_CLOSURE)
+        
+        # 消息处理循环
+        while True:
+            try:
+                # 接收消息
+                data = await websocket.receive_text()
+                message_data = json.loads(data)
+                error = await _check_can_send(session_factory, chat_room_id, user.id)
+                if error:
+                    connection.send({
+                        "type": "error",
+                        "chat_room_id": chat_room_id,
+                        "message": error
+                    })
+                    continue
+                await _handle_chat_message(connection, user, chat_room_id, message_data)
+                
+            except WebSocketDisconnect:
+                raise
+            except json.JSONDecodeError:
+                connection.send({
+                    "type": "error",
+                    "message": "消息格式错误"
+                })
+            except Exception as e:
+                if connection.closed:
+                    # 连接已被服务端关闭（慢消费者或发送失败）
+                    raise WebSocketDisconnect(status.WS_1008_POLICY_VIOLATION)
+                print(f"处理消息时出错: {e}")
+                connection.send({
+                    "type": "error",
+                    "message": "消息处理失败"
+                })
+                
+    except WebSocketDisconnect:
+        # 断开连接并广播用户离开通知
+        manager.disconnect(user.id, connection)
+        await _leave_rooms(user, {chat_room_id})
+        
+    except Exception as e:
+        print(f"WebSocket 错误: {e}")
+        manager.disconnect(user.id, connection)
+
+
+async def multiplexed_websocket_endpoint(
+    websocket: WebSocket,
+    token: str,
+    session_factory: SessionFactory
+):
+    """
+    多群聊 WebSocket 端点
+    
+    一条连接只做一次身份验证，之后通过帧订阅/退订任意多个群聊：
+    - {"type": "subscribe", "chat_room_id": 1}
+    - {"type": "unsubscribe", "chat_room_id": 1}
+    - {"type": "text", "chat_room_id": 1, "content": "..."}
+    服务端推送的群聊帧都带有 chat_room_id。
+    所在群聊有他人的新消息时（无论是否订阅）推送 {"type": "unread", "chat_room_id", "unread_count", "delta", "last_message_id"}。
+    退出、被移出群聊或群聊被删除时服务端主动退订，推送 {"type": "unsubscribed", "chat_room_id", "reason"}。
+    """
     
-    # 检查是否被禁言
-    if member.is_muted:
-        await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason="您已被禁言")
+    # 验证用户身份
+    user = await _authenticate(websocket, token, session_factory)
+    if user is None:
         return
     
-    # 建立连接
-    await manager.connect(websocket, chat_room_id, user.id)
+    connection = await manager.connect(websocket, user.id)
+    # 本连接订阅过的群聊，断开时据此广播离开通知（当前订阅以 connection.rooms 为准）
+    memberships: Set[int] = set()
     
     try:
-        # 更新最后活跃时间
-        member.last_active_at = datetime.utcnow()
-        db.commit()
-        
-        # 发送欢迎消息
-        welcome_msg = {
-            "type": "system",
-            "content": f"欢迎 {user.username} 加入群聊",
-            "timestamp": datetime.utcnow().isoformat()
-        }
-        await manager.broadcast_to_room(chat_room_id, welcome_msg)
-        
-        # 发送在线用户列表
-        online_users = manager.get_online_users(chat_room_id)
-        await websocket.send_text(json.dumps({
-            "type": "online_users",
-            "users": list(online_users),
-            "count": len(online_users)
-        }, ensure_ascii=False))
-        
-        # 广播用户加入通知
-        join_notification = {
-            "type": "user_joined",
+        connection.send({
+            "type": "connected",
             "user_id": user.id,
-            "username": user.username,
             "timestamp": datetime.utcnow().isoformat()
-        }
-        await manager.broadcast_to_room(chat_room_id, join_notification, exclude_user_id=user.id)
+        })
         
-        # 消息处理循环
         while True:
             try:
-                # 接收消息
                 data = await websocket.receive_text()
-                message_data = json.loads(data)
+                frame = json.loads(data)
+                frame_type = frame.get("type", "text")
+                chat_room_id = frame.get("chat_room_id")
                 
-                msg_type = message_data.get("type", "text")
-                content = message_data.get("content", "").strip()
-                
-                if not content and msg_type == "text":
-                    await websocket.send_text(json.dumps({
+                if not isinstance(chat_room_id, int):
+                    connection.send({
                         "type": "error",
-                        "message": "消息内容不能为空"
-                    }, ensure_ascii=False))
+                        "message": "缺少 chat_room_id"
+                    })
                     continue
                 
-                # 保存消息到数据库
-                chat_message = ChatMessage(
-                    chat_room_id=chat_room_id,
-                    user_id=user.id,
-                    content=content,
-                    message_type=msg_type
-                )
-                db.add(chat_message)
-                db.commit()
-                db.refresh(chat_message)
-                
-                # 构建消息响应
-                message_response = {
-                    "type": "message",
-                    "message_id": chat_message.id,
-                    "user_id": user.id,
-                    "username": user.username,
-                    "avatar_url": user.avatar_url,
-                    "content": content,
-                    "message_type": msg_type,
-                    "timestamp": chat_message.created_at.isoformat(),
-                    "is_own": False
-                }
+                if frame_type == "subscribe":
+                    # 以连接上的订阅为准：被移出群聊时 manager 会直接退订
+                    if chat_room_id not in connection.rooms:
+                        _, error = await _authorize_room(session_factory, chat_room_id, user.id)
+                        if error is None and not await _join_room(connection, user, chat_room_id):
+                            error = "订阅的群聊数量已达上限"
+                        if error:
+                            connection.send({
+                                "type": "error",
+                                "chat_room_id": chat_room_id,
+                                "message": error
+                            })
+                            continue
+                        memberships.add(chat_room_id)
+                    connection.send({"type": "subscribed", "chat_room_id": chat_room_id})
                 
-                # 广播给所有群聊成员
-                await manager.broadcast_to_room(chat_room_id, message_response)
+                elif frame_type == "unsubscribe":
+                    if chat_room_id in memberships:
+                        memberships.discard(chat_room_id)
+                        manager.unsubscribe(connection, chat_room_id)
+                        await _leave_rooms(user, {chat_room_id})
+                    connection.send({"type": "unsubscribed", "chat_room_id": chat_room_id})
                 
-                # 更新最后活跃时间
-                member.last_active_at = datetime.utcnow()
-                db.commit()
+                else:
+                    if chat_room_id not in connection.rooms:
+                        connection.send({
+                            "type": "error",
+                            "chat_room_id": chat_room_id,
+                            "message": "请先订阅该群聊"
+                        })
+                        continue
+                    error = await _check_can_send(session_factory, chat_room_id, user.id)
+                    if error:
+                        connection.send({
+                            "type": "error",
+                            "chat_room_id": chat_room_id,
+                            "message": error
+                        })
+                        continue
+                    await _handle_chat_message(connection, user, chat_room_id, frame)
                 
+            except WebSocketDisconnect:
+                raise
             except json.JSONDecodeError:
-                await websocket.send_text(json.dumps({
+                connection.send({
                     "type": "error",
                     "message": "消息格式错误"
-                }, ensure_ascii=False))
+                })
             except Exception as e:
+                if connection.closed:
+                    raise WebSocketDisconnect(status.WS_1008_POLICY_VIOLATION)
                 print(f"处理消息时出错: {e}")
-                await websocket.send_text(json.dumps({
+                connection.send({
                     "type": "error",
                     "message": "消息处理失败"
-                }, ensure_ascii=False))
-                
+                })
+    
     except WebSocketDisconnect:
-        # 断开连接
-        manager.disconnect(chat_room_id, user.id)
-        
-        # 广播用户离开通知
-        leave_notification = {
-            "type": "user_left",
-            "user_id": user.id,
-            "username": user.username,
-            "timestamp": datetime.utcnow().isoformat()
-        }
-        await manager.broadcast_to_room(chat_room_id, leave_notification)
-        
+        manager.disconnect(user.id, connection)
+        await _leave_rooms(user, set(memberships))
+    
     except Exception as e:
         print(f"WebSocket 错误: {e}")
-        manager.disconnect(chat_room_id, user.id)
+        manager.disconnect(user.id, connection)
@@ -0,0 +1,145 @@
+"""
+每日学习汇总
+
+user_daily_stats 按 (用户, 计划, 日期) 汇总打卡时长和次数，
+在打卡创建、修改、删除的同一事务中增量加减；统计、周报、打卡分析、群组统计都从这里读取，
+一年的统计最多读取 366 × 计划数 行，而不是加载全部打卡记录（包括打卡内容）。
+
+汇总出现偏差或首次上线时，用 python -m app.maintenance rebuild-daily-stats 从打卡表重建。
+"""
+from dataclasses import dataclass
+from datetime import date
+from typing import Iterable, List, Optional
+
+from sqlalchemy import delete, func, insert, select, true
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.sql import Select
+
+from app.models import Checkin, UserDailyStat
+
+stats = UserDailyStat.__table__
+
+
+@dataclass
+class DayTotal:
+    """某一天的汇总"""
+    stat_date: date
+    minutes: int
+    checkin_count: int
+
+
+@dataclass
+class PeriodTotals:
+    """一段时间的汇总，days 只包含有打卡的日期（升序）"""
+    days: List[DayTotal]
+
+    @property
+    def minutes(self) -> int:
+        return sum(day.minutes for day in self.days)
+
+    @property
+    def checkin_count(self) -> int:
+        return sum(day.checkin_count for day in self.days)
+
+    @property
+    def active_dates(self) -> set:
+        return {day.stat_date for day in self.days if day.checkin_count > 0}
+
+
+def dialect_insert(db, table):
+    """按会话的数据库类型选择支持 on_conflict_do_update 的 INSERT（PostgreSQL / SQLite）"""
+    dialect = postgresql if db.get_bind().dialect.name == "postgresql" else sqlite
+    return dialect.insert(table)
+
+
+def apply_checkin(db, user_id: int, plan_id: int, stat_date: date, minutes: int, count: int = 1):
+    """
+    把一次打卡的变化计入汇总（删除时传负数），返回待执行的语句列表，调用方在同一事务中执行
+
+    INSERT ... ON CONFLICT DO UPDATE 一条语句完成；次数减到 0 的行随后删除。
+    """
+    statement = dialect_insert(db, stats).values(
+        user_id=user_id, plan_id=plan_id, stat_date=stat_date,
+        minutes=minutes, checkin_count=count
+    )
+    statement = statement.on_conflict_do_update(
+        index_elements=[stats.c.user_id, stats.c.plan_id, stats.c.stat_date],
+        set_={
+            "minutes": stats.c.minutes + statement.excluded.minutes,
+            "checkin_count": stats.c.checkin_count + statement.excluded.checkin_count,
+        }
+    )
+    statements = [statement]
+    if count < 0:
+        statements.append(delete(stats).where(
+            stats.c.user_id == user_id,
+            stats.c.plan_id == plan_id,
+            stats.c.stat_date == stat_date,
+            stats.c.checkin_count <= 0
+        ))
+    return statements
+
+
+async def record_checkin_change(db, before: Optional[tuple] = None, after: Optional[tuple] = None):
+    """
+    按打卡修改前后的 (计划, 日期, 时长) 更新汇总，调用方负责提交
+
+    before / after 为 (user_id, plan_id, checkin_date, duration_min) 四元组；新建时 before 为空，删除时 after 为空。
+    """
+    statements = []
+    if before is not None:
+        statements += apply_checkin(db, *before[:3], minutes=-before[3], count=-1)
+    if after is not None:
+        statements += apply_checkin(db, *after[:3], minutes=after[3], count=1)
+    for statement in statements:
+        await db.execute(statement)
+
+
+def checkin_key(checkin: Checkin) -> tuple:
+    """record_checkin_change 使用的 (user_id, plan_id, checkin_date, duration_min)"""
+    return checkin.user_id, checkin.plan_id, checkin.checkin_date, checkin.duration_min
+
+
+def daily_totals_query(user_ids, start_date: date, end_date: date, plan_id: Optional[int] = None) -> Select:
+    """按 (用户, 日期) 汇总的查询，user_ids 可以是单个ID、ID列表或子查询"""
+    if isinstance(user_ids, int):
+        user_filter = stats.c.user_id == user_ids
+    else:
+        user_filter = stats.c.user_id.in_(user_ids)
+    return select(
+        stats.c.user_id,
+        stats.c.stat_date,
+        func.sum(stats.c.minutes).label("minutes"),
+        func.sum(stats.c.checkin_count).label("checkin_count")
+    ).where(
+        user_filter,
+        stats.c.stat_date >= start_date,
+        stats.c.stat_date <= end_date,
+        stats.c.plan_id == plan_id if plan_id else true()
+    ).group_by(stats.c.user_id, stats.c.stat_date).order_by(stats.c.user_id, stats.c.stat_date)
+
+
+def to_period_totals(rows: Iterable) -> PeriodTotals:
+    """把 daily_totals_query 的结果转换为 PeriodTotals"""
+    return PeriodTotals(days=[
+        DayTotal(stat_date=row.stat_date, minutes=int(row.minutes or 0), checkin_count=int(row.checkin_count or 0))
+        for row in rows
+    ])
+
+
+def rebuild_statements(user_id: Optional[int] = None) -> list:
+    """从打卡表重建汇总的语句（运维命令使用）：先删除再按 (用户, 计划, 日期) 分组写入"""
+    source = select(
+        Checkin.user_id, Checkin.plan_id, Checkin.checkin_date,
+        func.sum(Checkin.duration_min), func.count(Checkin.id)
+    ).group_by(Checkin.user_id, Checkin.plan_id, Checkin.checkin_date)
+    clear = delete(stats)
+    if user_id is not None:
+        source = source.where(Checkin.user_id == user_id)
+        clear = clear.where(stats.c.user_id == user_id)
+    return [
+        clear,
+        insert(stats).from_select(
+            ["user_id", "plan_id", "stat_date", "minutes", "checkin_count"], source
+        ),
+    ]
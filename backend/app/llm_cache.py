@@ -0,0 +1,233 @@
+"""
+大模型回复缓存
+
+周报和打卡分析的提示词完全由统计数据生成，统计没变时重新调用模型只会得到同类的回答。
+回复按内容寻址：键是（提示词模板名、模板版本、统计输入、模型）的 SHA-256，
+任何一项变化都会得到新的键，不需要主动失效；修改提示词模板时递增版本号即可。
+
+缓存值是流式输出的各段内容（非流式调用为一段），命中流式接口时逐段回放，前端体验不变。
+流式调用中途失败时不写入缓存。缓存读写出错只计数，不影响接口返回。
+未命中时经 app.services.ai.SingleFlight 合并同一键的并发调用：多个标签页或前端重试只请求一次上游，
+配置跨 worker 锁时拿到锁后再查一次缓存，其他 worker 刚生成的回复直接复用。
+
+后端（LLM_CACHE_BACKEND）：
+- memory：进程内 LRU + TTL，按条目数和总字节数淘汰（默认）
+- database：llm_response_cache 表（PostgreSQL / SQLite），多 worker 共享，
+  过期行用 python -m app.maintenance purge-llm-cache 清理
+- off：不缓存
+"""
+import hashlib
+import json
+import logging
+import os
+from datetime import datetime, timedelta
+from typing import AsyncIterator, List, Optional
+
+from sqlalchemy import delete, select
+
+from app.cache import TTLCache
+from app.daily_stats import dialect_insert
+from app.models import LLMResponseCache
+from app.services.ai import SingleFlight, llm_flights
+
+logger = logging.getLogger(__name__)
+
+MEMORY = "memory"
+DATABASE = "database"
+OFF = "off"
+
+responses = LLMResponseCache.__table__
+
+
+def cache_key(template: str, version: int, inputs: dict, model: str) -> str:
+    """由提示词模板、版本、统计输入和模型计算缓存键（输入按键排序后序列化，与字段顺序无关）"""
+    payload = json.dumps(
+        {"template": template, "version": version, "inputs": inputs, "model": model},
+        sort_keys=True, ensure_ascii=False, default=str
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _size(chunks: List[str]) -> int:
+    return sum(len(chunk.encode("utf-8")) for chunk in chunks)
+
+
+class MemoryBackend:
+    """进程内缓存，按条目数和总字节数淘汰最久未使用的回复"""
+    name = MEMORY
+
+    def __init__(self, maxsize: int = 1000, ttl: float = 86400, maxbytes: int = 16 * 1024 * 1024):
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl, weigher=_size, maxweight=maxbytes)
+
+    async def get(self, key: str) -> Optional[List[str]]:
+        return self.cache.get(key)
+
+    async def set(self, key: str, model: str, chunks: List[str]):
+        self.cache.set(key, chunks)
+
+    def get_stats(self) -> dict:
+        stats = self.cache.get_stats()
+        return {name: stats[name] for name in ("size", "maxsize", "weight", "maxweight", "ttl_seconds", "evictions")}
+
+
+class DatabaseBackend:
+    """llm_response_cache 表，多 worker 共享"""
+    name = DATABASE
+
+    def __init__(self, ttl: float = 86400, session_factory=None):
+        if session_factory is None:
+            from app.database import AsyncSessionLocal
+            session_factory = AsyncSessionLocal
+        self.ttl = ttl
+        self.session_factory = session_factory
+
+    async def get(self, key: str) -> Optional[List[str]]:
+        async with self.session_factory() as db:
+            value = (await db.execute(
+                select(responses.c.chunks).where(
+                    responses.c.cache_key == key,
+                    responses.c.expires_at > datetime.utcnow()
+                )
+            )).scalar()
+        return json.loads(value) if value is not None else None
+
+    async def set(self, key: str, model: str, chunks: List[str]):
+        now = datetime.utcnow()
+        values = {
+            "model": model,
+            "chunks": json.dumps(chunks, ensure_ascii=False),
+            "created_at": now,
+            "expires_at": now + timedelta(seconds=self.ttl),
+        }
+        async with self.session_factory() as db:
+            await db.execute(
+                dialect_insert(db, responses).values(cache_key=key, **values).on_conflict_do_update(
+                    index_elements=[responses.c.cache_key], set_=values
+                )
+            )
+            await db.commit()
+
+    def get_stats(self) -> dict:
+        return {"ttl_seconds": self.ttl}
+
+
+def purge_statement(now: Optional[datetime] = None):
+    """删除已过期的缓存行（数据库后端）"""
+    return delete(responses).where(responses.c.expires_at <= (now or datetime.utcnow()))
+
+
+class ResponseCache:
+    """带命中率统计的回复缓存，backend 为 None 时不缓存"""
+
+    def __init__(self, backend=None, flights: Optional[SingleFlight] = None):
+        self.backend = backend
+        self.flights = flights or SingleFlight()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.errors = 0
+
+    @classmethod
+    def from_env(cls) -> "ResponseCache":
+        kind = os.getenv("LLM_CACHE_BACKEND", MEMORY).strip().lower()
+        ttl = float(os.getenv("LLM_CACHE_TTL", "86400"))
+        if kind == OFF or ttl <= 0:
+            return cls(None, llm_flights)
+        if kind == MEMORY:
+            return cls(MemoryBackend(
+                maxsize=int(os.getenv("LLM_CACHE_MAX_ENTRIES", "1000")),
+                ttl=ttl,
+                maxbytes=int(os.getenv("LLM_CACHE_MAX_BYTES", str(16 * 1024 * 1024))),
+            ), llm_flights)
+        if kind == DATABASE:
+            return cls(DatabaseBackend(ttl=ttl), llm_flights)
+        raise ValueError(f"不支持的大模型缓存后端: {kind}")
+
+    async def get(self, key: str) -> Optional[List[str]]:
+        if self.backend is None:
+            return None
+        try:
+            chunks = await self.backend.get(key)
+        except Exception:
+            logger.exception("读取大模型回复缓存失败")
+            self.errors += 1
+            chunks = None
+        if chunks is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return chunks
+
+    async def set(self, key: str, model: str, chunks: List[str]):
+        if self.backend is None or not chunks:
+            return
+        try:
+            await self.backend.set(key, model, chunks)
+            self.stores += 1
+        except Exception:
+            logger.exception("写入大模型回复缓存失败")
+            self.errors += 1
+
+    async def _lookup(self, key: str) -> Optional[List[str]]:
+        """拿到跨 worker 锁后再查一次（不计入命中率）"""
+        if self.backend is None:
+            return None
+        try:
+            return await self.backend.get(key)
+        except Exception:
+            logger.exception("读取大模型回复缓存失败")
+            self.errors += 1
+            return None
+
+    async def complete(self, client, key: str, messages: List[dict], **kwargs) -> str:
+        """非流式调用：命中时直接返回缓存的回复，未命中时同一键的并发调用只请求一次上游"""
+        chunks = await self.get(key)
+        if chunks is not None:
+            return "".join(chunks)
+
+        async def fetch():
+            content = await client.complete(messages, **kwargs)
+            await self.set(key, kwargs.get("model", client.settings.model), [content])
+            return [content]
+
+        return "".join(await self.flights.do(key, fetch, recheck=lambda: self._lookup(key)))
+
+    async def stream(self, client, key: str, messages: List[dict], **kwargs) -> AsyncIterator[str]:
+        """
+        流式调用：命中时按原来的分段逐段回放
+
+        未命中时同一键的并发请求共享一次上游流式调用（后来者先收到已缓冲的分段），完整结束后写入缓存。
+        """
+        chunks = await self.get(key)
+        if chunks is not None:
+            for chunk in chunks:
+                yield chunk
+            return
+
+        async def produce():
+            received = []
+            async for chunk in client.stream(messages, **kwargs):
+                received.append(chunk)
+                yield chunk
+            await self.set(key, kwargs.get("model", client.settings.model), received)
+
+        async for chunk in self.flights.stream(key, produce, recheck=lambda: self._lookup(key)):
+            yield chunk
+
+    def get_stats(self) -> dict:
+        lookups = self.hits + self.misses
+        stats = {
+            "backend": self.backend.name if self.backend else OFF,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+            "stores": self.stores,
+            "errors": self.errors,
+        }
+        if self.backend is not None:
+            stats.update(self.backend.get_stats())
+        stats["single_flight"] = self.flights.get_stats()
+        return stats
+
+
+response_cache = ResponseCache.from_env()
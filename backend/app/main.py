@@ -1,11 +1,20 @@
+import logging
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from app.routes import auth, users, plans, checkins, groups, ai
-from app.routes import chat_rooms, chat_messages
+from app.routes import chat_rooms, chat_messages, admin
 from app.database import engine, Base, get_db
+from app.chat_websocket import manager
+from app.chat_message_writer import message_writer
+from app.chat_id_generator import worker_lease
+from app.services.ai import llm_client
+from app.report_jobs import report_jobs
 from app.models import User, Role, UserRole, Plan, Checkin, Group, GroupMember, AIWeeklyReport, APIKey
 from app.chat_models import ChatRoom, ChatRoomMember, ChatRoomJoinRequest, ChatMessage
 
+logger = logging.getLogger(__name__)
+
 app = FastAPI(title="StudySync API", version="1.0.0")
 
 app.add_middleware(
@@ -24,6 +33,14 @@ app.include_router(groups.router, prefix="/api")
 app.include_router(chat_rooms.router, prefix="/api")
 app.include_router(chat_messages.router, prefix="/api")
 app.include_router(ai.router, prefix="/api")
+app.include_router(admin.router, prefix="/api")
+
+
+@app.on_event("startup")
+def check_llm_settings():
+    # 大模型 API Key 只从环境变量读取；AI 是可选功能，缺失时只提示，AI 接口返回 503
+    if not llm_client.settings.configured:
+        logger.warning("未配置 LLM_API_KEY，AI 接口将返回 503")
 
 
 @app.on_event("startup")
@@ -47,6 +64,38 @@ def startup_event():
     db.close()
 
 
+# 周报任务状态通过 WebSocket 推送给用户
+report_jobs.status_listener = manager.send_to_user
+
+
+@app.on_event("startup")
+async def acquire_worker_id():
+    # 每个进程领取不同的消息ID worker 编号，之后才开始接收消息
+    await worker_lease.start()
+
+
+@app.on_event("startup")
+async def start_chat_broker():
+    await manager.start()
+
+
+@app.on_event("startup")
+async def start_report_jobs():
+    # 重新执行上次退出时未完成的周报任务
+    await report_jobs.start()
+
+
+@app.on_event("shutdown")
+async def stop_chat_broker():
+    await report_jobs.stop()
+    await manager.stop()
+    # 写入缓冲区中尚未落库的聊天消息
+    await message_writer.close()
+    await worker_lease.stop()
+    # 关闭大模型客户端的连接池
+    await llm_client.aclose()
+
+
 @app.get("/")
 async def root():
     return {
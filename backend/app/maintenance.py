@@ -0,0 +1,179 @@
+"""
+运维命令
+
+用法：
+    python -m app.maintenance backfill-search-tokens [--batch-size 1000]
+    python -m app.maintenance recount-unread [--chat-room-id 1]
+    python -m app.maintenance reconcile-member-counts
+    python -m app.maintenance rebuild-daily-stats [--user-id 1]
+    python -m app.maintenance rebuild-streaks [--user-id 1]
+    python -m app.maintenance purge-llm-cache
+    python -m app.maintenance generate-weekly-reports [--week-start 2024-01-01] [--workers 4]
+"""
+import argparse
+import asyncio
+from datetime import date
+
+from sqlalchemy import bindparam, select, update
+
+from .database import SessionLocal
+from .chat_models import ChatMessage
+from .chat_unread import recount_statement
+from .daily_stats import rebuild_statements
+from .llm_cache import purge_statement
+from .member_counts import reconcile_statements
+from .streaks import rebuild_streaks as rebuild_streak_rows
+from .services.message_search import search_text
+
+
+def backfill_search_tokens(batch_size: int = 1000, session_factory=SessionLocal) -> int:
+    """为 search_tokens 为空的历史消息生成分词，按消息ID分批提交，可重复执行"""
+    db = session_factory()
+    updated = 0
+    last_id = 0
+    try:
+        while True:
+            rows = db.execute(
+                select(ChatMessage.id, ChatMessage.content).filter(
+                    ChatMessage.id > last_id,
+                    ChatMessage.search_tokens.is_(None)
+                ).order_by(ChatMessage.id).limit(batch_size)
+            ).all()
+            if not rows:
+                break
+            db.execute(
+                update(ChatMessage.__table__).where(ChatMessage.__table__.c.id == bindparam("message_id")),
+                [{"message_id": message_id, "search_tokens": search_text(content)} for message_id, content in rows]
+            )
+            db.commit()
+            updated += len(rows)
+            last_id = rows[-1][0]
+            print(f"已处理 {updated} 条消息")
+    finally:
+        db.close()
+    return updated
+
+
+def recount_unread(chat_room_id=None, session_factory=SessionLocal) -> int:
+    """按已读游标重新统计成员未读数，用于修正计数偏差，返回更新的成员数"""
+    db = session_factory()
+    try:
+        result = db.execute(recount_statement(chat_room_id))
+        db.commit()
+        return result.rowcount
+    finally:
+        db.close()
+
+
+def reconcile_member_counts(session_factory=SessionLocal) -> dict:
+    """修正群聊和学习群组的成员数计数，返回各自被修正的行数"""
+    db = session_factory()
+    try:
+        chat_rooms, groups = [db.execute(statement).rowcount for statement in reconcile_statements()]
+        db.commit()
+        return {"chat_rooms": chat_rooms, "groups": groups}
+    finally:
+        db.close()
+
+
+def rebuild_daily_stats(user_id=None, session_factory=SessionLocal) -> int:
+    """从打卡表重建每日学习汇总，返回写入的汇总行数"""
+    db = session_factory()
+    try:
+        clear, fill = rebuild_statements(user_id)
+        db.execute(clear)
+        count = db.execute(fill).rowcount
+        db.commit()
+        return count
+    finally:
+        db.close()
+
+
+def rebuild_streaks(user_id=None, session_factory=SessionLocal) -> int:
+    """从每日学习汇总重建连续打卡记录，返回写入的行数"""
+    db = session_factory()
+    try:
+        count = rebuild_streak_rows(db, user_id)
+        db.commit()
+        return count
+    finally:
+        db.close()
+
+
+def purge_llm_cache(session_factory=SessionLocal) -> int:
+    """删除已过期的大模型回复缓存（数据库后端），返回删除的行数"""
+    db = session_factory()
+    try:
+        count = db.execute(purge_statement()).rowcount
+        db.commit()
+        return count
+    finally:
+        db.close()
+
+
+def generate_weekly_reports(week_start=None, workers: int = 4) -> dict:
+    """为该周有打卡的全部用户生成周报（默认上一周），返回完成和失败的任务数"""
+    from .database import async_engine
+    from .report_jobs import ReportJobQueue
+
+    async def run():
+        queue = ReportJobQueue(workers=workers)
+        try:
+            return await queue.run_batch(week_start)
+        finally:
+            await queue.stop()
+            await async_engine.dispose()
+
+    return asyncio.run(run())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="StudySync 运维命令")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    backfill = subparsers.add_parser("backfill-search-tokens", help="为历史聊天消息生成全文搜索分词")
+    backfill.add_argument("--batch-size", type=int, default=1000, help="每批处理的消息数")
+
+    recount = subparsers.add_parser("recount-unread", help="按已读游标重新统计群聊成员的未读数")
+    recount.add_argument("--chat-room-id", type=int, default=None, help="只处理该群聊（默认全部）")
+
+    subparsers.add_parser("reconcile-member-counts", help="按成员表修正群聊和学习群组的成员数")
+
+    rebuild = subparsers.add_parser("rebuild-daily-stats", help="从打卡表重建每日学习汇总")
+    rebuild.add_argument("--user-id", type=int, default=None, help="只处理该用户（默认全部）")
+
+    streaks = subparsers.add_parser("rebuild-streaks", help="从每日学习汇总重建连续打卡记录")
+    streaks.add_argument("--user-id", type=int, default=None, help="只处理该用户（默认全部）")
+
+    subparsers.add_parser("purge-llm-cache", help="删除已过期的大模型回复缓存")
+
+    reports = subparsers.add_parser("generate-weekly-reports", help="批量生成活跃用户的 AI 周报（建议夜间执行）")
+    reports.add_argument("--week-start", type=date.fromisoformat, default=None, help="周一日期（默认上一周）")
+    reports.add_argument("--workers", type=int, default=4, help="并发生成的任务数")
+
+    args = parser.parse_args(argv)
+    if args.command == "backfill-search-tokens":
+        count = backfill_search_tokens(args.batch_size)
+        print(f"完成，共更新 {count} 条消息")
+    elif args.command == "recount-unread":
+        count = recount_unread(args.chat_room_id)
+        print(f"完成，共更新 {count} 个成员的未读数")
+    elif args.command == "reconcile-member-counts":
+        fixed = reconcile_member_counts()
+        print(f"完成，修正了 {fixed['chat_rooms']} 个群聊、{fixed['groups']} 个学习群组的成员数")
+    elif args.command == "rebuild-daily-stats":
+        count = rebuild_daily_stats(args.user_id)
+        print(f"完成，共写入 {count} 行每日汇总")
+    elif args.command == "rebuild-streaks":
+        count = rebuild_streaks(args.user_id)
+        print(f"完成，共写入 {count} 行连续打卡记录")
+    elif args.command == "purge-llm-cache":
+        count = purge_llm_cache()
+        print(f"完成，共删除 {count} 条过期缓存")
+    elif args.command == "generate-weekly-reports":
+        counts = generate_weekly_reports(args.week_start, args.workers)
+        print(f"完成，生成 {counts['completed']} 份周报，失败 {counts['failed']} 份")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""
+群聊 / 学习群组成员数
+
+chat_rooms.member_count 和 groups.member_count 是冗余的成员计数，
+在成员加入、退出、被移除的同一事务中加减，读取成员数时不再 COUNT。
+
+群聊的人数上限检查合并进加一的 UPDATE（WHERE member_count < max_members）：
+数据库按行加锁串行执行，并发审批时不会超员，不需要先查再改。
+
+计数出现偏差（例如绕过接口直接改库）时，用
+python -m app.maintenance reconcile-member-counts 按成员表重新统计。
+"""
+from typing import List
+
+from sqlalchemy import func, select, update
+from sqlalchemy.sql.dml import Update
+
+from app.chat_models import ChatRoom, ChatRoomMember
+from app.models import Group, GroupMember
+
+
+def _no_sync(statement: Update) -> Update:
+    # 计数由数据库计算，不在 Python 中同步会话里的对象；需要最新值时 refresh
+    return statement.execution_options(synchronize_session=False)
+
+
+def reserve_chat_room_seat(chat_room_id: int) -> Update:
+    """群聊成员数加一；已满时不更新（rowcount 为 0）"""
+    return _no_sync(
+        update(ChatRoom).where(
+            ChatRoom.id == chat_room_id,
+            ChatRoom.member_count < ChatRoom.max_members
+        ).values(member_count=ChatRoom.member_count + 1)
+    )
+
+
+def release_chat_room_seat(chat_room_id: int) -> Update:
+    """群聊成员数减一"""
+    return _no_sync(
+        update(ChatRoom).where(
+            ChatRoom.id == chat_room_id,
+            ChatRoom.member_count > 0
+        ).values(member_count=ChatRoom.member_count - 1)
+    )
+
+
+def set_chat_room_max_members(chat_room_id: int, max_members: int) -> Update:
+    """修改人数上限；新上限小于当前成员数时不更新（rowcount 为 0）"""
+    return _no_sync(
+        update(ChatRoom).where(
+            ChatRoom.id == chat_room_id,
+            ChatRoom.member_count <= max_members
+        ).values(max_members=max_members)
+    )
+
+
+def adjust_group_member_count(group_id: int, delta: int) -> Update:
+    """学习群组成员数加减 delta"""
+    return _no_sync(
+        update(Group).where(Group.id == group_id).values(member_count=Group.member_count + delta)
+    )
+
+
+def reconcile_statements() -> List[Update]:
+    """按成员表重新统计成员数，只更新计数不一致的行"""
+    chat_room_actual = select(func.count(ChatRoomMember.id)).where(
+        ChatRoomMember.chat_room_id == ChatRoom.id
+    ).scalar_subquery()
+    group_actual = select(func.count()).select_from(GroupMember).where(
+        GroupMember.group_id == Group.id
+    ).scalar_subquery()
+    return [
+        _no_sync(update(ChatRoom).where(ChatRoom.member_count != chat_room_actual)
+                 .values(member_count=chat_room_actual)),
+        _no_sync(update(Group).where(Group.member_count != group_actual)
+                 .values(member_count=group_actual)),
+    ]
@@ -1,6 +1,6 @@
-from sqlalchemy import Column, BigInteger, Integer, String, Text, Boolean, Date, DateTime, ForeignKey, TIMESTAMP, UniqueConstraint
+from sqlalchemy import Column, BigInteger, Integer, String, Text, Boolean, Date, DateTime, ForeignKey, Index, TIMESTAMP, UniqueConstraint
 from sqlalchemy.orm import relationship
-from sqlalchemy.sql import func
+from sqlalchemy.sql import func, text
 from app.database import Base
 
 
@@ -63,6 +63,8 @@ class Checkin(Base):
     __tablename__ = "checkins"
     __table_args__ = (
         UniqueConstraint("user_id", "plan_id", "checkin_date", name="uq_user_plan_date"),
+        # 打卡记录按 (日期, ID) 倒序的游标分页，反向扫描即可
+        Index("idx_checkin_user_date_id", "user_id", "checkin_date", "id"),
     )
 
     id = Column(BigInteger, primary_key=True, index=True)
@@ -77,6 +79,31 @@ class Checkin(Base):
     plan = relationship("Plan", back_populates="checkins")
 
 
+class UserDailyStat(Base):
+    """按用户、计划、日期汇总的学习时长，由 app.daily_stats 随打卡增删改维护"""
+    __tablename__ = "user_daily_stats"
+    __table_args__ = (
+        Index("idx_user_daily_stats_user_date", "user_id", "stat_date"),
+    )
+
+    user_id = Column(BigInteger, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    plan_id = Column(BigInteger, ForeignKey("plans.id", ondelete="CASCADE"), primary_key=True)
+    stat_date = Column(Date, primary_key=True)
+    minutes = Column(Integer, nullable=False, default=0)
+    checkin_count = Column(Integer, nullable=False, default=0)
+
+
+class UserStreak(Base):
+    """连续打卡记录，plan_id 为 0 表示该用户的全部计划，由 app.streaks 维护"""
+    __tablename__ = "user_streaks"
+
+    user_id = Column(BigInteger, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    plan_id = Column(BigInteger, primary_key=True, default=0)
+    current_streak = Column(Integer, nullable=False, default=0)
+    longest_streak = Column(Integer, nullable=False, default=0)
+    last_checkin_date = Column(Date, nullable=False)
+
+
 class Group(Base):
     __tablename__ = "groups"
 
@@ -85,6 +112,7 @@ class Group(Base):
     description = Column(Text, nullable=True)
     daily_checkin_required = Column(Boolean, default=True, nullable=False)
     created_by = Column(BigInteger, ForeignKey("users.id"), nullable=False)
+    member_count = Column(Integer, default=0, server_default="0", nullable=False)  # 成员数，见 app.member_counts
     created_at = Column(TIMESTAMP(timezone=True), server_default=func.now())
     updated_at = Column(TIMESTAMP(timezone=True), server_default=func.now(), onupdate=func.now())
 
@@ -108,7 +136,8 @@ class GroupMember(Base):
 class AIWeeklyReport(Base):
     __tablename__ = "ai_weekly_reports"
 
-    id = Column(BigInteger, primary_key=True, index=True)
+    # SQLite 下 BIGINT 主键不会自增，upsert 时 id 为空会先违反 NOT NULL，因此在 SQLite 上映射为 INTEGER
+    id = Column(BigInteger().with_variant(Integer, "sqlite"), primary_key=True, index=True)
     user_id = Column(BigInteger, ForeignKey("users.id", ondelete="CASCADE"), nullable=False, index=True)
     week_start = Column(Date, nullable=False)
     week_end = Column(Date, nullable=False)
@@ -122,6 +151,45 @@ class AIWeeklyReport(Base):
 
     user = relationship("User", back_populates="ai_reports")
 
+    __table_args__ = (
+        # 每个用户每周一份周报，生成任务按该键 upsert
+        UniqueConstraint("user_id", "week_start", name="uq_ai_weekly_report_user_week"),
+    )
+
+
+class AIReportJob(Base):
+    """AI 周报后台任务，见 app.report_jobs"""
+    __tablename__ = "ai_report_jobs"
+
+    id = Column(String(36), primary_key=True)
+    user_id = Column(BigInteger, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
+    week_start = Column(Date, nullable=False)
+    week_end = Column(Date, nullable=False)
+    status = Column(String(20), nullable=False, default="pending")
+    error = Column(Text, nullable=True)
+    created_at = Column(DateTime, nullable=False)
+    started_at = Column(DateTime, nullable=True)  # 被 worker 领取的时间，超过 REPORT_JOB_STALE_SECONDS 视为该 worker 已退出
+    finished_at = Column(DateTime, nullable=True)
+
+    __table_args__ = (
+        # 同一 (用户, 周) 最多一个未完成任务，多个 worker 同时登记时只有一个能插入
+        Index("uq_ai_report_job_active", "user_id", "week_start", unique=True,
+              postgresql_where=text("status IN ('pending', 'running')"),
+              sqlite_where=text("status IN ('pending', 'running')")),
+        Index("idx_ai_report_job_status", "status"),
+    )
+
+
+class LLMResponseCache(Base):
+    """大模型回复缓存（数据库后端），键为提示词版本、统计输入和模型的哈希，见 app.llm_cache"""
+    __tablename__ = "llm_response_cache"
+
+    cache_key = Column(String(64), primary_key=True)
+    model = Column(String(100), nullable=False)
+    chunks = Column(Text, nullable=False)  # JSON 数组，按顺序保存流式输出的各段内容
+    created_at = Column(DateTime, nullable=False)
+    expires_at = Column(DateTime, nullable=False, index=True)
+
 
 class APIKey(Base):
     __tablename__ = "api_keys"
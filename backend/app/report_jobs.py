@@ -0,0 +1,368 @@
+"""
+AI 周报后台任务
+
+POST /ai/generate_report 只登记任务并立即返回任务ID，周报由进程内的后台协程生成：
+1. 任务先写入 ai_report_jobs 表（pending），再放入 asyncio 队列，由 REPORT_JOB_WORKERS 个协程处理
+2. 同一 (用户, 周) 已有未完成的任务时直接返回该任务，不重复生成
+3. 状态变化（running / completed / failed）通过 WebSocket 推送给用户（status_listener 由 app.main 注册），
+   也可以用 GET /ai/report_jobs/{task_id} 轮询
+4. 进程退出时未完成的任务留在表中，下次启动时重新入队
+5. 多个 worker 进程同时启动时都会把未完成的任务入队，执行前用
+   UPDATE ... WHERE status='pending' 按影响行数领取，每个任务只由一个 worker 执行；
+   running 超过 REPORT_JOB_STALE_SECONDS 的任务视为原 worker 已退出，可以重新领取
+
+夜间批量生成：python -m app.maintenance generate-weekly-reports [--week-start 2024-01-01]
+为该周有打卡的全部用户生成周报（默认上一周），建议用 cron 在低峰期执行。
+"""
+import asyncio
+import json
+import logging
+import os
+import uuid
+from datetime import date, datetime, timedelta
+from typing import Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import and_, func, or_, select, update
+from sqlalchemy.exc import IntegrityError
+
+from app.daily_stats import daily_totals_query, dialect_insert, to_period_totals
+from app.models import AIReportJob, AIWeeklyReport, UserDailyStat
+
+logger = logging.getLogger(__name__)
+
+PENDING = "pending"
+RUNNING = "running"
+COMPLETED = "completed"
+FAILED = "failed"
+UNFINISHED = (PENDING, RUNNING)
+
+jobs = AIReportJob.__table__
+
+
+async def build_weekly_report(db, user_id: int, week_start: date, week_end: date) -> dict:
+    """按每日汇总计算周报评分、问题和建议，按 (用户, 周) upsert 到 ai_weekly_reports（调用方负责提交）"""
+    totals = to_period_totals((await db.execute(daily_totals_query(user_id, week_start, week_end))).all())
+
+    total_hours = totals.minutes / 60
+    checkin_count = totals.checkin_count
+
+    unique_dates = len(totals.active_dates)
+    total_days = (week_end - week_start).days + 1
+    checkin_rate = (unique_dates / total_days) * 100 if total_days > 0 else 0
+
+    score = int(checkin_rate)
+    if total_hours > 10:
+        score = min(100, score + 10)
+
+    issues = []
+    suggestions = []
+
+    if checkin_count < 3:
+        issues.append("本周打卡次数较少")
+        suggestions.append("建议增加打卡频率，每天至少打卡一次")
+
+    if total_hours < 5:
+        issues.append("本周学习时长不足")
+        suggestions.append("建议每天增加学习时间，目标每周10小时以上")
+
+    if checkin_rate < 50:
+        issues.append("打卡频率不稳定")
+        suggestions.append("建议制定固定学习时间，培养学习习惯")
+
+    # 计算建议学习时长（基于用户实际表现动态调整）
+    # 基础建议：90分钟(1.5小时)，根据表现调整
+    if total_hours == 0:
+        recommended_hours = 90  # 无记录时建议从90分钟开始
+    elif checkin_rate >= 80 and total_hours >= 15:
+        recommended_hours = 180  # 表现优秀：3小时
+    elif checkin_rate >= 60 and total_hours >= 10:
+        recommended_hours = 150  # 表现良好：2.5小时
+    elif checkin_rate >= 40:
+        recommended_hours = 120  # 表现一般：2小时
+    else:
+        recommended_hours = 90  # 需要改进：1.5小时
+
+    report = {
+        "week_end": week_end,
+        "score": score,
+        "summary": "本周学习情况分析",
+        "issues": json.dumps(issues, ensure_ascii=False),
+        "suggestions": json.dumps(suggestions, ensure_ascii=False),
+        "recommended_hours": recommended_hours,
+    }
+    statement = dialect_insert(db, AIWeeklyReport.__table__).values(user_id=user_id, week_start=week_start, **report)
+    await db.execute(statement.on_conflict_do_update(
+        index_elements=["user_id", "week_start"],
+        set_={**{column: statement.excluded[column] for column in report}, "updated_at": func.now()}
+    ))
+    return report
+
+
+def _job_to_dict(row) -> dict:
+    return {
+        "task_id": row.id,
+        "user_id": row.user_id,
+        "week_start": row.week_start,
+        "week_end": row.week_end,
+        "status": row.status,
+        "error": row.error,
+        "created_at": row.created_at,
+        "finished_at": row.finished_at,
+    }
+
+
+def last_week_start(today: Optional[date] = None) -> date:
+    """上一个完整周的周一"""
+    today = today or date.today()
+    return today - timedelta(days=today.weekday() + 7)
+
+
+class ReportJobQueue:
+    """进程内周报任务队列，任务状态持久化在 ai_report_jobs 表"""
+
+    def __init__(self, workers: Optional[int] = None, session_factory=None):
+        if session_factory is None:
+            from app.database import AsyncSessionLocal
+            session_factory = AsyncSessionLocal
+        self.workers = workers if workers is not None else int(os.getenv("REPORT_JOB_WORKERS", "2"))
+        self.stale_seconds = float(os.getenv("REPORT_JOB_STALE_SECONDS", "600"))
+        self.session_factory = session_factory
+        # 状态变化时以 (user_id, 任务状态) 调用，由应用启动时注册为 WebSocket 推送
+        self.status_listener: Optional[Callable[[int, dict], Awaitable[None]]] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        # 未完成任务：(user_id, week_start) -> 任务状态，以及等待任务结束的 future
+        self._inflight: Dict[Tuple[int, date], dict] = {}
+        self._done: Dict[str, asyncio.Future] = {}
+        self._submitting: Dict[Tuple[int, date], asyncio.Future] = {}
+        self.completed = 0
+        self.failed = 0
+        self.deduplicated = 0
+        # 入队后发现已被其他 worker 领取、本进程跳过的任务数
+        self.claimed_elsewhere = 0
+
+    def _ensure_started(self):
+        # 测试等场景下事件循环可能被替换，后台任务需要跟随当前循环重新创建
+        if self._queue is None or not self._tasks or self._tasks[0].get_loop() is not asyncio.get_running_loop():
+            self._queue = asyncio.Queue()
+            self._inflight.clear()
+            self._done.clear()
+            self._submitting.clear()
+            self._tasks = [asyncio.create_task(self._run()) for _ in range(max(1, self.workers))]
+
+    async def start(self):
+        """启动工作协程，并把上次退出时未完成的任务重新入队（应用启动时调用）"""
+        self._ensure_started()
+        async with self.session_factory() as db:
+            rows = (await db.execute(
+                select(jobs).where(jobs.c.status.in_(UNFINISHED)).order_by(jobs.c.created_at)
+            )).all()
+        for row in rows:
+            self._enqueue(_job_to_dict(row))
+        return len(rows)
+
+    async def stop(self):
+        """停止工作协程，正在处理的任务留在表中，下次启动时重新执行"""
+        for task in self._tasks:
+            task.cancel()
+        for task in self._tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._tasks = []
+        self._queue = None
+
+    def _enqueue(self, job: dict):
+        self._inflight[(job["user_id"], job["week_start"])] = job
+        self._done[job["task_id"]] = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait(job)
+
+    async def submit(self, user_id: int, week_start: date, week_end: date) -> dict:
+        """登记周报任务；同一 (用户, 周) 已有未完成任务时返回该任务"""
+        self._ensure_started()
+        key = (user_id, week_start)
+        if key in self._inflight:
+            self.deduplicated += 1
+            return dict(self._inflight[key])
+        if key in self._submitting:
+            # 同一周的任务正在登记，等它的结果
+            self.deduplicated += 1
+            return dict(await asyncio.shield(self._submitting[key]))
+
+        submitting = asyncio.get_running_loop().create_future()
+        self._submitting[key] = submitting
+        try:
+            job = await self._register(user_id, week_start, week_end)
+            submitting.set_result(job)
+            return dict(job)
+        except BaseException as exc:
+            submitting.set_exception(exc)
+            # 没有其他人等待时避免“exception was never retrieved”警告
+            submitting.exception()
+            raise
+        finally:
+            del self._submitting[key]
+
+    async def _register(self, user_id: int, week_start: date, week_end: date) -> dict:
+        job = {
+            "task_id": str(uuid.uuid4()), "user_id": user_id, "week_start": week_start, "week_end": week_end,
+            "status": PENDING, "error": None, "created_at": datetime.utcnow(), "finished_at": None,
+        }
+        try:
+            async with self.session_factory() as db:
+                await db.execute(jobs.insert().values(
+                    id=job["task_id"], user_id=user_id, week_start=week_start, week_end=week_end,
+                    status=PENDING, created_at=job["created_at"]
+                ))
+                await db.commit()
+        except IntegrityError:
+            # 其他 worker 上已有未完成的任务（部分唯一索引 uq_ai_report_job_active）
+            async with self.session_factory() as db:
+                row = (await db.execute(select(jobs).where(
+                    jobs.c.user_id == user_id,
+                    jobs.c.week_start == week_start,
+                    jobs.c.status.in_(UNFINISHED)
+                ))).first()
+            if row is None:
+                raise
+            self.deduplicated += 1
+            existing = _job_to_dict(row)
+            if self._is_stale(row) and (user_id, week_start) not in self._inflight:
+                # 执行该任务的 worker 已退出，由本进程领取重新执行
+                self._enqueue(existing)
+            return existing
+        self._enqueue(job)
+        return job
+
+    async def get(self, job_id: str) -> Optional[dict]:
+        async with self.session_factory() as db:
+            row = (await db.execute(select(jobs).where(jobs.c.id == job_id))).first()
+        return _job_to_dict(row) if row is not None else None
+
+    async def wait(self, job_id: str) -> Optional[dict]:
+        """等待本进程中的任务结束，返回最终状态"""
+        future = self._done.get(job_id)
+        if future is not None:
+            await asyncio.shield(future)
+        return await self.get(job_id)
+
+    async def run_batch(self, week_start: Optional[date] = None, user_ids: Optional[Iterable[int]] = None) -> dict:
+        """为该周有打卡的全部用户（或指定用户）生成周报，等待全部完成后返回各状态的任务数"""
+        week_start = week_start or last_week_start()
+        week_end = week_start + timedelta(days=6)
+        if user_ids is None:
+            async with self.session_factory() as db:
+                user_ids = (await db.execute(
+                    select(UserDailyStat.user_id).where(
+                        UserDailyStat.stat_date >= week_start,
+                        UserDailyStat.stat_date <= week_end
+                    ).distinct().order_by(UserDailyStat.user_id)
+                )).scalars().all()
+        submitted = [await self.submit(user_id, week_start, week_end) for user_id in user_ids]
+        results = [await self.wait(job["task_id"]) for job in submitted]
+        counts = {COMPLETED: 0, FAILED: 0}
+        for job in results:
+            counts[job["status"]] = counts.get(job["status"], 0) + 1
+        return counts
+
+    async def _run(self):
+        while True:
+            job = await self._queue.get()
+            try:
+                await self._process(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("处理周报任务失败")
+            finally:
+                self._queue.task_done()
+
+    def _is_stale(self, row) -> bool:
+        return row.status == RUNNING and (
+            row.started_at is None or row.started_at < datetime.utcnow() - timedelta(seconds=self.stale_seconds)
+        )
+
+    async def _claim(self, job: dict) -> bool:
+        """领取任务：pending 或已超时的 running 改为 running，影响行数为 1 时由本进程执行"""
+        started_at = datetime.utcnow()
+        async with self.session_factory() as db:
+            result = await db.execute(update(jobs).where(
+                jobs.c.id == job["task_id"],
+                or_(
+                    jobs.c.status == PENDING,
+                    and_(jobs.c.status == RUNNING, or_(
+                        jobs.c.started_at.is_(None),
+                        jobs.c.started_at < started_at - timedelta(seconds=self.stale_seconds)
+                    ))
+                )
+            ).values(status=RUNNING, started_at=started_at))
+            await db.commit()
+        return result.rowcount == 1
+
+    async def _process(self, job: dict):
+        try:
+            claimed = await self._claim(job)
+        except Exception:
+            # 领取失败时任务仍是 pending，下次启动时重新入队
+            self._release(job, None)
+            raise
+        if not claimed:
+            # 其他 worker 已领取（多个进程启动时都会把未完成的任务入队）
+            self.claimed_elsewhere += 1
+            self._release(job, None)
+            return
+        await self._notify(job, RUNNING)
+        status, error = COMPLETED, None
+        try:
+            async with self.session_factory() as db:
+                await build_weekly_report(db, job["user_id"], job["week_start"], job["week_end"])
+                await db.commit()
+            self.completed += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception as exc:
+            logger.exception("生成周报失败: user_id=%s week_start=%s", job["user_id"], job["week_start"])
+            status, error = FAILED, str(exc)
+            self.failed += 1
+        try:
+            await self._set_status(job, status, error)
+        finally:
+            self._release(job, status)
+
+    def _release(self, job: dict, status: Optional[str]):
+        self._inflight.pop((job["user_id"], job["week_start"]), None)
+        future = self._done.pop(job["task_id"], None)
+        if future is not None and not future.done():
+            future.set_result(status)
+
+    async def _set_status(self, job: dict, status: str, error: Optional[str] = None):
+        job["finished_at"] = datetime.utcnow()
+        async with self.session_factory() as db:
+            await db.execute(update(jobs).where(jobs.c.id == job["task_id"]).values(
+                status=status, error=error, finished_at=job["finished_at"]
+            ))
+            await db.commit()
+        await self._notify(job, status, error)
+
+    async def _notify(self, job: dict, status: str, error: Optional[str] = None):
+        job.update(status=status, error=error)
+        if self.status_listener is not None:
+            try:
+                await self.status_listener(job["user_id"], {"type": "ai_report_job", **job})
+            except Exception:
+                logger.exception("推送周报任务状态失败")
+
+    def get_stats(self) -> dict:
+        return {
+            "workers": len(self._tasks),
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "in_flight": len(self._inflight),
+            "completed": self.completed,
+            "failed": self.failed,
+            "deduplicated": self.deduplicated,
+            "claimed_elsewhere": self.claimed_elsewhere,
+        }
+
+
+report_jobs = ReportJobQueue()
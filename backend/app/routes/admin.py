@@ -0,0 +1,113 @@
+from fastapi import APIRouter, Depends
+from app.database import engine, async_engine, get_pool_status, pool_metrics, async_pool_metrics
+from app.models import User
+from app.schemas import ResponseModel
+from app.auth import get_current_admin_user, user_cache
+from app.chat_websocket import manager
+from app.chat_message_writer import message_writer
+from app.chat_access import room_access
+from app.llm_cache import response_cache
+from app.report_jobs import report_jobs
+from app.sse import event_streams
+from app.services.prompts import prompts, token_usage
+
+router = APIRouter(prefix="/admin", tags=["系统管理"])
+
+
+@router.get("/db/pool", response_model=ResponseModel)
+async def get_db_pool_metrics(
+    current_user: User = Depends(get_current_admin_user)
+):
+    """
+    数据库连接池实时指标
+    
+    包含：
+    - 连接池大小、已借出连接数、溢出连接数
+    - 获取连接的等待耗时直方图（毫秒，累计计数）
+    - 等待连接池超时次数（timeouts）和其他获取失败次数（errors）
+    """
+    return ResponseModel(data={
+        "sync": get_pool_status(engine),
+        "async": get_pool_status(async_engine)
+    })
+
+
+@router.post("/db/pool/reset", response_model=ResponseModel)
+async def reset_db_pool_metrics(
+    current_user: User = Depends(get_current_admin_user)
+):
+    """清空等待耗时统计，便于压测前后对比"""
+    pool_metrics.reset()
+    async_pool_metrics.reset()
+    return ResponseModel(data={
+        "sync": get_pool_status(engine),
+        "async": get_pool_status(async_engine)
+    })
+
+
+@router.get("/chat/connections", response_model=ResponseModel)
+async def get_chat_connection_metrics(
+    current_user: User = Depends(get_current_admin_user)
+):
+    """
+    本 worker 的 WebSocket 连接指标
+    
+    包含在线连接数、发送队列积压、丢弃消息数以及因慢消费者被断开的连接数
+    """
+    return ResponseModel(data=manager.get_stats())
+
+
+@router.get("/chat/writer", response_model=ResponseModel)
+async def get_chat_writer_metrics(
+    current_user: User = Depends(get_current_admin_user)
+):
+    """聊天消息批量写入指标：缓冲区积压、已写入消息数与批次数、失败批次数"""
+    return ResponseModel(data=message_writer.get_stats())
+
+
+@router.get("/chat/access-cache", response_model=ResponseModel)
+async def get_chat_access_cache_metrics(
+    current_user: User = Depends(get_current_admin_user)
+):
+    """本 worker 的群聊权限缓存指标：条目数、命中/未命中次数、命中率、淘汰与失效次数"""
+    return ResponseModel(data=room_access.get_stats())
+
+
+@router.get("/auth/user-cache", response_model=ResponseModel)
+async def get_user_cache_metrics(
+    current_user: User = Depends(get_current_admin_user)
+):
+    """本 worker 的已认证用户缓存指标"""
+    return ResponseModel(data=user_cache.get_stats())
+
+
+@router.get("/ai/response-cache", response_model=ResponseModel)
+async def get_llm_response_cache_metrics(
+    current_user: User = Depends(get_current_admin_user)
+):
+    """本 worker 的大模型回复缓存指标：后端类型、命中/未命中次数、命中率、写入与出错次数"""
+    return ResponseModel(data=response_cache.get_stats())
+
+
+@router.get("/ai/report-jobs", response_model=ResponseModel)
+async def get_report_job_metrics(
+    current_user: User = Depends(get_current_admin_user)
+):
+    """本 worker 的周报任务队列指标：工作协程数、排队与处理中的任务数、完成/失败/去重次数"""
+    return ResponseModel(data=report_jobs.get_stats())
+
+
+@router.get("/ai/streams", response_model=ResponseModel)
+async def get_event_stream_metrics(
+    current_user: User = Depends(get_current_admin_user)
+):
+    """本 worker 的 SSE 流缓冲指标：缓冲中的流数、新开/重连补发/重新开始次数和刷新策略"""
+    return ResponseModel(data=event_streams.get_stats())
+
+
+@router.get("/ai/prompts", response_model=ResponseModel)
+async def get_prompt_metrics(
+    current_user: User = Depends(get_current_admin_user)
+):
+    """本 worker 的提示词模板（版本、估算 token 数、精简/截断次数）和按接口累计的 token 用量"""
+    return ResponseModel(data={**prompts.get_stats(), "token_usage": token_usage.get_stats()})
@@ -1,24 +1,36 @@
-from fastapi import APIRouter, Depends, HTTPException, status, Query
+from fastapi import APIRouter, Depends, HTTPException, status, Query, Header
 from fastapi.responses import StreamingResponse
-from sqlalchemy.orm import Session
-from sqlalchemy import func
-from app.database import get_db
-from app.models import User, AIWeeklyReport, Checkin
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import func, select
+from app.database import get_async_db, AsyncSessionLocal
+from app.models import User, AIWeeklyReport
+from app.daily_stats import daily_totals_query, to_period_totals
+from app.streaks import streaks_from_dates
 from app.schemas import AIReportResponse, AIReportGenerate, AIReportTaskResponse, ResponseModel, AILearningData, AICheckinAnalysisRequest, AICheckinAnalysisResponse, AICheckinStats, AICheckinPattern, AICheckinAnomaly
 from app.auth import get_current_user, api_key_auth
-from app.services.ai import deepseek_client
+from app.services.ai import llm_client
+from app.services.prompts import prompts
+from app.llm_cache import cache_key, response_cache
+from app.report_jobs import report_jobs
+from app.sse import coalesce, event_streams, wants_event_stream
 from datetime import date, datetime, timedelta
-import uuid
+from typing import Optional
 import ollama
 
 router = APIRouter(prefix="/ai", tags=["AI学习评估"])
 
 
+def require_llm():
+    """调用大模型的接口在未配置 API Key 时返回 503"""
+    if not llm_client.settings.configured:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="AI 服务未配置")
+
+
 @router.get("/weekly_report", response_model=ResponseModel)
 async def get_weekly_report(
     week_date: date = Query(None),
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     if not week_date:
         today = date.today()
@@ -27,10 +39,12 @@ async def get_weekly_report(
     week_start = week_date
     week_end = week_start + timedelta(days=6)
     
-    report = db.query(AIWeeklyReport).filter(
-        AIWeeklyReport.user_id == current_user.id,
-        AIWeeklyReport.week_start == week_start
-    ).first()
+    report = (await db.execute(
+        select(AIWeeklyReport).filter(
+            AIWeeklyReport.user_id == current_user.id,
+            AIWeeklyReport.week_start == week_start
+        )
+    )).scalars().first()
     
     if not report:
         return ResponseModel(
@@ -80,13 +94,20 @@ async def get_weekly_report(
     )
 
 
-@router.get("/weekly_report/stream")
+@router.get("/weekly_report/stream", dependencies=[Depends(require_llm)])
 async def stream_weekly_report(
     week_date: date = Query(None),
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    accept: Optional[str] = Header(None),
+    last_event_id: Optional[str] = Header(None)
 ):
-    """流式输出周报告分析结果"""
+    """流式输出周报告分析结果（Accept: text/event-stream 时为 SSE，见 app.sse）"""
+    sse = wants_event_stream(accept)
+    if sse:
+        resumed = event_streams.resume(current_user.id, last_event_id)
+        if resumed:
+            return event_streams.response(*resumed)
+    
     if not week_date:
         today = date.today()
         week_date = today - timedelta(days=today.weekday())
@@ -94,16 +115,13 @@ async def stream_weekly_report(
     week_start = week_date
     week_end = week_start + timedelta(days=6)
     
-    # 获取打卡数据
-    checkins = db.query(Checkin).filter(
-        Checkin.user_id == current_user.id,
-        Checkin.checkin_date >= week_start,
-        Checkin.checkin_date <= week_end
-    ).all()
+    # 获取打卡数据（每日汇总）；只在查询期间使用会话，流式输出期间不占用连接
+    async with AsyncSessionLocal() as db:
+        totals = to_period_totals((await db.execute(daily_totals_query(current_user.id, week_start, week_end))).all())
     
-    total_hours = sum(c.duration_min for c in checkins) / 60
-    checkin_count = len(checkins)
-    unique_dates = len(set(c.checkin_date for c in checkins))
+    total_hours = totals.minutes / 60
+    checkin_count = totals.checkin_count
+    unique_dates = len(totals.active_dates)
     total_days = (week_end - week_start).days + 1
     checkin_rate = (unique_dates / total_days) * 100 if total_days > 0 else 0
     
@@ -111,87 +129,63 @@ async def stream_weekly_report(
     if total_hours > 10:
         score = min(100, score + 10)
     
-    # 构建AI分析prompt
-    prompt = f"""你作为专业的学习教练AI，请基于以下学习数据，为用户提供详细的周学习评估报告：
-
-分析期间：{week_start} 至 {week_end}
-总打卡次数：{checkin_count}次
-总学习时长：{total_hours:.1f}小时
-打卡率：{checkin_rate:.1f}%
-
-请提供：
-1. 学习评分（总分、打卡频率、学习时长、学习稳定性）
-2. 学习总结（打卡频率、学习趋势、稳定性）
-3. 存在问题
-4. 改进建议
-5. 推荐学习时长
-
-要求分析详细、具体，避免空泛的描述。在提供改进建议时，请参考以下专业学习策略：
-
-优先建立打卡习惯：将"每日打卡"作为学习计划的最低执行标准，确保学习行为的连续性。即使在时间紧张的情况下，也应完成至少15-20分钟的学习并进行打卡记录。建议从设定25分钟的每日最低学习时长开始，逐步培养稳定的学习习惯，使学习成为日常生活中不可或缺的一部分。
-
-制定固定学习时段：在每日时间表中规划并固定一个30-60分钟的专属学习时段，选择不易被打扰的时间段，如早晨起床后、午休后或晚上睡前。通过持续在固定时间进行学习，建立条件反射和生物钟，提高学习效率和习惯养成速度。
-
-采用微学习策略：针对时间碎片化的情况，实施微学习策略以维持学习连贯性。可在通勤途中收听课程音频、利用排队等待时间记忆核心知识点、睡前10分钟回顾当日学习内容等。所有微学习活动均需记录并计入打卡系统，确保学习热度不中断。
-
-增强计划与记录体系：建立周计划与日任务的双层规划系统。每周初制定明确的学习主题和时间分配方案；每日学习前设定具体可执行的任务目标，如"完成第一章第二节阅读并制作思维导图笔记"，避免模糊的"学习一会儿"等非具体目标。学习结束后进行任务完成情况记录与反思。
-
-利用周末进行整合提升：针对工作日时间有限的特点，合理规划周末学习时间。建议安排2-3小时进行本周学习内容的系统复习、知识体系整理和实践练习，通过阶段性整合与巩固，强化学习效果并为下周学习做好准备。
-
-【输出格式要求】
-- 严格禁止使用任何Markdown格式元素，包括但不限于：标题符号(#)、列表标记(*、-、+)、粗体(**)、斜体(*)、链接格式([text](url))、代码块(```)、表格(|)、引用符号(>)、水平线(---)等
-- 仅返回纯文本内容，使用自然的换行和空格来组织内容结构
-- 确保文本逻辑清晰、结构合理、段落分明，具有高度可读性
-- 直接输出未经格式化的原始文本，不使用任何特殊格式标记或语法"""
+    # 构建AI分析prompt（模板见 app.services.prompts，超出 token 预算时精简学习策略参考段）
+    prompt = prompts.render(
+        "weekly_report",
+        week_start=week_start,
+        week_end=week_end,
+        checkin_count=checkin_count,
+        total_hours=total_hours,
+        checkin_rate=checkin_rate
+    )
     
-    def generate():
+    basic_data = {
+        "week_start": week_start.isoformat(),
+        "week_end": week_end.isoformat(),
+        "score": {
+            "total": score,
+            "frequency": int(checkin_rate),
+            "duration": min(100, int(total_hours * 10)),
+            "stability": int(checkin_rate)
+        }
+    }
+    # 统计数据没变时回放缓存的回复
+    key = cache_key(prompt.name, prompt.version, {
+        "week_start": week_start,
+        "week_end": week_end,
+        "checkin_count": checkin_count,
+        "total_hours": round(total_hours, 1),
+        "checkin_rate": round(checkin_rate, 1),
+        "variant": prompt.variant,
+    }, llm_client.settings.model)
+    messages = prompt.messages
+    settings = event_streams.settings
+    
+    def analysis():
+        return response_cache.stream(llm_client, key, messages, endpoint="weekly_report_stream")
+    
+    if sse:
+        async def produce(stream):
+            await stream.publish("basic", basic_data)
+            async for content in coalesce(analysis(), settings.flush_chars, settings.flush_interval):
+                await stream.publish("analysis", {"content": content})
+            await stream.publish("complete")
+        
+        return event_streams.response(event_streams.open(current_user.id, produce))
+    
+    async def generate():
         # 先输出基本统计数据
         import json
-        basic_data = {
-            "type": "basic",
-            "data": {
-                "week_start": week_start.isoformat(),
-                "week_end": week_end.isoformat(),
-                "score": {
-                    "total": score,
-                    "frequency": int(checkin_rate),
-                    "duration": min(100, int(total_hours * 10)),
-                    "stability": int(checkin_rate)
-                }
-            }
-        }
-        yield f"{json.dumps(basic_data)}\n"
+        yield f"{json.dumps({'type': 'basic', 'data': basic_data})}\n"
         
         # 使用DeepSeek API进行智能分析
         try:
-            stream = deepseek_client.chat.completions.create(
-                model="deepseek-chat",
-                messages=[{"role": "user", "content": prompt}],
-                stream=True
-            )
-            
-            full_content = ""
-            for chunk in stream:
-                content = chunk.choices[0].delta.content
-                if content:
-                    full_content += content
-                    # 每获取到一定内容就输出一次
-                    if len(full_content) > 200:
-                        analysis_data = {
-                            "type": "analysis",
-                            "data": {
-                                "content": full_content
-                            }
-                        }
-                        yield f"{json.dumps(analysis_data)}\n"
-                        full_content = ""
-            
-            # 输出剩余内容
-            if full_content:
+            # 第一段立即输出，之后每累计 200 个字符或等待超过刷新间隔输出一次
+            async for content in coalesce(analysis(), 200, settings.flush_interval):
                 analysis_data = {
                     "type": "analysis",
                     "data": {
-                        "content": full_content
+                        "content": content
                     }
                 }
                 yield f"{json.dumps(analysis_data)}\n"
@@ -216,147 +210,81 @@ async def stream_weekly_report(
 @router.post("/generate_report", response_model=ResponseModel)
 async def generate_report(
     report_data: AIReportGenerate,
-    current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    current_user: User = Depends(get_current_user)
 ):
-    user_id = current_user.id
-    
-    existing_report = db.query(AIWeeklyReport).filter(
-        AIWeeklyReport.user_id == user_id,
-        AIWeeklyReport.week_start == report_data.week_start
-    ).first()
-    
-    # 获取打卡数据
-    checkins = db.query(Checkin).filter(
-        Checkin.user_id == user_id,
-        Checkin.checkin_date >= report_data.week_start,
-        Checkin.checkin_date <= report_data.week_end
-    ).all()
-    
-    total_hours = sum(c.duration_min for c in checkins) / 60
-    checkin_count = len(checkins)
-    
-    unique_dates = len(set(c.checkin_date for c in checkins))
-    total_days = (report_data.week_end - report_data.week_start).days + 1
-    checkin_rate = (unique_dates / total_days) * 100 if total_days > 0 else 0
-    
-    score = int(checkin_rate)
-    if total_hours > 10:
-        score = min(100, score + 10)
-    
-    import json
-    
-    issues = []
-    suggestions = []
-    
-    if checkin_count < 3:
-        issues.append("本周打卡次数较少")
-        suggestions.append("建议增加打卡频率，每天至少打卡一次")
-    
-    if total_hours < 5:
-        issues.append("本周学习时长不足")
-        suggestions.append("建议每天增加学习时间，目标每周10小时以上")
-    
-    if checkin_rate < 50:
-        issues.append("打卡频率不稳定")
-        suggestions.append("建议制定固定学习时间，培养学习习惯")
-    
-    # 计算建议学习时长（基于用户实际表现动态调整）
-    # 基础建议：90分钟(1.5小时)，根据表现调整
-    if total_hours == 0:
-        recommended_hours = 90  # 无记录时建议从90分钟开始
-    elif checkin_rate >= 80 and total_hours >= 15:
-        recommended_hours = 180  # 表现优秀：3小时
-    elif checkin_rate >= 60 and total_hours >= 10:
-        recommended_hours = 150  # 表现良好：2.5小时
-    elif checkin_rate >= 40:
-        recommended_hours = 120  # 表现一般：2小时
-    else:
-        recommended_hours = 90  # 需要改进：1.5小时
-    
-    if existing_report:
-        # 更新现有报告
-        existing_report.score = score
-        existing_report.summary = "本周学习情况分析"
-        existing_report.issues = json.dumps(issues, ensure_ascii=False)
-        existing_report.suggestions = json.dumps(suggestions, ensure_ascii=False)
-        existing_report.recommended_hours = recommended_hours
-        existing_report.updated_at = datetime.now()
-        db.commit()
-    else:
-        # 创建新报告
-        new_report = AIWeeklyReport(
-            user_id=user_id,
-            week_start=report_data.week_start,
-            week_end=report_data.week_end,
-            score=score,
-            summary="本周学习情况分析",
-            issues=json.dumps(issues, ensure_ascii=False),
-            suggestions=json.dumps(suggestions, ensure_ascii=False),
-            recommended_hours=recommended_hours
-        )
-        db.add(new_report)
-        db.commit()
+    """登记周报生成任务，立即返回任务ID；同一周已有未完成的任务时返回该任务"""
+    job = await report_jobs.submit(current_user.id, report_data.week_start, report_data.week_end)
     
     return ResponseModel(
         data={
-            "task_id": str(uuid.uuid4()),
-            "status": "completed",
-            "estimated_time": 0
+            "task_id": job["task_id"],
+            "status": job["status"],
+            "estimated_time": 0 if job["status"] == "completed" else 1
         }
     )
 
 
-@router.post("/learning_coach")
+@router.get("/report_jobs/{task_id}", response_model=ResponseModel)
+async def get_report_job(
+    task_id: str,
+    current_user: User = Depends(get_current_user)
+):
+    """查询周报生成任务的状态（完成后通过 GET /ai/weekly_report 获取周报）"""
+    job = await report_jobs.get(task_id)
+    if job is None or job["user_id"] != current_user.id:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="任务不存在")
+    
+    return ResponseModel(data=job)
+
+
+@router.post("/learning_coach", dependencies=[Depends(require_llm)])
 async def learning_coach_stream(
     learning_data: AILearningData,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    accept: Optional[str] = Header(None),
+    last_event_id: Optional[str] = Header(None)
 ):
-    # 构建prompt
-    prompt = f"""你作为专业的学习教练AI，核心目标是帮助用户实现"可执行化"学习，避免泛泛而谈的建议。
-
-请基于以下学习数据，为用户提供系统化的学习指导，具体包括：
-1）精准的学习状态评估（基于实际数据，避免空泛描述）
-2）科学的下一阶段学习路线建议（需具备可操作性）
-3）详细的未来一周具体任务安排（需明确具体行动项）
-
-【输出格式要求】
-- 严格禁止使用任何Markdown格式元素，包括但不限于：标题符号(#)、列表标记(*、-、+)、粗体(**)、斜体(*)、链接格式([text](url))、代码块(```)、表格(|)、引用符号(>)、水平线(---)等
-- 仅返回纯文本内容，使用自然的换行和空格来组织内容结构
-- 确保文本逻辑清晰、结构合理、段落分明，具有高度可读性
-- 直接输出未经格式化的原始文本，不使用任何特殊格式标记或语法
-
-【学习数据】
-- 学习目标：{learning_data.learning_goal}
-- 本周总学习时长：{learning_data.weekly_total_hours}小时
-- 平均每日学习时长：{learning_data.average_daily_hours}小时
-- 目标每日学习时长：{learning_data.target_daily_hours}小时
-- 连续打卡天数：{learning_data.consecutive_checkin_days}天
-- 漏打卡天数：{learning_data.missed_checkin_days}天
-"""
-
-    def generate():
-        stream = deepseek_client.chat.completions.create(
-            model="deepseek-chat",
-            messages=[{"role": "user", "content": prompt}],
-            stream=True
-        )
-
-        for chunk in stream:
-            # DeepSeek 的流式内容在这里
-            content = chunk.choices[0].delta.content
-            if content:
-                yield content
+    """流式输出学习指导（Accept: text/event-stream 时为 SSE，见 app.sse）"""
+    sse = wants_event_stream(accept)
+    if sse:
+        resumed = event_streams.resume(current_user.id, last_event_id)
+        if resumed:
+            return event_streams.response(*resumed)
+    
+    # 构建prompt（学习目标过长时按 token 预算截断）
+    prompt = prompts.render(
+        "learning_coach",
+        learning_goal=learning_data.learning_goal,
+        weekly_total_hours=learning_data.weekly_total_hours,
+        average_daily_hours=learning_data.average_daily_hours,
+        target_daily_hours=learning_data.target_daily_hours,
+        consecutive_checkin_days=learning_data.consecutive_checkin_days,
+        missed_checkin_days=learning_data.missed_checkin_days
+    )
+    messages = prompt.messages
+    
+    if sse:
+        settings = event_streams.settings
+        
+        async def produce(stream):
+            async for content in coalesce(llm_client.stream(messages, endpoint="learning_coach"), settings.flush_chars, settings.flush_interval):
+                await stream.publish("analysis", {"content": content})
+            await stream.publish("complete")
+        
+        return event_streams.response(event_streams.open(current_user.id, produce))
+    
+    async def generate():
+        async for content in llm_client.stream(messages, endpoint="learning_coach"):
+            yield content
 
     return StreamingResponse(generate(), media_type="text/plain")
 
 
-@router.post("/checkin_analysis", response_model=ResponseModel)
+@router.post("/checkin_analysis", response_model=ResponseModel, dependencies=[Depends(require_llm)])
 async def get_checkin_analysis(
     analysis_request: AICheckinAnalysisRequest,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     # 设置默认日期范围
     if not analysis_request.start_date:
@@ -364,14 +292,12 @@ async def get_checkin_analysis(
     if not analysis_request.end_date:
         analysis_request.end_date = date.today()
     
-    # 获取用户的打卡记录
-    checkins = db.query(Checkin).filter(
-        Checkin.user_id == current_user.id,
-        Checkin.checkin_date >= analysis_request.start_date,
-        Checkin.checkin_date <= analysis_request.end_date
-    ).order_by(Checkin.checkin_date.asc()).all()
+    # 获取用户的每日打卡汇总
+    totals = to_period_totals((await db.execute(
+        daily_totals_query(current_user.id, analysis_request.start_date, analysis_request.end_date)
+    )).all())
     
-    if not checkins:
+    if not totals.days:
         return ResponseModel(
             data={
                 "period": f"{analysis_request.start_date} 至 {analysis_request.end_date}",
@@ -396,30 +322,19 @@ async def get_checkin_analysis(
         )
     
     # 基础统计分析
-    total_checkins = len(checkins)
-    total_hours = sum(c.duration_min for c in checkins) / 60
+    total_checkins = totals.checkin_count
+    total_hours = totals.minutes / 60
     
     # 计算打卡率
     total_days = (analysis_request.end_date - analysis_request.start_date).days + 1
-    checkin_dates = set(c.checkin_date for c in checkins)
+    checkin_dates = totals.active_dates
     checkin_rate = (len(checkin_dates) / total_days) * 100
     
     # 计算平均每日学习时长
     avg_daily_hours = total_hours / len(checkin_dates) if checkin_dates else 0
     
-    # 计算连续打卡天数（简化版本）
-    streak_days = 0
-    max_streak = 0
-    current_streak = 0
-    
-    for i in range(total_days):
-        current_date = analysis_request.start_date + timedelta(days=i)
-        if current_date in checkin_dates:
-            current_streak += 1
-            max_streak = max(max_streak, current_streak)
-        else:
-            current_streak = 0
-    
+    # 计算分析期间内的最长连续打卡天数（只遍历有打卡的日期）
+    max_streak = streaks_from_dates(checkin_dates).longest
     streak_days = max_streak
     
     # 计算异常打卡情况（简化版本）
@@ -468,51 +383,37 @@ async def get_checkin_analysis(
     ai_summary = basic_summary
     try:
         # 构建详细的分析prompt
-        analysis_prompt = f"""你作为专业的学习教练AI，请基于以下打卡数据进行深度分析：
-
-打卡统计：
-- 分析期间：{analysis_request.start_date} 至 {analysis_request.end_date}
-- 总打卡次数：{total_checkins}次
-- 总学习时长：{total_hours:.1f}小时
-- 平均每日学习时长：{avg_daily_hours:.1f}小时
-- 打卡率：{checkin_rate:.1f}%
-- 最长连续打卡：{streak_days}天
-- 未打卡天数：{missed_days}天
-
-请提供：
-1. 对当前学习状态的深度分析
-2. 识别出的学习模式和规律
-3. 发现的问题和改进建议
-4. 具体可行的优化方案
-
-要求分析要具体、可操作，避免空泛的建议。在提供改进建议时，请参考以下专业学习策略：
-
-优先建立打卡习惯：将"每日打卡"作为学习计划的最低执行标准，确保学习行为的连续性。即使在时间紧张的情况下，也应完成至少15-20分钟的学习并进行打卡记录。建议从设定25分钟的每日最低学习时长开始，逐步培养稳定的学习习惯，使学习成为日常生活中不可或缺的一部分。
-
-制定固定学习时段：在每日时间表中规划并固定一个30-60分钟的专属学习时段，选择不易被打扰的时间段，如早晨起床后、午休后或晚上睡前。通过持续在固定时间进行学习，建立条件反射和生物钟，提高学习效率和习惯养成速度。
-
-采用微学习策略：针对时间碎片化的情况，实施微学习策略以维持学习连贯性。可在通勤途中收听课程音频、利用排队等待时间记忆核心知识点、睡前10分钟回顾当日学习内容等。所有微学习活动均需记录并计入打卡系统，确保学习热度不中断。
-
-增强计划与记录体系：建立周计划与日任务的双层规划系统。每周初制定明确的学习主题和时间分配方案；每日学习前设定具体可执行的任务目标，如"完成第一章第二节阅读并制作思维导图笔记"，避免模糊的"学习一会儿"等非具体目标。学习结束后进行任务完成情况记录与反思。
-
-利用周末进行整合提升：针对工作日时间有限的特点，合理规划周末学习时间。建议安排2-3小时进行本周学习内容的系统复习、知识体系整理和实践练习，通过阶段性整合与巩固，强化学习效果并为下周学习做好准备。
-
-【输出格式要求】
-- 严格禁止使用任何Markdown格式元素，包括但不限于：标题符号(#)、列表标记(*、-、+)、粗体(**)、斜体(*)、链接格式([text](url))、代码块(```)、表格(|)、引用符号(>)、水平线(---)等
-- 仅返回纯文本内容，使用自然的换行和空格来组织内容结构
-- 确保文本逻辑清晰、结构合理、段落分明，具有高度可读性
-- 直接输出未经格式化的原始文本，不使用任何特殊格式标记或语法"""
+        analysis_prompt = prompts.render(
+            "checkin_analysis",
+            start_date=analysis_request.start_date,
+            end_date=analysis_request.end_date,
+            total_checkins=total_checkins,
+            total_hours=total_hours,
+            avg_daily_hours=avg_daily_hours,
+            checkin_rate=checkin_rate,
+            streak_days=streak_days,
+            missed_days=missed_days
+        )
 
-        # 使用同步调用
-        response = deepseek_client.chat.completions.create(
-            model="deepseek-chat",
-            messages=[{"role": "user", "content": analysis_prompt}],
+        key = cache_key(analysis_prompt.name, analysis_prompt.version, {
+            "start_date": analysis_request.start_date,
+            "end_date": analysis_request.end_date,
+            "total_checkins": total_checkins,
+            "total_hours": round(total_hours, 1),
+            "avg_daily_hours": round(avg_daily_hours, 1),
+            "checkin_rate": round(checkin_rate, 1),
+            "streak_days": streak_days,
+            "missed_days": missed_days,
+            "variant": analysis_prompt.variant,
+        }, llm_client.settings.model)
+        ai_summary = await response_cache.complete(
+            llm_client, key,
+            analysis_prompt.messages,
+            endpoint="checkin_analysis",
             max_tokens=2048,
             temperature=0.7
         )
         
-        ai_summary = response.choices[0].message.content
-        
         # 从AI响应中提取更多洞察和建议
         ai_lines = ai_summary.split('\n')
         for line in ai_lines:
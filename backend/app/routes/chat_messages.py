@@ -1,98 +1,160 @@
 from fastapi import APIRouter, Depends, HTTPException, status, Query, WebSocket
-from sqlalchemy.orm import Session
-from sqlalchemy import desc, func
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import desc, func, select
 from typing import Optional, List
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 
-from app.database import get_db
+from app.database import get_async_db, AsyncSessionLocal
 from app.auth import get_current_user
-from app.chat_models import ChatRoom, ChatRoomMember, ChatMessage, ChatRoomStatus
+from app.chat_models import ChatMessage
 from app.models import User
-from app.chat_websocket import chat_websocket_endpoint
+from app.chat_access import room_access
+from app.chat_message_writer import message_writer
+from app.chat_schemas import ChatReadRequest
+from app.chat_unread import mark_read, remove_message
+from app.services.message_search import (
+    ORDER_NEWEST, ORDER_RELEVANCE, InvalidSearchCursor, SearchQuery, highlight, message_search
+)
+from app.chat_websocket import chat_websocket_endpoint, manager, multiplexed_websocket_endpoint
 from app.schemas import ResponseModel
 
 router = APIRouter(prefix="/chat-rooms", tags=["聊天消息"])
 
 
+def _message_to_dict(message: ChatMessage, user: User, current_user_id: int) -> dict:
+    return {
+        "message_id": message.id,
+        "user_id": user.id,
+        "username": user.username,
+        "avatar_url": user.avatar_url,
+        "content": message.content,
+        "message_type": message.message_type,
+        "timestamp": message.created_at.isoformat(),
+        "is_own": user.id == current_user_id
+    }
+
+
+@router.post("/read")
+async def mark_messages_read(
+    read_request: ChatReadRequest,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """
+    批量上报已读位置
+
+    每个群聊的已读游标只前进不后退，返回新的已读位置和未读数；不是成员的群聊会被忽略。
+    未读数变化同时通过 WebSocket 推送给该用户的连接。
+    """
+    positions = {}
+    for position in read_request.positions:
+        positions[position.chat_room_id] = max(position.message_id, positions.get(position.chat_room_id, 0))
+    
+    # 已经推送给客户端的消息可能还在写入缓冲区中，先落库，避免落库时再次计入未读
+    await message_writer.flush(include_active=False)
+    results = await mark_read(db, current_user.id, positions)
+    
+    for item in results:
+        if item["delta"]:
+            await manager.send_to_user(current_user.id, {"type": "unread", **item})
+    
+    return ResponseModel(data={"rooms": results})
+
+
 @router.get("/{chat_room_id}/messages")
 async def get_chat_messages(
     chat_room_id: int,
-    before_id: Optional[int] = Query(None, description="获取此ID之前的消息（用于分页）"),
+    before_id: Optional[int] = Query(None, description="获取此ID之前的消息（向上翻页）"),
+    after_id: Optional[int] = Query(None, description="获取此ID之后的消息（向下翻页）"),
+    around_id: Optional[int] = Query(None, description="获取此ID前后的消息（定位到某条消息）"),
     limit: int = Query(50, ge=1, le=100, description="每页消息数量"),
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     获取群聊消息历史
     
-    支持分页加载，从最新消息开始，向上滚动加载更早的消息
+    基于消息ID的游标分页（走 (chat_room_id, id DESC) 部分索引），三个游标参数最多指定一个：
+    - 不指定：最新的 limit 条消息
+    - before_id：比该消息更早的消息，向上滚动加载
+    - after_id：比该消息更新的消息，向下滚动加载
+    - around_id：该消息及其前后的消息，用于跳转到搜索结果或引用消息
+    
+    多取一条判断是否还有更多，不再单独查询；返回的消息按时间正序排列。
     """
-    # 验证群聊存在
-    chat_room = db.query(ChatRoom).filter(
-        ChatRoom.id == chat_room_id,
-        ChatRoom.status == ChatRoomStatus.ACTIVE
-    ).first()
+    if sum(cursor is not None for cursor in (before_id, after_id, around_id)) > 1:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="before_id、after_id、around_id 只能指定一个"
+        )
     
-    if not chat_room:
+    # 验证群聊存在且用户是群聊成员（走权限缓存）
+    access = await room_access.get(db, chat_room_id, current_user.id)
+    
+    if not access.room_active:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="群聊不存在或已关闭"
         )
     
-    # 验证用户是群聊成员
-    is_member = db.query(ChatRoomMember).filter(
-        ChatRoomMember.chat_room_id == chat_room_id,
-        ChatRoomMember.user_id == current_user.id
-    ).first()
-    
-    if not is_member:
+    if not access.is_member:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="只有群聊成员才能查看消息"
         )
     
+    # 按 ID 翻页，缓冲区中未落库的消息会被之后的 after_id 跳过，先写入
+    await message_writer.flush_room(chat_room_id)
+    
     # 构建查询
-    query = db.query(ChatMessage, User).join(
+    query = select(ChatMessage, User).join(
         User, ChatMessage.user_id == User.id
     ).filter(
         ChatMessage.chat_room_id == chat_room_id,
         ChatMessage.is_deleted == False
     )
     
-    # 如果指定了before_id，获取更早的消息
-    if before_id:
-        query = query.filter(ChatMessage.id < before_id)
-    
-    # 按时间倒序，获取最新消息
-    messages = query.order_by(desc(ChatMessage.id)).limit(limit).all()
+    async def fetch_older(condition, count):
+        """按ID倒序取 count+1 条，返回 (正序消息, 是否还有更早的消息)"""
+        if condition is not None:
+            page_query = query.filter(condition)
+        else:
+            page_query = query
+        rows = (await db.execute(page_query.order_by(desc(ChatMessage.id)).limit(count + 1))).all()
+        return list(reversed(rows[:count])), len(rows) > count
+    
+    async def fetch_newer(condition, count):
+        """按ID正序取 count+1 条，返回 (正序消息, 是否还有更新的消息)"""
+        rows = (await db.execute(query.filter(condition).order_by(ChatMessage.id).limit(count + 1))).all()
+        return rows[:count], len(rows) > count
+    
+    if after_id is not None:
+        messages, has_more_after = await fetch_newer(ChatMessage.id > after_id, limit)
+        has_more_before = True
+    elif around_id is not None:
+        # 目标消息及更早的消息占一半，更新的消息占另一半
+        newer_count = limit // 2
+        older, has_more_before = await fetch_older(ChatMessage.id <= around_id, limit - newer_count)
+        newer, has_more_after = [], False
+        if newer_count:
+            newer, has_more_after = await fetch_newer(ChatMessage.id > around_id, newer_count)
+        messages = older + newer
+    elif before_id is not None:
+        messages, has_more_before = await fetch_older(ChatMessage.id < before_id, limit)
+        has_more_after = True
+    else:
+        messages, has_more_before = await fetch_older(None, limit)
+        has_more_after = False
     
-    # 转换为响应格式（反转顺序，使消息按时间正序排列）
-    messages_data = []
-    for message, user in reversed(messages):
-        messages_data.append({
-            "message_id": message.id,
-            "user_id": user.id,
-            "username": user.username,
-            "avatar_url": user.avatar_url,
-            "content": message.content,
-            "message_type": message.message_type,
-            "timestamp": message.created_at.isoformat(),
-            "is_own": user.id == current_user.id
-        })
-    
-    # 获取是否有更多消息
-    has_more = False
-    if messages:
-        oldest_id = min(m[0].id for m in messages)
-        has_more = db.query(ChatMessage).filter(
-            ChatMessage.chat_room_id == chat_room_id,
-            ChatMessage.id < oldest_id,
-            ChatMessage.is_deleted == False
-        ).first() is not None
+    messages_data = [_message_to_dict(message, user, current_user.id) for message, user in messages]
     
     return ResponseModel(data={
         "messages": messages_data,
-        "has_more": has_more,
+        "has_more": has_more_before,
+        "has_more_before": has_more_before,
+        "has_more_after": has_more_after,
+        "before_cursor": messages_data[0]["message_id"] if messages_data else None,
+        "after_cursor": messages_data[-1]["message_id"] if messages_data else None,
         "total_count": len(messages_data)
     })
 
@@ -103,37 +165,28 @@ async def send_message(
     content: str,
     message_type: str = Query("text", description="消息类型: text, image, file"),
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     发送消息（HTTP 方式，用于不支持 WebSocket 的场景）
     """
-    # 验证群聊存在
-    chat_room = db.query(ChatRoom).filter(
-        ChatRoom.id == chat_room_id,
-        ChatRoom.status == ChatRoomStatus.ACTIVE
-    ).first()
+    # 验证群聊存在且用户是群聊成员（走权限缓存）
+    access = await room_access.get(db, chat_room_id, current_user.id)
     
-    if not chat_room:
+    if not access.room_active:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="群聊不存在或已关闭"
         )
     
-    # 验证用户是群聊成员
-    member = db.query(ChatRoomMember).filter(
-        ChatRoomMember.chat_room_id == chat_room_id,
-        ChatRoomMember.user_id == current_user.id
-    ).first()
-    
-    if not member:
+    if not access.is_member:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="只有群聊成员才能发送消息"
         )
     
     # 检查是否被禁言
-    if member.is_muted:
+    if access.is_muted:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="您已被禁言，无法发送消息"
@@ -146,29 +199,21 @@ async def send_message(
             detail="消息内容不能为空"
         )
     
-    # 创建消息
-    chat_message = ChatMessage(
-        chat_room_id=chat_room_id,
-        user_id=current_user.id,
-        content=content.strip(),
-        message_type=message_type
-    )
-    db.add(chat_message)
+    # 创建消息：与 WebSocket 共用批量写入器，HTTP 请求等待消息落库后再返回
+    row = message_writer.new_message(chat_room_id, current_user.id, content.strip(), message_type)
+    await message_writer.submit(row, durable=True)
     
     # 更新最后活跃时间
-    member.last_active_at = datetime.utcnow()
-    
-    db.commit()
-    db.refresh(chat_message)
+    message_writer.touch_member(chat_room_id, current_user.id)
     
     return ResponseModel(data={
-        "message_id": chat_message.id,
+        "message_id": row["id"],
         "user_id": current_user.id,
         "username": current_user.username,
         "avatar_url": current_user.avatar_url,
-        "content": chat_message.content,
-        "message_type": chat_message.message_type,
-        "timestamp": chat_message.created_at.isoformat(),
+        "content": row["content"],
+        "message_type": row["message_type"],
+        "timestamp": row["created_at"].isoformat(),
         "is_own": True
     })
 
@@ -178,28 +223,31 @@ async def delete_message(
     chat_room_id: int,
     message_id: int,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     删除消息（仅发送者或群主/管理员可操作）
     """
-    # 验证群聊存在
-    chat_room = db.query(ChatRoom).filter(
-        ChatRoom.id == chat_room_id,
-        ChatRoom.status == ChatRoomStatus.ACTIVE
-    ).first()
+    # 验证群聊存在（走权限缓存）
+    access = await room_access.get(db, chat_room_id, current_user.id)
     
-    if not chat_room:
+    if not access.room_active:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="群聊不存在或已关闭"
         )
     
+    # 消息可能还在批量写入缓冲区中，先落库
+    if message_writer.is_pending(message_id):
+        await message_writer.flush(include_active=False)
+    
     # 获取消息
-    message = db.query(ChatMessage).filter(
-        ChatMessage.id == message_id,
-        ChatMessage.chat_room_id == chat_room_id
-    ).first()
+    message = (await db.execute(
+        select(ChatMessage).filter(
+            ChatMessage.id == message_id,
+            ChatMessage.chat_room_id == chat_room_id
+        )
+    )).scalars().first()
     
     if not message:
         raise HTTPException(
@@ -212,15 +260,9 @@ async def delete_message(
     
     if message.user_id == current_user.id:
         can_delete = True
-    else:
-        # 检查是否是群主或管理员
-        member = db.query(ChatRoomMember).filter(
-            ChatRoomMember.chat_room_id == chat_room_id,
-            ChatRoomMember.user_id == current_user.id,
-            ChatRoomMember.role.in_(["owner", "admin"])
-        ).first()
-        if member:
-            can_delete = True
+    elif access.is_manager:
+        # 群主或管理员
+        can_delete = True
     
     if not can_delete:
         raise HTTPException(
@@ -228,9 +270,11 @@ async def delete_message(
             detail="没有权限删除此消息"
         )
     
-    # 软删除
-    message.is_deleted = True
-    db.commit()
+    # 软删除，尚未读到这条消息的成员未读数减一
+    if not message.is_deleted:
+        message.is_deleted = True
+        await remove_message(db, chat_room_id, message.id, message.user_id)
+        await db.commit()
     
     return ResponseModel(data={"message": "消息已删除"})
 
@@ -238,63 +282,83 @@ async def delete_message(
 @router.get("/{chat_room_id}/messages/search")
 async def search_messages(
     chat_room_id: int,
-    keyword: str = Query(..., min_length=1, description="搜索关键词"),
+    keyword: str = Query(..., min_length=1, max_length=100, description="搜索关键词"),
+    sender_id: Optional[int] = Query(None, description="只搜索该用户发送的消息"),
+    start_date: Optional[date] = Query(None, description="开始日期（含）"),
+    end_date: Optional[date] = Query(None, description="结束日期（含）"),
+    order: str = Query(ORDER_RELEVANCE, pattern=f"^({ORDER_RELEVANCE}|{ORDER_NEWEST})$", description="排序：relevance 相关度 / newest 最新"),
+    cursor: Optional[str] = Query(None, description="上一页返回的 next_cursor"),
     limit: int = Query(20, ge=1, le=50, description="返回数量"),
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     搜索群聊消息
+
+    中文按二元词匹配，英文按单词匹配（不区分大小写），所有词都需命中；
+    结果中的 highlight 为 HTML 转义后用 <mark> 标记命中词的摘要片段。
     """
-    # 验证群聊存在
-    chat_room = db.query(ChatRoom).filter(
-        ChatRoom.id == chat_room_id,
-        ChatRoom.status == ChatRoomStatus.ACTIVE
-    ).first()
+    # 验证群聊存在且用户是群聊成员（走权限缓存）
+    access = await room_access.get(db, chat_room_id, current_user.id)
     
-    if not chat_room:
+    if not access.room_active:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="群聊不存在或已关闭"
         )
     
-    # 验证用户是群聊成员
-    is_member = db.query(ChatRoomMember).filter(
-        ChatRoomMember.chat_room_id == chat_room_id,
-        ChatRoomMember.user_id == current_user.id
-    ).first()
-    
-    if not is_member:
+    if not access.is_member:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="只有群聊成员才能搜索消息"
         )
     
-    # 搜索消息
-    messages = db.query(ChatMessage, User).join(
-        User, ChatMessage.user_id == User.id
-    ).filter(
-        ChatMessage.chat_room_id == chat_room_id,
-        ChatMessage.is_deleted == False,
-        ChatMessage.content.contains(keyword)
-    ).order_by(desc(ChatMessage.created_at)).limit(limit).all()
+    if start_date and end_date and start_date > end_date:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="开始日期不能晚于结束日期"
+        )
+    
+    query = SearchQuery(
+        chat_room_id=chat_room_id,
+        keyword=keyword,
+        limit=limit,
+        order=order,
+        cursor=cursor,
+        sender_id=sender_id,
+        start_date=start_date,
+        end_date=end_date
+    )
+    if not query.tokens:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="搜索关键词不能只包含标点或空白"
+        )
+    
+    # 消息写入是异步批量的，先把缓冲区中的消息落库，避免刚发的消息搜不到
+    await message_writer.flush(include_active=False)
+    
+    try:
+        result = await message_search.search(db, query)
+    except InvalidSearchCursor as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(e)
+        )
     
     messages_data = []
-    for message, user in messages:
-        messages_data.append({
-            "message_id": message.id,
-            "user_id": user.id,
-            "username": user.username,
-            "avatar_url": user.avatar_url,
-            "content": message.content,
-            "message_type": message.message_type,
-            "timestamp": message.created_at.isoformat(),
-            "is_own": user.id == current_user.id
-        })
+    for hit in result.hits:
+        item = _message_to_dict(hit.message, hit.user, current_user.id)
+        item["highlight"] = highlight(hit.message.content, keyword)
+        item["score"] = hit.score
+        messages_data.append(item)
     
     return ResponseModel(data={
         "messages": messages_data,
         "keyword": keyword,
+        "order": order,
+        "next_cursor": result.next_cursor,
+        "has_more": result.has_more,
         "total_count": len(messages_data)
     })
 
@@ -304,30 +368,21 @@ async def get_recent_messages(
     chat_room_id: int,
     days: int = Query(7, ge=1, le=30, description="最近几天的消息"),
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     获取最近几天的消息统计
     """
-    # 验证群聊存在
-    chat_room = db.query(ChatRoom).filter(
-        ChatRoom.id == chat_room_id,
-        ChatRoom.status == ChatRoomStatus.ACTIVE
-    ).first()
+    # 验证群聊存在且用户是群聊成员（走权限缓存）
+    access = await room_access.get(db, chat_room_id, current_user.id)
     
-    if not chat_room:
+    if not access.room_active:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="群聊不存在或已关闭"
         )
     
-    # 验证用户是群聊成员
-    is_member = db.query(ChatRoomMember).filter(
-        ChatRoomMember.chat_room_id == chat_room_id,
-        ChatRoomMember.user_id == current_user.id
-    ).first()
-    
-    if not is_member:
+    if not access.is_member:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="只有群聊成员才能查看消息统计"
@@ -338,36 +393,40 @@ async def get_recent_messages(
     start_date = end_date - timedelta(days=days)
     
     # 统计每天的消息数
-    daily_stats = db.query(
-        func.date(ChatMessage.created_at).label('date'),
-        func.count(ChatMessage.id).label('count')
-    ).filter(
-        ChatMessage.chat_room_id == chat_room_id,
-        ChatMessage.is_deleted == False,
-        ChatMessage.created_at >= start_date
-    ).group_by(
-        func.date(ChatMessage.created_at)
-    ).order_by(
-        func.date(ChatMessage.created_at)
-    ).all()
+    daily_stats = (await db.execute(
+        select(
+            func.date(ChatMessage.created_at).label('date'),
+            func.count(ChatMessage.id).label('count')
+        ).filter(
+            ChatMessage.chat_room_id == chat_room_id,
+            ChatMessage.is_deleted == False,
+            ChatMessage.created_at >= start_date
+        ).group_by(
+            func.date(ChatMessage.created_at)
+        ).order_by(
+            func.date(ChatMessage.created_at)
+        )
+    )).all()
     
     # 统计活跃用户
-    active_users = db.query(
-        ChatMessage.user_id,
-        User.username,
-        func.count(ChatMessage.id).label('message_count')
-    ).join(
-        User, ChatMessage.user_id == User.id
-    ).filter(
-        ChatMessage.chat_room_id == chat_room_id,
-        ChatMessage.is_deleted == False,
-        ChatMessage.created_at >= start_date
-    ).group_by(
-        ChatMessage.user_id,
-        User.username
-    ).order_by(
-        desc(func.count(ChatMessage.id))
-    ).limit(10).all()
+    active_users = (await db.execute(
+        select(
+            ChatMessage.user_id,
+            User.username,
+            func.count(ChatMessage.id).label('message_count')
+        ).join(
+            User, ChatMessage.user_id == User.id
+        ).filter(
+            ChatMessage.chat_room_id == chat_room_id,
+            ChatMessage.is_deleted == False,
+            ChatMessage.created_at >= start_date
+        ).group_by(
+            ChatMessage.user_id,
+            User.username
+        ).order_by(
+            desc(func.count(ChatMessage.id))
+        ).limit(10)
+    )).all()
     
     return ResponseModel(data={
         "daily_stats": [
@@ -398,9 +457,20 @@ async def websocket_endpoint(
     
     连接方式: ws://host/api/chat-rooms/ws/{chat_room_id}?token={jwt_token}
     """
-    # 获取数据库会话
-    db = next(get_db())
-    try:
-        await chat_websocket_endpoint(websocket, chat_room_id, token, db)
-    finally:
-        db.close()
+    # 端点内每次校验使用单独的短会话，连接期间不占用数据库连接
+    await chat_websocket_endpoint(websocket, chat_room_id, token, AsyncSessionLocal)
+
+
+@router.websocket("/ws")
+async def multiplexed_websocket(
+    websocket: WebSocket,
+    token: str
+):
+    """
+    多群聊 WebSocket 端点
+    
+    连接方式: ws://host/api/chat-rooms/ws?token={jwt_token}
+    连接后发送 {"type": "subscribe", "chat_room_id": id} 订阅群聊，
+    同一连接可同时订阅多个群聊，发送消息时需带上 chat_room_id。
+    """
+    await multiplexed_websocket_endpoint(websocket, token, AsyncSessionLocal)
@@ -1,15 +1,20 @@
 from fastapi import APIRouter, Depends, HTTPException, status, Query
-from sqlalchemy.orm import Session
-from sqlalchemy import func, or_
-from app.database import get_db
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import func, or_, select
+from app.database import get_async_db
 from app.models import User, Group
-from app.chat_models import ChatRoom, ChatRoomMember, ChatRoomJoinRequest, ChatRoomStatus, ChatRoomJoinStatus
+from app.chat_models import ChatMessage, ChatRoom, ChatRoomMember, ChatRoomJoinRequest, ChatRoomStatus, ChatRoomJoinStatus
 from app.chat_schemas import (
     ChatRoomCreate, ChatRoomUpdate, ChatRoomResponse, ChatRoomSearchResponse,
     ChatRoomJoinRequestCreate, ChatRoomJoinRequestResponse, ChatRoomJoinRequestReview,
     ChatRoomMembersResponse, ChatRoomMemberResponse, ChatIdSearchRequest, ChatRoomBriefResponse
 )
 from app.chat_id_generator import ChatIdGenerator
+from app.chat_access import room_access
+from app.member_counts import release_chat_room_seat, reserve_chat_room_seat, set_chat_room_max_members
+from app.chat_websocket import manager
+from app.chat_message_writer import message_writer
+from app.services.chat_room_list import list_my_chat_rooms
 from app.auth import get_current_user
 from typing import Optional, List
 
@@ -20,7 +25,7 @@ router = APIRouter(prefix="/chat-rooms", tags=["群聊"])
 async def create_chat_room(
     chat_room_data: ChatRoomCreate,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     创建群聊房间
@@ -39,7 +44,9 @@ async def create_chat_room(
     
     # 如果关联了学习群组，验证群组存在且用户是成员
     if chat_room_data.group_id:
-        group = db.query(Group).filter(Group.id == chat_room_data.group_id).first()
+        group = (await db.execute(
+            select(Group).filter(Group.id == chat_room_data.group_id)
+        )).scalars().first()
         if not group:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
@@ -48,10 +55,12 @@ async def create_chat_room(
         
         # 检查用户是否是群组成员
         from app.models import GroupMember
-        is_group_member = db.query(GroupMember).filter(
-            GroupMember.group_id == chat_room_data.group_id,
-            GroupMember.user_id == current_user.id
-        ).first()
+        is_group_member = (await db.execute(
+            select(GroupMember).filter(
+                GroupMember.group_id == chat_room_data.group_id,
+                GroupMember.user_id == current_user.id
+            )
+        )).scalars().first()
         
         if not is_group_member:
             raise HTTPException(
@@ -60,7 +69,7 @@ async def create_chat_room(
             )
     
     # 生成唯一群聊ID
-    chat_id = ChatIdGenerator.generate_unique(db)
+    chat_id = await ChatIdGenerator.generate_unique_async(db)
     if not chat_id:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -76,11 +85,12 @@ async def create_chat_room(
         group_id=chat_room_data.group_id,
         created_by=current_user.id,
         max_members=chat_room_data.max_members,
+        member_count=1,
         is_public=chat_room_data.is_public
     )
     db.add(new_chat_room)
-    db.commit()
-    db.refresh(new_chat_room)
+    await db.commit()
+    await db.refresh(new_chat_room)
     
     # 创建群主成员记录
     owner_member = ChatRoomMember(
@@ -90,7 +100,8 @@ async def create_chat_room(
         last_active_at=func.now()
     )
     db.add(owner_member)
-    db.commit()
+    await db.commit()
+    await manager.invalidate_room_access(new_chat_room.id)
     
     from app.schemas import ResponseModel
     
@@ -115,79 +126,24 @@ async def create_chat_room(
 @router.get("/my-rooms")
 async def get_my_chat_rooms(
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     获取我的群聊列表
 
-    返回：
+    返回（按最新消息倒序）：
     - created: 我创建的群聊
     - joined: 我加入的群聊
-    """
-    # 获取用户创建的所有群聊
-    created_rooms = db.query(ChatRoom).filter(
-        ChatRoom.created_by == current_user.id,
-        ChatRoom.status == ChatRoomStatus.ACTIVE
-    ).all()
-
-    # 获取用户加入的群聊（通过ChatRoomMember表）
-    joined_member_records = db.query(ChatRoomMember).filter(
-        ChatRoomMember.user_id == current_user.id
-    ).all()
-
-    joined_room_ids = [m.chat_room_id for m in joined_member_records]
-
-    # 获取加入的群聊详情（排除自己创建的）
-    joined_rooms = db.query(ChatRoom).filter(
-        ChatRoom.id.in_(joined_room_ids),
-        ChatRoom.created_by != current_user.id,
-        ChatRoom.status == ChatRoomStatus.ACTIVE
-    ).all()
-
-    # 构建返回数据
-    created_data = []
-    for room in created_rooms:
-        # 获取成员数
-        member_count = db.query(func.count(ChatRoomMember.id)).filter(
-            ChatRoomMember.chat_room_id == room.id
-        ).scalar() or 0
-
-        created_data.append({
-            "room_id": room.id,
-            "chat_id": room.chat_id,
-            "name": room.name,
-            "description": room.description,
-            "avatar_url": room.avatar_url,
-            "member_count": member_count,
-            "max_members": room.max_members,
-            "is_public": room.is_public,
-            "created_at": room.created_at
-        })
-
-    joined_data = []
-    for room in joined_rooms:
-        # 获取成员数
-        member_count = db.query(func.count(ChatRoomMember.id)).filter(
-            ChatRoomMember.chat_room_id == room.id
-        ).scalar() or 0
 
-        joined_data.append({
-            "room_id": room.id,
-            "chat_id": room.chat_id,
-            "name": room.name,
-            "description": room.description,
-            "avatar_url": room.avatar_url,
-            "member_count": member_count,
-            "max_members": room.max_members,
-            "is_public": room.is_public,
-            "created_at": room.created_at
-        })
+    每个群聊带成员数、我的角色、最新消息预览和未读数，固定两次查询，与群聊数量无关
+    """
+    rooms = await list_my_chat_rooms(db, current_user.id)
 
     from app.schemas import ResponseModel
     return ResponseModel(
         data={
-            "created": created_data,
-            "joined": joined_data
+            "created": rooms.created,
+            "joined": rooms.joined
         }
     )
 
@@ -195,16 +151,18 @@ async def get_my_chat_rooms(
 @router.get("/join-requests/pending")
 async def get_pending_join_requests(
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     获取当前用户作为群主/管理员的所有待处理入群申请
     """
     # 获取用户管理的所有群聊（群主或管理员）
-    managed_members = db.query(ChatRoomMember).filter(
-        ChatRoomMember.user_id == current_user.id,
-        ChatRoomMember.role.in_(["owner", "admin"])
-    ).all()
+    managed_members = (await db.execute(
+        select(ChatRoomMember).filter(
+            ChatRoomMember.user_id == current_user.id,
+            ChatRoomMember.role.in_(["owner", "admin"])
+        )
+    )).scalars().all()
 
     managed_room_ids = [m.chat_room_id for m in managed_members]
 
@@ -213,14 +171,16 @@ async def get_pending_join_requests(
         return ResponseModel(data={"approvals": []})
 
     # 查询这些群聊的待处理申请
-    pending_requests = db.query(ChatRoomJoinRequest, User, ChatRoom).join(
-        User, ChatRoomJoinRequest.user_id == User.id
-    ).join(
-        ChatRoom, ChatRoomJoinRequest.chat_room_id == ChatRoom.id
-    ).filter(
-        ChatRoomJoinRequest.chat_room_id.in_(managed_room_ids),
-        ChatRoomJoinRequest.status == ChatRoomJoinStatus.PENDING
-    ).order_by(ChatRoomJoinRequest.created_at.desc()).all()
+    pending_requests = (await db.execute(
+        select(ChatRoomJoinRequest, User, ChatRoom).join(
+            User, ChatRoomJoinRequest.user_id == User.id
+        ).join(
+            ChatRoom, ChatRoomJoinRequest.chat_room_id == ChatRoom.id
+        ).filter(
+            ChatRoomJoinRequest.chat_room_id.in_(managed_room_ids),
+            ChatRoomJoinRequest.status == ChatRoomJoinStatus.PENDING
+        ).order_by(ChatRoomJoinRequest.created_at.desc())
+    )).all()
 
     approvals_data = []
     for request, user, chat_room in pending_requests:
@@ -249,7 +209,7 @@ async def search_chat_rooms(
     page: int = Query(1, ge=1, description="页码"),
     page_size: int = Query(20, ge=1, le=100, description="每页数量"),
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     搜索群聊
@@ -259,7 +219,7 @@ async def search_chat_rooms(
     2. 按名称模糊搜索
     3. 只显示公开群聊或已加入的群聊
     """
-    query = db.query(ChatRoom).filter(ChatRoom.status == ChatRoomStatus.ACTIVE)
+    query = select(ChatRoom).filter(ChatRoom.status == ChatRoomStatus.ACTIVE)
     
     # 如果提供了群聊ID，进行精确匹配
     if chat_id:
@@ -280,9 +240,9 @@ async def search_chat_rooms(
         )
     
     # 只显示公开群聊或用户已加入的群聊
-    user_chat_ids = db.query(ChatRoomMember.chat_room_id).filter(
+    user_chat_ids = select(ChatRoomMember.chat_room_id).filter(
         ChatRoomMember.user_id == current_user.id
-    ).subquery()
+    )
     
     query = query.filter(
         or_(
@@ -292,31 +252,15 @@ async def search_chat_rooms(
     )
     
     # 统计总数
-    total = query.count()
+    total = await db.scalar(select(func.count()).select_from(query.subquery()))
     
     # 分页
     offset = (page - 1) * page_size
-    chat_rooms = query.offset(offset).limit(page_size).all()
-    
-    # 批量获取成员数
-    chat_room_ids = [room.id for room in chat_rooms]
-    member_counts = db.query(
-        ChatRoomMember.chat_room_id,
-        func.count(ChatRoomMember.id).label('count')
-    ).filter(
-        ChatRoomMember.chat_room_id.in_(chat_room_ids)
-    ).group_by(
-        ChatRoomMember.chat_room_id
-    ).all()
-    
-    # 构建成员数映射
-    member_count_map = {item.chat_room_id: item.count for item in member_counts}
+    chat_rooms = (await db.execute(query.offset(offset).limit(page_size))).scalars().all()
     
     # 构建响应数据
     chat_rooms_data = []
     for room in chat_rooms:
-        current_members = member_count_map.get(room.id, 0)
-        
         chat_rooms_data.append(ChatRoomResponse(
             chat_room_id=room.id,
             chat_id=room.chat_id,
@@ -326,7 +270,7 @@ async def search_chat_rooms(
             group_id=room.group_id,
             creator_id=room.created_by,
             max_members=room.max_members,
-            current_members=current_members,
+            current_members=room.member_count,
             is_public=room.is_public,
             status=room.status,
             created_at=room.created_at
@@ -347,7 +291,7 @@ async def search_chat_rooms(
 async def search_chat_room_by_id(
     chat_id: str = Query(..., min_length=6, max_length=20, description="群聊ID"),
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     通过群聊ID搜索群聊（精确匹配）
@@ -362,10 +306,12 @@ async def search_chat_room_by_id(
         )
     
     # 搜索群聊
-    chat_room = db.query(ChatRoom).filter(
-        ChatRoom.chat_id == chat_id.upper(),
-        ChatRoom.status == ChatRoomStatus.ACTIVE
-    ).first()
+    chat_room = (await db.execute(
+        select(ChatRoom).filter(
+            ChatRoom.chat_id == chat_id.upper(),
+            ChatRoom.status == ChatRoomStatus.ACTIVE
+        )
+    )).scalars().first()
     
     if not chat_room:
         raise HTTPException(
@@ -374,10 +320,12 @@ async def search_chat_room_by_id(
         )
     
     # 检查是否是公开群聊或用户已加入
-    is_member = db.query(ChatRoomMember).filter(
-        ChatRoomMember.chat_room_id == chat_room.id,
-        ChatRoomMember.user_id == current_user.id
-    ).first()
+    is_member = (await db.execute(
+        select(ChatRoomMember).filter(
+            ChatRoomMember.chat_room_id == chat_room.id,
+            ChatRoomMember.user_id == current_user.id
+        )
+    )).scalars().first()
     
     if not chat_room.is_public and not is_member:
         raise HTTPException(
@@ -385,11 +333,6 @@ async def search_chat_room_by_id(
             detail="该群聊不对外开放"
         )
     
-    # 获取当前成员数
-    current_members = db.query(ChatRoomMember).filter(
-        ChatRoomMember.chat_room_id == chat_room.id
-    ).count()
-    
     from app.schemas import ResponseModel
     return ResponseModel(
         data=ChatRoomBriefResponse(
@@ -398,7 +341,7 @@ async def search_chat_room_by_id(
             name=chat_room.name,
             description=chat_room.description,
             avatar_url=chat_room.avatar_url,
-            current_members=current_members,
+            current_members=chat_room.member_count,
             max_members=chat_room.max_members,
             is_public=chat_room.is_public
         ).model_dump()
@@ -409,16 +352,18 @@ async def search_chat_room_by_id(
 async def get_chat_room(
     chat_room_id: int,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     获取群聊详情
     """
     # 验证群聊存在
-    chat_room = db.query(ChatRoom).filter(
-        ChatRoom.id == chat_room_id,
-        ChatRoom.status == ChatRoomStatus.ACTIVE
-    ).first()
+    chat_room = (await db.execute(
+        select(ChatRoom).filter(
+            ChatRoom.id == chat_room_id,
+            ChatRoom.status == ChatRoomStatus.ACTIVE
+        )
+    )).scalars().first()
     
     if not chat_room:
         raise HTTPException(
@@ -427,21 +372,13 @@ async def get_chat_room(
         )
     
     # 检查是否是公开群聊或用户已加入
-    is_member = db.query(ChatRoomMember).filter(
-        ChatRoomMember.chat_room_id == chat_room_id,
-        ChatRoomMember.user_id == current_user.id
-    ).first()
-    
-    if not chat_room.is_public and not is_member:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="该群聊不对外开放"
-        )
-    
-    # 获取当前成员数
-    current_members = db.query(func.count(ChatRoomMember.id)).filter(
-        ChatRoomMember.chat_room_id == chat_room_id
-    ).scalar() or 0
+    if not chat_room.is_public:
+        access = await room_access.get(db, chat_room_id, current_user.id)
+        if not access.is_member:
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail="该群聊不对外开放"
+            )
     
     from app.schemas import ResponseModel
     
@@ -455,7 +392,7 @@ async def get_chat_room(
             group_id=chat_room.group_id,
             creator_id=chat_room.created_by,
             max_members=chat_room.max_members,
-            current_members=current_members,
+            current_members=chat_room.member_count,
             is_public=chat_room.is_public,
             status=chat_room.status,
             created_at=chat_room.created_at
@@ -468,16 +405,18 @@ async def update_chat_room(
     chat_room_id: int,
     update_data: ChatRoomUpdate,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     更新群聊信息（仅群主或管理员可操作）
     """
     # 验证群聊存在
-    chat_room = db.query(ChatRoom).filter(
-        ChatRoom.id == chat_room_id,
-        ChatRoom.status == ChatRoomStatus.ACTIVE
-    ).first()
+    chat_room = (await db.execute(
+        select(ChatRoom).filter(
+            ChatRoom.id == chat_room_id,
+            ChatRoom.status == ChatRoomStatus.ACTIVE
+        )
+    )).scalars().first()
     
     if not chat_room:
         raise HTTPException(
@@ -486,13 +425,9 @@ async def update_chat_room(
         )
     
     # 验证用户权限（群主或管理员）
-    member = db.query(ChatRoomMember).filter(
-        ChatRoomMember.chat_room_id == chat_room_id,
-        ChatRoomMember.user_id == current_user.id,
-        ChatRoomMember.role.in_(["owner", "admin"])
-    ).first()
+    access = await room_access.get(db, chat_room_id, current_user.id)
     
-    if not member:
+    if not access.is_manager:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="只有群主或管理员才能编辑群聊"
@@ -517,25 +452,16 @@ async def update_chat_room(
         chat_room.is_public = update_data.is_public
     
     if update_data.max_members is not None:
-        # 检查当前成员数是否超过新的上限
-        current_members = db.query(func.count(ChatRoomMember.id)).filter(
-            ChatRoomMember.chat_room_id == chat_room_id
-        ).scalar() or 0
-        
-        if update_data.max_members < current_members:
+        # 条件更新：新的上限不小于当前成员数时才生效，与并发的入群审批互斥
+        result = await db.execute(set_chat_room_max_members(chat_room_id, update_data.max_members))
+        if result.rowcount == 0:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail="新的成员上限不能小于当前成员数"
             )
-        chat_room.max_members = update_data.max_members
     
-    db.commit()
-    db.refresh(chat_room)
-    
-    # 获取当前成员数
-    current_members = db.query(func.count(ChatRoomMember.id)).filter(
-        ChatRoomMember.chat_room_id == chat_room_id
-    ).scalar() or 0
+    await db.commit()
+    await db.refresh(chat_room)
     
     from app.schemas import ResponseModel
     
@@ -549,7 +475,7 @@ async def update_chat_room(
             group_id=chat_room.group_id,
             creator_id=chat_room.created_by,
             max_members=chat_room.max_members,
-            current_members=current_members,
+            current_members=chat_room.member_count,
             is_public=chat_room.is_public,
             status=chat_room.status,
             created_at=chat_room.created_at
@@ -561,16 +487,18 @@ async def update_chat_room(
 async def delete_chat_room(
     chat_room_id: int,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     删除群聊（仅群主可操作）
     """
     # 验证群聊存在
-    chat_room = db.query(ChatRoom).filter(
-        ChatRoom.id == chat_room_id,
-        ChatRoom.status == ChatRoomStatus.ACTIVE
-    ).first()
+    chat_room = (await db.execute(
+        select(ChatRoom).filter(
+            ChatRoom.id == chat_room_id,
+            ChatRoom.status == ChatRoomStatus.ACTIVE
+        )
+    )).scalars().first()
     
     if not chat_room:
         raise HTTPException(
@@ -585,9 +513,10 @@ async def delete_chat_room(
             detail="只有群主才能删除群聊"
         )
     
-    # 软删除：将状态改为已关闭
-    chat_room.status = ChatRoomStatus.CLOSED
-    db.commit()
+    # 软删除：归档群聊，之后按 ACTIVE 查询的接口都视为已关闭
+    chat_room.status = ChatRoomStatus.ARCHIVED
+    await db.commit()
+    await manager.invalidate_room_access(chat_room_id, revoke="群聊已删除")
     
     from app.schemas import ResponseModel
     return ResponseModel(data={"message": "群聊已成功删除"})
@@ -597,7 +526,7 @@ async def delete_chat_room(
 async def leave_chat_room(
     chat_room_id: int,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     退出群聊
@@ -606,10 +535,12 @@ async def leave_chat_room(
     - 群主不能直接退出，需要先转让群主或删除群聊
     """
     # 验证群聊存在
-    chat_room = db.query(ChatRoom).filter(
-        ChatRoom.id == chat_room_id,
-        ChatRoom.status == ChatRoomStatus.ACTIVE
-    ).first()
+    chat_room = (await db.execute(
+        select(ChatRoom).filter(
+            ChatRoom.id == chat_room_id,
+            ChatRoom.status == ChatRoomStatus.ACTIVE
+        )
+    )).scalars().first()
     
     if not chat_room:
         raise HTTPException(
@@ -618,10 +549,12 @@ async def leave_chat_room(
         )
     
     # 获取成员记录
-    member = db.query(ChatRoomMember).filter(
-        ChatRoomMember.chat_room_id == chat_room_id,
-        ChatRoomMember.user_id == current_user.id
-    ).first()
+    member = (await db.execute(
+        select(ChatRoomMember).filter(
+            ChatRoomMember.chat_room_id == chat_room_id,
+            ChatRoomMember.user_id == current_user.id
+        )
+    )).scalars().first()
     
     if not member:
         raise HTTPException(
@@ -637,8 +570,10 @@ async def leave_chat_room(
         )
     
     # 删除成员记录
-    db.delete(member)
-    db.commit()
+    await db.delete(member)
+    await db.execute(release_chat_room_seat(chat_room_id))
+    await db.commit()
+    await manager.invalidate_room_access(chat_room_id, current_user.id, revoke="已退出群聊")
     
     from app.schemas import ResponseModel
     return ResponseModel(data={"message": "已成功退出群聊"})
@@ -649,16 +584,18 @@ async def create_join_request(
     chat_room_id: int,
     request_data: ChatRoomJoinRequestCreate,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     发送加入群聊请求
     """
     # 验证群聊存在且活跃
-    chat_room = db.query(ChatRoom).filter(
-        ChatRoom.id == chat_room_id,
-        ChatRoom.status == ChatRoomStatus.ACTIVE
-    ).first()
+    chat_room = (await db.execute(
+        select(ChatRoom).filter(
+            ChatRoom.id == chat_room_id,
+            ChatRoom.status == ChatRoomStatus.ACTIVE
+        )
+    )).scalars().first()
     
     if not chat_room:
         raise HTTPException(
@@ -667,10 +604,12 @@ async def create_join_request(
         )
     
     # 检查是否已加入
-    existing_member = db.query(ChatRoomMember).filter(
-        ChatRoomMember.chat_room_id == chat_room_id,
-        ChatRoomMember.user_id == current_user.id
-    ).first()
+    existing_member = (await db.execute(
+        select(ChatRoomMember).filter(
+            ChatRoomMember.chat_room_id == chat_room_id,
+            ChatRoomMember.user_id == current_user.id
+        )
+    )).scalars().first()
     
     if existing_member:
         raise HTTPException(
@@ -679,11 +618,13 @@ async def create_join_request(
         )
     
     # 检查是否已有待处理的申请
-    existing_pending_request = db.query(ChatRoomJoinRequest).filter(
-        ChatRoomJoinRequest.chat_room_id == chat_room_id,
-        ChatRoomJoinRequest.user_id == current_user.id,
-        ChatRoomJoinRequest.status == ChatRoomJoinStatus.PENDING
-    ).first()
+    existing_pending_request = (await db.execute(
+        select(ChatRoomJoinRequest).filter(
+            ChatRoomJoinRequest.chat_room_id == chat_room_id,
+            ChatRoomJoinRequest.user_id == current_user.id,
+            ChatRoomJoinRequest.status == ChatRoomJoinStatus.PENDING
+        )
+    )).scalars().first()
     
     if existing_pending_request:
         raise HTTPException(
@@ -692,22 +633,20 @@ async def create_join_request(
         )
     
     # 检查是否有已处理（approved/rejected/cancelled）的申请，如果有则删除旧记录
-    existing_old_request = db.query(ChatRoomJoinRequest).filter(
-        ChatRoomJoinRequest.chat_room_id == chat_room_id,
-        ChatRoomJoinRequest.user_id == current_user.id,
-        ChatRoomJoinRequest.status.in_([ChatRoomJoinStatus.APPROVED, ChatRoomJoinStatus.REJECTED, ChatRoomJoinStatus.CANCELLED])
-    ).first()
+    existing_old_request = (await db.execute(
+        select(ChatRoomJoinRequest).filter(
+            ChatRoomJoinRequest.chat_room_id == chat_room_id,
+            ChatRoomJoinRequest.user_id == current_user.id,
+            ChatRoomJoinRequest.status.in_([ChatRoomJoinStatus.APPROVED, ChatRoomJoinStatus.REJECTED, ChatRoomJoinStatus.CANCELLED])
+        )
+    )).scalars().first()
     
     if existing_old_request:
-        db.delete(existing_old_request)
-        db.commit()
-    
-    # 检查群聊是否已满
-    current_members = db.query(func.count(ChatRoomMember.id)).filter(
-        ChatRoomMember.chat_room_id == chat_room_id
-    ).scalar() or 0
+        await db.delete(existing_old_request)
+        await db.commit()
     
-    if current_members >= chat_room.max_members:
+    # 检查群聊是否已满（审批时会再次原子地检查）
+    if chat_room.member_count >= chat_room.max_members:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="群聊成员已满"
@@ -721,8 +660,8 @@ async def create_join_request(
         status=ChatRoomJoinStatus.PENDING
     )
     db.add(join_request)
-    db.commit()
-    db.refresh(join_request)
+    await db.commit()
+    await db.refresh(join_request)
     
     from app.schemas import ResponseModel
     return ResponseModel(
@@ -749,13 +688,15 @@ async def get_join_requests(
     chat_room_id: int,
     status_filter: Optional[ChatRoomJoinStatus] = Query(None, description="筛选状态"),
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     获取群聊加入请求列表（管理员/群主权限）
     """
     # 验证群聊存在
-    chat_room = db.query(ChatRoom).filter(ChatRoom.id == chat_room_id).first()
+    chat_room = (await db.execute(
+        select(ChatRoom).filter(ChatRoom.id == chat_room_id)
+    )).scalars().first()
     if not chat_room:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -763,11 +704,13 @@ async def get_join_requests(
         )
     
     # 验证用户权限（管理员或群主）
-    member = db.query(ChatRoomMember).filter(
-        ChatRoomMember.chat_room_id == chat_room_id,
-        ChatRoomMember.user_id == current_user.id,
-        ChatRoomMember.role.in_(["owner", "admin"])
-    ).first()
+    member = (await db.execute(
+        select(ChatRoomMember).filter(
+            ChatRoomMember.chat_room_id == chat_room_id,
+            ChatRoomMember.user_id == current_user.id,
+            ChatRoomMember.role.in_(["owner", "admin"])
+        )
+    )).scalars().first()
     
     if not member:
         raise HTTPException(
@@ -776,7 +719,7 @@ async def get_join_requests(
         )
     
     # 查询加入请求
-    query = db.query(ChatRoomJoinRequest, User).join(
+    query = select(ChatRoomJoinRequest, User).join(
         User, ChatRoomJoinRequest.user_id == User.id
     ).filter(ChatRoomJoinRequest.chat_room_id == chat_room_id)
     
@@ -786,10 +729,12 @@ async def get_join_requests(
     query = query.order_by(ChatRoomJoinRequest.created_at.desc())
     
     requests_data = []
-    for request, user in query.all():
+    for request, user in (await db.execute(query)).all():
         reviewer_name = None
         if request.reviewed_by:
-            reviewer = db.query(User).filter(User.id == request.reviewed_by).first()
+            reviewer = (await db.execute(
+                select(User).filter(User.id == request.reviewed_by)
+            )).scalars().first()
             reviewer_name = reviewer.username if reviewer else None
         
         requests_data.append(ChatRoomJoinRequestResponse(
@@ -818,13 +763,15 @@ async def review_join_request(
     request_id: int,
     review_data: ChatRoomJoinRequestReview,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     审批加入请求（管理员/群主权限）
     """
     # 验证群聊存在
-    chat_room = db.query(ChatRoom).filter(ChatRoom.id == chat_room_id).first()
+    chat_room = (await db.execute(
+        select(ChatRoom).filter(ChatRoom.id == chat_room_id)
+    )).scalars().first()
     if not chat_room:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -832,11 +779,13 @@ async def review_join_request(
         )
     
     # 验证用户权限（管理员或群主）
-    member = db.query(ChatRoomMember).filter(
-        ChatRoomMember.chat_room_id == chat_room_id,
-        ChatRoomMember.user_id == current_user.id,
-        ChatRoomMember.role.in_(["owner", "admin"])
-    ).first()
+    member = (await db.execute(
+        select(ChatRoomMember).filter(
+            ChatRoomMember.chat_room_id == chat_room_id,
+            ChatRoomMember.user_id == current_user.id,
+            ChatRoomMember.role.in_(["owner", "admin"])
+        )
+    )).scalars().first()
     
     if not member:
         raise HTTPException(
@@ -845,11 +794,13 @@ async def review_join_request(
         )
     
     # 获取加入请求
-    join_request = db.query(ChatRoomJoinRequest).filter(
-        ChatRoomJoinRequest.id == request_id,
-        ChatRoomJoinRequest.chat_room_id == chat_room_id,
-        ChatRoomJoinRequest.status == ChatRoomJoinStatus.PENDING
-    ).first()
+    join_request = (await db.execute(
+        select(ChatRoomJoinRequest).filter(
+            ChatRoomJoinRequest.id == request_id,
+            ChatRoomJoinRequest.chat_room_id == chat_room_id,
+            ChatRoomJoinRequest.status == ChatRoomJoinStatus.PENDING
+        )
+    )).scalars().first()
     
     if not join_request:
         raise HTTPException(
@@ -857,13 +808,13 @@ async def review_join_request(
             detail="加入请求不存在或已处理"
         )
     
-    # 检查群聊是否已满（只在批准时检查）
+    # 批准时占用一个名额：未满才加一的条件 UPDATE，并发审批也不会超员
     if review_data.approve:
-        current_members = db.query(func.count(ChatRoomMember.id)).filter(
-            ChatRoomMember.chat_room_id == chat_room_id
-        ).scalar() or 0
-        
-        if current_members >= chat_room.max_members:
+        # 入群前发出的消息可能还在写入缓冲区中，先落库，已读游标才能覆盖到它们，
+        # 否则这些消息落库时会计入新成员的未读数
+        await message_writer.flush(include_active=False)
+        result = await db.execute(reserve_chat_room_seat(chat_room_id))
+        if result.rowcount == 0:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
                 detail="群聊成员已满"
@@ -881,15 +832,23 @@ async def review_join_request(
             chat_room_id=chat_room_id,
             user_id=join_request.user_id,
             role="member",
-            last_active_at=func.now()
+            last_active_at=func.now(),
+            # 入群之前的历史消息不计入未读
+            last_read_message_id=select(func.max(ChatMessage.id)).filter(
+                ChatMessage.chat_room_id == chat_room_id
+            ).scalar_subquery()
         )
         db.add(new_member)
     
-    db.commit()
-    db.refresh(join_request)
+    await db.commit()
+    await db.refresh(join_request)
+    if review_data.approve:
+        await manager.invalidate_room_access(chat_room_id, join_request.user_id)
     
     # 获取用户信息
-    user = db.query(User).filter(User.id == join_request.user_id).first()
+    user = (await db.execute(
+        select(User).filter(User.id == join_request.user_id)
+    )).scalars().first()
     
     from app.schemas import ResponseModel
     return ResponseModel(
@@ -915,13 +874,15 @@ async def review_join_request(
 async def get_chat_room_members(
     chat_room_id: int,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     获取群聊成员列表
     """
     # 验证群聊存在
-    chat_room = db.query(ChatRoom).filter(ChatRoom.id == chat_room_id).first()
+    chat_room = (await db.execute(
+        select(ChatRoom).filter(ChatRoom.id == chat_room_id)
+    )).scalars().first()
     if not chat_room:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -929,10 +890,12 @@ async def get_chat_room_members(
         )
     
     # 检查用户是否是群聊成员
-    is_member = db.query(ChatRoomMember).filter(
-        ChatRoomMember.chat_room_id == chat_room_id,
-        ChatRoomMember.user_id == current_user.id
-    ).first()
+    is_member = (await db.execute(
+        select(ChatRoomMember).filter(
+            ChatRoomMember.chat_room_id == chat_room_id,
+            ChatRoomMember.user_id == current_user.id
+        )
+    )).scalars().first()
     
     if not is_member:
         raise HTTPException(
@@ -941,11 +904,11 @@ async def get_chat_room_members(
         )
     
     # 获取成员列表
-    members_query = db.query(ChatRoomMember, User).join(
+    members_query = select(ChatRoomMember, User).join(
         User, ChatRoomMember.user_id == User.id
     ).filter(ChatRoomMember.chat_room_id == chat_room_id)
     
-    members = members_query.all()
+    members = (await db.execute(members_query)).all()
     
     members_data = []
     for member, user in members:
@@ -977,7 +940,7 @@ async def remove_chat_room_member(
     chat_room_id: int,
     user_id: int,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     踢出群聊成员（群主/管理员权限）
@@ -988,10 +951,12 @@ async def remove_chat_room_member(
     - 不能踢出群主
     """
     # 验证群聊存在
-    chat_room = db.query(ChatRoom).filter(
-        ChatRoom.id == chat_room_id,
-        ChatRoom.status == ChatRoomStatus.ACTIVE
-    ).first()
+    chat_room = (await db.execute(
+        select(ChatRoom).filter(
+            ChatRoom.id == chat_room_id,
+            ChatRoom.status == ChatRoomStatus.ACTIVE
+        )
+    )).scalars().first()
     if not chat_room:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -999,22 +964,21 @@ async def remove_chat_room_member(
         )
     
     # 获取当前用户的成员信息
-    current_member = db.query(ChatRoomMember).filter(
-        ChatRoomMember.chat_room_id == chat_room_id,
-        ChatRoomMember.user_id == current_user.id
-    ).first()
+    current_member = await room_access.get(db, chat_room_id, current_user.id)
     
-    if not current_member:
+    if not current_member.is_member:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="您不在该群聊中"
         )
     
     # 获取目标成员信息
-    target_member = db.query(ChatRoomMember).filter(
-        ChatRoomMember.chat_room_id == chat_room_id,
-        ChatRoomMember.user_id == user_id
-    ).first()
+    target_member = (await db.execute(
+        select(ChatRoomMember).filter(
+            ChatRoomMember.chat_room_id == chat_room_id,
+            ChatRoomMember.user_id == user_id
+        )
+    )).scalars().first()
     
     if not target_member:
         raise HTTPException(
@@ -1047,8 +1011,10 @@ async def remove_chat_room_member(
         )
     
     # 删除成员记录
-    db.delete(target_member)
-    db.commit()
+    await db.delete(target_member)
+    await db.execute(release_chat_room_seat(chat_room_id))
+    await db.commit()
+    await manager.invalidate_room_access(chat_room_id, user_id, revoke="已被移出群聊")
     
     from app.schemas import ResponseModel
     return ResponseModel(data={"message": "已成功踢出成员"})
@@ -1060,7 +1026,7 @@ async def update_member_role(
     user_id: int,
     role_data: dict,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """
     更新群聊成员角色（仅群主可操作）
@@ -1071,10 +1037,12 @@ async def update_member_role(
     - 转让群主：将群主身份转让给其他成员
     """
     # 验证群聊存在
-    chat_room = db.query(ChatRoom).filter(
-        ChatRoom.id == chat_room_id,
-        ChatRoom.status == ChatRoomStatus.ACTIVE
-    ).first()
+    chat_room = (await db.execute(
+        select(ChatRoom).filter(
+            ChatRoom.id == chat_room_id,
+            ChatRoom.status == ChatRoomStatus.ACTIVE
+        )
+    )).scalars().first()
     if not chat_room:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -1082,11 +1050,13 @@ async def update_member_role(
         )
     
     # 验证当前用户是群主
-    current_member = db.query(ChatRoomMember).filter(
-        ChatRoomMember.chat_room_id == chat_room_id,
-        ChatRoomMember.user_id == current_user.id,
-        ChatRoomMember.role == "owner"
-    ).first()
+    current_member = (await db.execute(
+        select(ChatRoomMember).filter(
+            ChatRoomMember.chat_room_id == chat_room_id,
+            ChatRoomMember.user_id == current_user.id,
+            ChatRoomMember.role == "owner"
+        )
+    )).scalars().first()
     
     if not current_member:
         raise HTTPException(
@@ -1103,10 +1073,12 @@ async def update_member_role(
         )
     
     # 获取目标成员
-    target_member = db.query(ChatRoomMember).filter(
-        ChatRoomMember.chat_room_id == chat_room_id,
-        ChatRoomMember.user_id == user_id
-    ).first()
+    target_member = (await db.execute(
+        select(ChatRoomMember).filter(
+            ChatRoomMember.chat_room_id == chat_room_id,
+            ChatRoomMember.user_id == user_id
+        )
+    )).scalars().first()
     
     if not target_member:
         raise HTTPException(
@@ -1133,7 +1105,10 @@ async def update_member_role(
         # 普通角色变更
         target_member.role = new_role
     
-    db.commit()
+    await db.commit()
+    await manager.invalidate_room_access(chat_room_id, user_id)
+    if new_role == "owner":
+        await manager.invalidate_room_access(chat_room_id, current_user.id)
     
     from app.schemas import ResponseModel
     role_text = {"owner": "群主", "admin": "管理员", "member": "普通成员"}.get(new_role, new_role)
@@ -1,26 +1,38 @@
 from fastapi import APIRouter, Depends, HTTPException, status, Query
-from sqlalchemy.orm import Session
-from sqlalchemy import func
-from app.database import get_db
-from app.models import User, Plan, Checkin, GroupMember
+from fastapi.responses import StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import case, func, select, true, tuple_
+from app.daily_stats import checkin_key, record_checkin_change
+from app.streaks import advance_group_last_checkin, record_streak_change, sync_group_last_checkin
+from app.database import get_async_db, AsyncSessionLocal
+from app.models import User, Plan, Checkin, UserDailyStat
 from app.schemas import CheckinCreate, CheckinResponse, CheckinsListResponse, TodayCheckinResponse, CheckinStatsResponse, DailyStats, ResponseModel
 from app.auth import get_current_user
 from datetime import date, timedelta
-from typing import Optional
+from typing import Optional, Tuple
+import base64
+import csv
+import io
+import json
 
 router = APIRouter(prefix="/checkins", tags=["打卡记录"])
 
+# 导出时每批从数据库读取的行数
+EXPORT_BATCH_SIZE = 1000
+
 
 @router.post("", response_model=ResponseModel)
 async def create_checkin(
     checkin_data: CheckinCreate,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
-    plan = db.query(Plan).filter(
-        Plan.id == checkin_data.plan_id,
-        Plan.user_id == current_user.id
-    ).first()
+    plan = (await db.execute(
+        select(Plan).filter(
+            Plan.id == checkin_data.plan_id,
+            Plan.user_id == current_user.id
+        )
+    )).scalars().first()
     
     if not plan:
         raise HTTPException(
@@ -30,11 +42,13 @@ async def create_checkin(
     
     checkin_date = checkin_data.checkin_date or date.today()
     
-    existing_checkin = db.query(Checkin).filter(
-        Checkin.user_id == current_user.id,
-        Checkin.plan_id == checkin_data.plan_id,
-        Checkin.checkin_date == checkin_date
-    ).first()
+    existing_checkin = (await db.execute(
+        select(Checkin).filter(
+            Checkin.user_id == current_user.id,
+            Checkin.plan_id == checkin_data.plan_id,
+            Checkin.checkin_date == checkin_date
+        )
+    )).scalars().first()
     
     if existing_checkin:
         raise HTTPException(
@@ -50,14 +64,13 @@ async def create_checkin(
         content=checkin_data.content
     )
     db.add(new_checkin)
-    db.commit()
-    db.refresh(new_checkin)
-    
-    # 更新用户在所有群组中的最后打卡日期
-    user_groups = db.query(GroupMember).filter(GroupMember.user_id == current_user.id).all()
-    for group_member in user_groups:
-        group_member.last_checkin = checkin_date
-    db.commit()
+    change = {"after": (current_user.id, checkin_data.plan_id, checkin_date, checkin_data.hours)}
+    await record_checkin_change(db, **change)
+    await record_streak_change(db, **change)
+    # 更新用户在所有群组中的最后打卡日期（同一事务）
+    await db.execute(advance_group_last_checkin(current_user.id, checkin_date))
+    await db.commit()
+    await db.refresh(new_checkin)
     
     return ResponseModel(
         data={
@@ -72,6 +85,48 @@ async def create_checkin(
     )
 
 
+def _checkin_filters(user_id, plan_id, date_filter, start_date, end_date) -> list:
+    filters = [Checkin.user_id == user_id]
+    if plan_id:
+        filters.append(Checkin.plan_id == plan_id)
+    if date_filter:
+        filters.append(Checkin.checkin_date == date_filter)
+    if start_date:
+        filters.append(Checkin.checkin_date >= start_date)
+    if end_date:
+        filters.append(Checkin.checkin_date <= end_date)
+    return filters
+
+
+def _encode_cursor(checkin_date: date, checkin_id: int) -> str:
+    payload = {"d": checkin_date.isoformat(), "id": checkin_id}
+    return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode().rstrip("=")
+
+
+def _decode_cursor(cursor: str) -> Tuple[date, int]:
+    try:
+        payload = json.loads(base64.urlsafe_b64decode((cursor + "=" * (-len(cursor) % 4)).encode()))
+        return date.fromisoformat(payload["d"]), int(payload["id"])
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="无效的分页游标"
+        )
+
+
+def _checkin_to_dict(checkin: Checkin, plan_title: str) -> dict:
+    return {
+        "checkin_id": checkin.id,
+        "user_id": checkin.user_id,
+        "plan_id": checkin.plan_id,
+        "plan_title": plan_title,
+        "hours": checkin.duration_min / 60,
+        "content": checkin.content,
+        "date": checkin.checkin_date,
+        "created_at": checkin.created_at
+    }
+
+
 @router.get("", response_model=ResponseModel)
 async def get_checkins(
     plan_id: Optional[int] = Query(None),
@@ -80,60 +135,117 @@ async def get_checkins(
     end_date: Optional[date] = Query(None),
     page: int = Query(1, ge=1),
     page_size: int = Query(20, ge=1, le=100),
+    cursor: Optional[str] = Query(None, description="上一页返回的 next_cursor，传入后忽略 page"),
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
-    query = db.query(Checkin).filter(Checkin.user_id == current_user.id)
+    """
+    查询打卡记录，按 (打卡日期, ID) 倒序，计划标题随打卡一起 JOIN 取出
+
+    翻页可以用 page，也可以用游标：cursor 传上一页的 next_cursor，
+    沿 idx_checkin_user_date_id 索引从上一页末尾继续读取，翻到多深都不需要 OFFSET；游标模式不返回 total。
+    """
+    filters = _checkin_filters(current_user.id, plan_id, date_filter, start_date, end_date)
+    query = select(Checkin, Plan.title).join(Plan, Checkin.plan_id == Plan.id).filter(*filters).order_by(
+        Checkin.checkin_date.desc(), Checkin.id.desc()
+    )
     
-    if plan_id:
-        query = query.filter(Checkin.plan_id == plan_id)
-    if date_filter:
-        query = query.filter(Checkin.checkin_date == date_filter)
-    if start_date:
-        query = query.filter(Checkin.checkin_date >= start_date)
-    if end_date:
-        query = query.filter(Checkin.checkin_date <= end_date)
+    if cursor:
+        query = query.filter(tuple_(Checkin.checkin_date, Checkin.id) < tuple_(*_decode_cursor(cursor)))
+        total = None
+    else:
+        query = query.offset((page - 1) * page_size)
+        total = await db.scalar(select(func.count(Checkin.id)).filter(*filters))
     
-    total = query.count()
-    items = query.order_by(Checkin.checkin_date.desc()).offset((page - 1) * page_size).limit(page_size).all()
+    rows = (await db.execute(query.limit(page_size + 1))).all()
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
     
-    checkins_data = []
-    for checkin in items:
-        plan_title = db.query(Plan.title).filter(Plan.id == checkin.plan_id).scalar()
-        checkins_data.append({
-            "checkin_id": checkin.id,
-            "user_id": checkin.user_id,
-            "plan_id": checkin.plan_id,
-            "plan_title": plan_title,
-            "hours": checkin.duration_min / 60,
-            "content": checkin.content,
-            "date": checkin.checkin_date,
-            "created_at": checkin.created_at
-        })
+    checkins_data = [_checkin_to_dict(checkin, plan_title) for checkin, plan_title in rows]
     
     return ResponseModel(
         data={
             "total": total,
             "page": page,
             "page_size": page_size,
-            "items": checkins_data
+            "items": checkins_data,
+            "has_more": has_more,
+            "next_cursor": _encode_cursor(rows[-1][0].checkin_date, rows[-1][0].id) if has_more else None
         }
     )
 
 
+EXPORT_COLUMNS = ["checkin_id", "plan_id", "plan_title", "date", "hours", "content", "created_at"]
+
+
+@router.get("/export")
+async def export_checkins(
+    export_format: str = Query("ndjson", alias="format", pattern="^(ndjson|csv)$"),
+    plan_id: Optional[int] = Query(None),
+    start_date: Optional[date] = Query(None),
+    end_date: Optional[date] = Query(None),
+    current_user: User = Depends(get_current_user)
+):
+    """
+    导出全部打卡记录（NDJSON 每行一条 / CSV）
+
+    用流式游标逐批读取、逐行输出，不把全部记录加载到内存。
+    响应体在依赖清理之后才开始输出，所以生成器里单独打开并关闭会话，不使用请求级会话。
+    """
+    query = select(
+        Checkin.id, Checkin.plan_id, Plan.title, Checkin.checkin_date,
+        Checkin.duration_min, Checkin.content, Checkin.created_at
+    ).join(Plan, Checkin.plan_id == Plan.id).filter(
+        *_checkin_filters(current_user.id, plan_id, None, start_date, end_date)
+    ).order_by(Checkin.checkin_date.desc(), Checkin.id.desc()).execution_options(yield_per=EXPORT_BATCH_SIZE)
+    
+    def to_values(row) -> list:
+        return [row.id, row.plan_id, row.title, row.checkin_date.isoformat(), row.duration_min / 60,
+                row.content, row.created_at.isoformat() if row.created_at else None]
+    
+    async def generate():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        if export_format == "csv":
+            writer.writerow(EXPORT_COLUMNS)
+        async with AsyncSessionLocal() as db:
+            result = await db.stream(query)
+            async for rows in result.partitions():
+                for row in rows:
+                    if export_format == "csv":
+                        writer.writerow(to_values(row))
+                    else:
+                        buffer.write(json.dumps(dict(zip(EXPORT_COLUMNS, to_values(row))), ensure_ascii=False))
+                        buffer.write("\n")
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        if buffer.tell():
+            yield buffer.getvalue()
+    
+    media_type = "text/csv; charset=utf-8" if export_format == "csv" else "application/x-ndjson"
+    filename = f"checkins.{'csv' if export_format == 'csv' else 'ndjson'}"
+    return StreamingResponse(
+        generate(), media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+
 @router.get("/today", response_model=ResponseModel)
 async def get_today_checkins(
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     today = date.today()
     
-    checkins = db.query(Checkin, Plan.title).join(
-        Plan, Checkin.plan_id == Plan.id
-    ).filter(
-        Checkin.user_id == current_user.id,
-        Checkin.checkin_date == today
-    ).all()
+    checkins = (await db.execute(
+        select(Checkin, Plan.title).join(
+            Plan, Checkin.plan_id == Plan.id
+        ).filter(
+            Checkin.user_id == current_user.id,
+            Checkin.checkin_date == today
+        )
+    )).all()
     
     checkins_data = []
     total_hours = 0
@@ -164,7 +276,7 @@ async def get_checkin_stats(
     period: str = Query("week", pattern="^(week|month|year)$"),
     plan_id: Optional[int] = Query(None),
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     today = date.today()
     
@@ -178,42 +290,37 @@ async def get_checkin_stats(
         start_date = today.replace(month=1, day=1)
         end_date = today
     
-    query = db.query(Checkin).filter(
-        Checkin.user_id == current_user.id,
-        Checkin.checkin_date >= start_date,
-        Checkin.checkin_date <= end_date
-    )
-    
-    if plan_id:
-        query = query.filter(Checkin.plan_id == plan_id)
-    
-    checkins = query.all()
-    
-    total_hours = sum(c.duration_min for c in checkins) / 60
-    checkin_count = len(checkins)
-    
-    unique_dates = len(set(c.checkin_date for c in checkins))
+    # 从每日汇总按日期分组读取；daily_stats 统计全部计划，合计只统计 plan_id 指定的计划
+    in_plan = UserDailyStat.plan_id == plan_id if plan_id else true()
+    rows = (await db.execute(
+        select(
+            UserDailyStat.stat_date,
+            func.sum(UserDailyStat.minutes).label("minutes"),
+            func.sum(UserDailyStat.checkin_count).label("checkin_count"),
+            func.sum(case((in_plan, UserDailyStat.minutes), else_=0)).label("plan_minutes"),
+            func.sum(case((in_plan, UserDailyStat.checkin_count), else_=0)).label("plan_checkin_count")
+        ).filter(
+            UserDailyStat.user_id == current_user.id,
+            UserDailyStat.stat_date >= start_date,
+            UserDailyStat.stat_date <= end_date
+        ).group_by(UserDailyStat.stat_date).order_by(UserDailyStat.stat_date)
+    )).all()
+    
+    total_hours = sum(row.plan_minutes for row in rows) / 60
+    checkin_count = sum(row.plan_checkin_count for row in rows)
+    
+    unique_dates = sum(1 for row in rows if row.plan_checkin_count > 0)
     total_days = (end_date - start_date).days + 1
     checkin_rate = (unique_dates / total_days) * 100 if total_days > 0 else 0
     avg_hours_per_day = total_hours / total_days if total_days > 0 else 0
     
-    daily_stats_query = db.query(
-        Checkin.checkin_date,
-        func.sum(Checkin.duration_min).label("hours"),
-        func.count(Checkin.id).label("checkin_count")
-    ).filter(
-        Checkin.user_id == current_user.id,
-        Checkin.checkin_date >= start_date,
-        Checkin.checkin_date <= end_date
-    ).group_by(Checkin.checkin_date).all()
-    
     daily_stats = [
         DailyStats(
-            date=d.checkin_date,
-            hours=d.hours / 60,
-            checkin_count=d.checkin_count
+            date=row.stat_date,
+            hours=row.minutes / 60,
+            checkin_count=row.checkin_count
         )
-        for d in daily_stats_query
+        for row in rows
     ]
     
     return ResponseModel(
@@ -234,13 +341,15 @@ async def update_checkin(
     checkin_id: int,
     checkin_data: CheckinCreate,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     # 查找打卡记录
-    checkin = db.query(Checkin).filter(
-        Checkin.id == checkin_id,
-        Checkin.user_id == current_user.id
-    ).first()
+    checkin = (await db.execute(
+        select(Checkin).filter(
+            Checkin.id == checkin_id,
+            Checkin.user_id == current_user.id
+        )
+    )).scalars().first()
     
     if not checkin:
         raise HTTPException(
@@ -249,10 +358,12 @@ async def update_checkin(
         )
     
     # 验证计划是否存在且属于当前用户
-    plan = db.query(Plan).filter(
-        Plan.id == checkin_data.plan_id,
-        Plan.user_id == current_user.id
-    ).first()
+    plan = (await db.execute(
+        select(Plan).filter(
+            Plan.id == checkin_data.plan_id,
+            Plan.user_id == current_user.id
+        )
+    )).scalars().first()
     
     if not plan:
         raise HTTPException(
@@ -263,12 +374,14 @@ async def update_checkin(
     checkin_date = checkin_data.checkin_date or date.today()
     
     # 检查是否与其他打卡记录冲突
-    existing_checkin = db.query(Checkin).filter(
-        Checkin.user_id == current_user.id,
-        Checkin.plan_id == checkin_data.plan_id,
-        Checkin.checkin_date == checkin_date,
-        Checkin.id != checkin_id
-    ).first()
+    existing_checkin = (await db.execute(
+        select(Checkin).filter(
+            Checkin.user_id == current_user.id,
+            Checkin.plan_id == checkin_data.plan_id,
+            Checkin.checkin_date == checkin_date,
+            Checkin.id != checkin_id
+        )
+    )).scalars().first()
     
     if existing_checkin:
         raise HTTPException(
@@ -277,19 +390,19 @@ async def update_checkin(
         )
     
     # 更新打卡记录
+    before = checkin_key(checkin)
     checkin.plan_id = checkin_data.plan_id
     checkin.checkin_date = checkin_date
     checkin.duration_min = checkin_data.hours
     checkin.content = checkin_data.content
+    change = {"before": before, "after": checkin_key(checkin)}
+    await record_checkin_change(db, **change)
+    await record_streak_change(db, **change)
+    # 更新用户在所有群组中的最后打卡日期（同一事务，日期可能改早）
+    await db.execute(sync_group_last_checkin(current_user.id))
     
-    db.commit()
-    db.refresh(checkin)
-    
-    # 更新用户在所有群组中的最后打卡日期
-    user_groups = db.query(GroupMember).filter(GroupMember.user_id == current_user.id).all()
-    for group_member in user_groups:
-        group_member.last_checkin = checkin_date
-    db.commit()
+    await db.commit()
+    await db.refresh(checkin)
     
     return ResponseModel(
         data={
@@ -308,13 +421,15 @@ async def update_checkin(
 async def delete_checkin(
     checkin_id: int,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     # 查找打卡记录
-    checkin = db.query(Checkin).filter(
-        Checkin.id == checkin_id,
-        Checkin.user_id == current_user.id
-    ).first()
+    checkin = (await db.execute(
+        select(Checkin).filter(
+            Checkin.id == checkin_id,
+            Checkin.user_id == current_user.id
+        )
+    )).scalars().first()
     
     if not checkin:
         raise HTTPException(
@@ -323,8 +438,12 @@ async def delete_checkin(
         )
     
     # 删除打卡记录
-    db.delete(checkin)
-    db.commit()
+    before = checkin_key(checkin)
+    await db.delete(checkin)
+    await record_checkin_change(db, before=before)
+    await record_streak_change(db, before=before)
+    await db.execute(sync_group_last_checkin(current_user.id))
+    await db.commit()
     
     return ResponseModel(
         data={"message": "打卡记录删除成功"}
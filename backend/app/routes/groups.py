@@ -1,10 +1,12 @@
 from fastapi import APIRouter, Depends, HTTPException, status, Query
 from sqlalchemy.orm import Session
-from sqlalchemy import func
+from sqlalchemy import and_, case, func, select
 from app.database import get_db
-from app.models import User, Group, GroupMember, Checkin
+from app.models import User, Group, GroupMember, Checkin, UserDailyStat, UserStreak
 from app.schemas import GroupCreate, GroupResponse, GroupsListResponse, GroupMembersResponse, GroupMemberResponse, GroupCheckinsResponse, GroupCheckinMember, ResponseModel, APIKeyResponse, GroupTransferRequest, GroupUpdateRequest
 from app.auth import get_current_user, api_key_auth
+from app.member_counts import adjust_group_member_count
+from app.streaks import ALL_PLANS, current_streak
 from datetime import date, timedelta
 from typing import Optional
 
@@ -12,7 +14,7 @@ router = APIRouter(prefix="/groups", tags=["学习群组"])
 
 
 @router.post("", response_model=ResponseModel)
-async def create_group(
+def create_group(
     group_data: GroupCreate,
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
@@ -37,7 +39,8 @@ async def create_group(
         name=group_data.name.strip(),
         description=group_data.description,
         daily_checkin_required=group_data.daily_checkin_required,
-        created_by=current_user.id
+        created_by=current_user.id,
+        member_count=1
     )
     db.add(new_group)
     db.commit()
@@ -67,7 +70,7 @@ async def create_group(
 
 
 @router.post("/{group_id}/join", response_model=ResponseModel)
-async def join_group(
+def join_group(
     group_id: int,
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
@@ -106,6 +109,7 @@ async def join_group(
         last_checkin=None
     )
     db.add(new_member)
+    db.execute(adjust_group_member_count(group_id, 1))
     db.commit()
     
     return ResponseModel(
@@ -121,7 +125,7 @@ async def join_group(
 
 
 @router.post("/{group_id}/leave", response_model=ResponseModel)
-async def leave_group(
+def leave_group(
     group_id: int,
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
@@ -150,13 +154,14 @@ async def leave_group(
         )
     
     db.delete(member)
+    db.execute(adjust_group_member_count(group_id, -1))
     db.commit()
     
     return ResponseModel(data=None)
 
 
 @router.delete("/{group_id}", response_model=ResponseModel)
-async def delete_group(
+def delete_group(
     group_id: int,
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
@@ -186,7 +191,7 @@ async def delete_group(
 
 
 @router.post("/{group_id}/transfer", response_model=ResponseModel)
-async def transfer_group_ownership(
+def transfer_group_ownership(
     group_id: int,
     transfer_data: GroupTransferRequest,
     current_user: User = Depends(get_current_user),
@@ -259,7 +264,7 @@ async def transfer_group_ownership(
 
 
 @router.get("/{group_id}", response_model=ResponseModel)
-async def get_group(
+def get_group(
     group_id: int,
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
@@ -282,9 +287,6 @@ async def get_group(
         GroupMember.user_id == current_user.id
     ).first()
     
-    # 计算成员数
-    member_count = db.query(GroupMember).filter(GroupMember.group_id == group_id).count()
-    
     return ResponseModel(
         data={
             "group_id": group.id,
@@ -292,7 +294,7 @@ async def get_group(
             "description": group.description,
             "daily_checkin_required": group.daily_checkin_required,
             "creator_id": group.created_by,
-            "member_count": member_count,
+            "member_count": group.member_count,
             "created_at": group.created_at,
             "is_member": member is not None,
             "user_role": member.role if member else None
@@ -301,7 +303,7 @@ async def get_group(
 
 
 @router.put("/{group_id}", response_model=ResponseModel)
-async def update_group(
+def update_group(
     group_id: int,
     update_data: GroupUpdateRequest,
     current_user: User = Depends(get_current_user),
@@ -349,9 +351,6 @@ async def update_group(
     db.commit()
     db.refresh(group)
     
-    # 计算成员数
-    member_count = db.query(GroupMember).filter(GroupMember.group_id == group_id).count()
-    
     return ResponseModel(
         data={
             "group_id": group.id,
@@ -359,7 +358,7 @@ async def update_group(
             "description": group.description,
             "daily_checkin_required": group.daily_checkin_required,
             "creator_id": group.created_by,
-            "member_count": member_count,
+            "member_count": group.member_count,
             "created_at": group.created_at,
             "updated_at": group.updated_at if hasattr(group, 'updated_at') else None
         }
@@ -367,40 +366,34 @@ async def update_group(
 
 
 @router.get("", response_model=ResponseModel)
-async def get_groups(
+def get_groups(
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
     created_groups = db.query(Group).filter(Group.created_by == current_user.id).all()
-    joined_group_ids = db.query(GroupMember.group_id).filter(
-        GroupMember.user_id == current_user.id
-    ).all()
-    joined_groups = db.query(Group).filter(Group.id.in_([g[0] for g in joined_group_ids])).all()
+    # 加入的群组连同加入时间一次查出，成员数直接读取 groups.member_count
+    joined_groups = db.query(Group, GroupMember.joined_at).join(
+        GroupMember, GroupMember.group_id == Group.id
+    ).filter(GroupMember.user_id == current_user.id).all()
     
     created_data = []
     for group in created_groups:
-        member_count = db.query(GroupMember).filter(GroupMember.group_id == group.id).count()
         created_data.append({
             "group_id": group.id,
             "name": group.name,
             "description": group.description,
-            "member_count": member_count,
+            "member_count": group.member_count,
             "created_at": group.created_at
         })
     
     joined_data = []
-    for group in joined_groups:
-        member_count = db.query(GroupMember).filter(GroupMember.group_id == group.id).count()
-        joined_member = db.query(GroupMember).filter(
-            GroupMember.group_id == group.id,
-            GroupMember.user_id == current_user.id
-        ).first()
+    for group, joined_at in joined_groups:
         joined_data.append({
             "group_id": group.id,
             "name": group.name,
             "description": group.description,
-            "member_count": member_count,
-            "joined_at": joined_member.joined_at if joined_member else None
+            "member_count": group.member_count,
+            "joined_at": joined_at
         })
     
     return ResponseModel(
@@ -412,7 +405,7 @@ async def get_groups(
 
 
 @router.get("/{group_id}/members", response_model=ResponseModel)
-async def get_group_members(
+def get_group_members(
     group_id: int,
     status: str = Query(None),
     current_user: User = Depends(get_current_user),
@@ -474,7 +467,7 @@ async def get_group_members(
 
 
 @router.delete("/{group_id}/members/{user_id}", response_model=ResponseModel)
-async def remove_member(
+def remove_member(
     group_id: int,
     user_id: int,
     current_user: User = Depends(get_current_user),
@@ -522,6 +515,7 @@ async def remove_member(
         )
     
     db.delete(member)
+    db.execute(adjust_group_member_count(group_id, -1))
     db.commit()
     
     return ResponseModel(
@@ -534,15 +528,18 @@ async def remove_member(
 
 
 @router.get("/{group_id}/checkins", response_model=ResponseModel)
-async def get_group_checkins(
+def get_group_checkins(
     group_id: int,
     date_filter: date = Query(None, alias="date"),
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
-    from app.models import Checkin, Plan
-    from sqlalchemy import func
-    
+    """
+    获取群组某天的打卡情况（默认今天）
+
+    一条查询：群成员 JOIN 用户 LEFT JOIN 当天打卡，按成员逐行归入已打卡 / 未打卡，
+    不再逐个成员查询用户信息。同一成员当天打卡多个计划时，已打卡列表中每条打卡一项。
+    """
     target_date = date_filter or date.today()
     
     group = db.query(Group).filter(Group.id == group_id).first()
@@ -552,43 +549,47 @@ async def get_group_checkins(
             detail="群组不存在"
         )
     
-    members = db.query(GroupMember).filter(GroupMember.group_id == group_id).all()
-    member_ids = [m.user_id for m in members]
-    
-    checkins = db.query(Checkin, User, Plan).join(
-        User, Checkin.user_id == User.id
-    ).join(
-        Plan, Checkin.plan_id == Plan.id
-    ).filter(
-        Checkin.user_id.in_(member_ids),
-        Checkin.checkin_date == target_date
-    ).all()
+    rows = db.execute(
+        select(
+            GroupMember.user_id, User.username, Checkin.duration_min, Checkin.created_at
+        ).select_from(GroupMember).join(
+            User, GroupMember.user_id == User.id
+        ).outerjoin(
+            Checkin, and_(
+                Checkin.user_id == GroupMember.user_id,
+                Checkin.checkin_date == target_date
+            )
+        ).filter(
+            GroupMember.group_id == group_id
+        ).order_by(GroupMember.user_id, Checkin.created_at, Checkin.id).execution_options(yield_per=1000)
+    )
     
-    checked_in_ids = set()
+    total_members = 0
     checked_in_data = []
-    for checkin, user, plan in checkins:
-        checked_in_ids.add(user.id)
-        checked_in_data.append({
-            "user_id": user.id,
-            "username": user.username,
-            "hours": checkin.duration_min / 60,
-            "checkin_time": checkin.created_at
-        })
-    
     not_checked_in_data = []
-    for member in members:
-        user = db.query(User).filter(User.id == member.user_id).first()
-        if user and user.id not in checked_in_ids:
+    last_user_id = None
+    for user_id, username, duration_min, checkin_time in rows:
+        if user_id != last_user_id:
+            total_members += 1
+            last_user_id = user_id
+        if duration_min is None:
             not_checked_in_data.append({
-                "user_id": user.id,
-                "username": user.username
+                "user_id": user_id,
+                "username": username
+            })
+        else:
+            checked_in_data.append({
+                "user_id": user_id,
+                "username": username,
+                "hours": duration_min / 60,
+                "checkin_time": checkin_time
             })
     
     return ResponseModel(
         data={
             "group_id": group_id,
             "date": target_date,
-            "total_members": len(members),
+            "total_members": total_members,
             "checked_in_count": len(checked_in_data),
             "not_checked_in_count": len(not_checked_in_data),
             "checked_in": checked_in_data,
@@ -598,7 +599,7 @@ async def get_group_checkins(
 
 
 @router.get("/{group_id}/stats", response_model=ResponseModel)
-async def get_group_stats(
+def get_group_stats(
     group_id: int,
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
@@ -608,7 +609,7 @@ async def get_group_stats(
     
     包含：
     - 群组层面：当前群成员数、今日打卡人数、打卡率
-    - 个人层面：最近一次打卡日期、本周打卡天数、平均学习时长
+    - 个人层面：最近一次打卡日期、本周打卡天数、平均学习时长、当前/最长连续打卡天数
     """
     # 检查群组是否存在
     group = db.query(Group).filter(Group.id == group_id).first()
@@ -629,43 +630,43 @@ async def get_group_stats(
             detail="您不是该群组成员"
         )
     
-    # 获取群成员信息
-    members = db.query(GroupMember, User).join(
+    # 获取群成员信息和连续打卡记录
+    members = db.query(GroupMember, User, UserStreak).join(
         User, GroupMember.user_id == User.id
+    ).outerjoin(
+        UserStreak, and_(UserStreak.user_id == GroupMember.user_id, UserStreak.plan_id == ALL_PLANS)
     ).filter(GroupMember.group_id == group_id).all()
     
     # 计算当前群成员数
     total_members = len(members)
     
-    # 计算今日打卡人数
+    # 从每日汇总一次读出本周每个成员的打卡次数、时长和今日打卡次数
     today = date.today()
+    week_start = today - timedelta(days=today.weekday())
     member_ids = [m[0].user_id for m in members]
-    today_checkins = db.query(Checkin).filter(
-        Checkin.user_id.in_(member_ids),
-        Checkin.checkin_date == today
-    ).distinct(Checkin.user_id).all()
-    today_checked_in_count = len(today_checkins)
-    
-    # 计算打卡率
+    week_checkins = {
+        row.user_id: row
+        for row in db.query(
+            UserDailyStat.user_id,
+            func.sum(UserDailyStat.checkin_count).label("checkin_count"),
+            func.sum(UserDailyStat.minutes).label("total_minutes"),
+            func.sum(case((UserDailyStat.stat_date == today, UserDailyStat.checkin_count), else_=0)).label("today_count")
+        ).filter(
+            UserDailyStat.user_id.in_(member_ids),
+            UserDailyStat.stat_date >= week_start,
+            UserDailyStat.stat_date <= today
+        ).group_by(UserDailyStat.user_id).all()
+    }
+    
+    # 计算今日打卡人数和打卡率
+    today_checked_in_count = sum(1 for row in week_checkins.values() if row.today_count > 0)
     checkin_rate = today_checked_in_count / total_members if total_members > 0 else 0
     
-    # 计算本周打卡统计
-    week_start = today - timedelta(days=today.weekday())
-    week_checkins = db.query(
-        Checkin.user_id,
-        func.count(Checkin.id).label("checkin_count"),
-        func.sum(Checkin.duration_min).label("total_minutes")
-    ).filter(
-        Checkin.user_id.in_(member_ids),
-        Checkin.checkin_date >= week_start,
-        Checkin.checkin_date <= today
-    ).group_by(Checkin.user_id).all()
-    
     # 构建个人统计数据
     personal_stats = []
-    for member, user in members:
+    for member, user, streak in members:
         # 查找该用户的本周打卡统计
-        user_week_stats = next((s for s in week_checkins if s.user_id == user.id), None)
+        user_week_stats = week_checkins.get(user.id)
         week_checkin_days = user_week_stats.checkin_count if user_week_stats else 0
         avg_hours = (user_week_stats.total_minutes / 60 / week_checkin_days) if user_week_stats and week_checkin_days > 0 else 0
         
@@ -675,7 +676,9 @@ async def get_group_stats(
             "role": member.role,
             "last_checkin_date": member.last_checkin,
             "week_checkin_days": week_checkin_days,
-            "avg_hours_per_day": round(avg_hours, 2)
+            "avg_hours_per_day": round(avg_hours, 2),
+            "current_streak": current_streak(streak.current_streak, streak.last_checkin_date, today) if streak else 0,
+            "longest_streak": streak.longest_streak if streak else 0
         })
     
     # 获取当前用户的个人统计
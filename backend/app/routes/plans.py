@@ -1,8 +1,9 @@
 from fastapi import APIRouter, Depends, HTTPException, status, Query
 from sqlalchemy.orm import Session
-from sqlalchemy import func
+from sqlalchemy import delete, func
 from app.database import get_db
-from app.models import User, Plan, Checkin
+from app.models import User, Plan, UserDailyStat
+from app.streaks import rebuild_streaks, sync_group_last_checkin
 from app.schemas import PlanCreate, PlanUpdate, PlanResponse, PlansListResponse, ResponseModel
 from app.auth import get_current_user
 from typing import Optional
@@ -11,7 +12,7 @@ router = APIRouter(prefix="/plans", tags=["学习计划"])
 
 
 @router.post("", response_model=ResponseModel)
-async def create_plan(
+def create_plan(
     plan_data: PlanCreate,
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
@@ -44,27 +45,47 @@ async def create_plan(
 
 
 @router.get("", response_model=ResponseModel)
-async def get_plans(
+def get_plans(
     status_filter: Optional[str] = Query(None, alias="status"),
     page: int = Query(1, ge=1),
     page_size: int = Query(20, ge=1, le=100),
+    cursor: Optional[int] = Query(None, description="上一页返回的 next_cursor，传入后忽略 page"),
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
-    query = db.query(Plan).filter(Plan.user_id == current_user.id)
-    
+    """
+    获取学习计划列表（按创建先后倒序）
+
+    每个计划的累计时长、打卡次数、最后打卡日期来自每日汇总，与计划在同一条查询中按计划分组取出。
+    翻页可以用 page，也可以用游标：cursor 传上一页的 next_cursor，取ID更小的计划，深翻页不需要 OFFSET。
+    """
+    filters = [Plan.user_id == current_user.id]
     if status_filter:
-        query = query.filter(Plan.end_date >= func.current_date() if status_filter == "active" else False)
+        filters.append(Plan.end_date >= func.current_date() if status_filter == "active" else False)
+    
+    total = db.query(func.count(Plan.id)).filter(*filters).scalar()
+    
+    totals = db.query(
+        UserDailyStat.plan_id,
+        func.sum(UserDailyStat.minutes).label("minutes"),
+        func.sum(UserDailyStat.checkin_count).label("checkin_count"),
+        func.max(UserDailyStat.stat_date).label("last_checkin_date")
+    ).filter(UserDailyStat.user_id == current_user.id).group_by(UserDailyStat.plan_id).subquery()
     
-    total = query.count()
-    items = query.order_by(Plan.created_at.desc()).offset((page - 1) * page_size).limit(page_size).all()
+    query = db.query(Plan, totals.c.minutes, totals.c.checkin_count, totals.c.last_checkin_date).outerjoin(
+        totals, totals.c.plan_id == Plan.id
+    ).filter(*filters).order_by(Plan.id.desc())
+    if cursor is not None:
+        query = query.filter(Plan.id < cursor)
+    else:
+        query = query.offset((page - 1) * page_size)
+    rows = query.limit(page_size + 1).all()
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
     
     plans_data = []
-    for plan in items:
-        total_hours = db.query(func.sum(Checkin.duration_min)).filter(
-            Checkin.plan_id == plan.id
-        ).scalar() or 0
-        
+    for plan, minutes, checkin_count, last_checkin_date in rows:
+        total_minutes = minutes or 0
         plans_data.append({
             "plan_id": plan.id,
             "title": plan.title,
@@ -75,8 +96,10 @@ async def get_plans(
             "status": "active",
             "created_at": plan.created_at,
             "progress": {
-                "total_hours": total_hours / 60,
-                "completion_rate": min(100, (total_hours / (plan.daily_goal_min * 1)) * 100)
+                "total_hours": total_minutes / 60,
+                "checkin_count": checkin_count or 0,
+                "last_checkin_date": last_checkin_date,
+                "completion_rate": min(100, (total_minutes / (plan.daily_goal_min * 1)) * 100)
             }
         })
     
@@ -85,13 +108,15 @@ async def get_plans(
             "total": total,
             "page": page,
             "page_size": page_size,
-            "items": plans_data
+            "items": plans_data,
+            "has_more": has_more,
+            "next_cursor": plans_data[-1]["plan_id"] if has_more else None
         }
     )
 
 
 @router.put("/{plan_id}", response_model=ResponseModel)
-async def update_plan(
+def update_plan(
     plan_id: int,
     plan_data: PlanUpdate,
     current_user: User = Depends(get_current_user),
@@ -135,7 +160,7 @@ async def update_plan(
 
 
 @router.delete("/{plan_id}", response_model=ResponseModel)
-async def delete_plan(
+def delete_plan(
     plan_id: int,
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
@@ -152,6 +177,11 @@ async def delete_plan(
         )
     
     db.delete(plan)
+    # 计划的打卡随计划删除，同步清理每日汇总并重新计算该用户的连续打卡
+    db.execute(delete(UserDailyStat).where(UserDailyStat.plan_id == plan_id))
+    rebuild_streaks(db, current_user.id)
+    # 群组中的最后打卡日期跟随重建后的连续打卡记录（同一事务）
+    db.execute(sync_group_last_checkin(current_user.id))
     db.commit()
     
     return ResponseModel(data=None)
@@ -24,7 +24,7 @@ async def get_me(current_user: User = Depends(get_current_user)):
 
 
 @router.post("/api_key", response_model=ResponseModel)
-async def create_api_key(
+def create_api_key(
     current_user: User = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
@@ -1,8 +1,367 @@
-from openai import OpenAI
-
-# 👉 关键：把 timeout 调大
-deepseek_client = OpenAI(
-    api_key="sk-6c4b398b52ad47589ee338a676b43c99",
-    base_url="https://api.deepseek.com",
-    timeout=30.0   # ⬅️ 从默认 10s 改成 30s
-)
+"""
+大模型（DeepSeek，OpenAI 兼容接口）异步客户端
+
+路由都是 async def，同步的 OpenAI 客户端会在等待模型返回期间阻塞整个事件循环。这里统一使用 AsyncOpenAI：
+- 进程内共享一个 httpx.AsyncClient，保持长连接，连接池大小有上限
+- 用信号量限制同时进行的模型请求数，超出的请求排队等待，不会压垮上游
+- 连接超时和总超时分开配置
+- 连接失败、超时、429 和 5xx 按指数退避加随机抖动（full jitter）重试；
+  流式请求只在收到第一段内容之前重试，已经输出给客户端的内容不会重复
+
+同一个键的并发调用由 SingleFlight 合并为一次上游请求（见下方说明）。
+调用时传入 endpoint，按接口累计 token 用量（app.services.prompts.TokenUsage）。
+
+配置来自环境变量，见 LLMSettings.from_env。
+"""
+import asyncio
+import os
+import random
+import uuid
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, TypeVar
+
+import httpx
+from openai import APIConnectionError, APIStatusError, APITimeoutError, AsyncOpenAI
+
+from app.services.prompts import TokenUsage, estimate_message_tokens, estimate_tokens, token_usage
+
+# 可以重试的 HTTP 状态码
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+T = TypeVar("T")
+
+
+@dataclass
+class LLMSettings:
+    """大模型客户端配置，来自环境变量"""
+    # 只从 LLM_API_KEY 读取，不在代码中提供默认值
+    api_key: str = ""
+    base_url: str = "https://api.deepseek.com"
+    model: str = "deepseek-chat"
+    timeout: float = 30.0
+    connect_timeout: float = 5.0
+    max_connections: int = 20
+    max_keepalive: int = 10
+    max_concurrency: int = 10
+    max_retries: int = 3
+    backoff_base: float = 0.5
+    backoff_max: float = 8.0
+    # 流式请求带 stream_options.include_usage，最后一段返回 token 用量
+    stream_usage: bool = True
+
+    @classmethod
+    def from_env(cls) -> "LLMSettings":
+        defaults = cls()
+        return cls(
+            api_key=os.getenv("LLM_API_KEY", "").strip(),
+            base_url=os.getenv("LLM_BASE_URL", defaults.base_url),
+            model=os.getenv("LLM_MODEL", defaults.model),
+            timeout=float(os.getenv("LLM_TIMEOUT", defaults.timeout)),
+            connect_timeout=float(os.getenv("LLM_CONNECT_TIMEOUT", defaults.connect_timeout)),
+            max_connections=int(os.getenv("LLM_MAX_CONNECTIONS", defaults.max_connections)),
+            max_keepalive=int(os.getenv("LLM_MAX_KEEPALIVE", defaults.max_keepalive)),
+            max_concurrency=int(os.getenv("LLM_MAX_CONCURRENCY", defaults.max_concurrency)),
+            max_retries=int(os.getenv("LLM_MAX_RETRIES", defaults.max_retries)),
+            backoff_base=float(os.getenv("LLM_BACKOFF_BASE", defaults.backoff_base)),
+            backoff_max=float(os.getenv("LLM_BACKOFF_MAX", defaults.backoff_max)),
+            stream_usage=os.getenv("LLM_STREAM_USAGE", "1").strip().lower() not in ("0", "false", "no"),
+        )
+
+    @property
+    def configured(self) -> bool:
+        return bool(self.api_key)
+
+    def require_api_key(self):
+        """未配置 API Key 时报错（第一次创建客户端时检查，AI 是可选功能，不影响应用启动）"""
+        if not self.configured:
+            raise RuntimeError("未配置大模型 API Key，请设置环境变量 LLM_API_KEY")
+
+
+def is_retryable(error: Exception) -> bool:
+    """连接失败、超时以及限流 / 服务端错误可以重试，其余（参数错误、鉴权失败等）直接抛出"""
+    if isinstance(error, (APIConnectionError, APITimeoutError)):
+        return True
+    return isinstance(error, APIStatusError) and error.status_code in RETRYABLE_STATUS
+
+
+class LLMClient:
+    """共享连接池的异步大模型客户端"""
+
+    def __init__(self, settings: Optional[LLMSettings] = None, usage: Optional[TokenUsage] = None):
+        self.settings = settings or LLMSettings.from_env()
+        self.usage = usage or token_usage
+        self._client: Optional[AsyncOpenAI] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    @property
+    def client(self) -> AsyncOpenAI:
+        """首次使用时创建（需要在事件循环中），之后所有请求复用同一个连接池"""
+        if self._client is None:
+            settings = self.settings
+            settings.require_api_key()
+            http_client = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=settings.max_connections,
+                    max_keepalive_connections=settings.max_keepalive,
+                ),
+                timeout=httpx.Timeout(settings.timeout, connect=settings.connect_timeout),
+            )
+            self._client = AsyncOpenAI(
+                api_key=settings.api_key,
+                base_url=settings.base_url,
+                http_client=http_client,
+                # 重试由本类统一处理，避免 SDK 内部再重试一遍
+                max_retries=0,
+            )
+        return self._client
+
+    @property
+    def semaphore(self) -> asyncio.Semaphore:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.settings.max_concurrency)
+        return self._semaphore
+
+    def backoff(self, attempt: int) -> float:
+        """第 attempt 次重试前的等待时间：在 [0, min(上限, 基数 * 2^attempt)] 内随机取值"""
+        return random.uniform(0, min(self.settings.backoff_max, self.settings.backoff_base * 2 ** attempt))
+
+    def _record_usage(self, endpoint: Optional[str], messages: List[dict], usage, content: str):
+        """按接口记录 token 用量；上游没有返回 usage 时用估算值"""
+        if usage is not None:
+            self.usage.record(endpoint, usage.prompt_tokens or 0, usage.completion_tokens or 0)
+        else:
+            self.usage.record(endpoint, estimate_message_tokens(messages), estimate_tokens(content), estimated=True)
+
+    async def complete(self, messages: List[dict], endpoint: Optional[str] = None, **kwargs) -> str:
+        """非流式调用，返回完整回复文本；endpoint 为 token 用量统计使用的接口名"""
+        kwargs.setdefault("model", self.settings.model)
+        attempt = 0
+        while True:
+            try:
+                async with self.semaphore:
+                    response = await self.client.chat.completions.create(messages=messages, **kwargs)
+                content = response.choices[0].message.content or ""
+                self._record_usage(endpoint, messages, response.usage, content)
+                return content
+            except Exception as error:
+                if attempt >= self.settings.max_retries or not is_retryable(error):
+                    raise
+            await asyncio.sleep(self.backoff(attempt))
+            attempt += 1
+
+    async def stream(self, messages: List[dict], endpoint: Optional[str] = None, **kwargs) -> AsyncIterator[str]:
+        """流式调用，逐段产出回复文本；整个流式过程占用一个并发名额，结束（或中断）时记录 token 用量"""
+        kwargs.setdefault("model", self.settings.model)
+        if self.settings.stream_usage:
+            kwargs.setdefault("stream_options", {"include_usage": True})
+        attempt = 0
+        while True:
+            started = False
+            try:
+                async with self.semaphore:
+                    stream = await self.client.chat.completions.create(messages=messages, stream=True, **kwargs)
+                    received, usage = [], None
+                    try:
+                        async for chunk in stream:
+                            if getattr(chunk, "usage", None) is not None:
+                                usage = chunk.usage
+                            if not chunk.choices:
+                                continue
+                            content = chunk.choices[0].delta.content
+                            if content:
+                                started = True
+                                received.append(content)
+                                yield content
+                    finally:
+                        await stream.close()
+                        if received or usage is not None:
+                            self._record_usage(endpoint, messages, usage, "".join(received))
+                return
+            except Exception as error:
+                if started or attempt >= self.settings.max_retries or not is_retryable(error):
+                    raise
+            await asyncio.sleep(self.backoff(attempt))
+            attempt += 1
+
+    async def aclose(self):
+        """关闭连接池（应用关闭时调用）"""
+        if self._client is not None:
+            await self._client.close()
+            self._client = None
+        self._semaphore = None
+
+
+class FlightLock:
+    """
+    跨 worker 合并的扩展点：SingleFlight 的领头调用在 hold(key) 内执行
+
+    默认实现不加锁，只在本进程内合并。多 worker 部署时换成分布式锁（如 RedisFlightLock），
+    拿到锁后再查一次缓存（recheck），其他 worker 已经写入缓存的回复就不会再请求上游。
+    """
+
+    @asynccontextmanager
+    async def hold(self, key: str):
+        yield
+
+
+class RedisFlightLock(FlightLock):
+    """基于 Redis SET NX PX 的锁：拿不到锁时轮询等待，超过 wait_timeout 后不再等待直接调用"""
+
+    # 只删除自己持有的锁，避免锁过期后误删其他 worker 的锁
+    RELEASE_SCRIPT = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0"
+
+    def __init__(self, url: Optional[str] = None, client=None, ttl: float = 60.0,
+                 wait_timeout: float = 60.0, poll_interval: float = 0.1, prefix: str = "studysync:llm:flight:"):
+        self.url = url
+        self._client = client
+        self.ttl = ttl
+        self.wait_timeout = wait_timeout
+        self.poll_interval = poll_interval
+        self.prefix = prefix
+
+    @property
+    def client(self):
+        if self._client is None:
+            import redis.asyncio as redis
+            self._client = redis.from_url(self.url)
+        return self._client
+
+    @asynccontextmanager
+    async def hold(self, key: str):
+        name = self.prefix + key
+        token = uuid.uuid4().hex
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.wait_timeout
+        acquired = False
+        while True:
+            acquired = bool(await self.client.set(name, token, nx=True, px=int(self.ttl * 1000)))
+            if acquired or loop.time() >= deadline:
+                break
+            await asyncio.sleep(self.poll_interval)
+        try:
+            yield
+        finally:
+            if acquired:
+                await self.client.eval(self.RELEASE_SCRIPT, 1, name, token)
+
+
+@dataclass
+class _StreamFlight:
+    """一次进行中的流式调用：已收到的分段、是否结束、出错信息"""
+    chunks: List[str] = field(default_factory=list)
+    done: bool = False
+    error: Optional[BaseException] = None
+    changed: asyncio.Condition = field(default_factory=asyncio.Condition)
+    task: Optional[asyncio.Task] = None
+
+
+class SingleFlight:
+    """
+    合并同一个键的并发调用
+
+    - do()：同一键的并发调用共享一次上游请求的结果
+    - stream()：后来的订阅者挂到进行中的流上，先收到已缓冲的全部分段，再和领头者一起接收后续分段
+    上游调用在独立的任务中执行，领头的请求断开不会影响其他订阅者，结果照常写入缓存。
+    """
+
+    def __init__(self, lock: Optional[FlightLock] = None):
+        self.lock = lock or FlightLock()
+        self._calls: Dict[str, asyncio.Task] = {}
+        self._streams: Dict[str, _StreamFlight] = {}
+        self.leaders = 0
+        self.followers = 0
+
+    async def do(self, key: str, call: Callable[[], Awaitable[T]],
+                 recheck: Optional[Callable[[], Awaitable[Optional[T]]]] = None) -> T:
+        task = self._calls.get(key)
+        if task is None or task.get_loop() is not asyncio.get_running_loop():
+            self.leaders += 1
+            task = asyncio.create_task(self._lead(key, call, recheck))
+            self._calls[key] = task
+            task.add_done_callback(lambda done: self._forget(self._calls, key, done))
+        else:
+            self.followers += 1
+        return await asyncio.shield(task)
+
+    async def _lead(self, key, call, recheck):
+        async with self.lock.hold(key):
+            if recheck is not None:
+                result = await recheck()
+                if result is not None:
+                    return result
+            return await call()
+
+    async def stream(self, key: str, start: Callable[[], AsyncIterator[str]],
+                     recheck: Optional[Callable[[], Awaitable[Optional[List[str]]]]] = None) -> AsyncIterator[str]:
+        flight = self._streams.get(key)
+        if flight is None or flight.task.get_loop() is not asyncio.get_running_loop():
+            self.leaders += 1
+            flight = _StreamFlight()
+            flight.task = asyncio.create_task(self._produce(key, flight, start, recheck))
+            self._streams[key] = flight
+            flight.task.add_done_callback(lambda done: self._forget(self._streams, key, flight))
+        else:
+            self.followers += 1
+
+        index = 0
+        while True:
+            async with flight.changed:
+                await flight.changed.wait_for(lambda: len(flight.chunks) > index or flight.done)
+                chunks = flight.chunks[index:]
+                index += len(chunks)
+                finished = flight.done and index == len(flight.chunks)
+            for chunk in chunks:
+                yield chunk
+            if finished:
+                if flight.error is not None:
+                    raise flight.error
+                return
+
+    async def _produce(self, key, flight: _StreamFlight, start, recheck):
+        try:
+            async with self.lock.hold(key):
+                replay = await recheck() if recheck is not None else None
+                source = start() if replay is None else None
+                if source is None:
+                    async with flight.changed:
+                        flight.chunks.extend(replay)
+                        flight.changed.notify_all()
+                else:
+                    async for chunk in source:
+                        async with flight.changed:
+                            flight.chunks.append(chunk)
+                            flight.changed.notify_all()
+        except Exception as exc:
+            flight.error = exc
+        finally:
+            async with flight.changed:
+                flight.done = True
+                flight.changed.notify_all()
+
+    @staticmethod
+    def _forget(flights: dict, key: str, value):
+        if flights.get(key) is value:
+            del flights[key]
+
+    def get_stats(self) -> dict:
+        calls = self.leaders + self.followers
+        return {
+            "in_flight": len(self._calls) + len(self._streams),
+            "upstream_calls": self.leaders,
+            "shared_calls": self.followers,
+            "shared_rate": round(self.followers / calls, 4) if calls else None,
+        }
+
+
+def flight_lock_from_env() -> FlightLock:
+    """设置 LLM_LOCK_REDIS_URL 时跨 worker 合并，否则只在本进程内合并"""
+    url = os.getenv("LLM_LOCK_REDIS_URL", "").strip()
+    if not url:
+        return FlightLock()
+    ttl = float(os.getenv("LLM_LOCK_TTL", "60"))
+    return RedisFlightLock(url, ttl=ttl, wait_timeout=ttl)
+
+
+llm_client = LLMClient()
+llm_flights = SingleFlight(flight_lock_from_env())
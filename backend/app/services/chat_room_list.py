@@ -0,0 +1,108 @@
+"""
+我的群聊列表
+
+原来的实现对每个创建/加入的群聊各发一次 COUNT 查询，加入 50 个群聊的用户打开列表要 100 多次查询。
+这里固定两次查询，与群聊数量无关：
+1. 用户创建或加入的活跃群聊，带上自己的角色、已读位置、未读数和最新消息ID（相关子查询，一条 SQL）
+2. 按最新消息ID批量取消息预览和发送者
+
+成员数和未读数都直接读取增量维护的计数（见 app.member_counts、app.chat_unread），不做 COUNT。
+"""
+from dataclasses import dataclass
+from typing import Dict, List
+
+from sqlalchemy import and_, func, or_, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
+
+from app.chat_models import ChatMessage, ChatRoom, ChatRoomMember, ChatRoomStatus
+from app.models import User
+
+# 消息预览最多保留的字符数
+PREVIEW_LENGTH = 50
+
+
+@dataclass
+class MyChatRooms:
+    created: List[dict]
+    joined: List[dict]
+
+
+def _preview(content: str) -> str:
+    if len(content) <= PREVIEW_LENGTH:
+        return content
+    return content[:PREVIEW_LENGTH] + "…"
+
+
+async def list_my_chat_rooms(db: AsyncSession, user_id: int) -> MyChatRooms:
+    """用户创建的和加入的群聊（按最新消息倒序），共两次查询"""
+    membership = aliased(ChatRoomMember)
+    message = aliased(ChatMessage)
+
+    # 走 (chat_room_id, id DESC) 部分索引
+    last_message_id = select(func.max(message.id)).where(
+        message.chat_room_id == ChatRoom.id,
+        message.is_deleted == False
+    ).scalar_subquery()
+
+    rows = (await db.execute(
+        select(
+            ChatRoom,
+            membership.role,
+            membership.last_read_message_id,
+            membership.unread_count,
+            last_message_id.label("last_message_id")
+        ).outerjoin(
+            membership, and_(
+                membership.chat_room_id == ChatRoom.id,
+                membership.user_id == user_id
+            )
+        ).filter(
+            ChatRoom.status == ChatRoomStatus.ACTIVE,
+            or_(ChatRoom.created_by == user_id, membership.id.isnot(None))
+        )
+    )).all()
+
+    last_messages: Dict[int, dict] = {}
+    message_ids = [row.last_message_id for row in rows if row.last_message_id is not None]
+    if message_ids:
+        messages = (await db.execute(
+            select(
+                ChatMessage.id, ChatMessage.user_id, ChatMessage.content,
+                ChatMessage.message_type, ChatMessage.created_at, User.username
+            ).join(User, ChatMessage.user_id == User.id).filter(ChatMessage.id.in_(message_ids))
+        )).all()
+        for item in messages:
+            last_messages[item.id] = {
+                "message_id": item.id,
+                "user_id": item.user_id,
+                "username": item.username,
+                "content": _preview(item.content),
+                "message_type": item.message_type,
+                "timestamp": item.created_at.isoformat() if item.created_at else None
+            }
+
+    rows = sorted(rows, key=lambda row: (row.last_message_id or 0, row.ChatRoom.id), reverse=True)
+    result = MyChatRooms(created=[], joined=[])
+    for row in rows:
+        room = row.ChatRoom
+        item = {
+            "room_id": room.id,
+            "chat_id": room.chat_id,
+            "name": room.name,
+            "description": room.description,
+            "avatar_url": room.avatar_url,
+            "member_count": room.member_count,
+            "max_members": room.max_members,
+            "is_public": room.is_public,
+            "created_at": room.created_at,
+            "role": row.role,
+            "last_message": last_messages.get(row.last_message_id),
+            "last_read_message_id": row.last_read_message_id,
+            "unread_count": row.unread_count or 0
+        }
+        if room.created_by == user_id:
+            result.created.append(item)
+        else:
+            result.joined.append(item)
+    return result
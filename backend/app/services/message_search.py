@@ -0,0 +1,385 @@
+"""
+群聊消息全文搜索
+
+分词：中日韩文字按字切成一元 + 二元 n-gram，其他文字按单词切分并转小写。
+写入消息时把分词结果以空格拼接存入 chat_messages.search_tokens。
+
+两种后端：
+- PostgresSearchBackend：由 search_tokens 生成的 tsvector 存储列 search_vector + GIN 索引，
+  ts_rank_cd 排序，不依赖 zhparser / pg_trgm 等扩展
+- InvertedIndexBackend：纯 Python 倒排索引（BM25 排序），用于 SQLite 测试环境
+
+两种后端都支持按相关度或时间排序、游标分页、发送者和日期范围过滤，结果带高亮片段。
+"""
+import base64
+import html
+import json
+import math
+import os
+import re
+from dataclasses import dataclass, field
+from datetime import date, datetime, time, timedelta
+from typing import Dict, List, Optional, Set, Tuple
+
+from sqlalchemy import and_, desc, func, literal_column, or_, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from app.chat_models import ChatMessage
+from app.models import User
+
+ORDER_RELEVANCE = "relevance"
+ORDER_NEWEST = "newest"
+
+TS_CONFIG = literal_column("'simple'::regconfig")
+# PostgreSQL 生成列，见 app.chat_models 中的 DDL
+SEARCH_VECTOR = literal_column("chat_messages.search_vector")
+
+_CJK = (
+    "぀-ヿ"   # 日文假名
+    "㐀-䶿"   # 扩展 A
+    "一-鿿"   # 基本汉字
+    "가-힯"   # 韩文
+    "豈-﫿"   # 兼容汉字
+)
+_RUN_RE = re.compile(rf"[{_CJK}]+|[^\W_{_CJK}]+")
+_CJK_RE = re.compile(rf"[{_CJK}]")
+
+HIGHLIGHT_START = "<mark>"
+HIGHLIGHT_END = "</mark>"
+
+
+class InvalidSearchCursor(ValueError):
+    """分页游标无法解析"""
+
+
+def _runs(text: str) -> List[str]:
+    """切成连续的 CJK 片段和单词片段（小写）"""
+    return _RUN_RE.findall(text.lower())
+
+
+def _is_cjk(run: str) -> bool:
+    return bool(_CJK_RE.match(run))
+
+
+def tokenize(text: str) -> List[str]:
+    """文档分词：CJK 片段输出一元和二元 n-gram，其余按单词输出"""
+    tokens = []
+    for run in _runs(text or ""):
+        if _is_cjk(run):
+            tokens.extend(run)
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+        else:
+            tokens.append(run)
+    return tokens
+
+
+def query_tokens(keyword: str) -> List[str]:
+    """查询分词：CJK 片段只用二元 n-gram（单字时用一元），所有词都必须命中"""
+    tokens = []
+    for run in _runs(keyword):
+        if _is_cjk(run) and len(run) > 1:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+        else:
+            tokens.append(run)
+    # 去重并保持顺序
+    return list(dict.fromkeys(tokens))
+
+
+def search_text(content: str) -> str:
+    """写入 search_tokens 列的内容"""
+    return " ".join(tokenize(content))
+
+
+def highlight(content: str, keyword: str, max_length: int = 120) -> str:
+    """
+    生成带高亮的摘要片段
+
+    命中的关键词用 <mark> 包裹，其余文本做 HTML 转义，可以直接渲染；
+    整个关键词片段没有连续出现时退化为高亮其中的二元词。
+    """
+    lowered = content.lower()
+    spans = []
+    for run in _runs(keyword):
+        found = _find_all(lowered, run)
+        if not found and _is_cjk(run) and len(run) > 2:
+            for i in range(len(run) - 1):
+                found.extend(_find_all(lowered, run[i:i + 2]))
+        spans.extend(found)
+    spans = _merge_spans(spans)
+
+    if spans and len(content) > max_length:
+        start = max(0, min(spans[0][0] - max_length // 4, len(content) - max_length))
+    else:
+        start = 0
+    end = min(len(content), start + max_length)
+
+    parts = ["…"] if start > 0 else []
+    cursor = start
+    for span_start, span_end in spans:
+        if span_end <= start or span_start >= end:
+            continue
+        span_start, span_end = max(span_start, start), min(span_end, end)
+        parts.append(html.escape(content[cursor:span_start]))
+        parts.append(HIGHLIGHT_START + html.escape(content[span_start:span_end]) + HIGHLIGHT_END)
+        cursor = span_end
+    parts.append(html.escape(content[cursor:end]))
+    if end < len(content):
+        parts.append("…")
+    return "".join(parts)
+
+
+def _find_all(text: str, term: str) -> List[Tuple[int, int]]:
+    spans = []
+    index = text.find(term)
+    while index != -1:
+        spans.append((index, index + len(term)))
+        index = text.find(term, index + 1)
+    return spans
+
+
+def _merge_spans(spans: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    merged = []
+    for start, end in sorted(spans):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def encode_cursor(score: Optional[float], message_id: int) -> str:
+    payload = {"id": message_id} if score is None else {"s": score, "id": message_id}
+    return base64.urlsafe_b64encode(json.dumps(payload).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str, order: str) -> Tuple[Optional[float], int]:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        message_id = int(payload["id"])
+        score = float(payload["s"]) if order == ORDER_RELEVANCE else None
+    except (ValueError, KeyError, TypeError):
+        raise InvalidSearchCursor("无效的分页游标")
+    return score, message_id
+
+
+@dataclass
+class SearchQuery:
+    chat_room_id: int
+    keyword: str
+    limit: int = 20
+    order: str = ORDER_RELEVANCE
+    cursor: Optional[str] = None
+    sender_id: Optional[int] = None
+    start_date: Optional[date] = None
+    end_date: Optional[date] = None
+    tokens: List[str] = field(default_factory=list)
+
+    def __post_init__(self):
+        self.tokens = query_tokens(self.keyword)
+
+    def time_filters(self) -> list:
+        filters = []
+        if self.sender_id is not None:
+            filters.append(ChatMessage.user_id == self.sender_id)
+        if self.start_date is not None:
+            filters.append(ChatMessage.created_at >= datetime.combine(self.start_date, time.min))
+        if self.end_date is not None:
+            filters.append(ChatMessage.created_at < datetime.combine(self.end_date + timedelta(days=1), time.min))
+        return filters
+
+
+@dataclass
+class SearchHit:
+    message: ChatMessage
+    user: User
+    score: float
+
+
+@dataclass
+class SearchPage:
+    hits: List[SearchHit]
+    next_cursor: Optional[str]
+    backend: str
+
+    @property
+    def has_more(self) -> bool:
+        return self.next_cursor is not None
+
+
+def _page(hits: List[SearchHit], query: SearchQuery, backend: str) -> SearchPage:
+    """hits 最多 limit+1 条，多出的一条用来判断是否还有下一页"""
+    next_cursor = None
+    if len(hits) > query.limit:
+        hits = hits[:query.limit]
+        last = hits[-1]
+        next_cursor = encode_cursor(last.score if query.order == ORDER_RELEVANCE else None, last.message.id)
+    return SearchPage(hits=hits, next_cursor=next_cursor, backend=backend)
+
+
+class PostgresSearchBackend:
+    """基于 tsvector 存储列和 GIN 索引的搜索"""
+
+    name = "postgres"
+
+    async def search(self, db: AsyncSession, query: SearchQuery) -> SearchPage:
+        tsquery = func.to_tsquery(TS_CONFIG, " & ".join(f"'{token}'" for token in query.tokens))
+        rank = func.ts_rank_cd(SEARCH_VECTOR, tsquery)
+
+        stmt = select(ChatMessage, User, rank.label("score")).join(
+            User, ChatMessage.user_id == User.id
+        ).filter(
+            ChatMessage.chat_room_id == query.chat_room_id,
+            ChatMessage.is_deleted == False,
+            SEARCH_VECTOR.op("@@")(tsquery),
+            *query.time_filters()
+        )
+
+        if query.cursor:
+            score, last_id = decode_cursor(query.cursor, query.order)
+            if query.order == ORDER_RELEVANCE:
+                stmt = stmt.filter(or_(rank < score, and_(rank == score, ChatMessage.id < last_id)))
+            else:
+                stmt = stmt.filter(ChatMessage.id < last_id)
+
+        if query.order == ORDER_RELEVANCE:
+            stmt = stmt.order_by(desc("score"), desc(ChatMessage.id))
+        else:
+            stmt = stmt.order_by(desc(ChatMessage.id))
+
+        rows = (await db.execute(stmt.limit(query.limit + 1))).all()
+        hits = [SearchHit(message, user, float(score)) for message, user, score in rows]
+        return _page(hits, query, self.name)
+
+
+@dataclass
+class _RoomIndex:
+    """单个群聊的倒排索引"""
+    postings: Dict[str, Dict[int, int]] = field(default_factory=dict)
+    doc_lengths: Dict[int, int] = field(default_factory=dict)
+    total_length: int = 0
+    last_id: int = 0
+
+    def add(self, message_id: int, content: str):
+        if message_id in self.doc_lengths:
+            return
+        tokens = tokenize(content)
+        self.doc_lengths[message_id] = len(tokens)
+        self.total_length += len(tokens)
+        for token in tokens:
+            docs = self.postings.setdefault(token, {})
+            docs[message_id] = docs.get(message_id, 0) + 1
+        self.last_id = max(self.last_id, message_id)
+
+    def candidates(self, tokens: List[str]) -> Set[int]:
+        result: Optional[Set[int]] = None
+        for token in sorted(tokens, key=lambda t: len(self.postings.get(t, ()))):
+            docs = self.postings.get(token)
+            if not docs:
+                return set()
+            result = set(docs) if result is None else result & docs.keys()
+            if not result:
+                return set()
+        return result or set()
+
+    def score(self, message_id: int, tokens: List[str], k1: float = 1.2, b: float = 0.75) -> float:
+        """BM25"""
+        doc_count = len(self.doc_lengths)
+        avg_length = self.total_length / doc_count if doc_count else 1
+        length = self.doc_lengths.get(message_id, 0)
+        score = 0.0
+        for token in tokens:
+            docs = self.postings.get(token, {})
+            tf = docs.get(message_id, 0)
+            if not tf:
+                continue
+            idf = math.log(1 + (doc_count - len(docs) + 0.5) / (len(docs) + 0.5))
+            score += idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * length / avg_length))
+        return round(score, 6)
+
+
+class InvertedIndexBackend:
+    """
+    纯 Python 倒排索引，按群聊懒加载并增量同步
+
+    消息ID按时间递增，每次搜索前加载 last_id 之后的新消息；多 worker 写入时
+    ID 不一定按提交顺序出现，因此会回看 SYNC_OVERLAP_MS 内的消息补齐遗漏。
+    已删除消息保留在索引中，回表时过滤。
+    """
+
+    name = "memory"
+    SYNC_OVERLAP_MS = 5000
+
+    def __init__(self):
+        self._rooms: Dict[int, _RoomIndex] = {}
+
+    async def _sync(self, db: AsyncSession, chat_room_id: int) -> _RoomIndex:
+        from app.chat_id_generator import MessageIdGenerator
+
+        index = self._rooms.setdefault(chat_room_id, _RoomIndex())
+        overlap = self.SYNC_OVERLAP_MS << (MessageIdGenerator.WORKER_BITS + MessageIdGenerator.SEQUENCE_BITS)
+        rows = (await db.execute(
+            select(ChatMessage.id, ChatMessage.content).filter(
+                ChatMessage.chat_room_id == chat_room_id,
+                ChatMessage.id > index.last_id - overlap
+            ).order_by(ChatMessage.id)
+        )).all()
+        for message_id, content in rows:
+            index.add(message_id, content)
+        return index
+
+    def reset(self):
+        self._rooms.clear()
+
+    async def search(self, db: AsyncSession, query: SearchQuery) -> SearchPage:
+        index = await self._sync(db, query.chat_room_id)
+        candidate_ids = index.candidates(query.tokens)
+        if not candidate_ids:
+            return SearchPage(hits=[], next_cursor=None, backend=self.name)
+
+        rows = (await db.execute(
+            select(ChatMessage, User).join(User, ChatMessage.user_id == User.id).filter(
+                ChatMessage.id.in_(candidate_ids),
+                ChatMessage.chat_room_id == query.chat_room_id,
+                ChatMessage.is_deleted == False,
+                *query.time_filters()
+            )
+        )).all()
+
+        hits = [SearchHit(message, user, index.score(message.id, query.tokens)) for message, user in rows]
+        if query.order == ORDER_RELEVANCE:
+            hits.sort(key=lambda hit: (hit.score, hit.message.id), reverse=True)
+        else:
+            hits.sort(key=lambda hit: hit.message.id, reverse=True)
+
+        if query.cursor:
+            score, last_id = decode_cursor(query.cursor, query.order)
+            if query.order == ORDER_RELEVANCE:
+                hits = [h for h in hits if (h.score, h.message.id) < (score, last_id)]
+            else:
+                hits = [h for h in hits if h.message.id < last_id]
+
+        return _page(hits[:query.limit + 1], query, self.name)
+
+
+class MessageSearch:
+    """按数据库类型选择搜索后端，CHAT_SEARCH_BACKEND 可强制指定 postgres / memory"""
+
+    def __init__(self, backend: Optional[str] = None):
+        self.backend_name = (backend or os.getenv("CHAT_SEARCH_BACKEND", "auto")).strip().lower()
+        self.postgres = PostgresSearchBackend()
+        self.memory = InvertedIndexBackend()
+
+    def backend_for(self, db: AsyncSession):
+        if self.backend_name == "postgres":
+            return self.postgres
+        if self.backend_name == "memory":
+            return self.memory
+        dialect = db.get_bind().dialect.name
+        return self.postgres if dialect == "postgresql" else self.memory
+
+    async def search(self, db: AsyncSession, query: SearchQuery) -> SearchPage:
+        return await self.backend_for(db).search(db, query)
+
+
+message_search = MessageSearch()
@@ -0,0 +1,350 @@
+"""
+提示词注册表
+
+AI 模块的提示词模板在导入时编译一次（拆分为字面量和占位符，预先估算字面量的 token 数），
+请求时只填入统计数据。模板带版本号，回复缓存的键使用模板版本，修改模板后递增版本即可让旧回复失效。
+
+模板由若干段组成，各接口共用学习策略和输出格式两段。渲染时按 token 预算（LLM_PROMPT_BUDGET）裁剪：
+1. 有摘要的段（学习策略参考）换成摘要
+2. 仍超出时去掉可选段
+3. 仍超出时截断允许截断的用户输入（如学习目标）
+裁剪后仍超出预算时照常发送并计数。
+
+token 数按 DeepSeek 的估算规则：1 个中文字符约 0.6 token，1 个英文字符约 0.3 token。
+模型返回 usage 时以 usage 为准，否则用估算值，按接口累计在 TokenUsage 中。
+"""
+import logging
+import math
+import os
+import string
+import threading
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+CJK_TOKEN_RATIO = 0.6
+OTHER_TOKEN_RATIO = 0.3
+
+FULL = "full"
+SUMMARY = "summary"
+DROPPED = "dropped"
+TRIMMED = "trimmed"
+
+
+def _is_cjk(ch: str) -> bool:
+    return "\u4e00" <= ch <= "\u9fff" or "\u3000" <= ch <= "\u303f" or "\uff00" <= ch <= "\uffef"
+
+
+def _weight(text: str) -> float:
+    cjk = sum(1 for ch in text if _is_cjk(ch))
+    return cjk * CJK_TOKEN_RATIO + (len(text) - cjk) * OTHER_TOKEN_RATIO
+
+
+def estimate_tokens(text: str) -> int:
+    """按字符类型估算 token 数"""
+    return math.ceil(round(_weight(text), 6))
+
+
+def estimate_message_tokens(messages: List[dict]) -> int:
+    return sum(estimate_tokens(message.get("content") or "") for message in messages)
+
+
+@dataclass(frozen=True)
+class Block:
+    """
+    模板中的一段：text 可包含 {字段} 占位符
+
+    summary 为超出预算时替换用的摘要；optional 的段超出预算时可以去掉，去掉后以 dropped 代替（通常是段落分隔）。
+    """
+    text: str
+    summary: Optional[str] = None
+    optional: bool = False
+    dropped: str = ""
+
+
+class _CompiledText:
+    """预先拆分的模板文本：[(字面量, 字段名, 格式说明)]"""
+
+    def __init__(self, text: str):
+        self.parts: List[Tuple[str, Optional[str], str]] = [
+            (literal, name, spec or "") for literal, name, spec, _ in string.Formatter().parse(text)
+        ]
+        self.fields = tuple(name for _, name, _ in self.parts if name)
+        # 分段估算时累加未取整的值，整条提示词的估算与直接估算全文一致
+        self.static_weight = _weight("".join(literal for literal, _, _ in self.parts))
+        self.static_tokens = math.ceil(round(self.static_weight, 6))
+
+    def render(self, values: Dict[str, str]) -> str:
+        return "".join(literal + (values[name] if name else "") for literal, name, _ in self.parts)
+
+    def format_values(self, values: dict) -> Dict[str, str]:
+        return {name: format(values[name], spec) for _, name, spec in self.parts if name}
+
+
+@dataclass
+class RenderedPrompt:
+    name: str
+    version: int
+    text: str
+    tokens: int
+    # 各段使用的形式（full / summary / dropped），有截断时追加 trimmed
+    variant: Tuple[str, ...]
+
+    @property
+    def messages(self) -> List[dict]:
+        return [{"role": "user", "content": self.text}]
+
+
+class PromptTemplate:
+    """编译后的提示词模板"""
+
+    def __init__(self, name: str, version: int, blocks: List[Block], trim_fields: Tuple[str, ...] = (),
+                 min_field_chars: int = 20):
+        self.name = name
+        self.version = version
+        self.blocks = blocks
+        self.trim_fields = trim_fields
+        self.min_field_chars = min_field_chars
+        self._full = [_CompiledText(block.text) for block in blocks]
+        self._summary = [_CompiledText(block.summary) if block.summary is not None else None for block in blocks]
+        self._dropped = [_CompiledText(block.dropped) for block in blocks]
+        self._with_fields = [text for text in self._full + self._summary if text is not None and text.fields]
+        # 不含占位符内容的 token 数（全文 / 尽量精简）
+        self.static_tokens = sum(text.static_tokens for text in self._full)
+        self.min_static_tokens = sum(
+            self._dropped[i].static_tokens if block.optional
+            else (self._summary[i] or self._full[i]).static_tokens
+            for i, block in enumerate(blocks)
+        )
+
+    def _compiled(self, index: int, mode: str) -> _CompiledText:
+        if mode == SUMMARY:
+            return self._summary[index]
+        if mode == DROPPED:
+            return self._dropped[index]
+        return self._full[index]
+
+    def _estimate(self, modes: List[str], values: Dict[str, str]) -> int:
+        total = 0.0
+        for i, mode in enumerate(modes):
+            compiled = self._compiled(i, mode)
+            total += compiled.static_weight + sum(_weight(values[name]) for name in compiled.fields)
+        return math.ceil(round(total, 6))
+
+    def render(self, budget: Optional[int] = None, **values) -> RenderedPrompt:
+        formatted: Dict[str, str] = {}
+        for compiled in self._with_fields:
+            formatted.update(compiled.format_values(values))
+        modes = [FULL] * len(self.blocks)
+        trimmed = False
+        tokens = self._estimate(modes, formatted)
+        if budget:
+            for step in (SUMMARY, DROPPED):
+                for i, block in enumerate(self.blocks):
+                    if tokens <= budget:
+                        break
+                    if (step == SUMMARY and block.summary is not None and modes[i] == FULL) or \
+                            (step == DROPPED and block.optional):
+                        modes[i] = step
+                        tokens = self._estimate(modes, formatted)
+            for name in self.trim_fields:
+                value = original = formatted.get(name, "")
+                while tokens > budget and len(value) > self.min_field_chars:
+                    # 每个字符至多 0.6 token，至少去掉超出部分对应的字符数
+                    cut = math.ceil((tokens - budget) / CJK_TOKEN_RATIO)
+                    value = value[:max(self.min_field_chars, len(value) - cut)]
+                    formatted[name] = value + "…"
+                    tokens = self._estimate(modes, formatted)
+                trimmed = trimmed or value != original
+        text = "".join(self._compiled(i, mode).render(formatted) for i, mode in enumerate(modes))
+        variant = tuple(modes) + ((TRIMMED,) if trimmed else ())
+        return RenderedPrompt(self.name, self.version, text, tokens, variant)
+
+
+class PromptRegistry:
+    """按名称注册的提示词模板，统计各模板的渲染和裁剪次数"""
+
+    def __init__(self, budget: int = 0):
+        self.budget = budget
+        self._templates: Dict[str, PromptTemplate] = {}
+        self._stats: Dict[str, Dict[str, int]] = {}
+        self._lock = threading.Lock()
+
+    def register(self, template: PromptTemplate) -> PromptTemplate:
+        if template.name in self._templates:
+            raise ValueError(f"提示词模板已存在: {template.name}")
+        self._templates[template.name] = template
+        self._stats[template.name] = {"renders": 0, "summarized": 0, "dropped": 0, "trimmed": 0, "over_budget": 0}
+        return template
+
+    def get(self, name: str) -> PromptTemplate:
+        return self._templates[name]
+
+    def render(self, name: str, budget: Optional[int] = None, **values) -> RenderedPrompt:
+        budget = self.budget if budget is None else budget
+        prompt = self._templates[name].render(budget, **values)
+        with self._lock:
+            stats = self._stats[name]
+            stats["renders"] += 1
+            stats["summarized"] += SUMMARY in prompt.variant
+            stats["dropped"] += DROPPED in prompt.variant
+            stats["trimmed"] += TRIMMED in prompt.variant
+            if budget and prompt.tokens > budget:
+                stats["over_budget"] += 1
+                logger.warning("提示词 %s 超出 token 预算: %s > %s", name, prompt.tokens, budget)
+        return prompt
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {
+                "budget": self.budget,
+                "templates": {
+                    name: {
+                        "version": template.version,
+                        "static_tokens": template.static_tokens,
+                        "min_static_tokens": template.min_static_tokens,
+                        **self._stats[name],
+                    }
+                    for name, template in self._templates.items()
+                },
+            }
+
+
+@dataclass
+class _EndpointUsage:
+    calls: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    estimated_calls: int = 0
+
+
+class TokenUsage:
+    """按接口累计的模型 token 用量"""
+
+    def __init__(self):
+        self._endpoints: Dict[str, _EndpointUsage] = {}
+        self._lock = threading.Lock()
+
+    def record(self, endpoint: Optional[str], prompt_tokens: int, completion_tokens: int, estimated: bool = False):
+        with self._lock:
+            usage = self._endpoints.setdefault(endpoint or "other", _EndpointUsage())
+            usage.calls += 1
+            usage.prompt_tokens += prompt_tokens
+            usage.completion_tokens += completion_tokens
+            usage.estimated_calls += estimated
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {
+                endpoint: {
+                    "calls": usage.calls,
+                    "prompt_tokens": usage.prompt_tokens,
+                    "completion_tokens": usage.completion_tokens,
+                    "avg_prompt_tokens": round(usage.prompt_tokens / usage.calls, 1),
+                    "avg_completion_tokens": round(usage.completion_tokens / usage.calls, 1),
+                    "estimated_calls": usage.estimated_calls,
+                }
+                for endpoint, usage in self._endpoints.items()
+            }
+
+    def clear(self):
+        with self._lock:
+            self._endpoints.clear()
+
+
+# 模板文本（统计数据以占位符表示）
+
+WEEKLY_INTRO = """你作为专业的学习教练AI，请基于以下学习数据，为用户提供详细的周学习评估报告：
+
+分析期间：{week_start} 至 {week_end}
+总打卡次数：{checkin_count}次
+总学习时长：{total_hours:.1f}小时
+打卡率：{checkin_rate:.1f}%
+
+请提供：
+1. 学习评分（总分、打卡频率、学习时长、学习稳定性）
+2. 学习总结（打卡频率、学习趋势、稳定性）
+3. 存在问题
+4. 改进建议
+5. 推荐学习时长
+
+要求分析详细、具体，避免空泛的描述。"""
+
+ANALYSIS_INTRO = """你作为专业的学习教练AI，请基于以下打卡数据进行深度分析：
+
+打卡统计：
+- 分析期间：{start_date} 至 {end_date}
+- 总打卡次数：{total_checkins}次
+- 总学习时长：{total_hours:.1f}小时
+- 平均每日学习时长：{avg_daily_hours:.1f}小时
+- 打卡率：{checkin_rate:.1f}%
+- 最长连续打卡：{streak_days}天
+- 未打卡天数：{missed_days}天
+
+请提供：
+1. 对当前学习状态的深度分析
+2. 识别出的学习模式和规律
+3. 发现的问题和改进建议
+4. 具体可行的优化方案
+
+要求分析要具体、可操作，避免空泛的建议。"""
+
+COACH_INTRO = """你作为专业的学习教练AI，核心目标是帮助用户实现"可执行化"学习，避免泛泛而谈的建议。
+
+请基于以下学习数据，为用户提供系统化的学习指导，具体包括：
+1）精准的学习状态评估（基于实际数据，避免空泛描述）
+2）科学的下一阶段学习路线建议（需具备可操作性）
+3）详细的未来一周具体任务安排（需明确具体行动项）
+
+"""
+
+COACH_DATA = """【学习数据】
+- 学习目标：{learning_goal}
+- 本周总学习时长：{weekly_total_hours}小时
+- 平均每日学习时长：{average_daily_hours}小时
+- 目标每日学习时长：{target_daily_hours}小时
+- 连续打卡天数：{consecutive_checkin_days}天
+- 漏打卡天数：{missed_checkin_days}天
+"""
+
+STRATEGIES = """在提供改进建议时，请参考以下专业学习策略：
+
+优先建立打卡习惯：将"每日打卡"作为学习计划的最低执行标准，确保学习行为的连续性。即使在时间紧张的情况下，也应完成至少15-20分钟的学习并进行打卡记录。建议从设定25分钟的每日最低学习时长开始，逐步培养稳定的学习习惯，使学习成为日常生活中不可或缺的一部分。
+
+制定固定学习时段：在每日时间表中规划并固定一个30-60分钟的专属学习时段，选择不易被打扰的时间段，如早晨起床后、午休后或晚上睡前。通过持续在固定时间进行学习，建立条件反射和生物钟，提高学习效率和习惯养成速度。
+
+采用微学习策略：针对时间碎片化的情况，实施微学习策略以维持学习连贯性。可在通勤途中收听课程音频、利用排队等待时间记忆核心知识点、睡前10分钟回顾当日学习内容等。所有微学习活动均需记录并计入打卡系统，确保学习热度不中断。
+
+增强计划与记录体系：建立周计划与日任务的双层规划系统。每周初制定明确的学习主题和时间分配方案；每日学习前设定具体可执行的任务目标，如"完成第一章第二节阅读并制作思维导图笔记"，避免模糊的"学习一会儿"等非具体目标。学习结束后进行任务完成情况记录与反思。
+
+利用周末进行整合提升：针对工作日时间有限的特点，合理规划周末学习时间。建议安排2-3小时进行本周学习内容的系统复习、知识体系整理和实践练习，通过阶段性整合与巩固，强化学习效果并为下周学习做好准备。
+
+"""
+
+OUTPUT_FORMAT = """【输出格式要求】
+- 严格禁止使用任何Markdown格式元素，包括但不限于：标题符号(#)、列表标记(*、-、+)、粗体(**)、斜体(*)、链接格式([text](url))、代码块(```)、表格(|)、引用符号(>)、水平线(---)等
+- 仅返回纯文本内容，使用自然的换行和空格来组织内容结构
+- 确保文本逻辑清晰、结构合理、段落分明，具有高度可读性
+- 直接输出未经格式化的原始文本，不使用任何特殊格式标记或语法"""
+
+STRATEGIES_SUMMARY = """在提供改进建议时，请参考以下学习策略：每天至少学习15-20分钟并打卡；固定一个30-60分钟的学习时段；利用通勤、排队等碎片时间微学习并记录；制定周计划和具体可执行的每日任务；周末安排2-3小时复习整合。
+
+"""
+
+# 学习策略参考段：超出预算时先换成摘要，再去掉（保留段落分隔）
+STRATEGY_BLOCK = Block(STRATEGIES, summary=STRATEGIES_SUMMARY, optional=True, dropped="\n\n")
+
+prompts = PromptRegistry(budget=int(os.getenv("LLM_PROMPT_BUDGET", "1200")))
+
+WEEKLY_REPORT = prompts.register(PromptTemplate("weekly_report", 2, [
+    Block(WEEKLY_INTRO), STRATEGY_BLOCK, Block(OUTPUT_FORMAT),
+]))
+CHECKIN_ANALYSIS = prompts.register(PromptTemplate("checkin_analysis", 2, [
+    Block(ANALYSIS_INTRO), STRATEGY_BLOCK, Block(OUTPUT_FORMAT),
+]))
+LEARNING_COACH = prompts.register(PromptTemplate("learning_coach", 1, [
+    Block(COACH_INTRO), Block(OUTPUT_FORMAT), Block("\n\n" + COACH_DATA),
+], trim_fields=("learning_goal",)))
+
+token_usage = TokenUsage()
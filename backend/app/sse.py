@@ -0,0 +1,227 @@
+"""
+大模型流式接口的 Server-Sent Events 模式
+
+/ai/weekly_report/stream 和 /ai/learning_coach 默认仍输出原来的格式（JSON 行 / 纯文本），
+请求头带 Accept: text/event-stream 时改为 SSE：
+
+    retry: 2000
+
+    id: 3f2a...-1
+    event: basic
+    data: {...}
+
+    : ping
+
+- 每个事件都有 id（流ID-序号），模型输出在服务端独立的任务中生成并写入流缓冲，客户端断开不影响生成
+- 断线重连时带上 Last-Event-ID，从缓冲中补发之后的事件，流还在生成时继续跟随；
+  缓冲过期或不属于当前用户时重新开始一个流（流ID变化，客户端应清空已显示的内容）
+- 空闲超过 SSE_HEARTBEAT 秒发送注释帧，避免代理因长时间无数据断开连接
+- 模型的分段合并后再发送（coalesce）：第一段立即发送，之后累计到 SSE_FLUSH_CHARS 个字符
+  或距第一段未发送内容超过 SSE_FLUSH_INTERVAL 秒时发送，减少帧数又不拖慢首字
+
+流缓冲在进程内，多 worker 部署时重连需要落到同一个 worker（按会话保持）。
+"""
+import asyncio
+import json
+import logging
+import os
+import uuid
+from dataclasses import dataclass
+from typing import AsyncIterator, Awaitable, Callable, List, Optional, Tuple
+
+from fastapi.responses import StreamingResponse
+
+from app.cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+EVENT_STREAM = "text/event-stream"
+
+
+@dataclass
+class SSESettings:
+    """SSE 配置，来自环境变量"""
+    flush_chars: int = 48
+    flush_interval: float = 0.1
+    heartbeat: float = 15.0
+    retry_ms: int = 2000
+    buffer_ttl: float = 300.0
+    buffer_max_streams: int = 1000
+
+    @classmethod
+    def from_env(cls) -> "SSESettings":
+        return cls(
+            flush_chars=int(os.getenv("SSE_FLUSH_CHARS", "48")),
+            flush_interval=float(os.getenv("SSE_FLUSH_INTERVAL", "0.1")),
+            heartbeat=float(os.getenv("SSE_HEARTBEAT", "15")),
+            retry_ms=int(os.getenv("SSE_RETRY_MS", "2000")),
+            buffer_ttl=float(os.getenv("SSE_BUFFER_TTL", "300")),
+            buffer_max_streams=int(os.getenv("SSE_BUFFER_MAX_STREAMS", "1000")),
+        )
+
+
+def wants_event_stream(accept: Optional[str]) -> bool:
+    return bool(accept) and EVENT_STREAM in accept
+
+
+async def coalesce(source: AsyncIterator[str], max_chars: int, max_delay: float) -> AsyncIterator[str]:
+    """
+    合并上游的小分段：第一段立即产出，之后累计到 max_chars 个字符，
+    或第一段未产出内容已等待 max_delay 秒时产出（即使上游暂时没有新分段）
+    """
+    iterator = source.__aiter__()
+    loop = asyncio.get_running_loop()
+    pending: Optional[asyncio.Future] = None
+    buffer: List[str] = []
+    size = 0
+    deadline: Optional[float] = None
+    first = True
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(iterator.__anext__())
+            timeout = None if deadline is None else max(0.0, deadline - loop.time())
+            done, _ = await asyncio.wait({pending}, timeout=timeout)
+            if done:
+                finished, pending = pending, None
+                try:
+                    chunk = finished.result()
+                except StopAsyncIteration:
+                    break
+                if first:
+                    first = False
+                    yield chunk
+                    continue
+                buffer.append(chunk)
+                size += len(chunk)
+                if deadline is None:
+                    deadline = loop.time() + max_delay
+                if size < max_chars:
+                    continue
+            if buffer:
+                yield "".join(buffer)
+            buffer, size, deadline = [], 0, None
+        if buffer:
+            yield "".join(buffer)
+    finally:
+        if pending is not None:
+            pending.cancel()
+
+
+def format_event(event_id: str, event: str, data: str) -> str:
+    return f"id: {event_id}\nevent: {event}\ndata: {data}\n\n"
+
+
+class EventStream:
+    """一次流式回复的事件缓冲：生成任务写入，任意数量的连接从指定位置开始读取"""
+
+    def __init__(self, user_id: int):
+        self.stream_id = uuid.uuid4().hex
+        self.user_id = user_id
+        # (事件类型, JSON 数据)，序号从 1 开始
+        self.events: List[Tuple[str, str]] = []
+        self.done = False
+        self.changed = asyncio.Condition()
+        self.task: Optional[asyncio.Task] = None
+
+    def event_id(self, seq: int) -> str:
+        return f"{self.stream_id}-{seq}"
+
+    async def publish(self, event: str, data: Optional[dict] = None):
+        async with self.changed:
+            self.events.append((event, json.dumps(data or {}, ensure_ascii=False, default=str)))
+            self.changed.notify_all()
+
+    async def close(self):
+        async with self.changed:
+            self.done = True
+            self.changed.notify_all()
+
+    async def follow(self, after: int, heartbeat: float) -> AsyncIterator[str]:
+        """从第 after 个事件之后开始产出 SSE 帧，空闲超过 heartbeat 秒时产出心跳注释帧"""
+        seq = after
+        while True:
+            if len(self.events) <= seq and not self.done:
+                async with self.changed:
+                    try:
+                        await asyncio.wait_for(
+                            self.changed.wait_for(lambda: len(self.events) > seq or self.done), heartbeat
+                        )
+                    except asyncio.TimeoutError:
+                        yield ": ping\n\n"
+                        continue
+            events = self.events[seq:]
+            for event, data in events:
+                seq += 1
+                yield format_event(self.event_id(seq), event, data)
+            if self.done and seq == len(self.events):
+                return
+
+
+class EventStreamRegistry:
+    """进行中和最近结束的流，供 Last-Event-ID 重连时补发"""
+
+    def __init__(self, settings: Optional[SSESettings] = None):
+        self.settings = settings or SSESettings.from_env()
+        self._streams = TTLCache(maxsize=self.settings.buffer_max_streams, ttl=self.settings.buffer_ttl)
+        self.opened = 0
+        self.resumed = 0
+        self.restarted = 0
+
+    def open(self, user_id: int, produce: Callable[[EventStream], Awaitable[None]]) -> EventStream:
+        """在后台任务中执行 produce(stream) 生成事件，出错时追加 error 事件"""
+        stream = EventStream(user_id)
+        stream.task = asyncio.create_task(self._run(stream, produce))
+        self._streams.set(stream.stream_id, stream)
+        self.opened += 1
+        return stream
+
+    async def _run(self, stream: EventStream, produce):
+        try:
+            await produce(stream)
+        except Exception as exc:
+            logger.exception("生成流式回复失败")
+            await stream.publish("error", {"message": str(exc)})
+        finally:
+            await stream.close()
+
+    def resume(self, user_id: int, last_event_id: Optional[str]) -> Optional[Tuple[EventStream, int]]:
+        """按 Last-Event-ID 找到缓冲中的流和已收到的序号；找不到时返回 None，由调用方重新开始"""
+        if not last_event_id:
+            return None
+        stream_id, _, seq = last_event_id.strip().rpartition("-")
+        stream = self._streams.get(stream_id) if seq.isdigit() else None
+        if stream is not None and stream.user_id == user_id and (
+            stream.done or stream.task.get_loop() is asyncio.get_running_loop()
+        ):
+            self.resumed += 1
+            return stream, min(int(seq), len(stream.events))
+        self.restarted += 1
+        return None
+
+    def response(self, stream: EventStream, after: int = 0) -> StreamingResponse:
+        async def frames():
+            yield f"retry: {self.settings.retry_ms}\n\n"
+            async for frame in stream.follow(after, self.settings.heartbeat):
+                yield frame
+
+        return StreamingResponse(frames(), media_type=EVENT_STREAM, headers={
+            "Cache-Control": "no-cache",
+            # 关闭 nginx 的响应缓冲，事件立即到达客户端
+            "X-Accel-Buffering": "no",
+        })
+
+    def get_stats(self) -> dict:
+        return {
+            "buffered_streams": len(self._streams),
+            "opened": self.opened,
+            "resumed": self.resumed,
+            "restarted": self.restarted,
+            "flush_chars": self.settings.flush_chars,
+            "flush_interval_seconds": self.settings.flush_interval,
+            "heartbeat_seconds": self.settings.heartbeat,
+            "buffer_ttl_seconds": self.settings.buffer_ttl,
+        }
+
+
+event_streams = EventStreamRegistry()
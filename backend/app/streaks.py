@@ -0,0 +1,195 @@
+"""
+连续打卡
+
+user_streaks 按用户记录当前连续天数、最长连续天数和最后打卡日期：
+plan_id 为 0（ALL_PLANS）的一行统计该用户的全部计划，其余每个计划一行。
+
+- 新打卡日期不早于最后打卡日期时，一条 INSERT ... ON CONFLICT DO UPDATE 完成 O(1) 更新：
+  同一天不变，紧接着的后一天加一，中间断开则从 1 重新开始
+- 补打卡（早于最后打卡日期）、修改和删除打卡时，从 user_daily_stats 读出打卡日期重新计算
+- 重新计算按“日期序号 - 行号”分段（gaps and islands），只遍历有打卡的日期，不逐日遍历日历
+
+存储的 current_streak 是截至最后打卡日期的连续天数；最后打卡早于昨天时已经断开，读取时用 current_streak() 换算。
+group_members.last_checkin（用户在各群组中的最后打卡日期）也在这里随打卡一条 UPDATE 更新。
+历史数据用 python -m app.maintenance rebuild-streaks 重建（需先重建每日汇总）。
+"""
+from dataclasses import dataclass
+from datetime import date, timedelta
+from itertools import groupby
+from typing import Iterable, List, Optional
+
+from sqlalchemy import case, delete, or_, select, update
+
+from app.daily_stats import dialect_insert
+from app.models import GroupMember, UserDailyStat, UserStreak
+
+ALL_PLANS = 0
+
+streaks = UserStreak.__table__
+stats = UserDailyStat.__table__
+group_members = GroupMember.__table__
+
+
+@dataclass
+class Streak:
+    """截至最后打卡日期的连续天数和最长连续天数"""
+    current: int
+    longest: int
+    last_date: Optional[date]
+
+
+def streaks_from_dates(dates: Iterable[date]) -> Streak:
+    """由打卡日期计算连续天数：连续日期的“日期序号 - 行号”相同，按它分段即可"""
+    ordered = sorted(set(dates))
+    if not ordered:
+        return Streak(current=0, longest=0, last_date=None)
+    runs = [
+        len(list(run))
+        for _, run in groupby(enumerate(ordered), key=lambda item: item[1].toordinal() - item[0])
+    ]
+    return Streak(current=runs[-1], longest=max(runs), last_date=ordered[-1])
+
+
+def current_streak(current: int, last_date: Optional[date], today: Optional[date] = None) -> int:
+    """换算到 today 的当前连续天数：今天或昨天打过卡才算连续"""
+    today = today or date.today()
+    if last_date is None or last_date < today - timedelta(days=1):
+        return 0
+    return current
+
+
+def advance_statement(db, user_id: int, plan_id: int, checkin_date: date):
+    """按新打卡日期推进连续天数；日期早于最后打卡日期时不更新（rowcount 为 0），需要重新计算"""
+    statement = dialect_insert(db, streaks).values(
+        user_id=user_id, plan_id=plan_id,
+        current_streak=1, longest_streak=1, last_checkin_date=checkin_date
+    )
+    advanced = case(
+        (streaks.c.last_checkin_date == checkin_date, streaks.c.current_streak),
+        (streaks.c.last_checkin_date == checkin_date - timedelta(days=1), streaks.c.current_streak + 1),
+        else_=1
+    )
+    return statement.on_conflict_do_update(
+        index_elements=[streaks.c.user_id, streaks.c.plan_id],
+        set_={
+            "current_streak": advanced,
+            "longest_streak": case((advanced > streaks.c.longest_streak, advanced), else_=streaks.c.longest_streak),
+            "last_checkin_date": checkin_date,
+        },
+        where=streaks.c.last_checkin_date <= checkin_date
+    )
+
+
+def _dates_query(user_id: int, plan_id: int):
+    query = select(stats.c.stat_date).where(stats.c.user_id == user_id, stats.c.checkin_count > 0)
+    if plan_id != ALL_PLANS:
+        query = query.where(stats.c.plan_id == plan_id)
+    return query.distinct()
+
+
+def _store_statement(db, user_id: int, plan_id: int, streak: Streak):
+    """写入重新计算的结果；没有打卡日期时删除该行"""
+    if streak.last_date is None:
+        return delete(streaks).where(streaks.c.user_id == user_id, streaks.c.plan_id == plan_id)
+    values = {
+        "current_streak": streak.current,
+        "longest_streak": streak.longest,
+        "last_checkin_date": streak.last_date,
+    }
+    return dialect_insert(db, streaks).values(user_id=user_id, plan_id=plan_id, **values).on_conflict_do_update(
+        index_elements=[streaks.c.user_id, streaks.c.plan_id], set_=values
+    )
+
+
+async def recompute(db, user_id: int, plan_id: int = ALL_PLANS) -> Streak:
+    """从每日汇总重新计算一个范围的连续天数并写入（调用方负责提交）"""
+    dates = (await db.execute(_dates_query(user_id, plan_id))).scalars().all()
+    streak = streaks_from_dates(dates)
+    await db.execute(_store_statement(db, user_id, plan_id, streak))
+    return streak
+
+
+async def record_streak_change(db, before: Optional[tuple] = None, after: Optional[tuple] = None):
+    """
+    打卡写入后更新连续天数，需在 record_checkin_change 之后、同一事务中调用
+
+    before / after 与 record_checkin_change 相同，为 (user_id, plan_id, checkin_date, duration_min)。
+    新建打卡先尝试 O(1) 推进，补打卡时退回重新计算；修改和删除直接重新计算受影响的范围。
+    """
+    if before is None and after is not None:
+        user_id, plan_id, checkin_date = after[:3]
+        for scope in (ALL_PLANS, plan_id):
+            result = await db.execute(advance_statement(db, user_id, scope, checkin_date))
+            if result.rowcount == 0:
+                await recompute(db, user_id, scope)
+        return
+
+    scopes = {ALL_PLANS}
+    for key in (before, after):
+        if key is not None:
+            scopes.add(key[1])
+    user_id = (before or after)[0]
+    for scope in sorted(scopes):
+        await recompute(db, user_id, scope)
+
+
+def advance_group_last_checkin(user_id: int, checkin_date: date):
+    """
+    用户所在全部群组的 last_checkin 推进到 checkin_date（只增不减，相当于 GREATEST）
+
+    一条 UPDATE，只改写早于该日期的行；并发打卡按行加锁依次执行，结果总是较晚的日期。
+    """
+    return update(group_members).where(
+        group_members.c.user_id == user_id,
+        or_(group_members.c.last_checkin.is_(None), group_members.c.last_checkin < checkin_date)
+    ).values(last_checkin=checkin_date)
+
+
+def sync_group_last_checkin(user_id: int):
+    """修改或删除打卡后，把 last_checkin 同步为 user_streaks 中的最后打卡日期（需在 record_streak_change 之后执行）"""
+    latest = select(streaks.c.last_checkin_date).where(
+        streaks.c.user_id == user_id,
+        streaks.c.plan_id == ALL_PLANS
+    ).scalar_subquery()
+    return update(group_members).where(group_members.c.user_id == user_id).values(last_checkin=latest)
+
+
+def rebuild_streaks(db, user_id: Optional[int] = None, batch_size: int = 1000) -> int:
+    """从每日汇总重建连续打卡记录（同步会话，调用方负责提交），返回写入的行数"""
+    clear = delete(streaks)
+    source = select(stats.c.user_id, stats.c.plan_id, stats.c.stat_date).where(stats.c.checkin_count > 0)
+    if user_id is not None:
+        clear = clear.where(streaks.c.user_id == user_id)
+        source = source.where(stats.c.user_id == user_id)
+    db.execute(clear)
+
+    rows = db.execute(
+        source.order_by(stats.c.user_id, stats.c.plan_id, stats.c.stat_date).execution_options(yield_per=10000)
+    )
+    pending: List[dict] = []
+    written = 0
+    for current_user_id, user_rows in groupby(rows, key=lambda row: row.user_id):
+        all_dates = []
+        for plan_id, plan_rows in groupby(user_rows, key=lambda row: row.plan_id):
+            dates = [row.stat_date for row in plan_rows]
+            all_dates.extend(dates)
+            pending.append(_row(current_user_id, plan_id, streaks_from_dates(dates)))
+        pending.append(_row(current_user_id, ALL_PLANS, streaks_from_dates(all_dates)))
+        if len(pending) >= batch_size:
+            db.execute(streaks.insert(), pending)
+            written += len(pending)
+            pending = []
+    if pending:
+        db.execute(streaks.insert(), pending)
+        written += len(pending)
+    return written
+
+
+def _row(user_id: int, plan_id: int, streak: Streak) -> dict:
+    return {
+        "user_id": user_id,
+        "plan_id": plan_id,
+        "current_streak": streak.current,
+        "longest_streak": streak.longest,
+        "last_checkin_date": streak.last_date,
+    }
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+群聊广播扇出基准测试
+
+在进程内模拟一个满员群聊（默认 500 个连接，对应 ChatRoom.max_members），
+其中少数连接是慢客户端（每次发送都要等待较长时间）。
+对比两种广播方式下正常客户端收到消息的延迟：
+1. sequential：逐个 await send_text（原实现）
+2. queued：ConnectionManager 的每连接发送队列 + 写协程
+
+用法：
+    python benchmarks/bench_fanout.py --sockets 500 --slow 5 --slow-delay-ms 200
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.chat_broker import InProcessBroker
+from app.chat_websocket import ConnectionManager, ConnectionSettings
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="群聊广播扇出基准测试")
+    parser.add_argument("--sockets", type=int, default=500, help="群聊在线连接数")
+    parser.add_argument("--slow", type=int, default=5, help="慢客户端数量")
+    parser.add_argument("--slow-delay-ms", type=float, default=200, help="慢客户端每次发送耗时（毫秒）")
+    parser.add_argument("--send-delay-ms", type=float, default=0.05, help="正常客户端每次发送耗时（毫秒）")
+    parser.add_argument("--messages", type=int, default=20, help="广播消息条数")
+    return parser.parse_args()
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class SimulatedWebSocket:
+    """按固定耗时完成发送，并记录每条消息的送达时刻"""
+
+    def __init__(self, delay_ms: float, slow: bool):
+        self.delay = delay_ms / 1000
+        self.slow = slow
+        self.received_at = []
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, data: str):
+        await asyncio.sleep(self.delay)
+        self.received_at.append(time.perf_counter())
+
+    async def close(self, code=1000):
+        pass
+
+
+def make_sockets(args):
+    return [
+        SimulatedWebSocket(args.slow_delay_ms if i < args.slow else args.send_delay_ms, i < args.slow)
+        for i in range(args.sockets)
+    ]
+
+
+async def run_sequential(args):
+    sockets = make_sockets(args)
+    sent_at = []
+    for seq in range(args.messages):
+        sent_at.append(time.perf_counter())
+        for ws in sockets:
+            await ws.send_text(f'{{"seq": {seq}}}')
+    return sockets, sent_at
+
+
+async def run_queued(args):
+    settings = ConnectionSettings(
+        queue_size=max(args.messages, 1),
+        slow_consumer_timeout_ms=int(args.slow_delay_ms * 10),
+    )
+    manager = ConnectionManager(InProcessBroker(), settings)
+    sockets = make_sockets(args)
+    for user_id, ws in enumerate(sockets):
+        manager.subscribe(await manager.connect(ws, user_id), 1)
+
+    sent_at = []
+    for seq in range(args.messages):
+        sent_at.append(time.perf_counter())
+        await manager.broadcast_to_room(1, {"seq": seq})
+        await asyncio.sleep(0)
+
+    fast = [ws for ws in sockets if not ws.slow]
+    while any(len(ws.received_at) < args.messages for ws in fast):
+        await asyncio.sleep(0.001)
+    for user_id in range(len(sockets)):
+        manager.disconnect(user_id)
+    return sockets, sent_at
+
+
+def report(title, sockets, sent_at):
+    latencies = [
+        (received - sent_at[seq]) * 1000
+        for ws in sockets if not ws.slow
+        for seq, received in enumerate(ws.received_at)
+    ]
+    print(f"\n=== {title} ===")
+    print(f"正常客户端送达 {len(latencies)} 条")
+    print(f"p50 {percentile(latencies, 50):.1f} ms | p95 {percentile(latencies, 95):.1f} ms | "
+          f"p99 {percentile(latencies, 99):.1f} ms | max {max(latencies):.1f} ms | "
+          f"mean {statistics.mean(latencies):.1f} ms")
+
+
+def main():
+    args = parse_args()
+    print(f"{args.sockets} 个连接，其中 {args.slow} 个慢客户端（{args.slow_delay_ms} ms/次），"
+          f"广播 {args.messages} 条消息")
+    report("sequential（逐个 await send_text）", *asyncio.run(run_sequential(args)))
+    report("queued（每连接发送队列 + 写协程）", *asyncio.run(run_queued(args)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+"""
+大模型流式接口首字节 / 首字延迟基准测试
+
+启动一个本地的 OpenAI 兼容模拟大模型（首段延迟 --first-token 秒，之后每 --token-interval 秒输出一段），
+再在同一进程中用 uvicorn 运行 AI 路由（认证和数据库依赖替换为固定用户和临时 SQLite，只测流式输出本身），
+分别以原格式和 SSE 模式请求 /ai/weekly_report/stream 与 /ai/learning_coach，输出：
+- TTFB：收到第一个字节的时间
+- 首字：收到第一段模型内容的时间（JSON 行中的 analysis、SSE 的 analysis 事件、纯文本的第一个字节）
+- 总耗时和帧数（SSE 含 retry 和心跳帧）
+
+用法：
+    python benchmarks/bench_llm_stream.py --clients 20 --tokens 200
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="大模型流式接口首字节延迟基准测试")
+    parser.add_argument("--clients", type=int, default=20, help="每种模式的并发请求数")
+    parser.add_argument("--tokens", type=int, default=200, help="模拟模型每次回复的分段数")
+    parser.add_argument("--token-chars", type=int, default=2, help="每段字符数")
+    parser.add_argument("--first-token", type=float, default=0.1, help="模拟模型的首段延迟（秒）")
+    parser.add_argument("--token-interval", type=float, default=0.01, help="模拟模型的分段间隔（秒）")
+    return parser.parse_args()
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_server(app, port):
+    import uvicorn
+
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+
+def fake_llm(args):
+    from fastapi import FastAPI, Request
+    from fastapi.responses import StreamingResponse
+
+    llm = FastAPI()
+    token = "学" * args.token_chars
+
+    @llm.post("/chat/completions")
+    async def completions(request: Request):
+        body = await request.json()
+
+        async def sse():
+            await asyncio.sleep(args.first_token)
+            for i in range(args.tokens):
+                if i:
+                    await asyncio.sleep(args.token_interval)
+                chunk = {"id": "bench", "object": "chat.completion.chunk", "created": 0, "model": body["model"],
+                         "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}]}
+                yield f"data: {json.dumps(chunk)}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(sse(), media_type="text/event-stream")
+
+    return llm
+
+
+def api_app(database_url):
+    from fastapi import FastAPI
+    from sqlalchemy import create_engine
+    from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+    import app.chat_models  # noqa: F401  注册 Group -> ChatRoom 关系
+    from app.auth import get_current_user
+    from app.database import Base, to_async_url
+    from app.models import User
+    from app.routes import ai
+
+    engine = create_engine(database_url)
+    Base.metadata.create_all(bind=engine)
+    ai.AsyncSessionLocal = async_sessionmaker(
+        create_async_engine(to_async_url(database_url)), class_=AsyncSession, expire_on_commit=False
+    )
+
+    api = FastAPI()
+    api.include_router(ai.router, prefix="/api")
+    # 每个请求使用不同用户，避免周报流的同键合并掩盖首字延迟
+    counter = iter(range(1, 10 ** 9))
+    api.dependency_overrides[get_current_user] = lambda: User(id=next(counter), username="bench")
+    return api
+
+
+COACH_DATA = {
+    "learning_goal": "考研", "weekly_total_hours": 10, "average_daily_hours": 1.5,
+    "target_daily_hours": 2, "consecutive_checkin_days": 3, "missed_checkin_days": 1,
+}
+
+
+def is_content(mode, data):
+    """本次读到的字节中是否包含模型内容"""
+    if mode == "coach_text":
+        return bool(data)
+    if mode.endswith("_sse"):
+        return "event: analysis" in data
+    return '"type": "analysis"' in data
+
+
+async def one_request(client, mode, week_offset):
+    if mode.startswith("weekly"):
+        # 不同的周，统计输入不同，每个请求都会调用模型
+        request = client.build_request("GET", "/api/ai/weekly_report/stream",
+                                       params={"week_date": f"2024-{1 + week_offset // 28:02d}-{1 + week_offset % 28:02d}"})
+    else:
+        request = client.build_request("POST", "/api/ai/learning_coach", json=COACH_DATA)
+    if mode.endswith("_sse"):
+        request.headers["Accept"] = "text/event-stream"
+    start = time.perf_counter()
+    first_byte = first_content = None
+    text = ""
+    reads = 0
+    response = await client.send(request, stream=True)
+    async for data in response.aiter_text():
+        now = time.perf_counter() - start
+        if first_byte is None:
+            first_byte = now
+        text += data
+        reads += 1
+        if first_content is None and is_content(mode, text):
+            first_content = now
+    await response.aclose()
+    if mode.endswith("_sse"):
+        frames = text.count("\n\n")
+    elif mode == "coach_text":
+        # 纯文本没有分帧，按读取次数计
+        frames = reads
+    else:
+        frames = text.count("\n")
+    return first_byte * 1000, first_content * 1000, (time.perf_counter() - start) * 1000, frames
+
+
+async def run_mode(port, mode, clients):
+    import httpx
+
+    async with httpx.AsyncClient(base_url=f"http://127.0.0.1:{port}", timeout=120) as client:
+        return await asyncio.gather(*[one_request(client, mode, i) for i in range(clients)])
+
+
+def report(mode, results):
+    ttfb, first, total, frames = zip(*results)
+    print(f"\n=== {mode} ===")
+    print(f"TTFB  p50 {percentile(ttfb, 50):.1f} ms | p95 {percentile(ttfb, 95):.1f} ms")
+    print(f"首字  p50 {percentile(first, 50):.1f} ms | p95 {percentile(first, 95):.1f} ms | max {max(first):.1f} ms")
+    print(f"总耗时 p50 {percentile(total, 50):.1f} ms | 平均帧数 {statistics.mean(frames):.1f}")
+
+
+def main():
+    args = parse_args()
+    llm_port = free_port()
+    os.environ.update({
+        "LLM_BASE_URL": f"http://127.0.0.1:{llm_port}",
+        "LLM_API_KEY": "bench",
+        "LLM_CACHE_BACKEND": "off",
+        "LLM_MAX_CONCURRENCY": str(max(10, args.clients)),
+        "LLM_MAX_CONNECTIONS": str(max(20, args.clients)),
+    })
+    database_url = f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'bench_llm_stream.db')}"
+
+    llm_server = start_server(fake_llm(args), llm_port)
+    api_port = free_port()
+    api_server = start_server(api_app(database_url), api_port)
+    try:
+        # 预热：首次请求会创建模型客户端和连接池
+        asyncio.run(run_mode(api_port, "coach_text", 1))
+        for mode in ("weekly_json", "weekly_sse", "coach_text", "coach_sse"):
+            report(mode, asyncio.run(run_mode(api_port, mode, args.clients)))
+    finally:
+        api_server.should_exit = True
+        llm_server.should_exit = True
+
+
+if __name__ == "__main__":
+    main()
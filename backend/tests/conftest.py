@@ -0,0 +1,93 @@
+import asyncio
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, event
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from app.auth import get_current_user, user_cache
+from app.chat_access import room_access
+from app.database import Base, get_async_db, get_db
+from app.main import app
+from app.models import User
+
+
+@pytest.fixture(autouse=True)
+def clear_process_caches():
+    """每个测试使用独立的数据库，进程内缓存不能跨测试复用"""
+    room_access.clear()
+    user_cache.clear()
+    yield
+    room_access.clear()
+    user_cache.clear()
+
+
+class TempDatabase:
+    """
+    文件型 SQLite 测试库
+
+    同步引擎写入测试数据，路由通过覆盖 get_db / get_async_db 使用同一个文件；
+    两个引擎执行的 SQL 都记录在 statements 中，用于断言查询次数。
+    """
+
+    def __init__(self, path):
+        self.engine = create_engine(f"sqlite:///{path}")
+        Base.metadata.create_all(bind=self.engine)
+        self.session_factory = sessionmaker(bind=self.engine)
+        self.async_engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+        self.async_session_factory = async_sessionmaker(
+            self.async_engine, class_=AsyncSession, expire_on_commit=False
+        )
+        self.statements = []
+        for target in (self.engine, self.async_engine.sync_engine):
+            event.listen(target, "before_cursor_execute",
+                         lambda conn, cursor, sql, *args: self.statements.append(sql))
+
+    def add(self, *groups):
+        """按顺序写入多组数据，每组之后 flush（后一组可以引用前一组的外键），最后提交；不记录写入数据的 SQL"""
+        db = self.session_factory()
+        try:
+            for rows in groups:
+                db.add_all(rows)
+                db.flush()
+            db.commit()
+        finally:
+            db.close()
+        self.statements.clear()
+
+    def client(self, user_id: int = 1, username: str = "alice") -> TestClient:
+        """覆盖数据库依赖和当前用户，返回测试客户端"""
+        async def override_get_async_db():
+            async with self.async_session_factory() as session:
+                yield session
+
+        def override_get_db():
+            db = self.session_factory()
+            try:
+                yield db
+            finally:
+                db.close()
+
+        app.dependency_overrides[get_async_db] = override_get_async_db
+        app.dependency_overrides[get_db] = override_get_db
+        app.dependency_overrides[get_current_user] = lambda: User(id=user_id, username=username)
+        return TestClient(app)
+
+    def dispose(self):
+        asyncio.run(self.async_engine.dispose())
+        self.engine.dispose()
+
+
+@pytest.fixture
+def make_database(tmp_path):
+    """按文件名创建测试库，测试结束后清除依赖覆盖并关闭引擎"""
+    databases = []
+
+    def make(name: str = "test.db") -> TempDatabase:
+        database = TempDatabase(tmp_path / name)
+        databases.append(database)
+        return database
+
+    yield make
+    app.dependency_overrides.clear()
+    for database in databases:
+        database.dispose()
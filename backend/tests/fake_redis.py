@@ -0,0 +1,70 @@
+"""
+进程内的 Redis 发布/订阅替身
+
+只实现 RedisBroker 用到的 publish() / pubsub() 接口，以及 RedisFlightLock 用到的 set(nx, px) / eval()，
+多个 RedisBroker 共用同一个 FakeRedis 即可模拟多个 worker 订阅同一频道。
+"""
+import asyncio
+from typing import Dict, List
+
+
+class FakePubSub:
+    def __init__(self, server: "FakeRedis"):
+        self.server = server
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.channels: List[str] = []
+
+    async def subscribe(self, *channels):
+        for channel in channels:
+            self.channels.append(channel)
+            self.server.subscribers.setdefault(channel, []).append(self)
+            await self.queue.put({"type": "subscribe", "channel": channel, "data": 1})
+
+    async def unsubscribe(self, *channels):
+        for channel in channels or list(self.channels):
+            if self in self.server.subscribers.get(channel, []):
+                self.server.subscribers[channel].remove(self)
+            if channel in self.channels:
+                self.channels.remove(channel)
+
+    async def listen(self):
+        while True:
+            yield await self.queue.get()
+
+    async def aclose(self):
+        await self.unsubscribe()
+
+
+class FakeRedis:
+    def __init__(self):
+        self.subscribers: Dict[str, List[FakePubSub]] = {}
+        self.published = 0
+        # 键值（不模拟过期）
+        self.values: Dict[str, bytes] = {}
+
+    def pubsub(self) -> FakePubSub:
+        return FakePubSub(self)
+
+    async def publish(self, channel: str, data) -> int:
+        # 与真实 Redis 一样，订阅端收到的是字节串
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self.published += 1
+        receivers = self.subscribers.get(channel, [])
+        for pubsub in receivers:
+            await pubsub.queue.put({"type": "message", "channel": channel, "data": data})
+        return len(receivers)
+
+    async def set(self, name: str, value, nx: bool = False, px=None):
+        if nx and name in self.values:
+            return None
+        self.values[name] = value.encode("utf-8") if isinstance(value, str) else value
+        return True
+
+    async def eval(self, script: str, numkeys: int, *args):
+        # 只支持 RedisFlightLock.RELEASE_SCRIPT：值相同时删除
+        name, token = args[0], args[1]
+        if self.values.get(name) == token.encode("utf-8"):
+            del self.values[name]
+            return 1
+        return 0
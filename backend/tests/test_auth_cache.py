@@ -0,0 +1,122 @@
+import asyncio
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, event
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from app.auth import create_access_token, get_current_user, get_current_user_ws, user_cache
+from app.database import Base, get_db
+from app.main import app
+from app.models import User
+
+
+@pytest.fixture
+def setup(tmp_path):
+    path = tmp_path / "auth.db"
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(bind=engine)
+    session_factory = sessionmaker(bind=engine)
+    db = session_factory()
+    db.add(User(id=1, username="alice", email="alice@example.com", password_hash="x"))
+    db.commit()
+    db.close()
+
+    statements = []
+    event.listen(engine, "before_cursor_execute", lambda conn, cursor, sql, *args: statements.append(sql))
+
+    def override_get_db():
+        db = session_factory()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    app.dependency_overrides[get_db] = override_get_db
+    headers = {"Authorization": f"Bearer {create_access_token({'sub': '1'})}"}
+    yield TestClient(app), headers, session_factory, statements, path
+    app.dependency_overrides.clear()
+    engine.dispose()
+
+
+def user_queries(statements):
+    return [sql for sql in statements if "FROM users" in sql]
+
+
+class TestUserCache:
+    """测试已认证用户缓存"""
+
+    def test_second_request_skips_user_query(self, setup):
+        client, headers, _, statements, _ = setup
+
+        assert client.get("/api/users/me", headers=headers).json()["data"]["username"] == "alice"
+        assert len(user_queries(statements)) == 1
+        assert client.get("/api/users/me", headers=headers).json()["data"]["username"] == "alice"
+        assert len(user_queries(statements)) == 1
+        assert user_cache.get_stats()["hits"] >= 1
+
+    def test_invalid_token_still_rejected(self, setup):
+        client, headers, *_ = setup
+        client.get("/api/users/me", headers=headers)
+
+        response = client.get("/api/users/me", headers={"Authorization": "Bearer invalid"})
+        assert response.status_code == 401
+
+    def test_profile_update_invalidates(self, setup):
+        client, headers, session_factory, *_ = setup
+        client.get("/api/users/me", headers=headers)
+
+        db = session_factory()
+        db.get(User, 1).username = "alice2"
+        db.commit()
+        db.close()
+
+        assert client.get("/api/users/me", headers=headers).json()["data"]["username"] == "alice2"
+
+    def test_deleted_user_rejected(self, setup):
+        client, headers, session_factory, *_ = setup
+        client.get("/api/users/me", headers=headers)
+
+        db = session_factory()
+        db.delete(db.get(User, 1))
+        db.commit()
+        db.close()
+
+        assert client.get("/api/users/me", headers=headers).status_code == 401
+
+    def test_cached_user_is_attached_to_request_session(self, setup):
+        _, _, session_factory, *_ = setup
+        token = create_access_token({"sub": "1"})
+        first = session_factory()
+        get_current_user(token, first)
+        first.close()
+
+        db = session_factory()
+        user = get_current_user(token, db)
+        assert user in db
+        user.avatar_url = "https://example.com/a.png"
+        db.commit()
+        db.close()
+
+        check = session_factory()
+        assert check.get(User, 1).avatar_url == "https://example.com/a.png"
+        check.close()
+
+    def test_websocket_auth_uses_cache(self, setup):
+        *_, path = setup
+        engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+        statements = []
+        event.listen(engine.sync_engine, "before_cursor_execute",
+                     lambda conn, cursor, sql, *args: statements.append(sql))
+        session_factory = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+        token = create_access_token({"sub": "1"})
+
+        async def scenario():
+            names = []
+            for _ in range(3):
+                async with session_factory() as db:
+                    names.append((await get_current_user_ws(token, db)).username)
+            await engine.dispose()
+            return names
+
+        assert asyncio.run(scenario()) == ["alice"] * 3
+        assert len(user_queries(statements)) == 1
@@ -0,0 +1,209 @@
+import asyncio
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, event, update
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from app.auth import get_current_user
+from app.cache import TTLCache
+from app.chat_access import RoomAccessCache, room_access
+from app.chat_broker import InProcessBroker
+from app.chat_message_writer import message_writer
+from app.chat_models import ChatMessage, ChatRoom, ChatRoomMember
+from app.chat_websocket import ConnectionManager, ConnectionSettings
+from app.database import Base, get_async_db
+from app.main import app
+from app.models import User
+
+
+class FakeTimer:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestTTLCache:
+    """测试 LRU + TTL 缓存"""
+
+    def test_hit_miss_and_expiry(self):
+        timer = FakeTimer()
+        cache = TTLCache(maxsize=10, ttl=5, timer=timer)
+        cache.set("a", 1)
+
+        assert cache.get("a") == 1
+        timer.now = 5
+        assert cache.get("a") is None
+        assert cache.get_stats()["hits"] == 1
+        assert cache.get_stats()["misses"] == 1
+        assert len(cache) == 0
+
+    def test_lru_eviction(self):
+        cache = TTLCache(maxsize=2, ttl=60)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        cache.get("a")
+        cache.set("c", 3)
+
+        assert cache.get("b") is None
+        assert cache.get("a") == 1 and cache.get("c") == 3
+        assert cache.get_stats()["evictions"] == 1
+
+    def test_invalidation(self):
+        cache = TTLCache(maxsize=10, ttl=60)
+        for key in [(1, 1), (1, 2), (2, 1)]:
+            cache.set(key, True)
+
+        assert cache.pop((2, 1)) is True
+        assert cache.pop_where(lambda key: key[0] == 1) == 2
+        assert len(cache) == 0
+        assert cache.get_stats()["invalidations"] == 3
+
+    def test_disabled_when_ttl_zero(self):
+        cache = TTLCache(maxsize=10, ttl=0)
+        cache.set("a", 1)
+
+        assert cache.get("a") is None
+
+
+@pytest.fixture
+def setup(tmp_path):
+    """群聊 1：alice 群主、bob 普通成员；carol 不是成员"""
+    path = tmp_path / "access.db"
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(bind=engine)
+    db = sessionmaker(bind=engine, expire_on_commit=False)()
+    users = {name: User(id=i, username=name, password_hash="x")
+             for i, name in enumerate(["alice", "bob", "carol"], start=1)}
+    db.add_all(users.values())
+    db.flush()
+    db.add(ChatRoom(id=1, chat_id="ROOM01", name="数学", created_by=1))
+    db.flush()
+    db.add_all([
+        ChatRoomMember(id=1, chat_room_id=1, user_id=1, role="owner"),
+        ChatRoomMember(id=2, chat_room_id=1, user_id=2),
+    ])
+    db.add(ChatMessage(id=1, chat_room_id=1, user_id=1, content="hi"))
+    db.commit()
+    db.close()
+
+    async_engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+    statements = []
+    event.listen(async_engine.sync_engine, "before_cursor_execute",
+                 lambda conn, cursor, sql, *args: statements.append(sql))
+    session_factory = async_sessionmaker(async_engine, class_=AsyncSession, expire_on_commit=False)
+
+    async def override_get_async_db():
+        async with session_factory() as session:
+            yield session
+
+    app.dependency_overrides[get_async_db] = override_get_async_db
+    yield TestClient(app), users, engine, statements, session_factory
+    app.dependency_overrides.clear()
+    engine.dispose()
+
+
+def as_user(user):
+    app.dependency_overrides[get_current_user] = lambda: user
+
+
+class TestRoomAccessCache:
+    """测试群聊接口的权限缓存"""
+
+    def test_cached_check_skips_queries(self, setup):
+        client, users, _, statements, _ = setup
+        as_user(users["bob"])
+
+        assert client.get("/api/chat-rooms/1/messages").status_code == 200
+        first = len(statements)
+        hits = room_access.get_stats()["hits"]
+        statements.clear()
+        assert client.get("/api/chat-rooms/1/messages").status_code == 200
+
+        # 第二次请求省掉群聊和成员两次查询
+        assert len(statements) == first - 1
+        assert not any("chat_room_members" in sql for sql in statements)
+        assert room_access.get_stats()["hits"] == hits + 1
+
+    def test_removed_member_loses_access(self, setup):
+        client, users, *_ = setup
+        as_user(users["bob"])
+        assert client.get("/api/chat-rooms/1/messages").status_code == 200
+
+        as_user(users["alice"])
+        assert client.delete("/api/chat-rooms/1/members/2").status_code == 200
+
+        as_user(users["bob"])
+        assert client.get("/api/chat-rooms/1/messages").status_code == 403
+
+    def test_role_change_invalidates(self, setup):
+        client, users, *_ = setup
+        as_user(users["bob"])
+        assert client.put("/api/chat-rooms/1", json={"name": "线代"}).status_code == 403
+
+        as_user(users["alice"])
+        assert client.put("/api/chat-rooms/1/members/2/role", json={"role": "admin"}).status_code == 200
+
+        as_user(users["bob"])
+        assert client.put("/api/chat-rooms/1", json={"name": "线代"}).status_code == 200
+
+    def test_non_member_is_cached_until_invalidated(self, setup):
+        client, users, engine, *_ = setup
+        as_user(users["carol"])
+        assert client.get("/api/chat-rooms/1/messages").status_code == 403
+
+        with engine.begin() as conn:
+            conn.execute(ChatRoomMember.__table__.insert().values(id=3, chat_room_id=1, user_id=3, role="member"))
+        # 未失效前仍命中“不是成员”的缓存
+        assert client.get("/api/chat-rooms/1/messages").status_code == 403
+
+        room_access.invalidate(1, 3)
+        assert client.get("/api/chat-rooms/1/messages").status_code == 200
+
+    def test_mute_takes_effect_after_invalidation(self, setup, monkeypatch):
+        client, users, engine, _, session_factory = setup
+        monkeypatch.setattr(message_writer, "session_factory", session_factory)
+        as_user(users["bob"])
+        assert client.post("/api/chat-rooms/1/messages", params={"content": "a"}).status_code == 200
+
+        with engine.begin() as conn:
+            conn.execute(update(ChatRoomMember).where(ChatRoomMember.user_id == 2).values(is_muted=True))
+        room_access.invalidate(1, 2)
+
+        response = client.post("/api/chat-rooms/1/messages", params={"content": "b"})
+        assert response.status_code == 403
+        assert response.json()["detail"] == "您已被禁言，无法发送消息"
+
+    def test_broker_envelope_invalidates_other_workers(self):
+        async def scenario():
+            cache_key = (1, 2)
+            room_access.cache.set(cache_key, "stale")
+            manager = ConnectionManager(InProcessBroker(), ConnectionSettings())
+            await manager.deliver({"kind": "access", "chat_room_id": 1, "user_id": None})
+            return room_access.cache.get(cache_key)
+
+        assert asyncio.run(scenario()) is None
+
+    def test_invalidation_during_load_is_not_cached(self, setup):
+        *_, session_factory = setup
+        cache = RoomAccessCache(maxsize=10, ttl=60)
+
+        async def scenario():
+            async with session_factory() as db:
+                original = db.execute
+
+                async def execute_then_invalidate(*args, **kwargs):
+                    result = await original(*args, **kwargs)
+                    # 查询返回后、写入缓存前，其他请求修改了成员
+                    cache.invalidate(1, 2)
+                    return result
+
+                db.execute = execute_then_invalidate
+                access = await cache.get(db, 1, 2)
+            return access
+
+        access = asyncio.run(scenario())
+
+        assert access.role == "member"
+        assert len(cache.cache) == 0
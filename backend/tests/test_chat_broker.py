@@ -0,0 +1,92 @@
+import asyncio
+import json
+from app.chat_broker import InProcessBroker, RedisBroker, create_broker_from_env
+from app.chat_websocket import ConnectionManager
+from tests.fake_redis import FakeRedis
+
+
+class FakeWebSocket:
+    """记录收到的文本帧"""
+
+    def __init__(self):
+        self.sent = []
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, data: str):
+        self.sent.append(json.loads(data))
+
+
+async def wait_until(predicate, timeout=1.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not predicate():
+        if asyncio.get_running_loop().time() > deadline:
+            raise AssertionError("等待超时")
+        await asyncio.sleep(0.005)
+
+
+class TestInProcessBroker:
+    """测试单进程代理"""
+
+    def test_broadcast_reaches_local_sockets(self):
+        async def scenario():
+            manager = ConnectionManager(InProcessBroker())
+            ws1, ws2 = FakeWebSocket(), FakeWebSocket()
+            manager.subscribe(await manager.connect(ws1, 10), 1)
+            manager.subscribe(await manager.connect(ws2, 11), 1)
+
+            await manager.broadcast_to_room(1, {"type": "message", "content": "hi"}, exclude_user_id=11)
+            await manager.send_to_user(11, {"type": "system", "content": "only you"})
+            await wait_until(lambda: ws1.sent and ws2.sent)
+            return ws1.sent, ws2.sent
+
+        sent1, sent2 = asyncio.run(scenario())
+
+        assert sent1 == [{"type": "message", "content": "hi"}]
+        assert sent2 == [{"type": "system", "content": "only you"}]
+
+
+class TestRedisBroker:
+    """测试多 worker 通过 Redis 频道互相投递"""
+
+    def test_broadcast_across_workers(self):
+        async def scenario():
+            redis = FakeRedis()
+            worker_a = ConnectionManager(RedisBroker(client=redis))
+            worker_b = ConnectionManager(RedisBroker(client=redis))
+            await worker_a.start()
+            await worker_b.start()
+
+            ws_a, ws_b = FakeWebSocket(), FakeWebSocket()
+            worker_a.subscribe(await worker_a.connect(ws_a, 10), 1)
+            worker_b.subscribe(await worker_b.connect(ws_b, 11), 1)
+
+            # 在 worker A 上广播一次，两个 worker 的本地连接都应收到
+            await worker_a.broadcast_to_room(1, {"type": "message", "content": "hello"})
+            await wait_until(lambda: ws_a.sent and ws_b.sent)
+
+            # 定向消息只投递到持有该用户连接的 worker
+            await worker_a.send_to_user(11, {"type": "system", "content": "dm"})
+            await wait_until(lambda: len(ws_b.sent) == 2)
+
+            await worker_a.stop()
+            await worker_b.stop()
+            return redis, ws_a.sent, ws_b.sent
+
+        redis, sent_a, sent_b = asyncio.run(scenario())
+
+        assert redis.published == 2
+        assert sent_a == [{"type": "message", "content": "hello"}]
+        assert sent_b == [{"type": "message", "content": "hello"}, {"type": "system", "content": "dm"}]
+        assert redis.subscribers["studysync:chat"] == []
+
+    def test_create_broker_from_env(self, monkeypatch):
+        monkeypatch.delenv("CHAT_BROKER_URL", raising=False)
+        assert isinstance(create_broker_from_env(), InProcessBroker)
+
+        monkeypatch.setenv("CHAT_BROKER_URL", "redis://localhost:6379/0")
+        monkeypatch.setenv("CHAT_BROKER_CHANNEL", "chat-test")
+        broker = create_broker_from_env()
+        assert isinstance(broker, RedisBroker)
+        assert broker.channel == "chat-test"
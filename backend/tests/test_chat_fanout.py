@@ -0,0 +1,151 @@
+import asyncio
+import json
+import pytest
+from app.chat_broker import InProcessBroker
+from app.chat_websocket import ConnectionManager, ConnectionSettings, DISCONNECT, DROP_OLDEST
+
+
+class FakeWebSocket:
+    """可模拟慢客户端和发送失败的 WebSocket"""
+
+    def __init__(self, delay=0.0, fail=False):
+        self.delay = delay
+        self.fail = fail
+        self.sent = []
+        self.closed_with = None
+        self.unblock = asyncio.Event()
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, data: str):
+        if self.fail:
+            raise RuntimeError("socket closed")
+        if self.delay is None:
+            # 模拟 TCP 缓冲区已满，一直阻塞直到被放行
+            await self.unblock.wait()
+        elif self.delay:
+            await asyncio.sleep(self.delay)
+        self.sent.append(json.loads(data))
+
+    async def close(self, code=1000):
+        self.closed_with = code
+
+
+async def wait_until(predicate, timeout=1.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not predicate():
+        if asyncio.get_running_loop().time() > deadline:
+            raise AssertionError("等待超时")
+        await asyncio.sleep(0.005)
+
+
+def make_manager(**kwargs):
+    return ConnectionManager(InProcessBroker(), ConnectionSettings(**kwargs))
+
+
+class TestSlowConsumer:
+    """测试慢客户端不会拖慢其他连接"""
+
+    def test_slow_socket_does_not_block_room(self):
+        async def scenario():
+            manager = make_manager(queue_size=8, slow_consumer_timeout_ms=5000)
+            slow, fast = FakeWebSocket(delay=None), FakeWebSocket()
+            manager.subscribe(await manager.connect(slow, 10), 1)
+            manager.subscribe(await manager.connect(fast, 11), 1)
+
+            for i in range(3):
+                await manager.broadcast_to_room(1, {"seq": i})
+            await wait_until(lambda: len(fast.sent) == 3)
+            return slow, fast
+
+        slow, fast = asyncio.run(scenario())
+
+        assert [m["seq"] for m in fast.sent] == [0, 1, 2]
+        assert slow.sent == []
+
+    def test_drop_oldest_keeps_latest_messages(self):
+        async def scenario():
+            manager = make_manager(queue_size=2, slow_consumer_policy=DROP_OLDEST)
+            ws = FakeWebSocket(delay=None)
+            connection = await manager.connect(ws, 10)
+            manager.subscribe(connection, 1)
+
+            # 第一条被写协程取出后阻塞在发送中，其余进入队列
+            await manager.broadcast_to_room(1, {"seq": 0})
+            await asyncio.sleep(0.01)
+            for i in range(1, 5):
+                await manager.broadcast_to_room(1, {"seq": i})
+            ws.unblock.set()
+            await wait_until(lambda: len(ws.sent) == 3)
+            return ws, connection, manager
+
+        ws, connection, manager = asyncio.run(scenario())
+
+        assert [m["seq"] for m in ws.sent] == [0, 3, 4]
+        assert connection.dropped == 2
+        assert manager.get_online_users(1) == {10}
+
+    def test_disconnect_policy_on_full_queue(self):
+        async def scenario():
+            manager = make_manager(queue_size=2, slow_consumer_policy=DISCONNECT)
+            slow, fast = FakeWebSocket(delay=None), FakeWebSocket()
+            manager.subscribe(await manager.connect(slow, 10), 1)
+            manager.subscribe(await manager.connect(fast, 11), 1)
+
+            await manager.broadcast_to_room(1, {"seq": 0})
+            await asyncio.sleep(0.01)
+            for i in range(1, 4):
+                await manager.broadcast_to_room(1, {"seq": i})
+                await asyncio.sleep(0.005)
+            await wait_until(lambda: slow.closed_with is not None and len(fast.sent) == 4)
+            return slow, manager
+
+        slow, manager = asyncio.run(scenario())
+
+        assert slow.closed_with == 1008
+        assert manager.get_online_users(1) == {11}
+        assert manager.slow_consumer_disconnects == 1
+
+    def test_send_timeout_disconnects(self):
+        async def scenario():
+            manager = make_manager(slow_consumer_timeout_ms=50)
+            ws = FakeWebSocket(delay=None)
+            manager.subscribe(await manager.connect(ws, 10), 1)
+
+            await manager.broadcast_to_room(1, {"seq": 0})
+            await wait_until(lambda: ws.closed_with is not None)
+            return manager
+
+        manager = asyncio.run(scenario())
+
+        assert manager.get_online_users(1) == set()
+        assert manager.slow_consumer_disconnects == 1
+
+
+class TestFailedSocket:
+    """测试发送失败的连接会被移除"""
+
+    def test_failed_socket_removed(self):
+        async def scenario():
+            manager = make_manager()
+            broken, healthy = FakeWebSocket(fail=True), FakeWebSocket()
+            manager.subscribe(await manager.connect(broken, 10), 1)
+            manager.subscribe(await manager.connect(healthy, 11), 1)
+
+            await manager.broadcast_to_room(1, {"seq": 0})
+            await wait_until(lambda: healthy.sent and 10 not in manager.get_online_users(1))
+            await manager.broadcast_to_room(1, {"seq": 1})
+            await wait_until(lambda: len(healthy.sent) == 2)
+            return manager
+
+        manager = asyncio.run(scenario())
+
+        assert manager.get_online_users(1) == {11}
+        assert manager.send_failures == 1
+        assert manager.get_stats()["connections"] == 1
+
+    def test_invalid_policy(self, monkeypatch):
+        monkeypatch.setenv("CHAT_SLOW_CONSUMER_POLICY", "block")
+        with pytest.raises(ValueError):
+            ConnectionSettings.from_env()
@@ -0,0 +1,108 @@
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, text
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from app.auth import get_current_user
+from app.chat_models import ChatMessage, ChatRoom, ChatRoomMember
+from app.database import Base, get_async_db
+from app.main import app
+from app.models import User
+
+
+@pytest.fixture
+def client(tmp_path):
+    """30 条消息（ID 1-30），其中 10、20 已删除"""
+    path = tmp_path / "history.db"
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(bind=engine)
+    db = sessionmaker(bind=engine, expire_on_commit=False)()
+    user = User(id=1, username="alice", password_hash="x")
+    db.add(user)
+    db.flush()
+    db.add(ChatRoom(id=1, chat_id="ROOM01", name="数学", created_by=1))
+    db.flush()
+    db.add(ChatRoomMember(id=1, chat_room_id=1, user_id=1, role="owner"))
+    db.add_all([
+        ChatMessage(id=i, chat_room_id=1, user_id=1, content=f"消息{i}", is_deleted=i % 10 == 0)
+        for i in range(1, 31)
+    ])
+    db.commit()
+    db.close()
+
+    session_factory = async_sessionmaker(
+        create_async_engine(f"sqlite+aiosqlite:///{path}"), class_=AsyncSession, expire_on_commit=False
+    )
+
+    async def override_get_async_db():
+        async with session_factory() as session:
+            yield session
+
+    app.dependency_overrides[get_current_user] = lambda: user
+    app.dependency_overrides[get_async_db] = override_get_async_db
+    yield TestClient(app), engine
+    app.dependency_overrides.clear()
+    engine.dispose()
+
+
+def page(client, **params):
+    response = client.get("/api/chat-rooms/1/messages", params=params)
+    assert response.status_code == 200
+    return response.json()["data"]
+
+
+def ids(data):
+    return [m["message_id"] for m in data["messages"]]
+
+
+class TestKeysetPagination:
+    """测试聊天记录游标分页"""
+
+    def test_latest_page(self, client):
+        data = page(client[0], limit=5)
+
+        assert ids(data) == [25, 26, 27, 28, 29]
+        assert data["has_more"] is True
+        assert data["has_more_after"] is False
+        assert data["before_cursor"] == 25
+
+    def test_before_skips_deleted(self, client):
+        data = page(client[0], before_id=23, limit=3)
+
+        assert ids(data) == [19, 21, 22]
+        assert data["has_more_before"] is True
+
+    def test_before_reaches_start(self, client):
+        data = page(client[0], before_id=4, limit=5)
+
+        assert ids(data) == [1, 2, 3]
+        assert data["has_more_before"] is False
+
+    def test_after(self, client):
+        data = page(client[0], after_id=24, limit=3)
+
+        assert ids(data) == [25, 26, 27]
+        assert data["has_more_after"] is True
+        # 30 已删除，不算更新的消息
+        assert page(client[0], after_id=26, limit=3)["has_more_after"] is False
+
+    def test_around(self, client):
+        data = page(client[0], around_id=15, limit=5)
+
+        assert ids(data) == [13, 14, 15, 16, 17]
+        assert data["has_more_before"] is True
+        assert data["has_more_after"] is True
+
+    def test_only_one_cursor(self, client):
+        response = client[0].get("/api/chat-rooms/1/messages", params={"before_id": 5, "after_id": 1})
+
+        assert response.status_code == 400
+
+    def test_query_uses_partial_index(self, client):
+        with client[1].connect() as conn:
+            plan = conn.execute(text(
+                "EXPLAIN QUERY PLAN SELECT id FROM chat_messages "
+                "WHERE chat_room_id = 1 AND is_deleted = 0 AND id < 20 ORDER BY id DESC LIMIT 51"
+            )).all()
+
+        assert "idx_chat_message_room_id_desc" in " ".join(str(row) for row in plan)
@@ -0,0 +1,238 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+import pytest
+from sqlalchemy import create_engine, func, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from app.chat_id_generator import MessageIdGenerator, WorkerLease
+from app.chat_message_writer import DURABLE, WRITE_BEHIND, MessageWriter, WriterSettings
+from app.chat_models import ChatMessage, ChatMessageDeadLetter, ChatRoom, ChatRoomMember, ChatWorkerLease
+from app.database import Base
+from app.models import User
+
+
+class TestMessageIdGenerator:
+    """测试消息ID生成"""
+
+    def test_ids_are_increasing_and_js_safe(self):
+        generator = MessageIdGenerator(worker_id=3)
+        ids = [generator.next_id() for _ in range(5000)]
+
+        assert ids == sorted(ids)
+        assert len(set(ids)) == len(ids)
+        assert all(i < 2 ** 53 for i in ids)
+        assert (ids[0] >> MessageIdGenerator.SEQUENCE_BITS) & MessageIdGenerator.MAX_WORKER_ID == 3
+
+    def test_timestamp_roundtrip(self, monkeypatch):
+        generator = MessageIdGenerator(worker_id=0)
+        monkeypatch.setattr(MessageIdGenerator, "_now_ms", staticmethod(lambda: 1760000000123))
+
+        assert MessageIdGenerator.timestamp_ms(generator.next_id()) == 1760000000123
+
+    def test_invalid_worker_id(self):
+        with pytest.raises(ValueError):
+            MessageIdGenerator(worker_id=32)
+
+    def test_clock_moved_backwards_raises(self, monkeypatch):
+        generator = MessageIdGenerator(worker_id=1)
+        monkeypatch.setattr(generator, "_now_ms", lambda: 1735689600000)
+        for _ in range(MessageIdGenerator.MAX_SEQUENCE + 1):
+            generator.next_id()
+        monkeypatch.setattr(generator, "_now_ms", lambda: 1735689600000 - 1000)
+
+        # 序号用尽且时钟回拨 1 秒时立即报错，不在锁内空转
+        with pytest.raises(RuntimeError):
+            generator.next_id()
+
+
+@pytest.fixture
+def session_factory(tmp_path):
+    path = tmp_path / "writer.db"
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(bind=engine)
+    db = sessionmaker(bind=engine)()
+    db.add(User(id=1, username="alice", password_hash="x"))
+    db.flush()
+    db.add(ChatRoom(id=1, chat_id="ROOM01", name="数学", created_by=1))
+    db.flush()
+    db.add(ChatRoomMember(id=1, chat_room_id=1, user_id=1, role="owner"))
+    db.commit()
+    db.close()
+    engine.dispose()
+    return async_sessionmaker(
+        create_async_engine(f"sqlite+aiosqlite:///{path}"), class_=AsyncSession, expire_on_commit=False
+    )
+
+
+class TestWorkerLease:
+    """worker 编号租约"""
+
+    def test_processes_get_distinct_ids_and_expired_lease_is_reused(self, session_factory):
+        async def scenario():
+            first = WorkerLease(MessageIdGenerator(worker_id=0), session_factory, ttl=60)
+            second = WorkerLease(MessageIdGenerator(worker_id=0), session_factory, ttl=60)
+            ids = [await first.acquire(), await second.acquire()]
+            # 第一个进程停止续期，租约过期后编号可被新进程领取
+            async with session_factory() as db:
+                await db.execute(update(ChatWorkerLease).where(ChatWorkerLease.worker_id == 0)
+                                 .values(expires_at=datetime.now(timezone.utc) - timedelta(seconds=1)))
+                await db.commit()
+            third = WorkerLease(MessageIdGenerator(worker_id=0), session_factory, ttl=60)
+            ids.append(await third.acquire())
+            # 原进程续期时发现租约已被取得，重新领取其他编号
+            await first.renew()
+            ids.append(first.worker_id)
+            return ids, first.generator.worker_id
+
+        ids, generator_id = asyncio.run(scenario())
+
+        assert ids == [0, 1, 0, 2]
+        assert generator_id == 2
+
+
+async def count_messages(session_factory):
+    async with session_factory() as db:
+        return await db.scalar(select(func.count()).select_from(ChatMessage))
+
+
+class TestMessageWriter:
+    """测试批量写入"""
+
+    def test_write_behind_batches_messages(self, session_factory):
+        async def scenario():
+            writer = MessageWriter(WriterSettings(flush_interval_ms=1000, batch_size=100), session_factory)
+            rows = [writer.new_message(1, 1, f"消息{i}") for i in range(250)]
+            for row in rows:
+                await writer.submit(row)
+
+            # 写入前消息只在缓冲区中
+            assert writer.is_pending(rows[-1]["id"])
+            await writer.flush()
+            written = await count_messages(session_factory)
+            stats = writer.get_stats()
+            await writer.close()
+            return rows, written, stats
+
+        rows, written, stats = asyncio.run(scenario())
+
+        assert written == 250
+        assert stats["messages_written"] == 250
+        assert stats["pending_messages"] == 0
+        # 缓冲区达到 batch_size 时会提前唤醒写入任务
+        assert stats["batches_written"] >= 3
+
+    def test_background_flush(self, session_factory):
+        async def scenario():
+            writer = MessageWriter(WriterSettings(flush_interval_ms=10), session_factory)
+            await writer.submit(writer.new_message(1, 1, "hi"))
+            await asyncio.sleep(0.2)
+            written = await count_messages(session_factory)
+            await writer.close()
+            return written
+
+        assert asyncio.run(scenario()) == 1
+
+    def test_durable_submit_waits_for_commit(self, session_factory):
+        async def scenario():
+            writer = MessageWriter(WriterSettings(durability=DURABLE, flush_interval_ms=5), session_factory)
+            await writer.submit(writer.new_message(1, 1, "durable"))
+            written = await count_messages(session_factory)
+            await writer.close()
+            return written
+
+        assert asyncio.run(scenario()) == 1
+
+    def test_flush_room_before_reading_by_id(self, session_factory):
+        async def scenario():
+            writer = MessageWriter(WriterSettings(flush_interval_ms=1000), session_factory)
+            await writer.submit(writer.new_message(1, 1, "hi"))
+            # 其他群聊没有待写入的消息，不触发写入
+            await writer.flush_room(2)
+            before = await count_messages(session_factory)
+            await writer.flush_room(1)
+            after = await count_messages(session_factory)
+            await writer.close()
+            return before, after
+
+        assert asyncio.run(scenario()) == (0, 1)
+
+    def test_multi_worker_defaults_to_durable(self, monkeypatch):
+        monkeypatch.delenv("CHAT_MESSAGE_DURABILITY", raising=False)
+        monkeypatch.delenv("CHAT_BROKER_URL", raising=False)
+        assert WriterSettings.from_env().durability == WRITE_BEHIND
+
+        monkeypatch.setenv("CHAT_BROKER_URL", "redis://localhost:6379/0")
+        assert WriterSettings.from_env().durability == DURABLE
+
+        monkeypatch.setenv("CHAT_MESSAGE_DURABILITY", "write_behind")
+        assert WriterSettings.from_env().durability == WRITE_BEHIND
+
+    def test_member_activity_is_coalesced(self, session_factory):
+        async def scenario():
+            writer = MessageWriter(WriterSettings(flush_interval_ms=1000), session_factory)
+            for _ in range(50):
+                writer.touch_member(1, 1)
+            await writer.flush()
+            async with session_factory() as db:
+                active_at = await db.scalar(select(ChatRoomMember.last_active_at))
+            stats = writer.get_stats()
+            await writer.close()
+            return active_at, stats
+
+        active_at, stats = asyncio.run(scenario())
+
+        assert active_at is not None
+        assert stats["member_activity_updates"] == 1
+
+    def test_failed_batch_is_retried(self, session_factory):
+        class FlakySession:
+            """第一次提交失败，之后恢复正常"""
+            failures = 1
+
+            def __call__(self):
+                if FlakySession.failures:
+                    FlakySession.failures -= 1
+                    raise ConnectionError("数据库不可用")
+                return session_factory()
+
+        async def scenario():
+            writer = MessageWriter(WriterSettings(flush_interval_ms=1000), FlakySession())
+            await writer.submit(writer.new_message(1, 1, "retry"))
+            with pytest.raises(ConnectionError):
+                await writer.flush()
+            pending = writer.get_stats()["pending_messages"]
+            await writer.flush()
+            written = await count_messages(session_factory)
+            await writer.close()
+            return pending, written
+
+        assert asyncio.run(scenario()) == (1, 1)
+
+    def test_bad_row_is_dead_lettered(self, session_factory):
+        async def scenario():
+            writer = MessageWriter(WriterSettings(flush_interval_ms=1000, max_retries=2), session_factory)
+            duplicate = writer.new_message(1, 1, "first")
+            await writer.submit(duplicate)
+            await writer.flush()
+            rows = [writer.new_message(1, 1, f"消息{i}") for i in range(3)]
+            # 主键冲突的坏数据夹在正常消息中间
+            for row in (rows[0], dict(duplicate, content="again"), *rows[1:]):
+                await writer.submit(row)
+            with pytest.raises(IntegrityError):
+                await writer.flush()
+            # 达到重试上限后逐条写入，坏数据转入死信，不再阻塞缓冲区
+            await writer.flush()
+            async with session_factory() as db:
+                dead = (await db.execute(select(ChatMessageDeadLetter))).scalars().all()
+            written = await count_messages(session_factory)
+            stats = writer.get_stats()
+            await writer.close()
+            return duplicate, dead, written, stats
+
+        duplicate, dead, written, stats = asyncio.run(scenario())
+
+        assert written == 4
+        assert [(letter.message_id, letter.attempts) for letter in dead] == [(duplicate["id"], 3)]
+        assert '"again"' in dead[0].payload
+        assert (stats["pending_messages"], stats["dead_letters"], stats["isolated_batches"]) == (0, 1, 1)
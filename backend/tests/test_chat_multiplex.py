@@ -0,0 +1,239 @@
+import asyncio
+import json
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, event
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from app.auth import create_access_token
+from app.chat_broker import InProcessBroker
+from app.chat_message_writer import message_writer
+from app.chat_models import ChatRoom, ChatRoomMember, ChatRoomStatus
+from app.chat_websocket import ConnectionManager, ConnectionSettings
+from app.database import Base
+from app.main import app
+from app.models import User
+from app.routes import chat_messages, chat_rooms
+
+
+class FakeWebSocket:
+    def __init__(self):
+        self.sent = []
+        self.closed_with = None
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, data: str):
+        self.sent.append(json.loads(data))
+
+    async def close(self, code=1000):
+        self.closed_with = code
+
+
+async def wait_until(predicate, timeout=1.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not predicate():
+        if asyncio.get_running_loop().time() > deadline:
+            raise AssertionError("等待超时")
+        await asyncio.sleep(0.005)
+
+
+class TestConnectionManager:
+    """测试一条连接订阅多个群聊"""
+
+    def test_one_connection_many_rooms(self):
+        async def scenario():
+            manager = ConnectionManager(InProcessBroker(), ConnectionSettings())
+            ws = FakeWebSocket()
+            connection = await manager.connect(ws, 10)
+            for room_id in (1, 2, 3):
+                assert manager.subscribe(connection, room_id)
+
+            await manager.broadcast_to_room(1, {"room": 1})
+            await manager.broadcast_to_room(3, {"room": 3})
+            await manager.send_to_user(10, {"direct": True})
+            await wait_until(lambda: len(ws.sent) == 3)
+
+            assert manager.get_user_rooms(10) == {1, 2, 3}
+            assert manager.unsubscribe(connection, 2)
+            assert manager.get_user_rooms(10) == {1, 3}
+            assert manager.get_online_users(2) == set()
+            assert manager.get_online_users(1) == {10}
+
+            left = manager.disconnect(10, connection)
+            return manager, ws, left
+
+        manager, ws, left = asyncio.run(scenario())
+
+        assert ws.sent == [{"room": 1}, {"room": 3}, {"direct": True}]
+        assert left == {1, 3}
+        assert not manager.is_online(10)
+        assert manager.active_connections == {}
+
+    def test_reconnect_replaces_old_connection(self):
+        async def scenario():
+            manager = ConnectionManager(InProcessBroker(), ConnectionSettings())
+            old_ws, new_ws = FakeWebSocket(), FakeWebSocket()
+            old = await manager.connect(old_ws, 10)
+            manager.subscribe(old, 1)
+            new = await manager.connect(new_ws, 10)
+            await wait_until(lambda: old_ws.closed_with is not None)
+
+            # 旧连接的断开处理不能影响新连接
+            assert manager.disconnect(10, old) == set()
+            assert not manager.subscribe(old, 2)
+            assert manager.subscribe(new, 2)
+            return manager
+
+        manager = asyncio.run(scenario())
+
+        assert manager.get_user_rooms(10) == {2}
+        assert manager.get_online_users(1) == set()
+
+    def test_revoked_member_is_unsubscribed(self):
+        async def scenario():
+            manager = ConnectionManager(InProcessBroker(), ConnectionSettings())
+            alice, bob = FakeWebSocket(), FakeWebSocket()
+            alice_connection = await manager.connect(alice, 10)
+            bob_connection = await manager.connect(bob, 11)
+            for connection in (alice_connection, bob_connection):
+                manager.subscribe(connection, 1)
+                manager.subscribe(connection, 2)
+
+            # 角色变更等只失效缓存，不影响订阅
+            await manager.invalidate_room_access(1, 10)
+            await manager.invalidate_room_access(1, 10, revoke="已被移出群聊")
+            await manager.broadcast_to_room(1, {"room": 1})
+            await wait_until(lambda: {"room": 1} in bob.sent)
+            await manager.invalidate_room_access(2, revoke="群聊已删除")
+            await wait_until(lambda: len(bob.sent) == 2)
+            return manager, alice, bob
+
+        manager, alice, bob = asyncio.run(scenario())
+
+        assert alice.sent == [
+            {"type": "unsubscribed", "chat_room_id": 1, "reason": "已被移出群聊"},
+            {"type": "unsubscribed", "chat_room_id": 2, "reason": "群聊已删除"},
+        ]
+        assert bob.sent == [{"room": 1}, {"type": "unsubscribed", "chat_room_id": 2, "reason": "群聊已删除"}]
+        assert manager.get_user_rooms(10) == set() and manager.get_user_rooms(11) == {1}
+
+    def test_subscription_limit(self):
+        async def scenario():
+            manager = ConnectionManager(InProcessBroker(), ConnectionSettings(max_subscriptions=2))
+            connection = await manager.connect(FakeWebSocket(), 10)
+            return [manager.subscribe(connection, room_id) for room_id in (1, 2, 3)]
+
+        assert asyncio.run(scenario()) == [True, True, False]
+
+
+@pytest.fixture
+def chat_db(tmp_path, monkeypatch):
+    """文件型 SQLite：同步会话写入测试数据，WebSocket 端点使用异步会话"""
+    path = tmp_path / "chat.db"
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(bind=engine)
+    db = sessionmaker(bind=engine)()
+    db.add_all([
+        User(id=1, username="alice", email="alice@example.com", password_hash="x"),
+        User(id=2, username="bob", email="bob@example.com", password_hash="x"),
+    ])
+    db.flush()
+    db.add_all([
+        ChatRoom(id=1, chat_id="ROOM01", name="数学", created_by=1),
+        ChatRoom(id=2, chat_id="ROOM02", name="英语", created_by=1),
+        ChatRoom(id=3, chat_id="ROOM03", name="物理", created_by=2),
+    ])
+    db.flush()
+    db.add_all([
+        ChatRoomMember(id=1, chat_room_id=1, user_id=1, role="owner"),
+        ChatRoomMember(id=2, chat_room_id=2, user_id=1, role="owner"),
+        ChatRoomMember(id=3, chat_room_id=3, user_id=2, role="owner"),
+    ])
+    db.commit()
+    db.close()
+
+    async_engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+    session_factory = async_sessionmaker(async_engine, class_=AsyncSession, expire_on_commit=False)
+    monkeypatch.setattr(chat_messages, "AsyncSessionLocal", session_factory)
+    monkeypatch.setattr(message_writer, "session_factory", session_factory)
+    yield
+    engine.dispose()
+
+
+def receive_until(ws, frame_type):
+    while True:
+        frame = ws.receive_json()
+        if frame["type"] == frame_type:
+            return frame
+
+
+class TestMultiplexedEndpoint:
+    """测试多群聊 WebSocket 端点"""
+
+    def test_subscribe_and_unsubscribe(self, chat_db):
+        client = TestClient(app)
+        token = create_access_token({"sub": "1"})
+
+        with client.websocket_connect(f"/api/chat-rooms/ws?token={token}") as ws:
+            assert ws.receive_json()["type"] == "connected"
+
+            ws.send_json({"type": "subscribe", "chat_room_id": 1})
+            assert receive_until(ws, "subscribed")["chat_room_id"] == 1
+            ws.send_json({"type": "subscribe", "chat_room_id": 2})
+            assert receive_until(ws, "subscribed")["chat_room_id"] == 2
+
+            # 不是成员的群聊不能订阅
+            ws.send_json({"type": "subscribe", "chat_room_id": 3})
+            error = receive_until(ws, "error")
+            assert error == {"type": "error", "chat_room_id": 3, "message": "不是群聊成员"}
+
+            # 未订阅的群聊不能发消息
+            ws.send_json({"type": "text", "chat_room_id": 3, "content": "hi"})
+            assert receive_until(ws, "error")["message"] == "请先订阅该群聊"
+
+            ws.send_json({"type": "unsubscribe", "chat_room_id": 1})
+            assert receive_until(ws, "unsubscribed")["chat_room_id"] == 1
+
+    def test_idle_socket_holds_no_connection(self, chat_db):
+        client = TestClient(app)
+        token = create_access_token({"sub": "1"})
+        checked_out = []
+        engine = chat_messages.AsyncSessionLocal.kw["bind"].sync_engine
+        event.listen(engine, "checkout", lambda *args: checked_out.append(1))
+        event.listen(engine, "checkin", lambda *args: checked_out.pop())
+
+        with client.websocket_connect(f"/api/chat-rooms/ws?token={token}") as ws:
+            assert ws.receive_json()["type"] == "connected"
+            ws.send_json({"type": "subscribe", "chat_room_id": 1})
+            receive_until(ws, "subscribed")
+            # 权限校验查询完即归还连接，空闲的 WebSocket 不占用连接池
+            assert checked_out == []
+
+
+class TestDeleteChatRoom:
+    """删除群聊后订阅者被退订"""
+
+    def test_delete_revokes_subscribers(self, chat_db, monkeypatch):
+        async def scenario():
+            manager = ConnectionManager(InProcessBroker(), ConnectionSettings())
+            monkeypatch.setattr(chat_rooms, "manager", manager)
+            alice = FakeWebSocket()
+            connection = await manager.connect(alice, 1)
+            manager.subscribe(connection, 1)
+            manager.subscribe(connection, 2)
+
+            async with chat_messages.AsyncSessionLocal() as db:
+                await chat_rooms.delete_chat_room(1, current_user=User(id=1, username="alice"), db=db)
+            await wait_until(lambda: len(alice.sent) == 1)
+
+            async with chat_messages.AsyncSessionLocal() as db:
+                room = await db.get(ChatRoom, 1)
+            return manager, alice, room.status
+
+        manager, alice, room_status = asyncio.run(scenario())
+
+        assert room_status == ChatRoomStatus.ARCHIVED
+        assert alice.sent == [{"type": "unsubscribed", "chat_room_id": 1, "reason": "群聊已删除"}]
+        assert manager.get_user_rooms(1) == {2}
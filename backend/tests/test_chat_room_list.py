@@ -0,0 +1,115 @@
+from datetime import datetime, timedelta, timezone
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, event
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from app.auth import get_current_user
+from app.chat_models import ChatMessage, ChatRoom, ChatRoomMember, ChatRoomStatus
+from app.database import Base, get_async_db
+from app.main import app
+from app.models import User
+
+JOINED_AT = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+def seed(db, rooms):
+    """alice 创建 rooms 个群聊，并加入 bob 创建的 rooms 个群聊；每个群聊有 bob 的 2 条消息"""
+    db.add_all([User(id=1, username="alice", password_hash="x"), User(id=2, username="bob", password_hash="x")])
+    db.flush()
+    member_id = message_id = 0
+    for room_id in range(1, rooms * 2 + 1):
+        creator = 1 if room_id <= rooms else 2
+        db.add(ChatRoom(id=room_id, chat_id=f"ROOM{room_id:02d}", name=f"群{room_id}", created_by=creator,
+                        member_count=2))
+        db.flush()
+        for user_id in (1, 2):
+            member_id += 1
+            role = "owner" if user_id == creator else "member"
+            db.add(ChatRoomMember(id=member_id, chat_room_id=room_id, user_id=user_id, role=role,
+                                  last_active_at=JOINED_AT))
+        for minutes in (1, 2):
+            message_id += 1
+            db.add(ChatMessage(id=message_id, chat_room_id=room_id, user_id=2, content=f"消息{message_id}",
+                               created_at=JOINED_AT + timedelta(minutes=minutes)))
+    db.commit()
+
+
+@pytest.fixture
+def make_client(tmp_path):
+    engines = []
+
+    def make(rooms):
+        path = tmp_path / f"rooms_{rooms}.db"
+        engine = create_engine(f"sqlite:///{path}")
+        Base.metadata.create_all(bind=engine)
+        db = sessionmaker(bind=engine)()
+        seed(db, rooms)
+        db.close()
+        engines.append(engine)
+
+        async_engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+        statements = []
+        event.listen(async_engine.sync_engine, "before_cursor_execute",
+                     lambda conn, cursor, sql, *args: statements.append(sql))
+        session_factory = async_sessionmaker(async_engine, class_=AsyncSession, expire_on_commit=False)
+
+        async def override_get_async_db():
+            async with session_factory() as session:
+                yield session
+
+        app.dependency_overrides[get_async_db] = override_get_async_db
+        app.dependency_overrides[get_current_user] = lambda: User(id=1, username="alice")
+        return TestClient(app), engine, statements
+
+    yield make
+    app.dependency_overrides.clear()
+    for engine in engines:
+        engine.dispose()
+
+
+class TestMyChatRooms:
+    """测试我的群聊列表"""
+
+    def test_query_count_does_not_grow_with_rooms(self, make_client):
+        counts = []
+        for rooms in (2, 25):
+            client, _, statements = make_client(rooms)
+            response = client.get("/api/chat-rooms/my-rooms")
+            assert response.status_code == 200
+            data = response.json()["data"]
+            assert len(data["created"]) == rooms and len(data["joined"]) == rooms
+            counts.append(len(statements))
+
+        assert counts[0] == counts[1] == 2
+
+    def test_room_details(self, make_client):
+        client, engine, _ = make_client(2)
+        with engine.begin() as conn:
+            conn.execute(ChatRoomMember.__table__.update().where(
+                ChatRoomMember.chat_room_id == 3, ChatRoomMember.user_id == 1
+            ).values(last_read_message_id=5, unread_count=1))
+            conn.execute(ChatRoom.__table__.update().where(ChatRoom.id == 4).values(status=ChatRoomStatus.ARCHIVED))
+
+        data = client.get("/api/chat-rooms/my-rooms").json()["data"]
+
+        assert [room["room_id"] for room in data["created"]] == [2, 1]
+        assert [room["room_id"] for room in data["joined"]] == [3]
+        owned, joined = data["created"][0], data["joined"][0]
+        assert owned["role"] == "owner" and owned["member_count"] == 2 and owned["unread_count"] == 0
+        assert joined["role"] == "member" and joined["unread_count"] == 1
+        assert joined["last_read_message_id"] == 5
+        assert joined["last_message"]["message_id"] == 6
+        assert joined["last_message"]["username"] == "bob"
+        assert joined["last_message"]["content"] == "消息6"
+
+    def test_deleted_last_message_and_long_preview(self, make_client):
+        client, engine, _ = make_client(1)
+        with engine.begin() as conn:
+            conn.execute(ChatMessage.__table__.update().where(ChatMessage.id == 2).values(is_deleted=True))
+            conn.execute(ChatMessage.__table__.update().where(ChatMessage.id == 1).values(content="长" * 80))
+
+        room = client.get("/api/chat-rooms/my-rooms").json()["data"]["created"][0]
+
+        assert room["last_message"]["message_id"] == 1
+        assert room["last_message"]["content"] == "长" * 50 + "…"
@@ -0,0 +1,179 @@
+import asyncio
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, event, select
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from app.auth import get_current_user
+from app.chat_broker import InProcessBroker
+from app.chat_message_writer import MessageWriter, WriterSettings, message_writer
+from app.chat_models import ChatMessage, ChatRoom, ChatRoomMember
+from app.chat_websocket import ConnectionManager, ConnectionSettings
+from app.database import Base, get_async_db
+from app.main import app
+from app.maintenance import recount_unread
+from app.models import User
+
+
+@pytest.fixture
+def setup(tmp_path, monkeypatch):
+    """群聊 1：alice 群主，bob、carol 成员；群聊 2 只有 alice；群聊 1 已有 bob 的消息 1、2"""
+    path = tmp_path / "unread.db"
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(bind=engine)
+    db = sessionmaker(bind=engine)()
+    db.add_all([User(id=i, username=name, password_hash="x")
+                for i, name in enumerate(["alice", "bob", "carol"], start=1)])
+    db.flush()
+    db.add_all([ChatRoom(id=1, chat_id="ROOM01", name="数学", created_by=1),
+                ChatRoom(id=2, chat_id="ROOM02", name="英语", created_by=1)])
+    db.flush()
+    db.add_all([
+        ChatRoomMember(id=1, chat_room_id=1, user_id=1, role="owner", unread_count=2),
+        ChatRoomMember(id=2, chat_room_id=1, user_id=2, last_read_message_id=2),
+        ChatRoomMember(id=3, chat_room_id=1, user_id=3, unread_count=2),
+        ChatRoomMember(id=4, chat_room_id=2, user_id=1, role="owner"),
+        ChatMessage(id=1, chat_room_id=1, user_id=2, content="第一条"),
+        ChatMessage(id=2, chat_room_id=1, user_id=2, content="第二条"),
+    ])
+    db.commit()
+    db.close()
+
+    async_engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+    statements = []
+    event.listen(async_engine.sync_engine, "before_cursor_execute",
+                 lambda conn, cursor, sql, *args: statements.append(sql))
+    session_factory = async_sessionmaker(async_engine, class_=AsyncSession, expire_on_commit=False)
+    monkeypatch.setattr(message_writer, "session_factory", session_factory)
+
+    async def override_get_async_db():
+        async with session_factory() as session:
+            yield session
+
+    app.dependency_overrides[get_async_db] = override_get_async_db
+    yield TestClient(app), engine, session_factory, statements
+    app.dependency_overrides.clear()
+    engine.dispose()
+
+
+def as_user(user_id):
+    app.dependency_overrides[get_current_user] = lambda: User(id=user_id, username=f"user{user_id}")
+
+
+def unread_counts(engine, chat_room_id=1):
+    with engine.connect() as conn:
+        rows = conn.execute(select(ChatRoomMember.user_id, ChatRoomMember.unread_count).where(
+            ChatRoomMember.chat_room_id == chat_room_id
+        )).all()
+    return dict(rows)
+
+
+class FakeConnection:
+    def __init__(self):
+        self.frames = []
+
+    def send(self, message):
+        self.frames.append(message)
+        return True
+
+
+class TestUnreadCounters:
+    """测试已读游标与增量未读数"""
+
+    def test_writer_increments_other_members(self, setup):
+        _, engine, session_factory, _ = setup
+        writer = MessageWriter(WriterSettings(), session_factory)
+        published = []
+
+        async def listener(updates):
+            published.extend(updates)
+
+        writer.unread_listener = listener
+
+        async def scenario():
+            for user_id in (2, 2, 1):
+                await writer.submit(writer.new_message(1, user_id, "hi"))
+            await writer.close()
+
+        asyncio.run(scenario())
+
+        assert unread_counts(engine) == {1: 4, 2: 1, 3: 5}
+        assert len(published) == 1
+        assert sorted(published[0].counts) == [(1, 4, 2), (2, 1, 1), (3, 5, 3)]
+
+    def test_flushed_message_already_read_is_not_counted(self, setup):
+        _, engine, session_factory, _ = setup
+        writer = MessageWriter(WriterSettings(), session_factory)
+
+        async def scenario():
+            row = writer.new_message(1, 2, "已经通过 WebSocket 看到")
+            await writer.submit(row)
+            # 客户端在消息落库之前就上报了已读
+            with engine.begin() as conn:
+                conn.execute(ChatRoomMember.__table__.update().where(ChatRoomMember.user_id == 3).values(
+                    last_read_message_id=row["id"], unread_count=0))
+            await writer.close()
+
+        asyncio.run(scenario())
+
+        assert unread_counts(engine)[3] == 0
+        assert unread_counts(engine)[1] == 3
+
+    def test_bulk_mark_read(self, setup):
+        client, engine, _, statements = setup
+        as_user(3)
+        statements.clear()
+
+        response = client.post("/api/chat-rooms/read", json={"positions": [
+            {"chat_room_id": 1, "message_id": 1},
+            {"chat_room_id": 2, "message_id": 5},
+        ]})
+
+        assert response.status_code == 200
+        # 群聊 2 不是成员，忽略
+        assert response.json()["data"]["rooms"] == [
+            {"chat_room_id": 1, "last_read_message_id": 1, "unread_count": 1, "delta": -1}
+        ]
+        assert len(statements) == 3
+
+        # 游标只前进，且不超过最新消息
+        client.post("/api/chat-rooms/read", json={"positions": [{"chat_room_id": 1, "message_id": 999}]})
+        client.post("/api/chat-rooms/read", json={"positions": [{"chat_room_id": 1, "message_id": 1}]})
+        data = client.get("/api/chat-rooms/my-rooms").json()["data"]
+        assert data["joined"][0]["last_read_message_id"] == 2
+        assert data["joined"][0]["unread_count"] == 0
+
+    def test_delete_message_decrements_unread(self, setup):
+        client, engine, *_ = setup
+        as_user(3)
+        client.post("/api/chat-rooms/read", json={"positions": [{"chat_room_id": 1, "message_id": 1}]})
+
+        as_user(1)
+        assert client.delete("/api/chat-rooms/1/messages/2").status_code == 200
+        assert client.delete("/api/chat-rooms/1/messages/2").status_code == 200
+
+        # alice 和 carol 都还没读到消息 2；重复删除不会再减
+        assert unread_counts(engine) == {1: 1, 2: 0, 3: 0}
+
+    def test_recount_repairs_drift(self, setup):
+        _, engine, *_ = setup
+        with engine.begin() as conn:
+            conn.execute(ChatRoomMember.__table__.update().values(unread_count=42))
+
+        assert recount_unread(session_factory=sessionmaker(bind=engine)) == 4
+        assert unread_counts(engine) == {1: 2, 2: 0, 3: 2}
+        assert unread_counts(engine, 2) == {1: 0}
+
+    def test_unread_envelope_reaches_online_members(self):
+        manager = ConnectionManager(InProcessBroker(), ConnectionSettings())
+        connection = FakeConnection()
+        manager.user_connections[3] = connection
+
+        asyncio.run(manager.deliver({
+            "kind": "unread", "chat_room_id": 1, "last_message_id": 9,
+            "counts": [[1, 4, 1], [3, 7, 1]]
+        }))
+
+        assert connection.frames == [{
+            "type": "unread", "chat_room_id": 1, "unread_count": 7, "delta": 1, "last_message_id": 9
+        }]
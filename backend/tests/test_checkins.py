@@ -0,0 +1,100 @@
+import csv
+import io
+import json
+from datetime import date, timedelta
+import pytest
+from app.models import Checkin, Plan, User
+from app.routes import checkins as checkins_routes
+
+START = date(2024, 1, 1)
+
+
+@pytest.fixture
+def setup(make_database, monkeypatch):
+    """alice 有两个计划，连续 30 天每天各打卡一次（共 60 条）；bob 打卡一次"""
+    database = make_database("checkins.db")
+    database.add(
+        [User(id=1, username="alice", password_hash="x"), User(id=2, username="bob", password_hash="x")],
+        [Plan(id=1, user_id=1, title="数学", daily_goal_min=60, start_date=START),
+         Plan(id=2, user_id=1, title="英语", daily_goal_min=60, start_date=START),
+         Plan(id=3, user_id=2, title="bob", daily_goal_min=60, start_date=START)],
+        [Checkin(id=day * 2 + plan_id, user_id=1, plan_id=plan_id, checkin_date=START + timedelta(days=day),
+                 duration_min=30 * plan_id, content=f"第{day}天,\"计划{plan_id}\"")
+         for day in range(30) for plan_id in (1, 2)]
+        + [Checkin(id=100, user_id=2, plan_id=3, checkin_date=START, duration_min=60, content="bob")],
+    )
+    # 导出在生成器里自己打开会话
+    monkeypatch.setattr(checkins_routes, "AsyncSessionLocal", database.async_session_factory)
+    yield database.client(), database.statements
+
+
+def expected_order():
+    """按 (日期, ID) 倒序的全部打卡ID"""
+    return [day * 2 + plan_id for day in range(29, -1, -1) for plan_id in (2, 1)]
+
+
+class TestGetCheckins:
+    """测试打卡记录列表"""
+
+    def test_plan_titles_joined(self, setup):
+        client, statements = setup
+        statements.clear()
+
+        data = client.get("/api/checkins", params={"page_size": 50}).json()["data"]
+
+        assert data["total"] == 60
+        assert [item["checkin_id"] for item in data["items"]] == expected_order()[:50]
+        assert {item["plan_title"] for item in data["items"]} == {"数学", "英语"}
+        assert len(statements) == 2
+
+    def test_cursor_pagination(self, setup):
+        client, statements = setup
+        seen = []
+        cursor = None
+        while True:
+            params = {"page_size": 7} if cursor is None else {"page_size": 7, "cursor": cursor}
+            statements.clear()
+            data = client.get("/api/checkins", params=params).json()["data"]
+            seen += [item["checkin_id"] for item in data["items"]]
+            if cursor is not None:
+                assert data["total"] is None
+                assert len(statements) == 1
+            cursor = data["next_cursor"]
+            if not data["has_more"]:
+                break
+
+        assert seen == expected_order()
+
+    def test_invalid_cursor(self, setup):
+        client, _ = setup
+
+        response = client.get("/api/checkins", params={"cursor": "not-a-cursor"})
+
+        assert response.status_code == 400
+        assert response.json()["detail"] == "无效的分页游标"
+
+
+class TestExportCheckins:
+    """测试打卡记录导出"""
+
+    def test_ndjson(self, setup):
+        client, _ = setup
+
+        response = client.get("/api/checkins/export", params={"plan_id": 2})
+
+        assert response.headers["content-type"].startswith("application/x-ndjson")
+        rows = [json.loads(line) for line in response.text.splitlines()]
+        assert [row["checkin_id"] for row in rows] == [i for i in expected_order() if i % 2 == 0]
+        assert rows[0] == {"checkin_id": 60, "plan_id": 2, "plan_title": "英语", "date": "2024-01-30", "hours": 1.0,
+                           "content": "第29天,\"计划2\"", "created_at": rows[0]["created_at"]}
+
+    def test_csv(self, setup):
+        client, _ = setup
+
+        response = client.get("/api/checkins/export", params={"format": "csv", "end_date": "2024-01-02"})
+
+        assert response.headers["content-type"].startswith("text/csv")
+        rows = list(csv.reader(io.StringIO(response.text)))
+        assert rows[0] == ["checkin_id", "plan_id", "plan_title", "date", "hours", "content", "created_at"]
+        assert [row[0] for row in rows[1:]] == ["4", "3", "2", "1"]
+        assert rows[1][5] == "第1天,\"计划2\""
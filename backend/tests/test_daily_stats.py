@@ -0,0 +1,149 @@
+import asyncio
+from datetime import date, timedelta
+import pytest
+from sqlalchemy import select
+from app.daily_stats import record_checkin_change
+from app.streaks import advance_group_last_checkin
+from app.maintenance import rebuild_daily_stats, rebuild_streaks
+from app.models import Checkin, Group, GroupMember, Plan, User, UserDailyStat
+
+TODAY = date.today()
+WEEK_START = TODAY - timedelta(days=TODAY.weekday())
+
+
+@pytest.fixture
+def setup(make_database):
+    """alice 有三个计划，本周一打卡两次（计划 2、4）、今天打卡一次（计划 1）；bob 今天打卡一次；两人在学习群组 1 中"""
+    database = make_database("daily.db")
+    database.add(
+        [User(id=1, username="alice", password_hash="x"), User(id=2, username="bob", password_hash="x")],
+        [Plan(id=i, user_id=user_id, title=f"计划{i}", daily_goal_min=60, start_date=WEEK_START)
+         for i, user_id in [(1, 1), (2, 1), (3, 2), (4, 1)]] + [Group(id=1, name="考研", created_by=1, member_count=2)],
+        [GroupMember(group_id=1, user_id=1, role="owner"),
+         GroupMember(group_id=1, user_id=2),
+         Checkin(id=1, user_id=1, plan_id=4, checkin_date=WEEK_START, duration_min=60, content="a"),
+         Checkin(id=2, user_id=1, plan_id=2, checkin_date=WEEK_START, duration_min=30, content="b"),
+         Checkin(id=3, user_id=1, plan_id=1, checkin_date=TODAY, duration_min=90, content="c"),
+         Checkin(id=4, user_id=2, plan_id=3, checkin_date=TODAY, duration_min=120, content="d")],
+    )
+    rebuild_daily_stats(session_factory=database.session_factory)
+    rebuild_streaks(session_factory=database.session_factory)
+    yield database.client(), database.engine, database.async_session_factory, database.statements
+
+
+def rollup(engine, user_id=1):
+    with engine.connect() as conn:
+        return {
+            (row.plan_id, row.stat_date): (row.minutes, row.checkin_count)
+            for row in conn.execute(select(UserDailyStat).where(UserDailyStat.user_id == user_id))
+        }
+
+
+class TestMaintenance:
+    """测试汇总的增量维护和重建"""
+
+    def test_rebuild_from_checkins(self, setup):
+        _, engine, *_ = setup
+
+        assert rollup(engine) == {(4, WEEK_START): (60, 1), (2, WEEK_START): (30, 1), (1, TODAY): (90, 1)}
+
+    def test_create_and_delete_adjust_rollup(self, setup):
+        _, engine, session_factory, _ = setup
+        day = TODAY - timedelta(days=30)
+
+        async def scenario():
+            async with session_factory() as db:
+                await record_checkin_change(db, after=(1, 2, day, 45))
+                await record_checkin_change(db, after=(1, 2, day, 15))
+                await db.commit()
+            assert rollup(engine)[(2, day)] == (60, 2)
+            async with session_factory() as db:
+                await record_checkin_change(db, before=(1, 2, day, 45))
+                await record_checkin_change(db, before=(1, 2, day, 15))
+                await db.commit()
+
+        asyncio.run(scenario())
+        assert (2, day) not in rollup(engine)
+
+    def test_update_moves_minutes(self, setup):
+        client, engine, *_ = setup
+        new_day = TODAY - timedelta(days=10)
+
+        response = client.put("/api/checkins/2", json={"plan_id": 1, "hours": 0.5, "content": "b", "checkin_date": str(new_day)})
+
+        assert response.status_code == 200
+        assert (2, WEEK_START) not in rollup(engine)
+        assert rollup(engine)[(1, new_day)] == (30, 1)
+
+    def test_delete_route_removes_row(self, setup):
+        client, engine, *_ = setup
+
+        assert client.delete("/api/checkins/2").status_code == 200
+        assert (2, WEEK_START) not in rollup(engine)
+
+
+class TestReaders:
+    """测试统计接口读取汇总"""
+
+    def test_week_stats(self, setup):
+        client, _, _, statements = setup
+        statements.clear()
+
+        data = client.get("/api/checkins/stats", params={"period": "week"}).json()["data"]
+        by_plan = client.get("/api/checkins/stats", params={"period": "week", "plan_id": 2}).json()["data"]
+
+        assert data["checkin_count"] == 3
+        assert data["total_hours"] == 3.0
+        assert sum(day["checkin_count"] for day in data["daily_stats"]) == 3
+        assert by_plan["checkin_count"] == 1
+        assert by_plan["total_hours"] == 0.5
+        assert by_plan["daily_stats"] == data["daily_stats"]
+        assert not any("from checkins" in sql.lower() for sql in statements)
+
+    def test_group_stats(self, setup):
+        client, *_ = setup
+
+        data = client.get("/api/groups/1/stats").json()["data"]
+
+        assert data["today_checked_in_count"] == 2
+        assert data["checkin_rate"] == 100.0
+        stats = {item["user_id"]: item for item in data["personal_stats"]}
+        assert stats[1]["week_checkin_days"] == 3
+        assert stats[1]["avg_hours_per_day"] == 1.0
+        assert stats[2]["week_checkin_days"] == 1
+
+
+def last_checkins(engine):
+    with engine.connect() as conn:
+        return dict(conn.execute(select(GroupMember.user_id, GroupMember.last_checkin)).all())
+
+
+class TestGroupLastCheckin:
+    """测试群组成员最后打卡日期的单条 UPDATE"""
+
+    def test_advance_never_moves_backwards(self, setup):
+        _, engine, session_factory, statements = setup
+
+        async def advance(day):
+            async with session_factory() as db:
+                await db.execute(advance_group_last_checkin(1, day))
+                await db.commit()
+
+        asyncio.run(advance(TODAY))
+        statements.clear()
+        asyncio.run(advance(TODAY - timedelta(days=3)))
+
+        assert sum(sql.lstrip().upper().startswith("UPDATE GROUP_MEMBERS") for sql in statements) == 1
+        assert not any(sql.lstrip().upper().startswith("SELECT") for sql in statements)
+        assert last_checkins(engine)[1] == TODAY
+
+    def test_update_and_delete_follow_latest_checkin(self, setup):
+        client, engine, *_ = setup
+        earlier = TODAY - timedelta(days=20)
+
+        assert client.put("/api/checkins/3", json={"plan_id": 1, "hours": 1, "content": "c", "checkin_date": str(earlier)}).status_code == 200
+        assert last_checkins(engine)[1] == WEEK_START
+
+        assert client.delete("/api/checkins/1").status_code == 200
+        assert client.delete("/api/checkins/2").status_code == 200
+        assert last_checkins(engine)[1] == earlier
@@ -0,0 +1,97 @@
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from app.database import (
+    EngineSettings, InstrumentedQueuePool, PoolMetrics, build_connect_args,
+    get_pool_status, pool_metrics, to_async_url
+)
+
+
+class TestEngineSettings:
+    """测试连接池配置读取"""
+    
+    def test_from_env(self, monkeypatch):
+        monkeypatch.setenv("DB_POOL_SIZE", "20")
+        monkeypatch.setenv("DB_MAX_OVERFLOW", "0")
+        monkeypatch.setenv("DB_POOL_PRE_PING", "false")
+        monkeypatch.setenv("DB_STATEMENT_TIMEOUT_MS", "5000")
+        monkeypatch.setenv("DB_APPLICATION_NAME", "studysync-api")
+        
+        settings = EngineSettings.from_env()
+        
+        assert settings.pool_size == 20
+        assert settings.max_overflow == 0
+        assert settings.pool_pre_ping is False
+        assert settings.statement_timeout_ms == 5000
+        assert settings.application_name.startswith("studysync-api-")
+    
+    def test_postgres_connect_args(self):
+        settings = EngineSettings(statement_timeout_ms=3000, application_name="studysync-1")
+        
+        args = build_connect_args("postgresql://u:p@localhost/db", settings)
+        
+        assert args["application_name"] == "studysync-1"
+        assert args["options"] == "-c statement_timeout=3000"
+        assert build_connect_args("sqlite://", settings) == {}
+    
+    def test_asyncpg_connect_args(self):
+        settings = EngineSettings(statement_timeout_ms=3000, application_name="studysync-1")
+        args = build_connect_args("postgresql+asyncpg://u:p@localhost/db", settings)
+        
+        assert args == {"server_settings": {"application_name": "studysync-1", "statement_timeout": "3000"}}
+    
+    def test_to_async_url(self):
+        assert to_async_url("postgresql://u:p@localhost:5432/db") == "postgresql+asyncpg://u:p@localhost:5432/db"
+        assert to_async_url("sqlite:///./test.db") == "sqlite+aiosqlite:///./test.db"
+
+
+class TestPoolMetrics:
+    """测试连接池等待耗时统计"""
+    
+    def test_histogram_is_cumulative(self):
+        metrics = PoolMetrics(buckets_ms=[1, 10])
+        metrics.observe_wait(0.0005)
+        metrics.observe_wait(0.005)
+        metrics.observe_wait(0.5)
+        
+        assert metrics.histogram() == {"1": 1, "10": 2, "+Inf": 3}
+        assert metrics.wait_count == 3
+    
+    def test_pool_records_wait_and_timeout(self):
+        pool_metrics.reset()
+        engine = create_engine(
+            "sqlite://",
+            poolclass=InstrumentedQueuePool,
+            pool_size=1,
+            max_overflow=0,
+            pool_timeout=0.05,
+        )
+        conn = engine.connect()
+        try:
+            status = get_pool_status(engine, EngineSettings(max_overflow=0))
+            assert status["checked_out"] == 1
+            assert status["max_overflow"] == 0
+            with pytest.raises(PoolTimeoutError):
+                engine.connect()
+        finally:
+            conn.close()
+            engine.dispose()
+        
+        assert pool_metrics.wait_count == 2
+        assert pool_metrics.timeouts == 1
+        assert pool_metrics.errors == 0
+    
+    def test_connect_failure_is_not_a_timeout(self):
+        pool_metrics.reset()
+        
+        def refuse():
+            raise ConnectionRefusedError("数据库不可用")
+        
+        engine = create_engine("sqlite://", poolclass=InstrumentedQueuePool, creator=refuse)
+        with pytest.raises(Exception):
+            engine.connect()
+        engine.dispose()
+        
+        assert pool_metrics.wait_count == 1
+        assert pool_metrics.timeouts == 0
+        assert pool_metrics.errors == 1
@@ -0,0 +1,57 @@
+from datetime import date, timedelta
+import pytest
+from app.models import Checkin, Group, GroupMember, Plan, User
+
+TODAY = date.today()
+
+
+@pytest.fixture
+def make_client(make_database):
+    """学习群组 1 有 members 个成员；成员 1 今天打卡两个计划，成员 2 今天打卡一次、昨天一次，其余未打卡"""
+    def make(members):
+        database = make_database(f"group_{members}.db")
+        database.add(
+            [User(id=i, username=f"user{i}", password_hash="x") for i in range(1, members + 1)],
+            [Group(id=1, name="考研", created_by=1, member_count=members)]
+            + [Plan(id=i, user_id=user_id, title=f"计划{i}", daily_goal_min=60, start_date=TODAY)
+               for i, user_id in [(1, 1), (2, 1), (3, 2)]],
+            [GroupMember(group_id=1, user_id=i, role="owner" if i == 1 else "member") for i in range(1, members + 1)]
+            + [Checkin(id=1, user_id=1, plan_id=1, checkin_date=TODAY, duration_min=60, content="a"),
+               Checkin(id=2, user_id=1, plan_id=2, checkin_date=TODAY, duration_min=30, content="b"),
+               Checkin(id=3, user_id=2, plan_id=3, checkin_date=TODAY, duration_min=90, content="c"),
+               Checkin(id=4, user_id=2, plan_id=3, checkin_date=TODAY - timedelta(days=1), duration_min=90, content="d")],
+        )
+        return database.client(user_id=1, username="user1"), database.statements
+
+    return make
+
+
+class TestGroupCheckins:
+    """测试群组打卡概览"""
+
+    def test_checked_in_and_missing_members(self, make_client):
+        client, _ = make_client(4)
+
+        data = client.get("/api/groups/1/checkins").json()["data"]
+
+        assert data["total_members"] == 4
+        assert [(item["user_id"], item["hours"]) for item in data["checked_in"]] == [(1, 1.0), (1, 0.5), (2, 1.5)]
+        assert data["not_checked_in"] == [{"user_id": 3, "username": "user3"}, {"user_id": 4, "username": "user4"}]
+        assert data["checked_in_count"] == 3 and data["not_checked_in_count"] == 2
+
+    def test_date_filter(self, make_client):
+        client, _ = make_client(3)
+
+        data = client.get("/api/groups/1/checkins", params={"date": str(TODAY - timedelta(days=1))}).json()["data"]
+
+        assert [item["user_id"] for item in data["checked_in"]] == [2]
+        assert [item["user_id"] for item in data["not_checked_in"]] == [1, 3]
+
+    def test_query_count_does_not_grow_with_members(self, make_client):
+        counts = []
+        for members in (3, 200):
+            client, statements = make_client(members)
+            assert client.get("/api/groups/1/checkins").json()["data"]["not_checked_in_count"] == members - 2
+            counts.append(len(statements))
+
+        assert counts[0] == counts[1] == 2
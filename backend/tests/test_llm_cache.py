@@ -0,0 +1,153 @@
+import asyncio
+from datetime import datetime, timedelta
+import pytest
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from app.database import Base
+from app.llm_cache import DatabaseBackend, MemoryBackend, ResponseCache, cache_key, purge_statement
+from app.models import LLMResponseCache
+from app.services.ai import LLMSettings
+
+CHUNKS = ["本周", "打卡", "稳定"]
+
+
+class FakeClient:
+    """记录调用次数的模型客户端，fail_after 段之后抛出异常"""
+
+    def __init__(self, fail_after=None):
+        self.settings = LLMSettings(model="mock")
+        self.calls = 0
+        self.fail_after = fail_after
+
+    async def complete(self, messages, **kwargs):
+        self.calls += 1
+        return "".join(CHUNKS)
+
+    async def stream(self, messages, **kwargs):
+        self.calls += 1
+        for i, chunk in enumerate(CHUNKS):
+            if self.fail_after is not None and i >= self.fail_after:
+                raise RuntimeError("连接中断")
+            yield chunk
+
+
+async def collect(cache, client, key):
+    return [chunk async for chunk in cache.stream(client, key, [{"role": "user", "content": "hi"}])]
+
+
+class TestCacheKey:
+    """缓存键只取决于模板、版本、输入和模型"""
+
+    def test_key(self):
+        key = cache_key("weekly_report", 1, {"a": 1, "b": 2.5}, "deepseek-chat")
+
+        assert key == cache_key("weekly_report", 1, {"b": 2.5, "a": 1}, "deepseek-chat")
+        assert key != cache_key("weekly_report", 2, {"a": 1, "b": 2.5}, "deepseek-chat")
+        assert key != cache_key("weekly_report", 1, {"a": 1, "b": 2.6}, "deepseek-chat")
+        assert key != cache_key("weekly_report", 1, {"a": 1, "b": 2.5}, "deepseek-reasoner")
+        assert key != cache_key("checkin_analysis", 1, {"a": 1, "b": 2.5}, "deepseek-chat")
+
+
+class TestMemoryCache:
+    """进程内缓存"""
+
+    def test_stream_replayed_chunk_by_chunk(self):
+        cache = ResponseCache(MemoryBackend())
+        client = FakeClient()
+
+        first = asyncio.run(collect(cache, client, "k"))
+        second = asyncio.run(collect(cache, client, "k"))
+
+        assert first == second == CHUNKS
+        assert client.calls == 1
+        stats = cache.get_stats()
+        assert (stats["hits"], stats["misses"], stats["hit_rate"], stats["stores"]) == (1, 1, 0.5, 1)
+
+    def test_complete_shares_entry_format(self):
+        cache = ResponseCache(MemoryBackend())
+        client = FakeClient()
+
+        results = [asyncio.run(cache.complete(client, "k", [])) for _ in range(3)]
+
+        assert results == ["".join(CHUNKS)] * 3
+        assert client.calls == 1
+
+    def test_failed_stream_not_cached(self):
+        cache = ResponseCache(MemoryBackend())
+
+        with pytest.raises(RuntimeError):
+            asyncio.run(collect(cache, FakeClient(fail_after=2), "k"))
+
+        assert cache.get_stats()["stores"] == 0
+        assert asyncio.run(collect(cache, FakeClient(), "k")) == CHUNKS
+
+    def test_evicted_by_total_bytes(self):
+        backend = MemoryBackend(maxsize=100, maxbytes=20)
+        cache = ResponseCache(backend)
+
+        async def fill():
+            for key in "abcd":
+                await cache.set(key, "mock", ["x" * 8])
+            return [await cache.get(key) for key in "abcd"]
+
+        assert asyncio.run(fill()) == [None, None, ["x" * 8], ["x" * 8]]
+        stats = cache.get_stats()
+        assert (stats["size"], stats["weight"], stats["evictions"]) == (2, 16, 2)
+
+    def test_disabled(self):
+        cache = ResponseCache(None)
+        client = FakeClient()
+
+        asyncio.run(collect(cache, client, "k"))
+        asyncio.run(collect(cache, client, "k"))
+
+        assert client.calls == 2
+        assert cache.get_stats()["backend"] == "off"
+
+
+@pytest.fixture
+def session_factory(tmp_path):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'llm_cache.db'}")
+
+    async def prepare():
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        return async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+
+    yield asyncio.run(prepare())
+    asyncio.run(engine.dispose())
+
+
+class TestDatabaseCache:
+    """数据库后端"""
+
+    def test_shared_between_instances(self, session_factory):
+        async def scenario():
+            client = FakeClient()
+            first = await collect(ResponseCache(DatabaseBackend(session_factory=session_factory)), client, "k")
+            # 另一个 worker 上的缓存实例读到同一行
+            second = await collect(ResponseCache(DatabaseBackend(session_factory=session_factory)), client, "k")
+            return first, second, client.calls
+
+        first, second, calls = asyncio.run(scenario())
+        assert first == second == CHUNKS
+        assert calls == 1
+
+    def test_expired_rows_ignored_and_purged(self, session_factory):
+        async def scenario():
+            cache = ResponseCache(DatabaseBackend(ttl=60, session_factory=session_factory))
+            await cache.set("old", "mock", CHUNKS)
+            await cache.set("new", "mock", CHUNKS)
+            later = datetime.utcnow() + timedelta(seconds=30)
+            async with session_factory() as db:
+                await db.execute(LLMResponseCache.__table__.update().where(
+                    LLMResponseCache.cache_key == "old").values(expires_at=datetime.utcnow()))
+                await db.commit()
+            expired = await cache.get("old")
+            async with session_factory() as db:
+                purged = (await db.execute(purge_statement(later))).rowcount
+                await db.commit()
+                remaining = (await db.execute(select(func.count()).select_from(LLMResponseCache))).scalar()
+            return expired, purged, remaining
+
+        assert asyncio.run(scenario()) == (None, 1, 1)
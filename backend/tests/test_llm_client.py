@@ -0,0 +1,389 @@
+import asyncio
+import json
+import socket
+import threading
+import time
+import pytest
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.testclient import TestClient
+from openai import BadRequestError
+from app.auth import get_current_user
+from app.main import app
+from app.models import User
+from app.routes import ai as ai_routes
+from app.llm_cache import MemoryBackend, ResponseCache
+from app.services.ai import LLMClient, LLMSettings, RedisFlightLock, SingleFlight
+from app.services.prompts import TokenUsage
+from tests.fake_redis import FakeRedis
+
+CHUNKS = ["今天", "学习", "状态", "不错"]
+
+
+class MockLLM:
+    """本地 OpenAI 兼容的模拟大模型服务：每个请求延迟 latency 秒，记录同时处理中的请求数"""
+
+    def __init__(self):
+        self.latency = 0.2
+        self.fail_status = 503
+        self.fail_first = 0
+        self.requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.app = FastAPI()
+        self.app.post("/chat/completions")(self.completions)
+
+    def reset(self, latency=0.2, fail_first=0, fail_status=503):
+        self.latency, self.fail_first, self.fail_status = latency, fail_first, fail_status
+        self.requests = self.in_flight = self.max_in_flight = 0
+
+    async def completions(self, request: Request):
+        body = await request.json()
+        self.requests += 1
+        if self.fail_first > 0:
+            self.fail_first -= 1
+            return JSONResponse({"error": {"message": "busy"}}, status_code=self.fail_status)
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.latency)
+        finally:
+            self.in_flight -= 1
+        if body.get("stream"):
+            return StreamingResponse(self.sse(body["model"]), media_type="text/event-stream")
+        return {
+            "id": "mock", "object": "chat.completion", "created": 0, "model": body["model"],
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant", "content": "".join(CHUNKS)}}],
+            "usage": {"prompt_tokens": 12, "completion_tokens": 5, "total_tokens": 17},
+        }
+
+    async def sse(self, model):
+        for content in CHUNKS:
+            chunk = {"id": "mock", "object": "chat.completion.chunk", "created": 0, "model": model,
+                     "choices": [{"index": 0, "delta": {"content": content}, "finish_reason": None}]}
+            yield f"data: {json.dumps(chunk)}\n\n"
+        yield "data: [DONE]\n\n"
+
+
+@pytest.fixture(scope="module")
+def mock_llm():
+    mock = MockLLM()
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    server = uvicorn.Server(uvicorn.Config(mock.app, log_level="warning"))
+    thread = threading.Thread(target=server.run, kwargs={"sockets": [sock]}, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    mock.base_url = f"http://127.0.0.1:{sock.getsockname()[1]}"
+    yield mock
+    server.should_exit = True
+    thread.join()
+
+
+def make_client(mock, **overrides):
+    settings = dict(api_key="test", base_url=mock.base_url, max_connections=50, max_keepalive=50,
+                    max_concurrency=50, backoff_base=0.01)
+    settings.update(overrides)
+    return LLMClient(LLMSettings(**settings))
+
+
+def run(mock, scenario, **overrides):
+    async def main():
+        client = make_client(mock, **overrides)
+        try:
+            return await scenario(client)
+        finally:
+            await client.aclose()
+    return asyncio.run(main())
+
+
+class TestConcurrency:
+    """请求在共享连接池上并发进行，不阻塞事件循环"""
+
+    def test_concurrent_throughput(self, mock_llm):
+        mock_llm.reset(latency=0.2)
+        ticks = []
+
+        async def ticker(stop):
+            while not stop.is_set():
+                ticks.append(time.perf_counter())
+                await asyncio.sleep(0.01)
+
+        async def scenario(client):
+            stop = asyncio.Event()
+            task = asyncio.create_task(ticker(stop))
+            start = time.perf_counter()
+            results = await asyncio.gather(*[client.complete([{"role": "user", "content": "hi"}]) for _ in range(20)])
+            elapsed = time.perf_counter() - start
+            stop.set()
+            await task
+            return results, elapsed
+
+        results, elapsed = run(mock_llm, scenario)
+
+        assert results == ["今天学习状态不错"] * 20
+        # 串行需要 20 * 0.2 = 4 秒
+        assert elapsed < 1.5
+        assert mock_llm.max_in_flight == 20
+        # 等待模型返回期间事件循环仍在运行
+        assert len(ticks) >= 10
+
+    def test_concurrency_limit(self, mock_llm):
+        mock_llm.reset(latency=0.05)
+
+        async def scenario(client):
+            return await asyncio.gather(*[client.complete([{"role": "user", "content": "hi"}]) for _ in range(9)])
+
+        run(mock_llm, scenario, max_concurrency=3)
+
+        assert mock_llm.requests == 9
+        assert mock_llm.max_in_flight == 3
+
+
+class TestRetry:
+    """可重试的错误按退避重试，其余错误直接抛出"""
+
+    def test_retry_on_server_error(self, mock_llm):
+        mock_llm.reset(latency=0, fail_first=2)
+
+        result = run(mock_llm, lambda client: client.complete([{"role": "user", "content": "hi"}]))
+
+        assert result == "今天学习状态不错"
+        assert mock_llm.requests == 3
+
+    def test_gives_up_after_max_retries(self, mock_llm):
+        mock_llm.reset(latency=0, fail_first=10, fail_status=429)
+
+        with pytest.raises(Exception):
+            run(mock_llm, lambda client: client.complete([{"role": "user", "content": "hi"}]), max_retries=2)
+        assert mock_llm.requests == 3
+
+    def test_client_error_not_retried(self, mock_llm):
+        mock_llm.reset(latency=0, fail_first=1, fail_status=400)
+
+        with pytest.raises(BadRequestError):
+            run(mock_llm, lambda client: client.complete([{"role": "user", "content": "hi"}]))
+        assert mock_llm.requests == 1
+
+    def test_backoff_has_jitter_and_cap(self):
+        client = LLMClient(LLMSettings(backoff_base=0.5, backoff_max=2.0))
+        delays = [client.backoff(attempt) for attempt in range(10) for _ in range(20)]
+
+        assert all(0 <= delay <= 2.0 for delay in delays)
+        assert len(set(delays)) > 1
+
+
+class TestSettings:
+    """配置读取"""
+
+    def test_api_key_only_from_env(self, monkeypatch):
+        monkeypatch.delenv("LLM_API_KEY", raising=False)
+        settings = LLMSettings.from_env()
+
+        assert settings.api_key == ""
+        assert not settings.configured
+        with pytest.raises(RuntimeError, match="LLM_API_KEY"):
+            settings.require_api_key()
+        with pytest.raises(RuntimeError):
+            LLMClient(settings).client
+
+        monkeypatch.setenv("LLM_API_KEY", "sk-test")
+        assert LLMSettings.from_env().api_key == "sk-test"
+
+
+class TestStream:
+    """流式调用"""
+
+    def test_stream_chunks(self, mock_llm):
+        mock_llm.reset(latency=0, fail_first=1)
+
+        async def scenario(client):
+            return [content async for content in client.stream([{"role": "user", "content": "hi"}])]
+
+        assert run(mock_llm, scenario) == CHUNKS
+        assert mock_llm.requests == 2
+
+    def test_learning_coach_route(self, mock_llm, monkeypatch):
+        mock_llm.reset(latency=0)
+        monkeypatch.setattr(ai_routes, "llm_client", make_client(mock_llm))
+        app.dependency_overrides[get_current_user] = lambda: User(id=1, username="alice")
+        try:
+            response = TestClient(app).post("/api/ai/learning_coach", json={
+                "learning_goal": "考研", "weekly_total_hours": 10, "average_daily_hours": 1.5,
+                "target_daily_hours": 2, "consecutive_checkin_days": 3, "missed_checkin_days": 1,
+            })
+        finally:
+            app.dependency_overrides.clear()
+
+        assert response.status_code == 200
+        assert response.text == "".join(CHUNKS)
+
+    def test_routes_unavailable_without_api_key(self, monkeypatch):
+        monkeypatch.setattr(ai_routes, "llm_client", LLMClient(LLMSettings(api_key="")))
+        app.dependency_overrides[get_current_user] = lambda: User(id=1, username="alice")
+        try:
+            response = TestClient(app).post("/api/ai/learning_coach", json={
+                "learning_goal": "考研", "weekly_total_hours": 10, "average_daily_hours": 1.5,
+                "target_daily_hours": 2, "consecutive_checkin_days": 3, "missed_checkin_days": 1,
+            })
+        finally:
+            app.dependency_overrides.clear()
+
+        assert response.status_code == 503
+        assert response.json()["detail"] == "AI 服务未配置"
+
+
+class TestTokenUsage:
+    """按接口记录 token 用量"""
+
+    def test_usage_from_response_or_estimated(self, mock_llm):
+        mock_llm.reset(latency=0)
+        usage = TokenUsage()
+
+        async def main():
+            client = LLMClient(make_client(mock_llm).settings, usage=usage)
+            try:
+                await client.complete([{"role": "user", "content": "hi"}], endpoint="checkin_analysis")
+                # 模拟服务的流式响应不带 usage，按字符数估算
+                return [content async for content in client.stream([{"role": "user", "content": "你好"}],
+                                                                   endpoint="learning_coach")]
+            finally:
+                await client.aclose()
+
+        asyncio.run(main())
+        stats = usage.get_stats()
+
+        assert stats["checkin_analysis"] == {
+            "calls": 1, "prompt_tokens": 12, "completion_tokens": 5,
+            "avg_prompt_tokens": 12.0, "avg_completion_tokens": 5.0, "estimated_calls": 0,
+        }
+        # 2 个中文字符约 1.2 token，8 个中文字符约 4.8 token
+        assert stats["learning_coach"]["prompt_tokens"] == 2
+        assert stats["learning_coach"]["completion_tokens"] == 5
+        assert stats["learning_coach"]["estimated_calls"] == 1
+
+
+class GatedStream:
+    """按 release() 放行逐段输出的上游流，记录调用次数"""
+
+    def __init__(self, chunks=CHUNKS, fail=False):
+        self.chunks = chunks
+        self.fail = fail
+        self.calls = 0
+        self.gate = asyncio.Semaphore(0)
+        self.settings = LLMSettings(model="mock")
+
+    def release(self, count=1):
+        for _ in range(count):
+            self.gate.release()
+
+    async def stream(self, messages=None, **kwargs):
+        self.calls += 1
+        for chunk in self.chunks:
+            await self.gate.acquire()
+            yield chunk
+        if self.fail:
+            raise RuntimeError("上游中断")
+
+
+async def collect(iterator, received=None):
+    received = [] if received is None else received
+    async for chunk in iterator:
+        received.append(chunk)
+    return received
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+class TestSingleFlight:
+    """同一键的并发调用合并为一次上游请求"""
+
+    def test_do_shares_result(self):
+        calls = []
+
+        async def call():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return "结果"
+
+        async def scenario():
+            flights = SingleFlight()
+            results = await asyncio.gather(*[flights.do("k", call) for _ in range(10)])
+            return results, flights.get_stats()
+
+        results, stats = asyncio.run(scenario())
+        assert results == ["结果"] * 10
+        assert len(calls) == 1
+        assert (stats["upstream_calls"], stats["shared_calls"], stats["in_flight"]) == (1, 9, 0)
+
+    def test_late_subscriber_gets_buffered_chunks(self):
+        async def scenario():
+            flights = SingleFlight()
+            upstream = GatedStream()
+            first = asyncio.create_task(collect(flights.stream("k", upstream.stream)))
+            upstream.release(2)
+            await settle()
+            second_received = []
+            second = asyncio.create_task(collect(flights.stream("k", upstream.stream), second_received))
+            await settle()
+            # 后来者立即收到已缓冲的两段
+            buffered = list(second_received)
+            upstream.release(len(CHUNKS) - 2)
+            return await first, await second, buffered, upstream.calls
+
+        first, second, buffered, calls = asyncio.run(scenario())
+        assert first == second == CHUNKS
+        assert buffered == CHUNKS[:2]
+        assert calls == 1
+
+    def test_leader_disconnect_does_not_stop_followers(self):
+        async def scenario():
+            flights = SingleFlight()
+            upstream = GatedStream()
+            leader = asyncio.create_task(collect(flights.stream("k", upstream.stream)))
+            follower = asyncio.create_task(collect(flights.stream("k", upstream.stream)))
+            upstream.release(1)
+            await settle()
+            leader.cancel()
+            upstream.release(len(CHUNKS) - 1)
+            return await follower
+
+        assert asyncio.run(scenario()) == CHUNKS
+
+    def test_error_reaches_every_subscriber(self):
+        async def scenario():
+            flights = SingleFlight()
+            upstream = GatedStream(fail=True)
+            tasks = [asyncio.create_task(collect(flights.stream("k", upstream.stream))) for _ in range(3)]
+            upstream.release(len(CHUNKS))
+            return await asyncio.gather(*tasks, return_exceptions=True)
+
+        results = asyncio.run(scenario())
+        assert all(isinstance(result, RuntimeError) for result in results)
+
+    def test_cross_worker_lock_reuses_cached_reply(self):
+        """两个 worker 共用 Redis 锁和共享缓存：后拿到锁的 worker 从缓存回放，不再请求上游"""
+        async def scenario():
+            redis = FakeRedis()
+            backend = MemoryBackend()
+            workers = [
+                ResponseCache(backend, SingleFlight(RedisFlightLock(client=redis, poll_interval=0.01)))
+                for _ in range(2)
+            ]
+            upstream = GatedStream()
+            tasks = [asyncio.create_task(collect(worker.stream(upstream, "k", []))) for worker in workers]
+            await settle()
+            upstream.release(len(CHUNKS))
+            results = await asyncio.gather(*tasks)
+            return results, upstream.calls, redis.values
+
+        results, calls, locks = asyncio.run(scenario())
+        assert results == [CHUNKS, CHUNKS]
+        assert calls == 1
+        assert locks == {}
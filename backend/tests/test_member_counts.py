@@ -0,0 +1,143 @@
+import asyncio
+import pytest
+from sqlalchemy import select
+from sqlalchemy.orm import sessionmaker
+from app.auth import get_current_user
+from app.chat_models import ChatRoom, ChatRoomJoinRequest, ChatRoomMember
+from app.main import app
+from app.maintenance import reconcile_member_counts
+from app.member_counts import reserve_chat_room_seat
+from app.models import Group, GroupMember, User
+
+
+@pytest.fixture
+def setup(make_database):
+    """群聊 1（上限 10）：alice 群主、bob 成员，carol 有待审批申请；学习群组 1：alice 群主"""
+    database = make_database("counts.db")
+    database.add(
+        [User(id=i, username=name, password_hash="x") for i, name in enumerate(["alice", "bob", "carol"], start=1)],
+        [ChatRoom(id=1, chat_id="MATHXY", name="数学", created_by=1, max_members=10, member_count=2),
+         Group(id=1, name="考研", created_by=1, member_count=1)],
+        [ChatRoomMember(id=1, chat_room_id=1, user_id=1, role="owner"),
+         ChatRoomMember(id=2, chat_room_id=1, user_id=2),
+         ChatRoomJoinRequest(id=1, chat_room_id=1, user_id=3),
+         GroupMember(group_id=1, user_id=1, role="owner")],
+    )
+    yield database.client(), database.engine, database.async_session_factory, database.statements
+
+
+def as_user(user_id):
+    app.dependency_overrides[get_current_user] = lambda: User(id=user_id, username=f"user{user_id}")
+
+
+def chat_room_count(engine):
+    with engine.connect() as conn:
+        return conn.execute(select(ChatRoom.member_count).where(ChatRoom.id == 1)).scalar()
+
+
+def group_count(engine):
+    with engine.connect() as conn:
+        return conn.execute(select(Group.member_count).where(Group.id == 1)).scalar()
+
+
+class TestChatRoomMemberCount:
+    """测试群聊成员数计数"""
+
+    def test_read_paths_do_not_count(self, setup):
+        client, _, _, statements = setup
+        as_user(1)
+        statements.clear()
+
+        assert client.get("/api/chat-rooms/1").json()["data"]["current_members"] == 2
+        assert client.get("/api/chat-rooms/search-by-id", params={"chat_id": "MATHXY"}).json()["data"]["current_members"] == 2
+        assert client.get("/api/chat-rooms/search").json()["data"]["chat_rooms"][0]["current_members"] == 2
+        assert not any("count(chat_room_members" in sql.lower() for sql in statements)
+
+    def test_leave_and_remove_decrement(self, setup):
+        client, engine, *_ = setup
+        with engine.begin() as conn:
+            conn.execute(ChatRoomMember.__table__.insert().values(id=3, chat_room_id=1, user_id=3, role="member"))
+            conn.execute(ChatRoom.__table__.update().values(member_count=3))
+
+        as_user(2)
+        assert client.post("/api/chat-rooms/1/leave").status_code == 200
+        as_user(1)
+        assert client.delete("/api/chat-rooms/1/members/3").status_code == 200
+
+        assert chat_room_count(engine) == 1
+
+    def test_approve_rejected_when_full(self, setup):
+        client, engine, *_ = setup
+        with engine.begin() as conn:
+            conn.execute(ChatRoom.__table__.update().values(member_count=10))
+        as_user(1)
+
+        response = client.post("/api/chat-rooms/1/join-requests/1/review", json={"approve": True})
+
+        assert response.status_code == 400
+        assert response.json()["detail"] == "群聊成员已满"
+        assert chat_room_count(engine) == 10
+        with engine.connect() as conn:
+            assert conn.execute(select(ChatRoomMember).where(ChatRoomMember.user_id == 3)).first() is None
+
+    def test_concurrent_reservations_never_exceed_capacity(self, setup):
+        _, engine, session_factory, _ = setup
+
+        async def reserve():
+            async with session_factory() as db:
+                result = await db.execute(reserve_chat_room_seat(1))
+                await db.commit()
+                return result.rowcount
+
+        async def scenario():
+            return await asyncio.gather(*[reserve() for _ in range(20)])
+
+        assert sum(asyncio.run(scenario())) == 8
+        assert chat_room_count(engine) == 10
+
+    def test_max_members_below_count_rejected(self, setup):
+        client, engine, *_ = setup
+        with engine.begin() as conn:
+            conn.execute(ChatRoom.__table__.update().values(member_count=12, max_members=20))
+        as_user(1)
+
+        assert client.put("/api/chat-rooms/1", json={"max_members": 10}).status_code == 400
+        response = client.put("/api/chat-rooms/1", json={"max_members": 12})
+        assert response.status_code == 200
+        assert response.json()["data"]["max_members"] == 12
+        assert response.json()["data"]["current_members"] == 12
+
+
+class TestGroupMemberCount:
+    """测试学习群组成员数计数"""
+
+    def test_join_and_leave(self, setup):
+        client, engine, *_ = setup
+        as_user(2)
+        assert client.post("/api/groups/1/join").status_code == 200
+        as_user(3)
+        assert client.post("/api/groups/1/join").status_code == 200
+        assert group_count(engine) == 3
+
+        assert client.post("/api/groups/1/leave").status_code == 200
+        as_user(1)
+        assert client.delete("/api/groups/1/members/2").status_code == 200
+        assert group_count(engine) == 1
+
+        data = client.get("/api/groups").json()["data"]
+        assert data["created"][0]["member_count"] == 1
+        assert data["joined"][0]["member_count"] == 1
+        assert client.get("/api/groups/1").json()["data"]["member_count"] == 1
+
+
+class TestReconcile:
+    """测试成员数修正命令"""
+
+    def test_reconcile_repairs_drift(self, setup):
+        _, engine, *_ = setup
+        with engine.begin() as conn:
+            conn.execute(ChatRoom.__table__.update().values(member_count=7))
+
+        assert reconcile_member_counts(sessionmaker(bind=engine)) == {"chat_rooms": 1, "groups": 0}
+        assert chat_room_count(engine) == 2
+        assert group_count(engine) == 1
@@ -0,0 +1,154 @@
+from datetime import datetime
+
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, select
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from app.auth import get_current_user
+from app.chat_models import ChatMessage, ChatRoom, ChatRoomMember
+from app.database import Base, get_async_db
+from app.main import app
+from app.maintenance import backfill_search_tokens
+from app.models import User
+from app.services.message_search import highlight, message_search, query_tokens, search_text, tokenize
+
+MESSAGES = [
+    # (id, 发送者, 内容, 日期)
+    (1, 1, "今天复习线性代数", datetime(2024, 3, 1, 9)),
+    (2, 2, "线性代数的特征值好难", datetime(2024, 3, 2, 9)),
+    (3, 1, "Python 作业写完了", datetime(2024, 3, 3, 9)),
+    (4, 2, "python python 一起学", datetime(2024, 3, 4, 9)),
+    (5, 1, "代数代数代数，线性代数期末见", datetime(2024, 3, 5, 9)),
+    (6, 2, "已撤回的线性代数消息", datetime(2024, 3, 6, 9)),
+    (7, 1, "<b>线性</b>代数", datetime(2024, 3, 7, 9)),
+]
+
+
+@pytest.fixture
+def client(tmp_path):
+    path = tmp_path / "search.db"
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(bind=engine)
+    db = sessionmaker(bind=engine, expire_on_commit=False)()
+    alice = User(id=1, username="alice", password_hash="x")
+    db.add_all([alice, User(id=2, username="bob", password_hash="x")])
+    db.flush()
+    db.add(ChatRoom(id=1, chat_id="ROOM01", name="数学", created_by=1))
+    db.flush()
+    db.add_all([
+        ChatRoomMember(id=1, chat_room_id=1, user_id=1, role="owner"),
+        ChatRoomMember(id=2, chat_room_id=1, user_id=2),
+    ])
+    db.add_all([
+        ChatMessage(id=i, chat_room_id=1, user_id=sender, content=content, created_at=created_at,
+                    is_deleted=i == 6, search_tokens=search_text(content))
+        for i, sender, content, created_at in MESSAGES
+    ])
+    db.commit()
+    db.close()
+
+    session_factory = async_sessionmaker(
+        create_async_engine(f"sqlite+aiosqlite:///{path}"), class_=AsyncSession, expire_on_commit=False
+    )
+
+    async def override_get_async_db():
+        async with session_factory() as session:
+            yield session
+
+    message_search.memory.reset()
+    app.dependency_overrides[get_current_user] = lambda: alice
+    app.dependency_overrides[get_async_db] = override_get_async_db
+    yield TestClient(app), engine
+    app.dependency_overrides.clear()
+    message_search.memory.reset()
+    engine.dispose()
+
+
+def search(client, **params):
+    response = client.get("/api/chat-rooms/1/messages/search", params=params)
+    assert response.status_code == 200
+    return response.json()["data"]
+
+
+def ids(data):
+    return [m["message_id"] for m in data["messages"]]
+
+
+class TestTokenizer:
+    """测试分词与高亮"""
+
+    def test_cjk_ngrams_and_words(self):
+        assert tokenize("线性代数 Python!") == ["线", "性", "代", "数", "线性", "性代", "代数", "python"]
+        assert query_tokens("线性代数") == ["线性", "性代", "代数"]
+        assert query_tokens("数") == ["数"]
+        assert query_tokens("？！") == []
+
+    def test_highlight_escapes_html(self):
+        assert highlight("<b>线性</b>代数", "线性") == "&lt;b&gt;<mark>线性</mark>&lt;/b&gt;代数"
+
+    def test_highlight_snippet(self):
+        content = "前" * 200 + "线性代数" + "后" * 200
+        snippet = highlight(content, "线性代数", max_length=40)
+
+        assert snippet.startswith("…") and snippet.endswith("…")
+        assert "<mark>线性代数</mark>" in snippet
+
+
+class TestMessageSearch:
+    """测试消息搜索接口（SQLite 使用内存倒排索引）"""
+
+    def test_relevance_order(self, client):
+        data = search(client[0], keyword="代数")
+
+        # 已删除的 6 不出现；5 中“代数”出现次数最多
+        assert ids(data)[0] == 5
+        assert sorted(ids(data)) == [1, 2, 5, 7]
+        assert data["messages"][0]["highlight"].count("<mark>") >= 1
+
+    def test_case_insensitive_words(self, client):
+        assert ids(search(client[0], keyword="PYTHON", order="newest")) == [4, 3]
+
+    def test_all_terms_must_match(self, client):
+        assert ids(search(client[0], keyword="线性代数 期末")) == [5]
+
+    def test_cursor_pagination(self, client):
+        full = ids(search(client[0], keyword="代数", limit=50))
+        first = search(client[0], keyword="代数", limit=2)
+        second = search(client[0], keyword="代数", limit=2, cursor=first["next_cursor"])
+
+        assert first["has_more"] is True
+        assert second["has_more"] is False
+        assert ids(first) + ids(second) == full
+
+    def test_sender_and_date_filters(self, client):
+        assert ids(search(client[0], keyword="代数", sender_id=2)) == [2]
+        assert ids(search(client[0], keyword="代数", start_date="2024-03-02", end_date="2024-03-05",
+                          order="newest")) == [5, 2]
+
+    def test_invalid_input(self, client):
+        url = "/api/chat-rooms/1/messages/search"
+
+        assert client[0].get(url, params={"keyword": "代数", "cursor": "???"}).status_code == 400
+        assert client[0].get(url, params={"keyword": "！！"}).status_code == 400
+        assert client[0].get(url, params={"keyword": "代数", "order": "oldest"}).status_code == 422
+
+    def test_index_picks_up_new_messages(self, client):
+        assert ids(search(client[0], keyword="概率")) == []
+        db = sessionmaker(bind=client[1])()
+        db.add(ChatMessage(id=8, chat_room_id=1, user_id=2, content="概率论也要复习"))
+        db.commit()
+        db.close()
+
+        assert ids(search(client[0], keyword="概率")) == [8]
+
+    def test_backfill_search_tokens(self, client):
+        db = sessionmaker(bind=client[1])()
+        db.query(ChatMessage).update({ChatMessage.search_tokens: None})
+        db.commit()
+        db.close()
+
+        assert backfill_search_tokens(batch_size=3, session_factory=sessionmaker(bind=client[1])) == 7
+        with client[1].connect() as conn:
+            tokens = conn.execute(select(ChatMessage.search_tokens).filter(ChatMessage.id == 3)).scalar()
+        assert tokens == "python 作 业 写 完 了 作业 业写 写完 完了"
@@ -0,0 +1,82 @@
+from datetime import date, timedelta
+import pytest
+from app.maintenance import rebuild_daily_stats
+from app.models import Checkin, Group, GroupMember, Plan, User
+
+START = date(2024, 3, 1)
+
+
+@pytest.fixture
+def setup(make_database):
+    """alice 有 25 个计划，计划 i 有 i % 3 次打卡（每次 30 分钟）；bob 有 1 个计划；alice 在一个群组中"""
+    database = make_database("plans.db")
+    checkins = [(plan_id, day) for plan_id in range(1, 27) for day in range(plan_id % 3)]
+    database.add(
+        [User(id=1, username="alice", password_hash="x"), User(id=2, username="bob", password_hash="x")],
+        [Plan(id=i, user_id=1, title=f"计划{i}", daily_goal_min=60, start_date=START) for i in range(1, 26)]
+        + [Plan(id=26, user_id=2, title="bob", daily_goal_min=60, start_date=START), Group(id=1, name="学习小组", created_by=1)],
+        [Checkin(id=checkin_id, user_id=1 if plan_id <= 25 else 2, plan_id=plan_id,
+                 checkin_date=START + timedelta(days=day), duration_min=30, content="x")
+         for checkin_id, (plan_id, day) in enumerate(checkins, start=1)]
+        + [GroupMember(group_id=1, user_id=1, last_checkin=START + timedelta(days=1))],
+    )
+    rebuild_daily_stats(session_factory=database.session_factory)
+    yield database.client(), database.statements, database.session_factory
+
+
+class TestGetPlans:
+    """测试计划列表"""
+
+    def test_progress_from_grouped_query(self, setup):
+        client, statements, _ = setup
+        statements.clear()
+
+        data = client.get("/api/plans", params={"page_size": 10}).json()["data"]
+
+        assert data["total"] == 25
+        assert [item["plan_id"] for item in data["items"]] == list(range(25, 15, -1))
+        progress = {item["plan_id"]: item["progress"] for item in data["items"]}
+        assert progress[23] == {"total_hours": 1.0, "checkin_count": 2, "last_checkin_date": str(START + timedelta(days=1)),
+                                "completion_rate": 100}
+        assert progress[22]["checkin_count"] == 1 and progress[22]["completion_rate"] == 50
+        assert progress[24] == {"total_hours": 0, "checkin_count": 0, "last_checkin_date": None, "completion_rate": 0}
+        assert len(statements) == 2
+
+    def test_cursor_pagination(self, setup):
+        client, _, _ = setup
+        seen = []
+        cursor = None
+        while True:
+            params = {"page_size": 7} if cursor is None else {"page_size": 7, "cursor": cursor}
+            data = client.get("/api/plans", params=params).json()["data"]
+            seen += [item["plan_id"] for item in data["items"]]
+            cursor = data["next_cursor"]
+            if not data["has_more"]:
+                break
+
+        assert seen == list(range(25, 0, -1))
+        assert cursor is None
+
+    def test_page_pagination_still_supported(self, setup):
+        client, _, _ = setup
+
+        data = client.get("/api/plans", params={"page": 3, "page_size": 10}).json()["data"]
+
+        assert [item["plan_id"] for item in data["items"]] == list(range(5, 0, -1))
+        assert data["has_more"] is False
+
+
+class TestDeletePlan:
+    """测试删除计划"""
+
+    def test_group_last_checkin_follows_remaining_checkins(self, setup):
+        client, _, session_factory = setup
+
+        # 第二天的打卡都在 i % 3 == 2 的计划中，全部删除后最后打卡日期回到第一天
+        for plan_id in range(2, 26, 3):
+            assert client.delete(f"/api/plans/{plan_id}").status_code == 200
+
+        db = session_factory()
+        member = db.get(GroupMember, (1, 1))
+        db.close()
+        assert member.last_checkin == START
@@ -0,0 +1,87 @@
+from datetime import date
+import pytest
+from app.services.prompts import (
+    DROPPED, FULL, SUMMARY, TRIMMED, Block, PromptRegistry, PromptTemplate, STRATEGIES_SUMMARY,
+    TokenUsage, estimate_tokens, prompts,
+)
+
+WEEKLY = dict(week_start=date(2024, 1, 1), week_end=date(2024, 1, 7), checkin_count=5,
+              total_hours=12.345, checkin_rate=71.43)
+COACH = dict(learning_goal="考研", weekly_total_hours=10, average_daily_hours=1.5, target_daily_hours=2,
+             consecutive_checkin_days=3, missed_checkin_days=1)
+
+
+class TestEstimate:
+    """token 估算"""
+
+    def test_cjk_and_ascii(self):
+        assert estimate_tokens("") == 0
+        assert estimate_tokens("学习") == 2
+        assert estimate_tokens("hello world") == 4
+        assert estimate_tokens("学习 plan") == 3
+
+
+class TestTemplate:
+    """模板编译和预算裁剪"""
+
+    def test_render_within_budget_keeps_full_text(self):
+        prompt = prompts.render("weekly_report", budget=10000, **WEEKLY)
+
+        assert prompt.variant == (FULL, FULL, FULL)
+        assert "打卡率：71.4%" in prompt.text and "总学习时长：12.3小时" in prompt.text
+        assert "优先建立打卡习惯" in prompt.text
+        assert prompt.tokens == estimate_tokens(prompt.text)
+        assert prompt.messages == [{"role": "user", "content": prompt.text}]
+
+    def test_summary_then_drop(self):
+        full = prompts.render("weekly_report", budget=0, **WEEKLY)
+        summarized = prompts.render("weekly_report", budget=full.tokens - 1, **WEEKLY)
+        dropped = prompts.render("weekly_report", budget=summarized.tokens - 1, **WEEKLY)
+
+        assert summarized.variant == (FULL, SUMMARY, FULL)
+        assert STRATEGIES_SUMMARY in summarized.text and "优先建立打卡习惯" not in summarized.text
+        assert dropped.variant == (FULL, DROPPED, FULL)
+        assert "学习策略" not in dropped.text
+        assert "避免空泛的描述。\n\n【输出格式要求】" in dropped.text
+        assert full.tokens > summarized.tokens > dropped.tokens
+
+    def test_trims_long_user_input(self):
+        prompt = prompts.render("learning_coach", budget=300, **dict(COACH, learning_goal="考研" * 500))
+
+        assert prompt.variant[-1] == TRIMMED
+        assert prompt.tokens <= 300
+        assert "- 学习目标：考研" in prompt.text and "…\n- 本周总学习时长：10小时" in prompt.text
+
+    def test_over_budget_counted(self):
+        registry = PromptRegistry(budget=3)
+        registry.register(PromptTemplate("short", 1, [Block("学习目标：{goal}")]))
+
+        prompt = registry.render("short", goal="考研")
+        stats = registry.get_stats()["templates"]["short"]
+
+        assert prompt.text == "学习目标：考研"
+        assert (stats["renders"], stats["over_budget"]) == (1, 1)
+
+    def test_duplicate_name_rejected(self):
+        registry = PromptRegistry()
+        registry.register(PromptTemplate("short", 1, [Block("x")]))
+
+        with pytest.raises(ValueError):
+            registry.register(PromptTemplate("short", 2, [Block("y")]))
+
+
+class TestTokenUsage:
+    """按接口累计 token 用量"""
+
+    def test_record(self):
+        usage = TokenUsage()
+        usage.record("weekly_report_stream", 500, 300)
+        usage.record("weekly_report_stream", 520, 280, estimated=True)
+        usage.record(None, 10, 5)
+
+        stats = usage.get_stats()
+        assert stats["weekly_report_stream"] == {
+            "calls": 2, "prompt_tokens": 1020, "completion_tokens": 580,
+            "avg_prompt_tokens": 510.0, "avg_completion_tokens": 290.0, "estimated_calls": 1,
+        }
+        assert stats["other"]["calls"] == 1
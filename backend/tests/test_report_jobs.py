@@ -0,0 +1,199 @@
+import asyncio
+from datetime import date, datetime, timedelta
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine, select
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from app import report_jobs as report_jobs_module
+from app.auth import get_current_user
+from app.database import Base
+from app.main import app
+from app.models import AIReportJob, AIWeeklyReport, User, UserDailyStat
+from app.report_jobs import COMPLETED, FAILED, PENDING, ReportJobQueue
+from app.routes import ai as ai_routes
+
+WEEK = date(2024, 1, 1)
+
+
+@pytest.fixture
+def session_factory(tmp_path):
+    """alice 本周打卡 5 天（每天 3 小时），bob 打卡 1 天，carol 本周没有打卡"""
+    path = tmp_path / "report_jobs.db"
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(bind=engine)
+    db = sessionmaker(bind=engine)()
+    db.add_all([User(id=i, username=name, password_hash="x") for i, name in ((1, "alice"), (2, "bob"), (3, "carol"))])
+    db.flush()
+    db.add_all([UserDailyStat(user_id=1, plan_id=1, stat_date=WEEK + timedelta(days=i), minutes=180, checkin_count=1)
+                for i in range(5)])
+    db.add(UserDailyStat(user_id=2, plan_id=2, stat_date=WEEK, minutes=30, checkin_count=1))
+    # 已有的周报行，任务按 (用户, 周) 更新而不是再插入一行
+    db.add_all([AIWeeklyReport(id=i, user_id=i, week_start=WEEK, week_end=WEEK + timedelta(days=6), score=0)
+                for i in (1, 2, 3)])
+    db.commit()
+    db.close()
+    engine.dispose()
+
+    async_engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+    yield async_sessionmaker(async_engine, class_=AsyncSession, expire_on_commit=False)
+    asyncio.run(async_engine.dispose())
+
+
+async def report_scores(session_factory):
+    async with session_factory() as db:
+        rows = (await db.execute(select(AIWeeklyReport.user_id, AIWeeklyReport.score))).all()
+    return dict(rows)
+
+
+class TestReportJobQueue:
+    """测试周报任务队列"""
+
+    def test_duplicate_submissions_share_one_job(self, session_factory):
+        async def scenario():
+            queue = ReportJobQueue(workers=2, session_factory=session_factory)
+            events = []
+
+            async def listener(user_id, message):
+                events.append((user_id, message["type"], message["status"]))
+
+            queue.status_listener = listener
+            submitted = await asyncio.gather(*[queue.submit(1, WEEK, WEEK + timedelta(days=6)) for _ in range(3)])
+            final = await queue.wait(submitted[0]["task_id"])
+            async with session_factory() as db:
+                job_count = len((await db.execute(select(AIReportJob.id))).all())
+            stats = queue.get_stats()
+            await queue.stop()
+            return submitted, final, job_count, events, stats, await report_scores(session_factory)
+
+        submitted, final, job_count, events, stats, scores = asyncio.run(scenario())
+
+        assert len({job["task_id"] for job in submitted}) == 1
+        assert submitted[0]["status"] == PENDING
+        assert final["status"] == COMPLETED and final["finished_at"] is not None
+        assert job_count == 1
+        assert events == [(1, "ai_report_job", "running"), (1, "ai_report_job", "completed")]
+        assert stats["deduplicated"] == 2 and stats["completed"] == 1
+        # 5/7 天打卡 + 学习超过 10 小时
+        assert scores[1] == 81
+
+    def test_new_job_after_previous_finished(self, session_factory):
+        async def scenario():
+            queue = ReportJobQueue(workers=1, session_factory=session_factory)
+            first = await queue.submit(2, WEEK, WEEK + timedelta(days=6))
+            await queue.wait(first["task_id"])
+            second = await queue.submit(2, WEEK, WEEK + timedelta(days=6))
+            await queue.wait(second["task_id"])
+            await queue.stop()
+            return first, second
+
+        first, second = asyncio.run(scenario())
+        assert first["task_id"] != second["task_id"]
+
+    def test_failure_recorded(self, session_factory, monkeypatch):
+        async def broken(*args):
+            raise RuntimeError("汇总表不可用")
+
+        monkeypatch.setattr(report_jobs_module, "build_weekly_report", broken)
+
+        async def scenario():
+            queue = ReportJobQueue(workers=1, session_factory=session_factory)
+            job = await queue.submit(1, WEEK, WEEK + timedelta(days=6))
+            final = await queue.wait(job["task_id"])
+            await queue.stop()
+            return final, queue.get_stats()
+
+        final, stats = asyncio.run(scenario())
+        assert final["status"] == FAILED and final["error"] == "汇总表不可用"
+        assert stats["failed"] == 1 and stats["in_flight"] == 0
+
+    def test_unfinished_jobs_resumed_on_start(self, session_factory):
+        async def scenario():
+            async with session_factory() as db:
+                db.add(AIReportJob(id="left-over", user_id=1, week_start=WEEK, week_end=WEEK + timedelta(days=6),
+                                   status="running", created_at=datetime.utcnow()))
+                await db.commit()
+            queue = ReportJobQueue(workers=1, session_factory=session_factory)
+            resumed = await queue.start()
+            final = await queue.wait("left-over")
+            await queue.stop()
+            return resumed, final
+
+        resumed, final = asyncio.run(scenario())
+        assert resumed == 1
+        assert final["status"] == COMPLETED
+
+    def test_each_job_runs_once_across_workers(self, session_factory):
+        next_week = WEEK + timedelta(days=7)
+
+        async def scenario():
+            async with session_factory() as db:
+                db.add(AIReportJob(id="pending", user_id=1, week_start=next_week, week_end=next_week + timedelta(days=6),
+                                   status=PENDING, created_at=datetime.utcnow()))
+                await db.commit()
+            # 两个 worker 进程同时启动，都会把未完成的任务入队
+            queues = [ReportJobQueue(workers=1, session_factory=session_factory) for _ in range(2)]
+            await asyncio.gather(*[queue.start() for queue in queues])
+            await asyncio.gather(*[queue.wait("pending") for queue in queues])
+            # 同一周再生成一次，按 (用户, 周) 更新原来的周报
+            again = await queues[0].submit(1, next_week, next_week + timedelta(days=6))
+            await queues[0].wait(again["task_id"])
+            stats = [queue.get_stats() for queue in queues]
+            for queue in queues:
+                await queue.stop()
+            async with session_factory() as db:
+                reports = (await db.execute(
+                    select(AIWeeklyReport.id).where(AIWeeklyReport.week_start == next_week)
+                )).all()
+            return stats, reports
+
+        stats, reports = asyncio.run(scenario())
+        assert sum(s["completed"] for s in stats) == 2
+        assert sum(s["claimed_elsewhere"] for s in stats) == 1
+        assert len(reports) == 1
+
+    def test_batch_generates_active_users(self, session_factory):
+        async def scenario():
+            queue = ReportJobQueue(workers=3, session_factory=session_factory)
+            counts = await queue.run_batch(WEEK)
+            await queue.stop()
+            return counts, await report_scores(session_factory)
+
+        counts, scores = asyncio.run(scenario())
+        assert counts == {COMPLETED: 2, FAILED: 0}
+        # carol 本周没有打卡，不生成
+        assert scores == {1: 81, 2: 14, 3: 0}
+
+
+class TestReportJobRoutes:
+    """测试周报任务接口"""
+
+    def test_submit_and_poll(self, session_factory, monkeypatch):
+        queue = ReportJobQueue(workers=1, session_factory=session_factory)
+        monkeypatch.setattr(ai_routes, "report_jobs", queue)
+        app.dependency_overrides[get_current_user] = lambda: User(id=1, username="alice")
+        client = TestClient(app)
+        try:
+            data = client.post("/api/ai/generate_report", json={
+                "user_id": 1, "week_start": str(WEEK), "week_end": str(WEEK + timedelta(days=6))
+            }).json()["data"]
+            # 每个请求使用独立的事件循环，请求结束时任务可能还未执行；模拟重启后恢复未完成的任务
+            polled = client.get(f"/api/ai/report_jobs/{data['task_id']}").json()["data"]
+
+            async def restart():
+                await queue.start()
+                await queue.wait(data["task_id"])
+                await queue.stop()
+
+            asyncio.run(restart())
+            job = client.get(f"/api/ai/report_jobs/{data['task_id']}").json()["data"]
+            app.dependency_overrides[get_current_user] = lambda: User(id=2, username="bob")
+            other = client.get(f"/api/ai/report_jobs/{data['task_id']}")
+        finally:
+            app.dependency_overrides.clear()
+
+        assert data["status"] == PENDING
+        assert polled["task_id"] == data["task_id"]
+        assert job["status"] == COMPLETED
+        assert other.status_code == 404
+        assert other.json()["detail"] == "任务不存在"
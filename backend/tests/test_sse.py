@@ -0,0 +1,197 @@
+import asyncio
+import json
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from app.auth import get_current_user
+from app.database import Base
+from app.llm_cache import ResponseCache
+from app.main import app
+from app.models import User
+from app.routes import ai as ai_routes
+from app.services.ai import LLMSettings
+from app.sse import EventStreamRegistry, SSESettings, coalesce
+
+CHUNKS = ["今天", "学习", "状态", "不错"]
+COACH_DATA = {
+    "learning_goal": "考研", "weekly_total_hours": 10, "average_daily_hours": 1.5,
+    "target_daily_hours": 2, "consecutive_checkin_days": 3, "missed_checkin_days": 1,
+}
+
+
+class FakeClient:
+    """逐段输出固定回复的模型客户端"""
+    settings = LLMSettings(api_key="test", model="fake")
+
+    def __init__(self):
+        self.calls = 0
+
+    async def stream(self, messages, **kwargs):
+        self.calls += 1
+        for chunk in CHUNKS:
+            yield chunk
+
+
+async def timed(delays):
+    """每段之前等待 delays 中对应的秒数"""
+    for delay, chunk in zip(delays, CHUNKS):
+        await asyncio.sleep(delay)
+        yield chunk
+
+
+async def collect_timed(iterator):
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    return [(chunk, loop.time() - start) async for chunk in iterator]
+
+
+def parse_events(body):
+    """把 SSE 响应体解析为 (id, event, data) 列表，忽略 retry 和心跳帧"""
+    events = []
+    for frame in body.split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in frame.splitlines() if not line.startswith(":") and ": " in line)
+        if "event" in fields:
+            events.append((fields["id"], fields["event"], json.loads(fields["data"])))
+    return events
+
+
+class TestCoalesce:
+    """分段合并的刷新策略"""
+
+    def test_first_chunk_immediate_then_size_flush(self):
+        async def scenario():
+            return await collect_timed(coalesce(timed([0.01] * 4), max_chars=4, max_delay=10))
+
+        result = asyncio.run(scenario())
+        assert [chunk for chunk, _ in result] == ["今天", "学习状态", "不错"]
+        assert result[0][1] < 0.05
+
+    def test_time_flush_while_upstream_is_slow(self):
+        async def scenario():
+            return await collect_timed(coalesce(timed([0, 0, 0.3, 0]), max_chars=100, max_delay=0.05))
+
+        result = asyncio.run(scenario())
+        assert [chunk for chunk, _ in result] == ["今天", "学习", "状态不错"]
+        # 第二段不必等到上游的第三段
+        assert result[1][1] < 0.2
+
+    def test_error_propagates(self):
+        async def broken():
+            yield "今天"
+            raise RuntimeError("上游中断")
+
+        async def scenario():
+            return [chunk async for chunk in coalesce(broken(), max_chars=10, max_delay=0.05)]
+
+        with pytest.raises(RuntimeError):
+            asyncio.run(scenario())
+
+
+class TestEventStream:
+    """流缓冲、心跳和断线补发"""
+
+    def test_heartbeat_and_resume_mid_stream(self):
+        async def scenario():
+            registry = EventStreamRegistry(SSESettings(heartbeat=0.05))
+            gate = asyncio.Event()
+
+            async def produce(stream):
+                await stream.publish("analysis", {"content": "今天"})
+                await stream.publish("analysis", {"content": "学习"})
+                await gate.wait()
+                await stream.publish("complete")
+
+            stream = registry.open(1, produce)
+            first = []
+            async for frame in stream.follow(0, heartbeat=0.05):
+                first.append(frame)
+                if frame.startswith(":"):
+                    # 收到心跳后断开连接
+                    break
+            last_id = [line for line in first[1].splitlines() if line.startswith("id: ")][0][4:]
+            resumed, after = registry.resume(1, last_id)
+            gate.set()
+            rest = [frame async for frame in resumed.follow(after, heartbeat=0.05)]
+            foreign = registry.resume(2, last_id)
+            return first, rest, registry.get_stats(), foreign
+
+        first, rest, stats, foreign = asyncio.run(scenario())
+        assert first[0].startswith("id: ") and "今天" in first[0]
+        assert first[-1] == ": ping\n\n"
+        assert [frame for frame in rest if not frame.startswith(":")] == [rest[-1]]
+        assert "event: complete" in rest[-1] and rest[-1].startswith("id: ") and rest[-1].split("\n")[0].endswith("-3")
+        assert foreign is None
+        assert (stats["opened"], stats["resumed"], stats["restarted"]) == (1, 1, 1)
+
+    def test_unknown_event_id_restarts(self):
+        async def scenario():
+            registry = EventStreamRegistry(SSESettings())
+            return registry.resume(1, "missing-3"), registry.resume(1, "garbage"), registry.restarted
+
+        assert asyncio.run(scenario()) == (None, None, 2)
+
+
+@pytest.fixture
+def routes(tmp_path, monkeypatch):
+    engine = create_engine(f"sqlite:///{tmp_path / 'sse.db'}")
+    Base.metadata.create_all(bind=engine)
+    monkeypatch.setattr(ai_routes, "AsyncSessionLocal", async_sessionmaker(
+        create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'sse.db'}"), class_=AsyncSession, expire_on_commit=False
+    ))
+
+    client = FakeClient()
+    monkeypatch.setattr(ai_routes, "llm_client", client)
+    monkeypatch.setattr(ai_routes, "response_cache", ResponseCache(None))
+    monkeypatch.setattr(ai_routes, "event_streams", EventStreamRegistry(SSESettings(flush_chars=4)))
+    app.dependency_overrides[get_current_user] = lambda: User(id=1, username="alice")
+    yield TestClient(app), client
+    app.dependency_overrides.clear()
+    engine.dispose()
+
+
+class TestStreamRoutes:
+    """流式接口的 SSE 模式"""
+
+    def test_weekly_report_events_and_resume(self, routes):
+        http, llm = routes
+        response = http.get("/api/ai/weekly_report/stream", params={"week_date": "2024-01-01"},
+                            headers={"Accept": "text/event-stream"})
+        events = parse_events(response.text)
+
+        assert response.headers["content-type"].startswith("text/event-stream")
+        assert response.text.startswith("retry: ")
+        assert [event for _, event, _ in events] == ["basic", "analysis", "analysis", "analysis", "complete"]
+        assert events[0][2]["week_start"] == "2024-01-01"
+        assert "".join(data["content"] for _, event, data in events if event == "analysis") == "".join(CHUNKS)
+        stream_ids = {event_id.rsplit("-", 1)[0] for event_id, _, _ in events}
+        assert len(stream_ids) == 1
+
+        resumed = parse_events(http.get("/api/ai/weekly_report/stream", headers={
+            "Accept": "text/event-stream", "Last-Event-ID": events[1][0]
+        }).text)
+        assert resumed == events[2:]
+        assert llm.calls == 1
+
+    def test_legacy_json_lines_unchanged(self, routes):
+        http, _ = routes
+        lines = [json.loads(line) for line in http.get(
+            "/api/ai/weekly_report/stream", params={"week_date": "2024-01-01"}
+        ).text.splitlines()]
+
+        assert [line["type"] for line in lines][0] == "basic" and lines[-1]["type"] == "complete"
+        assert "".join(line["data"]["content"] for line in lines if line["type"] == "analysis") == "".join(CHUNKS)
+
+    def test_learning_coach_resume_other_user_restarts(self, routes):
+        http, llm = routes
+        first = parse_events(http.post("/api/ai/learning_coach", json=COACH_DATA,
+                                       headers={"Accept": "text/event-stream"}).text)
+        app.dependency_overrides[get_current_user] = lambda: User(id=2, username="bob")
+        second = parse_events(http.post("/api/ai/learning_coach", json=COACH_DATA, headers={
+            "Accept": "text/event-stream", "Last-Event-ID": first[0][0]
+        }).text)
+
+        assert first[-1][1] == "complete"
+        assert len(second) == len(first)
+        assert second[0][0].rsplit("-", 1)[0] != first[0][0].rsplit("-", 1)[0]
+        assert llm.calls == 2
@@ -0,0 +1,145 @@
+import asyncio
+import random
+from datetime import date, timedelta
+import pytest
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from app.daily_stats import record_checkin_change
+from app.database import Base
+from app.models import Plan, User, UserStreak
+from app.streaks import ALL_PLANS, current_streak, rebuild_streaks, record_streak_change, streaks_from_dates
+
+START = date(2024, 1, 1)
+
+
+def naive_streaks(dates, start, end):
+    """原来的逐日遍历：从 start 走到 end，返回（截至最后打卡日期的连续天数, 最长连续天数）"""
+    dates = set(dates)
+    current = longest = run = 0
+    day = start
+    while day <= end:
+        if day in dates:
+            run += 1
+            longest = max(longest, run)
+            current = run
+        else:
+            run = 0
+        day += timedelta(days=1)
+    return current, longest
+
+
+def random_dates(rng):
+    density = rng.random()
+    return [START + timedelta(days=i) for i in range(rng.randint(0, 120)) if rng.random() < density]
+
+
+class TestStreaksFromDates:
+    """按日期分段计算与逐日遍历的结果一致"""
+
+    def test_matches_naive_loop(self):
+        rng = random.Random(20240101)
+        for _ in range(500):
+            dates = random_dates(rng)
+            rng.shuffle(dates)
+            streak = streaks_from_dates(dates + dates[:3])
+            end = max(dates) if dates else START
+            assert (streak.current, streak.longest) == naive_streaks(dates, START, end)
+            assert streak.last_date == (max(dates) if dates else None)
+
+    def test_current_streak_expires(self):
+        today = date(2024, 3, 10)
+        assert current_streak(5, today, today) == 5
+        assert current_streak(5, today - timedelta(days=1), today) == 5
+        assert current_streak(5, today - timedelta(days=2), today) == 0
+        assert current_streak(0, None, today) == 0
+
+
+@pytest.fixture
+def session_factory(tmp_path):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'streaks.db'}")
+
+    async def prepare():
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        factory = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+        async with factory() as db:
+            db.add(User(id=1, username="alice", password_hash="x"))
+            await db.flush()
+            db.add_all([Plan(id=i, user_id=1, title=f"计划{i}", daily_goal_min=60, start_date=START) for i in (1, 2)])
+            await db.commit()
+        return factory
+
+    yield asyncio.run(prepare())
+    asyncio.run(engine.dispose())
+
+
+async def stored(db):
+    rows = (await db.execute(select(
+        UserStreak.plan_id, UserStreak.current_streak, UserStreak.longest_streak, UserStreak.last_checkin_date
+    ))).all()
+    return {row[0]: tuple(row[1:]) for row in rows}
+
+
+def expected(checkins):
+    """由现存打卡 {(plan_id, date)} 得出每个范围应有的连续打卡记录"""
+    result = {}
+    for scope in {ALL_PLANS} | {plan_id for plan_id, _ in checkins}:
+        streak = streaks_from_dates(day for plan_id, day in checkins if scope in (ALL_PLANS, plan_id))
+        result[scope] = (streak.current, streak.longest, streak.last_date)
+    return result
+
+
+class TestIncrementalUpdates:
+    """随机增删（含补打卡、修改）后，增量维护的结果与重新计算一致"""
+
+    def test_random_writes_match_recompute(self, session_factory):
+        rng = random.Random(7)
+
+        async def scenario():
+            checkins = set()
+            async with session_factory() as db:
+                for _ in range(150):
+                    action = rng.random()
+                    if checkins and action < 0.25:
+                        plan_id, day = rng.choice(sorted(checkins))
+                        checkins.remove((plan_id, day))
+                        change = {"before": (1, plan_id, day, 30)}
+                    elif checkins and action < 0.4:
+                        old = rng.choice(sorted(checkins))
+                        new = (rng.choice((1, 2)), START + timedelta(days=rng.randint(0, 40)))
+                        if new in checkins:
+                            continue
+                        checkins.remove(old)
+                        checkins.add(new)
+                        change = {"before": (1, *old, 30), "after": (1, *new, 30)}
+                    else:
+                        key = (rng.choice((1, 2)), START + timedelta(days=rng.randint(0, 40)))
+                        if key in checkins:
+                            continue
+                        checkins.add(key)
+                        change = {"after": (1, *key, 30)}
+                    await record_checkin_change(db, **change)
+                    await record_streak_change(db, **change)
+                    await db.commit()
+
+                    current = {scope: value for scope, value in expected(checkins).items() if value[2] is not None}
+                    assert await stored(db) == current
+
+        asyncio.run(scenario())
+
+    def test_rebuild_matches_incremental(self, session_factory):
+        async def scenario():
+            async with session_factory() as db:
+                for plan_id, offset in [(1, 0), (1, 1), (2, 2), (2, 4), (1, 5)]:
+                    change = {"after": (1, plan_id, START + timedelta(days=offset), 30)}
+                    await record_checkin_change(db, **change)
+                    await record_streak_change(db, **change)
+                await db.commit()
+                incremental = await stored(db)
+                await db.run_sync(lambda session: rebuild_streaks(session))
+                await db.commit()
+                return incremental, await stored(db)
+
+        incremental, rebuilt = asyncio.run(scenario())
+        assert incremental == rebuilt
+        assert rebuilt[ALL_PLANS] == (2, 3, START + timedelta(days=5))